@@ -12,7 +12,9 @@ from pocket_coffea.scripts.make_config import make_config
 from pocket_coffea.scripts.plot.make_plots import make_plots
 from pocket_coffea.scripts.plot.plot_cutflow import plot_cutflow
 from pocket_coffea.scripts.print_parameters import print_parameters
+from pocket_coffea.scripts.profile_report import profile_report
 from pocket_coffea.scripts.runner import run
+from pocket_coffea.scripts.track_branches import track_branches
 
 title = r"""[dodger_blue1]
     ____             __        __  ______      ________
@@ -55,6 +57,8 @@ cli.add_command(merge_columns.main, name="merge-columns")
 cli.add_command(print_parameters)
 cli.add_command(check_jobs)
 cli.add_command(inspect_job)
+cli.add_command(profile_report)
+cli.add_command(track_branches)
 
 
 if __name__ == "__main__":
@@ -350,7 +350,7 @@ class ExecutorFactoryManualABC(ABC):
                   f"current fileset. Samples present: {sorted(samples_present)}. These keys will be ignored.")
 
     @staticmethod
-    def _resolve_chunksize_for_job(chunksize_cfg, job_split):
+    def _resolve_chunksize_for_job(chunksize_cfg, job_split, adaptive_chunksize=None):
         '''Resolve the chunksize for a single condor job.
 
         `chunksize_cfg` is either an int (legacy uniform behaviour) or a dict
@@ -361,9 +361,17 @@ class ExecutorFactoryManualABC(ABC):
         In dict mode the job is required to cover exactly one sample (so the
         choice of chunksize is unambiguous). Pair the dict form of chunksize
         with the dict form of `max-events-per-job`, which already isolates one
-        sample per job.'''
+        sample per job.
+
+        `adaptive_chunksize` is the optional `{sample: int}` dict derived from the measured
+        throughput with `--adaptive-chunksize`. It is used only with a scalar `chunksize_cfg`:
+        the job gets the smallest adaptive chunksize of its samples (the scalar value
+        for the samples without measurements).'''
         # Accept both plain dict and OmegaConf DictConfig (from --custom-run-options YAML).
         if not isinstance(chunksize_cfg, Mapping):
+            if adaptive_chunksize:
+                samples = {ds["metadata"]["sample"] for ds in job_split.values()}
+                return min(int(adaptive_chunksize.get(sample, chunksize_cfg)) for sample in samples)
             return int(chunksize_cfg)
         samples = {ds["metadata"]["sample"] for ds in job_split.values()}
         if len(samples) != 1:
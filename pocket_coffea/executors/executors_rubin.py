@@ -211,7 +211,8 @@ echo 'Done'"""
         # Resolve per-job chunksize: accepts a scalar or per-sample dict.
         chunksize_cfg = self.run_options['chunksize']
         self._validate_chunksize_keys(chunksize_cfg, self.filesets)
-        per_job_chunksize = [self._resolve_chunksize_for_job(chunksize_cfg, split)
+        adaptive_chunksize = self.run_options.get("adaptive-chunksize-by-sample", None)
+        per_job_chunksize = [self._resolve_chunksize_for_job(chunksize_cfg, split, adaptive_chunksize)
                              for split in self._splits]
         if len(set(per_job_chunksize)) > 1:
             print(f"[chunksize] Per-job chunksize varies (min={min(per_job_chunksize)}, "
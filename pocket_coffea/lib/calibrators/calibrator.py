@@ -44,6 +44,11 @@ class Calibrator(ABC, metaclass=CalibratorRegistry):
     _variations: List[str] = [] # default empty variations
     # The calibrated collections format is expected to be "collection.field"
     calibrated_collections: List[str] = []
+    # Collections read by the calibrate method (same format, "collection" or "collection.field").
+    # Used by the CalibratorsManager to skip the calibrator for the variations not affecting
+    # its inputs. None means unknown dependencies; an empty list means that the output depends
+    # only on the state prepared in the initialize method.
+    depends_on_collections: List[str] = None
     
     def __init__(self, params=None, metadata=None, do_variations=True, **kwargs):
         '''
@@ -1,9 +1,20 @@
 from .calibrator import Calibrator
+from ...utils.profiling import profile_stage
 from collections import defaultdict
 from typing import List
 import copy
 
 
+def _collections_overlap(coll_a, coll_b):
+    '''Check if two collection names, in the format "collection" or "collection.field",
+    refer to overlapping data (e.g. "Jet" and "Jet.pt" overlap, "Jet.pt" and "Jet.mass" do not).'''
+    collection_a, _, field_a = coll_a.partition(".")
+    collection_b, _, field_b = coll_b.partition(".")
+    if collection_a != collection_b:
+        return False
+    return not field_a or not field_b or field_a == field_b
+
+
 class CalibratorsManager():
     """
     This class manages the calibration of collections for each event.
@@ -23,6 +34,17 @@ class CalibratorsManager():
     This can be useful if a calibrator needs to use the original collection to calibrate another one after a previous
     calibrator has already modified the collection.
 
+    If `skip_unaffected_calibrators` is True the manager works in dependency-aware mode:
+    the output of each calibrator for the nominal variation is cached (the manager lives for one chunk)
+    and, for a shape variation, only the calibrators owning the variation are re-run, together with
+    the downstream calibrators reading the collections modified by them (declared with the
+    `depends_on_collections` attribute of the calibrator, e.g. the MET calibrator after the jets one).
+    The other calibrators reuse their cached nominal output. Calibrators not declaring their
+    dependencies are re-run if any calibrator before them in the sequence has been re-run.
+
+    If a `profiler` (see utils.profiling) is given, the time spent in the calibration loop and in each
+    calibrator (initialize and calibrate) is recorded in the "calibrators" and "calibrators/<name>" stages.
+
     kwargs can be passed to the constructor to pass objects necessary for
     the calibrators to work, such as jme-factor, loaded once by the processor.  TO BE IMPROVED
     """
@@ -32,6 +54,8 @@ class CalibratorsManager():
                  params,
                  metadata=None,
                  requested_calibrator_variations=None,
+                 skip_unaffected_calibrators=False,
+                 profiler=None,
                  **kwargs
                  ):
         self.calibrator_list = calibrators_list
@@ -42,6 +66,11 @@ class CalibratorsManager():
         self.available_variations_bycalibrator = defaultdict(list)
         self.requested_calibrator_variations = requested_calibrator_variations
         self.original_coll = {}
+        self.skip_unaffected_calibrators = skip_unaffected_calibrators
+        self.profiler = profiler
+        # Output of each calibrator for the nominal variation, used in dependency-aware mode
+        self._nominal_outputs = {}
+        self._calibrators_to_run = {}
 
         # Initialize all the calibrators
         for calibrator in self.calibrator_list:
@@ -55,8 +84,9 @@ class CalibratorsManager():
             else:
                 # If the calibrator is in the list of requested variations, we initialize it with variations
                 C = calibrator(params, metadata, do_variations=True, **kwargs)
-           
-            C.initialize(events)
+
+            with profile_stage(self.profiler, f"calibrators/{calibrator.name}"):
+                C.initialize(events)
             self.calibrator_sequence.append(C)
             # storing the list of calibrator touching a collection in a dictionary
             for calibrated_collection in C.calibrated_collections:
@@ -87,6 +117,43 @@ class CalibratorsManager():
 
         # Clear the original collection ict
         self.original_coll.clear()
+
+    def get_calibrators_to_run(self, variation):
+        '''Return the names of the calibrators whose output for the given variation
+        may differ from the nominal one: the calibrators owning the variation and
+        the calibrators downstream of them reading the collections they modify.
+        All the calibrators are returned for the nominal variation.'''
+        if variation == "nominal":
+            return [calibrator.name for calibrator in self.calibrator_sequence]
+        if variation in self._calibrators_to_run:
+            return self._calibrators_to_run[variation]
+        to_run = []
+        modified_collections = []
+        for calibrator in self.calibrator_sequence:
+            if variation in calibrator.variations:
+                rerun = True
+            elif calibrator.depends_on_collections is None:
+                # Unknown dependencies: be conservative
+                rerun = len(modified_collections) > 0
+            else:
+                rerun = any(_collections_overlap(dep, coll)
+                            for dep in calibrator.depends_on_collections
+                            for coll in modified_collections)
+            if rerun:
+                to_run.append(calibrator.name)
+                modified_collections += calibrator.calibrated_collections
+        self._calibrators_to_run[variation] = to_run
+        return to_run
+
+    def get_modified_collections(self, variation):
+        '''Return the calibrated collections that may differ from the nominal ones
+        for the given variation (the ones of the calibrators returned by `get_calibrators_to_run`).
+        An empty list is returned for the nominal variation.'''
+        if variation == "nominal":
+            return []
+        to_run = self.get_calibrators_to_run(variation)
+        return [coll for calibrator in self.calibrator_sequence if calibrator.name in to_run
+                for coll in calibrator.calibrated_collections]
     
                         
     def calibrate(self, events, variation, debug=False):
@@ -101,17 +168,31 @@ class CalibratorsManager():
             raise ValueError(f"Variation {variation} not available. Available variations: {self.available_variations}")
         
         applied_calibrators = []
+        if self.skip_unaffected_calibrators:
+            calibrators_to_run = self.get_calibrators_to_run(variation)
         # Store the original collections before applying the calibrators
         for calibrator in self.calibrator_sequence:
-            if debug:
-                print(f"Applying calibrator: {calibrator.name} for variation: {variation}")
-            # If the variation is not handled by the calibrator
-            # it will return the nominal collection. 
-            # we don't want to control this in the manager, we 
-            # want to get back the collection to replace, also if it is the 
-            # nominal one.
-            colls = calibrator.calibrate(events, self.original_coll, variation, 
-                                         already_applied_calibrators=applied_calibrators)
+            if (self.skip_unaffected_calibrators and
+                calibrator.name not in calibrators_to_run and
+                calibrator.name in self._nominal_outputs):
+                # The output of the calibrator is not affected by the variation:
+                # reuse the nominal one
+                if debug:
+                    print(f"Reusing nominal output of calibrator: {calibrator.name} for variation: {variation}")
+                colls = self._nominal_outputs[calibrator.name]
+            else:
+                if debug:
+                    print(f"Applying calibrator: {calibrator.name} for variation: {variation}")
+                # If the variation is not handled by the calibrator
+                # it will return the nominal collection. 
+                # we don't want to control this in the manager, we 
+                # want to get back the collection to replace, also if it is the 
+                # nominal one.
+                with profile_stage(self.profiler, f"calibrators/{calibrator.name}"):
+                    colls = calibrator.calibrate(events, self.original_coll, variation,
+                                                 already_applied_calibrators=applied_calibrators)
+                if self.skip_unaffected_calibrators and variation == "nominal":
+                    self._nominal_outputs[calibrator.name] = colls
             if debug:
                 print(f"Calibrator {calibrator.name} returned collections: {colls.keys()}")
             for col in colls:
@@ -168,11 +249,13 @@ class CalibratorsManager():
             # Call the calibrator objects in sequence
             # This will call all the calibrators in the sequence
             # for the given variation
-            events_out = self.calibrate(events, variation, debug=debug)
+            with profile_stage(self.profiler, "calibrators"):
+                events_out = self.calibrate(events, variation, debug=debug)
             # Yield the modified events
             yield variation, events_out
             # Reset the events to the original collections
-            self.reset_events_to_original(events)
+            with profile_stage(self.profiler, "calibrators"):
+                self.reset_events_to_original(events)
             # This is needed to make sure that the next variation is handled properly 
             # in case calibrations are computed on the fly on the modified values
         
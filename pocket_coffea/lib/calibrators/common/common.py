@@ -3,7 +3,7 @@ import numpy as np
 import vector
 import awkward as ak
 import cachetools
-from pocket_coffea.lib.jets import met_correction_after_jec, jet_correction_corrlib, msoftdrop_correction, JET_SORTIDX_FIELD
+from pocket_coffea.lib.jets import met_correction_after_jec, jet_correction_corrlib, msoftdrop_correction, apply_jes_delta, JET_SORTIDX_FIELD
 from pocket_coffea.lib.leptons import (
     get_ele_scaled, 
     get_ele_smeared, 
@@ -24,6 +24,8 @@ class JetsCalibrator(Calibrator):
     The set of calibrations to be applied is defined in the parameters file under the 
     `jets_calibration.collection` section.
     All the jet types that have apply_jec_MC or apply_jec_Data set to True will be calibrated.
+    If `jets_calibration.lazy_jes_variations` is True, only the relative JES shifts of each source
+    are kept in memory and the varied pt and mass are built when the variation is requested.
     If the pT regression is requested for a jet type, it should be done by the JetsPtRegressionCalibrator, 
     this calibrator will raise an exception if configured to apply pT regression.
     """
@@ -31,12 +33,17 @@ class JetsCalibrator(Calibrator):
     name = "jet_calibration"
     has_variations = True
     isMC_only = False
+    # The calibrated values are prepared in initialize
+    depends_on_collections = []
 
     def __init__(self, params, metadata, do_variations, **kwargs):
         super().__init__(params, metadata, do_variations, **kwargs)
         self._year = metadata["year"]
         self.jet_calib_param = self.params.jets_calibration
         self.jets_calibrated = {}
+        # Relative JES shifts by collection, used in lazy mode
+        self.jes_deltas = {}
+        self.lazy_jes_variations = self.jet_calib_param.get("lazy_jes_variations", False)
         self.jets_calibrated_types = []
         # Map each calibrated collection name to the jet-type alias used to look up its
         # per-jet-type configuration (e.g. sort_by_pt). Filled in initialize.
@@ -119,7 +126,10 @@ class JetsCalibrator(Calibrator):
                 nano_version=nano_aod_version,
                 jec_syst=self.do_variations,
                 apply_jer=self.jet_calib_param.apply_jer_MC[self.year][jet_type_alias] if self.isMC else False,
+                lazy_jes_variations=self.lazy_jes_variations,
             )
+            if self.lazy_jes_variations:
+                corrected_jets, self.jes_deltas[jet_coll_name] = corrected_jets
             # update the rawFactor of the corrected jets
             #print(f"Calibrating jet collection {jet_coll_name} with jet type {jet_type} and alias {jet_type_alias}. " + f"Year: {self._year}")
             self.jets_calibrated[jet_coll_name] = ak.with_field(
@@ -361,7 +371,14 @@ class JetsCalibrator(Calibrator):
         if jet_coll_name not in self.jets_calibrated:
             raise ValueError(f"Jet collection {jet_coll_name} not found in the calibrated jets.")
         # Apply the variation to the jets. Re-sorting is handled uniformly by calibrate.
-        if direction == "up":
+        if variation_type in self.jes_deltas.get(jet_coll_name, {}):
+            # Lazy mode: build the varied pt and mass from the stored shift
+            out[jet_coll_name]["pt"], out[jet_coll_name]["mass"] = apply_jes_delta(
+                self.jets_calibrated[jet_coll_name],
+                self.jes_deltas[jet_coll_name][variation_type],
+                direction,
+            )
+        elif direction == "up":
             out[jet_coll_name]["pt"] = self.jets_calibrated[jet_coll_name][f"pt_{variation_type}_up"]
             out[jet_coll_name]["mass"] = self.jets_calibrated[jet_coll_name][f"mass_{variation_type}_up"]
         elif direction == "down":
@@ -393,6 +410,8 @@ class JetsSoftdropMassCalibrator(Calibrator):
     name = "msoftdrop_calibration"
     has_variations = True
     isMC_only = False
+    # The calibrated values are prepared in initialize
+    depends_on_collections = []
 
     def __init__(self, params, metadata, do_variations, **kwargs):
         super().__init__(params, metadata, do_variations, **kwargs)
@@ -555,6 +574,8 @@ class METCalibrator(Calibrator):
         self.corrT1METJet_branch = self.met_calib_cfg.CorrT1METJet_collection
         self.calibrated_collections = [f"{self.met_branch}.pt", f"{self.met_branch}.phi"]
         self.jet_collection = self.met_calib_cfg.Jet_collection
+        self.depends_on_collections = [self.jet_collection, "Electron", "Muon", self.met_branch,
+                                       self.rawMet_branch, self.corrT1METJet_branch]
         self._variations = ["unclust_EnUp", "unclust_EnDown"]
        
     def initialize(self, events):
@@ -713,6 +734,8 @@ class ElectronsScaleCalibrator(Calibrator):
     name = "electron_scale_and_smearing"
     has_variations = True
     isMC_only = False
+    # The calibrated values are prepared in initialize
+    depends_on_collections = []
     calibrated_collections = ["Electron.pt", "Electron.pt_original", "Electron.energyErr"]
 
     def __init__(self, params, metadata, do_variations=True, **kwargs):
@@ -832,6 +855,8 @@ class MuonsCalibrator(Calibrator):
     name = "muons_scale_and_resolution"
     has_variations = True
     isMC_only = False
+    # The calibrated values are prepared in initialize
+    depends_on_collections = []
     calibrated_collections = ["Muon.pt", "Muon.pt_original", "Muon.energyErr"]
 
 
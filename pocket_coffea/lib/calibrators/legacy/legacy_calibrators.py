@@ -20,6 +20,8 @@ class JetsCalibrator(Calibrator):
     name = "jet_calibration_legacy"
     has_variations = True
     isMC_only = False
+    # The calibrated values are prepared in initialize
+    depends_on_collections = []
 
     def __init__(self, params, metadata, do_variations, jme_factory, **kwargs):
         super().__init__(params, metadata, do_variations=True, **kwargs)
@@ -370,6 +372,8 @@ class MuonsRochesterCalibrator(Calibrator):
     name = "muons_rochester"
     has_variations = True
     isMC_only = False
+    # The calibrated values are prepared in initialize
+    depends_on_collections = []
     calibrated_collections = ["Muon.pt", "Muon.pt_original"]
 
     def __init__(self, params, metadata, do_variations=True, **kwargs):
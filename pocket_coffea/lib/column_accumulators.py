@@ -0,0 +1,149 @@
+"""Column accumulators for the `columns` output.
+
+coffea's `column_accumulator` concatenates the numpy arrays at every addition: merging the
+outputs of N chunks one by one copies O(N^2) data and makes the memory of the reduce
+step spike. The `chunked_column_accumulator` keeps instead the list of the arrays of the
+chunks and concatenates them only when the value is accessed or when the output is pickled
+(saved or sent between processes). The blocks held in memory can also be spilled to
+memory-mapped files above a size threshold.
+
+The accumulator to be used is chosen with the `accumulator` option of the `ColOut`
+objects or for all the columns of the `ColumnsManager` (see the documentation).
+"""
+import os
+import tempfile
+
+import numpy as np
+from coffea.processor.accumulator import column_accumulator
+
+
+class chunked_column_accumulator(column_accumulator):
+    """An appendable numpy ndarray stored as a list of blocks.
+
+    It can be merged with the coffea `column_accumulator` (it is a subclass of it) and its
+    `value` is the same numpy array. The blocks are concatenated in a single array on the first
+    access to `value` and when the accumulator is pickled.
+
+    Parameters
+    ----------
+        value : numpy.ndarray
+            The first block.
+        spill_threshold_mb : float, optional
+            If the blocks kept in memory exceed this size they are written to
+            memory-mapped files in `spill_dir` (default: the temporary directory). The files are
+            unlinked right away and their space is released with the last reference to the blocks.
+        spill_dir : str, optional
+    """
+
+    def __init__(self, value, spill_threshold_mb=None, spill_dir=None):
+        if not isinstance(value, np.ndarray):
+            raise ValueError("chunked_column_accumulator only works with numpy arrays")
+        self._empty = np.zeros(dtype=value.dtype, shape=(0,) + value.shape[1:])
+        self._blocks = [value] if len(value) else []
+        self.spill_threshold_mb = spill_threshold_mb
+        self.spill_dir = spill_dir
+
+    def __repr__(self):
+        return "chunked_column_accumulator(%r)" % self.value
+
+    def __len__(self):
+        return sum(len(b) for b in self._blocks)
+
+    @property
+    def nblocks(self):
+        return len(self._blocks)
+
+    def identity(self):
+        return chunked_column_accumulator(self._empty, self.spill_threshold_mb, self.spill_dir)
+
+    def add(self, other):
+        if not isinstance(other, column_accumulator):
+            raise ValueError("chunked_column_accumulator cannot be added to %r" % type(other))
+        if other._empty.shape != self._empty.shape:
+            raise ValueError(
+                "Cannot add two column_accumulator objects of dissimilar shape (%r vs %r)"
+                % (self._empty.shape, other._empty.shape)
+            )
+        if isinstance(other, chunked_column_accumulator):
+            self._blocks.extend(other._blocks)
+        elif len(other.value):
+            self._blocks.append(other.value)
+        if self.spill_threshold_mb is not None:
+            self._spill_if_needed()
+
+    @property
+    def value(self):
+        """The current value of the column: the blocks are concatenated (once)."""
+        if len(self._blocks) == 0:
+            return self._empty
+        if len(self._blocks) > 1:
+            self._blocks = [np.concatenate(self._blocks)]
+        return self._blocks[0]
+
+    # The coffea column_accumulator.add reads `_value` of the other accumulator
+    @property
+    def _value(self):
+        return self.value
+
+    @_value.setter
+    def _value(self, value):
+        self._blocks = [value] if len(value) else []
+
+    def _spill_if_needed(self):
+        in_memory = sum(b.nbytes for b in self._blocks if not isinstance(b, np.memmap))
+        if in_memory <= self.spill_threshold_mb * 1024**2:
+            return
+        # Each run of consecutive in-memory blocks is written to a file, keeping the order of the rows
+        blocks, run = [], []
+        for b in self._blocks + [None]:
+            if b is not None and not isinstance(b, np.memmap):
+                run.append(b)
+                continue
+            if run:
+                blocks.append(self._spill(run))
+                run = []
+            if b is not None:
+                blocks.append(b)
+        self._blocks = blocks
+
+    def _spill(self, arrays):
+        nrows = sum(len(b) for b in arrays)
+        fd, path = tempfile.mkstemp(suffix=".npy", prefix="pocket_coffea_column_", dir=self.spill_dir)
+        os.close(fd)
+        try:
+            spilled = np.lib.format.open_memmap(
+                path, mode="w+", dtype=self._empty.dtype, shape=(nrows,) + self._empty.shape[1:]
+            )
+            start = 0
+            for b in arrays:
+                spilled[start : start + len(b)] = b
+                start += len(b)
+            spilled.flush()
+        finally:
+            # The mapping stays valid after the unlink
+            os.unlink(path)
+        return spilled
+
+    def __getstate__(self):
+        # Pickle a single in-memory array, independent of the spill files
+        state = self.__dict__.copy()
+        value = self.value
+        state["_blocks"] = [np.asarray(value)] if len(value) else []
+        return state
+
+
+COLUMN_ACCUMULATORS = {
+    "column": column_accumulator,
+    "chunked": chunked_column_accumulator,
+}
+
+
+def make_column_accumulator(value, accumulator="column", spill_threshold_mb=None, spill_dir=None):
+    """Create the accumulator of type `accumulator` ("column" or "chunked") for the numpy array `value`."""
+    if accumulator not in COLUMN_ACCUMULATORS:
+        raise ValueError(
+            f"Unknown column accumulator {accumulator}: available {list(COLUMN_ACCUMULATORS.keys())}"
+        )
+    if accumulator == "chunked":
+        return chunked_column_accumulator(value, spill_threshold_mb=spill_threshold_mb, spill_dir=spill_dir)
+    return column_accumulator(value)
@@ -1,7 +1,7 @@
 from dataclasses import dataclass
 from typing import List
-from coffea.processor.accumulator import column_accumulator
 import awkward as ak
+from .column_accumulators import make_column_accumulator
 from .weights.weights_manager import get_weights_by_cat_var
 
 
@@ -15,15 +15,27 @@ class ColOut:
     fill_value: float = -999.0  # by default the None elements are filled
     pos_start: int = None  # First position in the collection to export. If None export from the first element
     pos_end: int = None  # Last position in the collection to export. If None export until the last element
+    accumulator: str = None  # "column" or "chunked". If None the default of the ColumnsManager is used
 
 
 class ColumnsManager:
-    def __init__(self, cfg, categories_config, variations_config):
+    def __init__(self, cfg, categories_config, variations_config, accumulator="column", spill_threshold_mb=None):
+        '''`accumulator` is the default type of the column accumulators ("column" for the
+        coffea `column_accumulator`, "chunked" for the `chunked_column_accumulator`), used for the weights
+        and for the `ColOut` not specifying it. `spill_threshold_mb` is passed to the chunked accumulators.'''
         self.cfg = cfg
         self.categories_config = categories_config
         self.variations_config = variations_config
+        self.accumulator = accumulator
+        self.spill_threshold_mb = spill_threshold_mb
         self.output = {}
 
+    def column_accumulator(self, value, outarray=None):
+        accumulator = self.accumulator
+        if outarray is not None and outarray.accumulator is not None:
+            accumulator = outarray.accumulator
+        return make_column_accumulator(value, accumulator, spill_threshold_mb=self.spill_threshold_mb)
+
     @property
     def ncols(self):
         return sum([len(cols) for cols in self.cfg.values()])
@@ -53,7 +65,7 @@ class ColumnsManager:
 
             # Getting the weight variations into nominal column s
             if weights_manager:
-                self.output[category][variation]["weight"] = column_accumulator(
+                self.output[category][variation]["weight"] = self.column_accumulator(
                     ak.to_numpy(weights_manager.get_weight(category, subsample=subsample)[mask], allow_missing=False))
                 if weights_manager._isMC:
                     available_weights_variations = []
@@ -64,7 +76,7 @@ class ColumnsManager:
                     for weight in get_weights_by_cat_var(available_weights_variations, weights_manager, category, variation).keys():
                         # Ask the WeightsManager the available variations
                         if weight != "nominal":
-                            self.output[category][variation][f"weight_variation_{weight}"] = column_accumulator(
+                            self.output[category][variation][f"weight_variation_{weight}"] = self.column_accumulator(
                                 ak.to_numpy(weights_manager.get_weight(category, subsample=subsample, modifier=weight)[mask], allow_missing=False))
 
             for outarray in outarrays:
@@ -97,7 +109,7 @@ class ColumnsManager:
                     N = ak.num(data)
                     self.output[category][variation][
                         f"{outarray.collection}_N"
-                    ] = column_accumulator(ak.to_numpy(N, allow_missing=False))
+                    ] = self.column_accumulator(ak.to_numpy(N, allow_missing=False), outarray)
                 # looping on the columns
                 for col in outarray.columns:
                     if data.ndim > 1 and not outarray.flatten:
@@ -127,11 +139,12 @@ class ColumnsManager:
 
                     self.output[category][variation][
                         f"{outarray.collection}_{col}"
-                    ] = column_accumulator(
+                    ] = self.column_accumulator(
                         ak.to_numpy(
                             out,
                             allow_missing=False,
-                        )
+                        ),
+                        outarray,
                     )
         return self.output
 
@@ -4,7 +4,7 @@ from .triggers import get_trigger_mask_byprimarydataset,  apply_trigger_mask, re
 import correctionlib
 from pocket_coffea.lib.correction_cache import load_correction_set
 import numpy as np
-from coffea.lumi_tools import LumiMask
+from pocket_coffea.lib.lumi_mask_cache import load_lumi_mask
 
 
 
@@ -189,7 +189,8 @@ eventFlags = Cut(
 
 def apply_golden_json(events, params, year, processor_params, sample, isMC, **kwargs):
     if not isMC:
-        return LumiMask(processor_params.lumi.goldenJSON[year])(
+        # The golden JSON is parsed and indexed once per worker process
+        return load_lumi_mask(processor_params.lumi.goldenJSON[year])(
                 events.run, events.luminosityBlock)
     else:
         return np.ones(len(events), dtype=bool)
@@ -82,8 +82,9 @@ def metric_phi(obj, obj2):
     return abs(delta_phi(obj.phi,obj2.phi))
 
 
-def object_matching(obj, obj2, dr_min, dpt_max=None, return_indices=False):
-    # Compute deltaR(quark, jet) and save the nearest jet (deltaR matching)
+def _matching_table(obj, obj2, dr_min, dpt_max=None):
+    '''Compute the deltaR of all the (obj, obj2) pairs, flattened in the order of
+    ak.argcartesian([obj, obj2]), and the mask of the pairs passing the deltaR (+ pT) cuts.'''
     deltaR = ak.flatten(obj.metric_table(obj2), axis=2)
     # Keeping only the pairs with a deltaR min
     maskDR = deltaR < dr_min
@@ -99,6 +100,12 @@ def object_matching(obj, obj2, dr_min, dpt_max=None, return_indices=False):
         deltaPt = ak.flatten(deltaPt_table, axis=2)
         maskPt = deltaPt < dpt_max
         maskDR = maskDR & maskPt
+    return deltaR, maskDR
+
+
+def object_matching(obj, obj2, dr_min, dpt_max=None, return_indices=False):
+    # Compute deltaR(quark, jet) and save the nearest jet (deltaR matching)
+    deltaR, maskDR = _matching_table(obj, obj2, dr_min, dpt_max)
 
     # Get the indexing to sort the pairs by deltaR
     idx_pairs_sorted = ak.argsort(deltaR, axis=1)
@@ -186,6 +193,115 @@ def object_matching(obj, obj2, dr_min, dpt_max=None, return_indices=False):
         return matched_obj, matched_obj2, deltaR_padnone
 
 
+##################################################################
+# Array-native greedy matching
+
+
+@numba.njit
+def get_matching_indices_flat(deltaR, valid, n_obj, n_obj2, out_idx_obj, out_deltaR):
+    '''
+    Greedy unique matching working directly on the flat content of the pairs arrays.
+
+    - deltaR/valid: flat deltaR and cuts mask of the pairs of all the events, each event
+      containing n_obj x n_obj2 pairs in the order of ak.argcartesian([obj, obj2])
+    - n_obj/n_obj2: number of objects of the two collections in each event
+    - out_idx_obj/out_deltaR: preallocated outputs with one entry for each object of the second
+      collection (flat), filled with the index of the matched object of the first collection
+      and the deltaR of the pair. They must be initialized to -1 and NaN (no match).
+
+    The valid pairs of each event are considered in order of increasing deltaR (stable sort,
+    as ak.argsort) and a pair is accepted if none of its objects has been used yet.
+    The used objects are tracked with per-event bitsets.
+    '''
+    max_pairs = 0
+    max_obj = 1
+    max_obj2 = 1
+    for iev in range(len(n_obj)):
+        max_pairs = max(max_pairs, n_obj[iev] * n_obj2[iev])
+        max_obj = max(max_obj, n_obj[iev])
+        max_obj2 = max(max_obj2, n_obj2[iev])
+    candidates = np.empty(max_pairs, dtype=np.int64)
+    candidates_dr = np.empty(max_pairs, dtype=deltaR.dtype)
+    used_obj = np.zeros((max_obj + 63) // 64, dtype=np.uint64)
+    used_obj2 = np.zeros((max_obj2 + 63) // 64, dtype=np.uint64)
+
+    pair_start = 0
+    obj2_start = 0
+    for iev in range(len(n_obj)):
+        n2 = n_obj2[iev]
+        npairs = n_obj[iev] * n2
+        nvalid = 0
+        for p in range(npairs):
+            if valid[pair_start + p]:
+                candidates[nvalid] = p
+                candidates_dr[nvalid] = deltaR[pair_start + p]
+                nvalid += 1
+        if nvalid > 0:
+            used_obj[:] = 0
+            used_obj2[:] = 0
+            order = np.argsort(candidates_dr[:nvalid], kind="mergesort")
+            for k in order:
+                p = candidates[k]
+                i1 = p // n2
+                i2 = p % n2
+                bit1 = np.uint64(1) << np.uint64(i1 & 63)
+                bit2 = np.uint64(1) << np.uint64(i2 & 63)
+                if (used_obj[i1 >> 6] & bit1) or (used_obj2[i2 >> 6] & bit2):
+                    continue
+                used_obj[i1 >> 6] |= bit1
+                used_obj2[i2 >> 6] |= bit2
+                out_idx_obj[obj2_start + i2] = i1
+                out_deltaR[obj2_start + i2] = deltaR[pair_start + p]
+        pair_start += npairs
+        obj2_start += n2
+
+
+def object_matching_flat(obj, obj2, dr_min, dpt_max=None, return_indices=False):
+    '''
+    Same greedy deltaR (+ pT) matching of `object_matching`, with the same outputs,
+    implemented on the flat numpy content of the pairs arrays with preallocated
+    output buffers (see `get_matching_indices_flat`) instead of ak.ArrayBuilder.
+    '''
+    deltaR, maskDR = _matching_table(obj, obj2, dr_min, dpt_max)
+    n_obj = ak.to_numpy(ak.num(obj, axis=1), allow_missing=False).astype(np.int64)
+    n_obj2 = ak.to_numpy(ak.num(obj2, axis=1), allow_missing=False).astype(np.int64)
+    deltaR_flat = ak.to_numpy(ak.flatten(deltaR, axis=1), allow_missing=False)
+    valid_flat = ak.to_numpy(ak.flatten(maskDR, axis=1), allow_missing=False)
+
+    out_idx_obj = np.full(n_obj2.sum(), -1, dtype=np.int64)
+    out_deltaR = np.full(n_obj2.sum(), np.nan, dtype=np.float64)
+    get_matching_indices_flat(deltaR_flat, valid_flat, n_obj, n_obj2, out_idx_obj, out_deltaR)
+    # Same dtype of the deltaR of object_matching
+    out_deltaR = out_deltaR.astype(deltaR_flat.dtype, copy=False)
+
+    matched = out_idx_obj >= 0
+    event_obj2 = np.repeat(np.arange(len(n_obj2)), n_obj2)
+    local_idx_obj2 = np.arange(len(out_idx_obj), dtype=np.int64) - (np.cumsum(n_obj2) - n_obj2)[event_obj2]
+    idx_obj_padnone = ak.unflatten(ak.mask(out_idx_obj, matched), n_obj2)
+    idx_obj2_padnone = ak.unflatten(ak.mask(local_idx_obj2, matched), n_obj2)
+    deltaR_padnone = ak.unflatten(ak.mask(out_deltaR, matched), n_obj2)
+
+    # Finally the objects are sliced through the padded indices
+    # In this way, to a None entry in the indices will correspond a None entry in the object
+    matched_obj = obj[idx_obj_padnone]
+    matched_obj2 = obj2[idx_obj2_padnone]
+
+    if return_indices:
+        # deltaR of the matched pairs, ordered as the second collection, without padding
+        n_matched = np.bincount(event_obj2[matched], minlength=len(n_obj2))
+        deltaR_masked = ak.unflatten(out_deltaR[matched], n_matched)
+        return (
+            matched_obj,
+            matched_obj2,
+            deltaR_padnone,
+            idx_obj_padnone,
+            idx_obj2_padnone,
+            deltaR_masked,
+        )
+    else:
+        return matched_obj, matched_obj2, deltaR_padnone
+
+
 ##################################################################3
 # Not unique deltaR matching
 
@@ -0,0 +1,235 @@
+'''
+Columnar fill engine for the HistManager.
+
+The legacy `HistManager.fill_histograms` path calls `hist.Hist.fill` once for every
+(histogram, category, subsample, variation) combination, re-masking and re-flattening the
+same axis arrays each time. The engine in this module instead:
+
+- converts the (category, subsample) event masks to numpy **once per chunk**;
+- flattens each histogram's axis arrays **once**, computing the global bin index of every
+  entry with the axis objects themselves (`axis.index`), so that the binning is exactly
+  the one used by boost-histogram;
+- builds, for each (category, subsample), the matrix of weights of all the variations to
+  fill and accumulates everything with `np.bincount` on the flow-inclusive linear bin index.
+
+Each (category, variation) cell of a histogram is filled by a single block of entries,
+kept in event order, and summed from zero as boost-histogram does: the result is
+bit-identical to the legacy path (verifiable with `tests/perf/profile_hist_fill.py --compare`).
+
+Histograms using features not covered by the engine (growth axes, storages different
+from Weight/Double, per-event categorical axes, 2D category masks) are reported as not
+supported and filled by the legacy path.
+'''
+import numpy as np
+import awkward as ak
+import hist
+
+_SUPPORTED_STORAGES = (hist.storage.Weight, hist.storage.Double)
+
+
+def _c_strides(shape):
+    '''Strides (in number of elements) of a C-ordered array of the given shape.'''
+    return np.cumprod((1,) + tuple(shape[:0:-1]), dtype=np.int64)[::-1]
+
+
+def _flow_index(axis, values):
+    '''Return the flow-inclusive bin index of `values` along `axis` and
+    the mask of the entries which are actually filled (out of range values on axes
+    without under/overflow are dropped by boost-histogram).'''
+    idx = np.asarray(axis.index(values), dtype=np.int64)
+    if axis.traits.underflow:
+        idx = idx + 1
+    valid = (idx >= 0) & (idx < axis.extent)
+    return idx, valid
+
+
+class ColumnarFillEngine:
+    '''
+    Helper object built once per `HistManager.fill_histograms` call (i.e. per chunk and
+    shape variation). It caches the numpy version of the (category, subsample) masks
+    and the per-event weights of every (category, subsample, variation) so that they are
+    shared among all the histograms.
+
+    :param combined_masks: dictionary (category, subsample) -> (mask, mask_is_empty)
+    :param weight_getter: callable (category, subsample, variation) -> per-event weight array.
+    '''
+
+    def __init__(self, combined_masks, weight_getter):
+        self.weight_getter = weight_getter
+        self.masks = {}
+        self.has_2D_masks = False
+        for key, (mask, mask_is_empty) in combined_masks.items():
+            if mask.ndim > 1:
+                self.has_2D_masks = True
+                continue
+            self.masks[key] = (
+                ak.to_numpy(mask, allow_missing=False).astype(bool),
+                mask_is_empty,
+            )
+        self._positions = {}
+        self._weights_cache = {}
+
+    def get_event_positions(self, category, subsample):
+        '''Position of each event in the list of events passing the
+        (category, subsample) mask (meaningful only for the passing events).'''
+        key = (category, subsample)
+        if key not in self._positions:
+            self._positions[key] = np.cumsum(self.masks[key][0]) - 1
+        return self._positions[key]
+
+    def get_weights_matrix(self, category, subsample, variations):
+        '''Stack the masked per-event weights of the requested variations for a given
+        (category, subsample) in a (n_variations, n_masked_events) matrix.'''
+        key = (category, subsample, tuple(variations))
+        if key not in self._weights_cache:
+            mask = self.masks[(category, subsample)][0]
+            self._weights_cache[key] = np.stack(
+                [
+                    ak.to_numpy(self.weight_getter(category, subsample, var), allow_missing=False)[mask]
+                    for var in variations
+                ]
+            )
+        return self._weights_cache[key]
+
+    def prepare_entries(self, hist_obj, fill_numeric, fill_categorical, data_ndim, nevents):
+        '''
+        Flatten the numeric axes once and compute the flow-inclusive linear bin index of
+        every entry for all the axes except `cat` and `variation`.
+
+        Returns None if the histogram cannot be handled by the engine, otherwise a tuple
+        (entry_event, entry_bin) with the event index and the linear bin index of each
+        entry to be filled.
+        '''
+        if self.has_2D_masks or data_ndim is None:
+            return None
+        if hist_obj.storage_type not in _SUPPORTED_STORAGES:
+            return None
+        if any(ax.traits.growth for ax in hist_obj.axes):
+            return None
+
+        # Flatten the numeric data, keeping track of the event of each entry
+        flat = {}
+        entry_event = None
+        for field, data in fill_numeric.items():
+            if data_ndim > 1:
+                if entry_event is None:
+                    counts = ak.num(data, axis=1)
+                    if ak.any(ak.is_none(counts)):
+                        return None
+                    entry_event = np.repeat(
+                        np.arange(nevents, dtype=np.int64),
+                        ak.to_numpy(counts, allow_missing=False),
+                    )
+                flat[field] = ak.flatten(data)
+            else:
+                flat[field] = data
+        if entry_event is None:
+            entry_event = np.arange(nevents, dtype=np.int64)
+
+        isnotnone = None
+        for data in flat.values():
+            notnone = ~ak.is_none(data)
+            isnotnone = notnone if isnotnone is None else isnotnone & notnone
+        isnotnone = ak.to_numpy(isnotnone, allow_missing=False)
+        entry_event = entry_event[isnotnone]
+
+        strides = _c_strides(hist_obj.view(flow=True).shape)
+        entry_bin = np.zeros(len(entry_event), dtype=np.int64)
+        entry_valid = np.ones(len(entry_event), dtype=bool)
+        for iax, axis in enumerate(hist_obj.axes):
+            if axis.name in ("cat", "variation"):
+                continue
+            if axis.name in fill_numeric:
+                values = ak.to_numpy(flat[axis.name][isnotnone], allow_missing=False)
+                if isinstance(axis, hist.axis.Integer) and not np.issubdtype(values.dtype, np.integer):
+                    # boost-histogram refuses it: let the legacy path raise the error
+                    return None
+                idx, valid = _flow_index(axis, values)
+                entry_bin += idx * strides[iax]
+                entry_valid &= valid
+            elif axis.name in fill_categorical:
+                value = fill_categorical[axis.name]
+                if not isinstance(value, (str, int, np.integer)):
+                    return None
+                if value in axis:
+                    idx = axis.index(value)
+                elif axis.traits.overflow:
+                    idx = axis.extent - 1
+                else:
+                    # boost-histogram drops the entries
+                    return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+                entry_bin += idx * strides[iax]
+            else:
+                return None
+        return entry_event[entry_valid], entry_bin[entry_valid]
+
+
+class ColumnarFillBuffer:
+    '''
+    Accumulates the content of one histogram object in flat (flow-inclusive) arrays and
+    adds it to the histogram storage at the end.
+
+    The `cat` and `variation` axes are the leading axes of the PocketCoffea histograms,
+    therefore each (category, variation) cell is a contiguous block of the C-ordered
+    storage, covering all the other axes. Each block is filled with a single bincount
+    of the entries' bin index.
+    '''
+
+    def __init__(self, hist_obj, weighted):
+        self.hist_obj = hist_obj
+        self.weighted = weighted
+        self.shape = hist_obj.view(flow=True).shape
+        self.strides = _c_strides(self.shape)
+        self.axes_index = {ax.name: i for i, ax in enumerate(hist_obj.axes)}
+        n_outer = len([ax for ax in hist_obj.axes[:2] if ax.name in ("cat", "variation")])
+        self.block_size = int(np.prod(self.shape[n_outer:], dtype=np.int64))
+        size = int(np.prod(self.shape, dtype=np.int64))
+        self._sumw = np.zeros(size)
+        self._sumw2 = np.zeros(size)
+        self._filled = False
+
+    def cell_offset(self, **categories):
+        '''Linear offset of the cell identified by the `cat` and `variation` values.'''
+        offset = 0
+        for axname, value in categories.items():
+            iax = self.axes_index[axname]
+            offset += self.hist_obj.axes[iax].index(value) * self.strides[iax]
+        return offset
+
+    def add(self, offsets, bins, weights=None):
+        '''
+        Fill the entries with linear bin index `bins` in the cells starting at `offsets`.
+        `weights` is a (len(offsets), len(bins)) matrix, None for unweighted filling.
+        '''
+        if len(bins) == 0:
+            return
+        self._filled = True
+        if not self.weighted:
+            counts = np.bincount(bins, minlength=self.block_size)
+            for offset in offsets:
+                self._sumw[offset:offset + self.block_size] += counts
+                self._sumw2[offset:offset + self.block_size] += counts
+            return
+        # boost-histogram accumulates the weights in double precision
+        weights = np.asarray(weights, dtype=np.float64)
+        for offset, w in zip(offsets, weights):
+            self._sumw[offset:offset + self.block_size] += np.bincount(
+                bins, weights=w, minlength=self.block_size
+            )
+            self._sumw2[offset:offset + self.block_size] += np.bincount(
+                bins, weights=w * w, minlength=self.block_size
+            )
+
+    def flush(self):
+        '''Add the accumulated content to the histogram storage.'''
+        if not self._filled:
+            return
+        view = self.hist_obj.view(flow=True)
+        if self.hist_obj.storage_type is hist.storage.Weight:
+            view["value"] += self._sumw.reshape(self.shape)
+            view["variance"] += self._sumw2.reshape(self.shape)
+        else:
+            view += self._sumw.reshape(self.shape)
+        self._sumw[:] = 0.
+        self._sumw2[:] = 0.
+        self._filled = False
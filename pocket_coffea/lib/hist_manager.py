@@ -1,12 +1,16 @@
 import hist
+import numpy as np
 import awkward as ak
 from collections import defaultdict
 from coffea.analysis_tools import PackedSelection
 from typing import List, Tuple
 from dataclasses import dataclass, field
-from copy import deepcopy
+from copy import deepcopy, copy
+import hashlib
 import logging
+import cachetools
 from .weights.weights_manager import get_weights_by_cat_var, get_weights_by_cat_var_subsample
+from .hist_fill_engine import ColumnarFillEngine, ColumnarFillBuffer
 
 
 @dataclass
@@ -139,6 +143,20 @@ def weights_cache(fun):
             return fun(self, weight, mask, data_structure)
     return inner
 
+# Per-process cache of the histograms built by the HistManager (see HistManager._templates_key)
+_hist_templates_cache = cachetools.LRUCache(maxsize=8)
+
+
+def _clone_hist_conf(hcfg):
+    '''Copy of a template HistConf with an empty histogram, not sharing any mutable attribute.'''
+    out = copy(hcfg)
+    out.axes = list(hcfg.axes)
+    out.only_categories = list(hcfg.only_categories)
+    out.only_variations = list(hcfg.only_variations)
+    out.hist_obj = hcfg.hist_obj.copy()
+    return out
+
+
 class HistManager:
     def __init__(
         self,
@@ -154,8 +172,18 @@ class HistManager:
         processor_params,
         custom_axes=None,
         isMC=True,
+        fill_engine="legacy",
+        cache_templates=True,
     ):
         self.processor_params = processor_params
+        if fill_engine not in ("legacy", "columnar"):
+            raise ValueError(
+                f"Unknown histogram fill engine '{fill_engine}'. Available: 'legacy', 'columnar'"
+            )
+        # "legacy": one hist.fill call for each histogram/category/subsample/variation.
+        # "columnar": one bincount per histogram covering all categories and variations
+        # (see hist_fill_engine.py). Histograms not supported by it use the legacy path.
+        self.fill_engine = fill_engine
         self.isMC = isMC
         self.year = year
         self.sample = sample
@@ -258,17 +286,66 @@ class HistManager:
             self.available_shape_variations_bysubsample = {
                 sub: set(vars) for sub, vars in self.available_shape_variations_bysubsample.items()
             }
+
+        if cache_templates:
+            # The histograms are built once per process for each configuration, sample and
+            # set of categories and variations: each chunk gets zeroed copies of them.
+            key = self._templates_key(hist_config, custom_axes)
+            templates = _hist_templates_cache.get(key)
+            if templates is None:
+                templates = self._build_histograms(hist_config, custom_axes)
+                _hist_templates_cache[key] = templates
+            for subsample, hists in templates.items():
+                for name, hcfg in hists.items():
+                    self.histograms[subsample][name] = _clone_hist_conf(hcfg)
+        else:
+            self.histograms.update(self._build_histograms(hist_config, custom_axes))
+
+    def _templates_key(self, hist_config, custom_axes):
+        '''Key of the histograms templates cache: the histograms depend on the configuration
+        (through the repr of the HistConf attributes), on the sample and categories and on the
+        available variations.'''
+        config_repr = repr(([(name, vars(hcfg)) for name, hcfg in hist_config.items()], custom_axes))
+        config_hash = hashlib.sha1(config_repr.encode()).hexdigest()
+        if self.has_subsamples:
+            by_subsample = tuple(
+                (sub,
+                 frozenset(self.available_weights_variations_bysubsample[sub]),
+                 frozenset(self.available_shape_variations_bysubsample[sub]))
+                for sub in self.subsamples
+            )
+        else:
+            by_subsample = tuple(self.subsamples)
+        # The wildcards of `only_variations` are expanded with the variations of the calibrators
+        calibrators_variations = tuple(
+            (name, tuple(variations))
+            for name, variations in sorted(
+                getattr(self.calibrators_manager, "available_variations_bycalibrator", {}).items())
+        )
+        return (
+            config_hash,
+            self.sample,
+            self.isMC,
+            tuple(sorted(self.available_categories)),
+            frozenset(self.available_weights_variations),
+            frozenset(self.available_shape_variations),
+            by_subsample,
+            calibrators_variations,
+        )
+
+    def _build_histograms(self, hist_config, custom_axes):
+        '''Build the HistConf objects, with the empty histograms, for each subsample.'''
+        histograms = defaultdict(dict)
         # Prepare the variations Axes summing all the required variations
         # The variation config is organized as the weights one, by sample and by category, and by subsample
-        
         for name, hcfg in deepcopy(hist_config).items():
             # Check if the histogram is active for the current sample
             # We only check for the parent sample, not for subsamples
             if hcfg.only_samples != None:
-                if sample not in hcfg.only_samples:
+                if self.sample not in hcfg.only_samples:
                     continue
             elif hcfg.exclude_samples != None:
-                if sample in hcfg.exclude_samples:
+                if self.sample in hcfg.exclude_samples:
                     continue
             # Now we handle the selection of the categories
             cats = []
@@ -345,7 +422,9 @@ class HistManager:
                     *all_axes, storage=hcfg_sub.storage, name="Counts"
                 )
                 # Save the hist in the configuration and store the full config object
-                self.histograms[subsample][name] = hcfg_sub
+                histograms[subsample][name] = hcfg_sub
+        return histograms
+
 
     def get_histograms(self, subsample):
         # Exclude by default metadata histo
@@ -423,6 +502,19 @@ class HistManager:
                 _m = _cat_mask & _subs_mask
                 combined_masks[(_category, _subsample)] = (_m, ak.sum(_m) == 0)
 
+        columnar_engine = None
+        if self.fill_engine == "columnar":
+            def get_fill_weight(category, subsample, variation):
+                # Same weight as the legacy path: variations not defined for the category
+                # or the subsample fall back to the nominal weight.
+                w = weights[category].get(variation, weights[category]["nominal"])
+                if self.has_subsamples:
+                    w = w * weights_sub[subsample][category].get(
+                        variation, weights_sub[subsample][category]["nominal"]
+                    )
+                return w
+            columnar_engine = ColumnarFillEngine(combined_masks, get_fill_weight)
+
         # Looping on the histograms to read the values only once
         # Then categories, subsamples and weights are applied and masked correctly
         # ASSUNTION, the histograms are the same for each subsample
@@ -536,6 +628,21 @@ class HistManager:
                     else:
                         raise NotImplementedError()
 
+            if columnar_engine is not None and self._fill_histogram_columnar(
+                columnar_engine,
+                name,
+                histo,
+                shape_variation,
+                fill_numeric,
+                fill_categorical,
+                data_ndim,
+                cat_masks_list,
+                subs_masks_list,
+                custom_weight,
+                len(events),
+            ):
+                continue
+
             # Now the variables have been read for all the events
             # We need now to iterate on categories and subsamples
             # Mask the events, the weights and then flatten and remove the None correctly
@@ -850,6 +957,99 @@ class HistManager:
                         )
 
 
+    def _fill_histogram_columnar(
+        self,
+        engine,
+        name,
+        histo,
+        shape_variation,
+        fill_numeric,
+        fill_categorical,
+        data_ndim,
+        cat_masks_list,
+        subs_masks_list,
+        custom_weight,
+        nevents,
+    ):
+        '''
+        Fill all the categories, subsamples and variations of the histogram `name`
+        with the columnar engine. The variations and weights filled for each
+        (category, subsample) are the same of the legacy loop in `fill_histograms`.
+
+        Returns False if the histogram is not supported by the engine: nothing has been
+        filled and the legacy path must be used.
+        '''
+        entries = engine.prepare_entries(
+            histo.hist_obj, fill_numeric, fill_categorical, data_ndim, nevents
+        )
+        if entries is None:
+            return False
+        entry_event, entry_bin = entries
+
+        custom_w = None
+        if not histo.no_weights and custom_weight != None and name in custom_weight:
+            custom_w = ak.to_numpy(custom_weight[name], allow_missing=False)
+
+        buffers = {
+            subsample: ColumnarFillBuffer(
+                self.histograms[subsample][name].hist_obj, weighted=not histo.no_weights
+            )
+            for subsample in self.subsamples
+        }
+        for category, _ in cat_masks_list:
+            if category not in histo.only_categories:
+                continue
+            for subsample, _ in subs_masks_list:
+                mask, mask_is_empty = engine.masks[(category, subsample)]
+                if mask_is_empty:
+                    continue
+                buffer = buffers[subsample]
+
+                weights_variations = ["nominal"]
+                if self.isMC:
+                    if histo.no_weights:
+                        fill_variations = ["nominal"]
+                    elif shape_variation == "nominal":
+                        # Only weights variations on the nominal shape pass
+                        fill_variations = [
+                            v for v in buffer.hist_obj.axes["variation"]
+                            if not (
+                                v in self.available_shape_variations
+                                or (self.has_subsamples and v in self.available_shape_variations_bysubsample[subsample])
+                            )
+                        ]
+                        weights_variations = fill_variations
+                        if len(fill_variations) == 0:
+                            continue
+                    else:
+                        in_full_sample = shape_variation in self.available_shape_variations_bycat[category]
+                        in_subsample = (self.has_subsamples and
+                                        shape_variation in self.available_shape_variations_bysubsample_bycat[subsample][category])
+                        if not in_full_sample and not in_subsample:
+                            continue
+                        fill_variations = [shape_variation]
+                    offsets = np.array(
+                        [buffer.cell_offset(cat=category, variation=v) for v in fill_variations],
+                        dtype=np.int64,
+                    )
+                else:
+                    offsets = np.array([buffer.cell_offset(cat=category)], dtype=np.int64)
+
+                sel = mask[entry_event]
+                events_sel = entry_event[sel]
+                if histo.no_weights:
+                    buffer.add(offsets, entry_bin[sel])
+                else:
+                    positions = engine.get_event_positions(category, subsample)[events_sel]
+                    w = engine.get_weights_matrix(category, subsample, weights_variations)[:, positions]
+                    if custom_w is not None:
+                        w = w * custom_w[events_sel]
+                    buffer.add(offsets, entry_bin[sel], w)
+
+        for buffer in buffers.values():
+            buffer.flush()
+        return True
+
         ###################
         # Utilities to handle the Weights cache
 
@@ -504,7 +504,19 @@ def jet_correction_corrlib(
     nano_version,
     apply_jer=True,
     jec_syst=True,
-):    
+    lazy_jes_variations=False,
+):
+    '''Apply the JEC (and JER for MC) to the `jet_coll_name` collection with correctionlib.
+
+    The nominal pt and mass are replaced by the corrected ones. For each JES variation
+    the varied pt and mass are stored as `pt_JES_<source>_up/down` and `mass_JES_<source>_up/down`
+    fields of the returned jets, and similarly for the JER variation.
+
+    If `lazy_jes_variations` is True the JES varied fields are not created: the function
+    returns the tuple (jets, jes_deltas) where jes_deltas is a dictionary
+    {"JES_<source>": flat array of the relative shifts}, so that the varied pt and mass
+    can be built on demand as `pt * (1 +/- delta)` (see `apply_jes_delta`).
+    '''
     isMC = chunk_metadata["isMC"]
     year = chunk_metadata["year"]
     era = chunk_metadata["era"]
@@ -646,6 +658,7 @@ def jet_correction_corrlib(
             jets["mass"] = jets["mass_jer"]
 
     # jes systematics
+    jes_deltas = {}
     if jes_syst:
         # update evaluate dictionary
         eval_dict.update({"JetPt": jets.pt})
@@ -663,6 +676,10 @@ def jet_correction_corrlib(
             # systematics
             inputs = [eval_dict[input.name] for input in sf.inputs]
             sf_delta = sf.evaluate(*inputs)
+            if lazy_jes_variations:
+                # Only the shift is stored: the varied pt and mass are built on demand
+                jes_deltas[f"JES_{jes_vari}"] = sf_delta
+                continue
 
             # divide by correction since it is already applied before
             corr_up_variation = 1 + sf_delta
@@ -673,9 +690,25 @@ def jet_correction_corrlib(
             jets[f"mass_JES_{jes_vari}_up"] = jets.mass * corr_up_variation
             jets[f"mass_JES_{jes_vari}_down"] = jets.mass * corr_down_variation
     jets_jagged = ak.unflatten(jets, counts)
+    if lazy_jes_variations:
+        return jets_jagged, jes_deltas
     return jets_jagged
 
 
+def apply_jes_delta(jets, sf_delta, direction):
+    '''Return the (pt, mass) of the jets shifted by the flat JES relative uncertainty `sf_delta`
+    (as stored by `jet_correction_corrlib` with lazy_jes_variations=True) in the given direction ("up"/"down").
+    The jets must be in the same order as when the shift has been evaluated.'''
+    if direction == "up":
+        corr_variation = 1 + sf_delta
+    elif direction == "down":
+        corr_variation = 1 - sf_delta
+    else:
+        raise ValueError(f"Direction {direction} not recognized. It should be 'up' or 'down'.")
+    corr_variation = ak.unflatten(corr_variation, ak.num(jets))
+    return jets.pt * corr_variation, jets.mass * corr_variation
+
+
 
 
 def msoftdrop_correction(
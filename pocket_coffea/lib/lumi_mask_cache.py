@@ -0,0 +1,195 @@
+"""Process-local cache of pre-indexed golden-JSON lumi masks.
+
+``apply_golden_json`` used to build a new ``coffea.lumi_tools.LumiMask`` for every data
+chunk: the certification JSON was re-read and re-parsed each time, and each call also
+refilled a numba typed dictionary with all the runs before evaluating the mask.
+
+Here the JSON is parsed once per worker process and per path (as for
+``correction_cache.load_correction_set``) into two sorted arrays with the first and last
+valid (run, lumi) pair of each lumi-section range, encoded in a single 64-bit key
+``run << 32 | lumi``. The lookup is then a single vectorized ``np.searchsorted`` over the
+range starts. The result is identical to ``LumiMask``: an event is valid if
+``first <= lumi <= last`` for one of the ranges of its run.
+
+The module also provides the helpers to precompute, per fileset, the data files whose
+run range is entirely outside the golden JSON, so that the runner can drop them from the
+fileset before processing (see ``pocket-coffea run --skip-files-outside-golden-json``).
+The list is persisted by ``update_golden_json_skiplist`` together with the golden JSON
+(path and hash) and the files it was computed for.
+"""
+import os
+import functools
+import hashlib
+import json
+
+import numpy as np
+import awkward as ak
+
+from pocket_coffea.utils.metadata import to_bool
+
+
+def _lumi_key(runs, lumis):
+    return (np.asarray(runs, dtype=np.uint64) << np.uint64(32)) | np.asarray(lumis, dtype=np.uint64)
+
+
+class IndexedLumiMask:
+    """Vectorized lookup table of the valid lumi sections of a golden JSON.
+
+    The object is callable with the same signature of ``coffea.lumi_tools.LumiMask``.
+    """
+
+    def __init__(self, jsonfile):
+        with open(jsonfile) as fin:
+            goldenjson = json.load(fin)
+        runs, firsts, lasts = [], [], []
+        for run, lumilist in goldenjson.items():
+            ranges = np.array(lumilist, dtype=np.uint64).reshape(-1, 2)
+            runs.append(np.full(len(ranges), int(run), dtype=np.uint64))
+            firsts.append(ranges[:, 0])
+            lasts.append(ranges[:, 1])
+        if runs:
+            runs = np.concatenate(runs)
+            starts = _lumi_key(runs, np.concatenate(firsts))
+            ends = _lumi_key(runs, np.concatenate(lasts))
+        else:
+            runs = starts = ends = np.zeros(0, dtype=np.uint64)
+        order = np.argsort(starts, kind="stable")
+        self._starts = starts[order]
+        self._ends = ends[order]
+        self.runs = np.unique(runs)
+
+    def __call__(self, runs, lumis):
+        """Return a boolean numpy array, True for the valid (run, lumi) pairs."""
+        if isinstance(runs, ak.Array):
+            runs = ak.to_numpy(runs)
+        if isinstance(lumis, ak.Array):
+            lumis = ak.to_numpy(lumis)
+        keys = _lumi_key(runs, lumis)
+        # Index of the last range starting before (or at) each key
+        idx = np.searchsorted(self._starts, keys, side="right") - 1
+        valid = idx >= 0
+        valid[valid] = keys[valid] <= self._ends[idx[valid]]
+        return valid
+
+    def overlaps_run_range(self, run_min, run_max):
+        """True if at least one run of the golden JSON is in [run_min, run_max]."""
+        i = np.searchsorted(self.runs, np.uint64(run_min), side="left")
+        return bool(i < len(self.runs) and self.runs[i] <= run_max)
+
+
+@functools.lru_cache(maxsize=None)
+def load_lumi_mask(path):
+    """Return the IndexedLumiMask for the golden JSON at ``path``, parsed once per process."""
+    return IndexedLumiMask(path)
+
+
+def get_file_run_range(path, treename="Runs"):
+    """Return the (min, max) run number of a NanoAOD file, reading only its small
+    ``Runs`` tree. Returns None if the range cannot be determined."""
+    import uproot
+
+    with uproot.open(path) as f:
+        if treename not in f:
+            return None
+        runs = f[treename]["run"].array(library="np")
+    if len(runs) == 0:
+        return None
+    return int(runs.min()), int(runs.max())
+
+
+def files_outside_golden_json(filesets, goldenJSON, run_range_getter=get_file_run_range):
+    """Precompute, for each data dataset of the filesets, the list of files whose run
+    range is entirely outside the golden JSON of the dataset year.
+
+    :param filesets: dictionary dataset -> {"files": [...], "metadata": {...}}
+    :param goldenJSON: dictionary year -> golden JSON path (e.g. ``params.lumi.goldenJSON``)
+    :param run_range_getter: callable file -> (run_min, run_max) or None.
+    :return: dictionary dataset -> list of files to skip (only datasets with files to skip).
+    """
+    out = {}
+    for dataset, fileset in filesets.items():
+        metadata = fileset["metadata"]
+        if to_bool(metadata["isMC"]) or metadata["year"] not in goldenJSON:
+            continue
+        mask = load_lumi_mask(goldenJSON[metadata["year"]])
+        to_skip = []
+        for file in fileset["files"]:
+            run_range = run_range_getter(file)
+            if run_range is None:
+                # Unknown: keep the file
+                continue
+            if not mask.overlaps_run_range(*run_range):
+                to_skip.append(file)
+        if to_skip:
+            out[dataset] = to_skip
+    return out
+
+
+def remove_files_outside_golden_json(filesets, files_to_skip):
+    """Return a copy of the filesets without the files listed in ``files_to_skip``
+    (as returned by ``files_outside_golden_json``). Datasets left without files are dropped."""
+    out = {}
+    for dataset, fileset in filesets.items():
+        skip = set(files_to_skip.get(dataset, []))
+        if not skip:
+            out[dataset] = fileset
+            continue
+        files = [f for f in fileset["files"] if f not in skip]
+        if files:
+            out[dataset] = {**fileset, "files": files}
+    return out
+
+
+def golden_json_hash(path):
+    """sha256 of the content of a golden JSON file."""
+    with open(path, "rb") as fin:
+        return hashlib.sha256(fin.read()).hexdigest()
+
+
+def update_golden_json_skiplist(skiplist_file, filesets, goldenJSON, run_range_getter=get_file_run_range):
+    """Return the files of the data datasets of the filesets outside the golden JSON, as
+    ``files_outside_golden_json``, reusing and updating the list stored in ``skiplist_file``.
+
+    For each data dataset the file stores the golden JSON (path and sha256 of its content)
+    and the files checked against it. The stored result of a dataset is reused only if its
+    golden JSON is unchanged: otherwise the dataset is checked again. Only the files not
+    checked yet are read (e.g. a dataset added to the run or new files of a dataset), and
+    the result is merged in the file, which keeps the datasets of the other runs.
+    """
+    stored = {}
+    if os.path.exists(skiplist_file):
+        with open(skiplist_file) as fin:
+            stored = json.load(fin).get("datasets", {})
+    hashes = {}
+    to_check = {}
+    for dataset, fileset in filesets.items():
+        metadata = fileset["metadata"]
+        if to_bool(metadata["isMC"]) or metadata["year"] not in goldenJSON:
+            continue
+        path = goldenJSON[metadata["year"]]
+        if path not in hashes:
+            hashes[path] = golden_json_hash(path)
+        entry = stored.get(dataset)
+        if entry is None or entry["goldenJSON"] != path or entry["sha256"] != hashes[path]:
+            entry = stored[dataset] = {"goldenJSON": path, "sha256": hashes[path], "checked": [], "skip": []}
+        checked = set(entry["checked"])
+        new_files = [f for f in fileset["files"] if f not in checked]
+        if new_files:
+            to_check[dataset] = {**fileset, "files": new_files}
+    if to_check:
+        new_skip = files_outside_golden_json(to_check, goldenJSON, run_range_getter=run_range_getter)
+        for dataset, fileset in to_check.items():
+            stored[dataset]["checked"] += fileset["files"]
+            stored[dataset]["skip"] += new_skip.get(dataset, [])
+        tmp_file = skiplist_file + ".tmp"
+        with open(tmp_file, "w") as fout:
+            json.dump({"datasets": stored}, fout, indent=2)
+        os.replace(tmp_file, skiplist_file)
+    out = {}
+    for dataset, fileset in filesets.items():
+        if dataset in stored:
+            files = set(fileset["files"])
+            to_skip = [f for f in stored[dataset]["skip"] if f in files]
+            if to_skip:
+                out[dataset] = to_skip
+    return out
@@ -1,8 +1,30 @@
 from numba import njit
 import numpy as np 
+import awkward as ak
 
 
 
+def get_genparts_offsets_index(firstgenpart_idxG, genparts):
+    '''
+    Build once per chunk the index needed to convert the global GenPart indices (no masks)
+    to indices in the flat (masked) genparts array. The same index is meant to be passed
+    to all the `analyze_W_flat` / `analyze_parton_decays_flat_nomesons` calls of the chunk.
+
+    - firstgenpart_idxG: global index of the first genpart of each event
+    - genparts: the (masked) jagged GenPart collection
+
+    Returns:
+    - firstgenpart_idxG_numpy: numpy int64 array of the global index of the first genpart of each event
+    - genparts_offsets: numpy int64 array of the offsets of the genparts array in the masked array
+    - nevents: number of events
+    '''
+    firstgenpart_idxG_numpy = ak.to_numpy(firstgenpart_idxG, allow_missing=False).astype(np.int64)
+    counts = ak.to_numpy(ak.num(genparts, axis=1), allow_missing=False)
+    genparts_offsets = np.zeros(len(counts), dtype=np.int64)
+    np.cumsum(counts[:-1], out=genparts_offsets[1:])
+    return firstgenpart_idxG_numpy, genparts_offsets, len(firstgenpart_idxG_numpy)
+
+
 @njit
 def reverse_index_array(idxGs, firstgenpart_idxG_numpy,
                         genparts_offsets, nevents):
@@ -14,6 +36,29 @@ def reverse_index_array(idxGs, firstgenpart_idxG_numpy,
     - firstgenpart_idxG_numpy: array of the global index of the first genpart of the array
     - genparts_offsets: array of the offsets of the genparts array in the masked array
     - nevents: number of events
+    (the index can be built once per chunk with `get_genparts_offsets_index`)
+
+    The event of each index is found with a binary search on the (sorted) global index
+    of the first genpart of the events: O(N_idx x log(N_events)).
+    '''
+    out = np.zeros(len(idxGs), dtype="int64")
+    # The event j is the first one with firstgenpart_idxG_numpy[j+1] > idxG,
+    # or the last event if not found
+    events_start = firstgenpart_idxG_numpy[1:nevents]
+    for i, idxG in enumerate(idxGs):
+        j = min(np.searchsorted(events_start, idxG, side="right"), nevents - 1)
+        out[i] = genparts_offsets[j] + (idxG - firstgenpart_idxG_numpy[j])
+
+    return out
+
+
+@njit
+def reverse_index_array_linear(idxGs, firstgenpart_idxG_numpy,
+                               genparts_offsets, nevents):
+    '''
+    Reference implementation of `reverse_index_array` with a linear scan
+    over the events for each index: O(N_idx x N_events).
+    Kept for validation and benchmarking (tests/perf/bench_reverse_index.py).
     '''
     out = np.zeros(len(idxGs), dtype="int64")
     for i, idxG in enumerate(idxGs):
@@ -44,6 +89,7 @@ def analyze_W_flat(W_idx, children_idx, genparts_statusFlags, genparts_pdgId,
     - firstgenpart_idxG_numpy: array of the global index of the first genpart of the array
     - genparts_offsets: array of the offsets of the genparts array in the masked array
     - nevents: number of events
+    (the index can be built once per chunk with `get_genparts_offsets_index`)
 
     Returns:
     - is_leptonic: array of booleans, True if the W decayed leptonically
@@ -106,6 +152,7 @@ def analyze_parton_decays_flat_nomesons(parts_idx, children_idx,
     - firstgenpart_idxG_numpy: array of the global index of the first genpart of the array
     - genparts_offsets: array of the offsets of the genparts array in the masked array
     - nevents: number of events
+    (the index can be built once per chunk with `get_genparts_offsets_index`)
     
     Expects parts_idx in global index (with maskes).
 
@@ -4,13 +4,21 @@ import awkward as ak
 import numpy as np
 import math
 import uproot
+import vector
 from vector import MomentumObject4D
-import lhapdf
 
-from coffea import hist
 from coffea.nanoevents.methods import nanoaod
 
-from parameters.nureco import nureco
+try:
+    import lhapdf
+except ImportError:
+    lhapdf = None
+
+try:
+    from parameters.nureco import nureco
+except ImportError:
+    # The neutrino reconstruction parameters are provided by the analysis
+    nureco = None
 
 # ak.behavior.update(nanoaod.behavior)
 
@@ -167,7 +175,7 @@ def pnuCalculator_v7(leptons, leptons_bar, bjets, METs, fatjets, scan=True):
     }
 
     nEvents = len(pairs)
-    mask_events_withsol = np.zeros(nEvents, dtype=np.bool)
+    mask_events_withsol = np.zeros(nEvents, dtype=bool)
 
     for ievt in range(nEvents):
 
@@ -450,14 +458,14 @@ def pnuCalculator_v7(leptons, leptons_bar, bjets, METs, fatjets, scan=True):
                                 b_bar_4vec = MomentumObject4D.from_xyzt(
                                     b_bar.x, b_bar.y, b_bar.z, b_bar.mass
                                 )
-                                fatjet = MomentumObject4D.from_xyzt(
+                                fatjet_4vec = MomentumObject4D.from_xyzt(
                                     fatjet.x, fatjet.y, fatjet.z, fatjet.mass
                                 )
                                 # w_plus       = (neutrino + lepton_plus)
                                 top = neutrino + lepton_plus + b_4vec
                                 # w_minus          = (antineutrino + lepton_minus)
                                 antitop = antineutrino + lepton_minus + b_bar_4vec
-                                ttH = top + antitop + fatjet
+                                ttH = top + antitop + fatjet_4vec
                                 # m_w_plus     = w_plus.mass
                                 # m_top        = top.mass
                                 # m_w_minus    = w_minus.mass
@@ -602,3 +610,357 @@ def pnuCalculator_v7(leptons, leptons_bar, bjets, METs, fatjets, scan=True):
     pbbarjets = ak.zip(pbbarjets, with_name="PtEtaPhiMCandidate")
 
     return pnu, pnubar, pbjets, pbbarjets, mask_events_withsol
+
+
+# PDG ids of the parton pairs entering the PDF weight (lhapdf.UP/AUP, DOWN/ADOWN, GLUON)
+PDF_PARTON_PAIRS = [(2, -2), (1, -1), (21, 21)]
+
+
+def PDFweight_array(x1, x2, Q, pdf):
+    '''Array version of `PDFweight`. The `xfxQ` method of the PDF is called element by element
+    if it does not accept arrays, as for the lhapdf python bindings.'''
+    xfxQ = np.vectorize(pdf.xfxQ, otypes=[np.float64])
+    weight = np.zeros(len(x1))
+    for p1, p2 in PDF_PARTON_PAIRS:
+        weight += xfxQ(p1, x1, Q) * xfxQ(p2, x2, Q)
+        if p1 != p2:
+            # permutation between quarks and anti-quarks
+            weight += xfxQ(p1, x2, Q) * xfxQ(p2, x1, Q)
+    return weight
+
+
+def _nureco_coeffs(lept, coefficients, M_W):
+    '''Coefficients of the conic of the neutrino transverse momentum, as in `pnuCalculator_v7`.
+    `lept` is a dictionary of numpy arrays.'''
+    k1, k2, k3, k4 = coefficients
+    F = M_W**2 - lept["mass"] ** 2
+    pt2 = lept["energy"] ** 2 - lept["z"] ** 2
+    K1 = k1 / k4
+    K2 = k2 / k4
+    K3 = k3 / k4
+    K12 = k1 * k2 / k4**2
+    K13 = k1 * k3 / k4**2
+    K23 = k2 * k3 / k4**2
+
+    k22 = F**2 - 4 * pt2 * K1**2 - 4 * F * lept["z"] * K1
+    k21 = 4 * F * (lept["x"] - lept["z"] * K2) - 8 * pt2 * K12 - 8 * lept["x"] * lept["z"] * K1
+    k20 = -4 * (lept["energy"] ** 2 - lept["x"] ** 2) - 4 * pt2 * K2**2 - 8 * lept["x"] * lept["z"] * K2
+    k11 = 4 * F * (lept["y"] - lept["z"] * K3) - 8 * pt2 * K13 - 8 * lept["y"] * lept["z"] * K1
+    k10 = (
+        -8 * pt2 * K23
+        + 8 * lept["x"] * lept["y"]
+        - 8 * lept["x"] * lept["z"] * K3
+        - 8 * lept["y"] * lept["z"] * K2
+    )
+    k00 = -4 * (lept["energy"] ** 2 - lept["y"] ** 2) - 4 * pt2 * K3**2 - 8 * lept["y"] * lept["z"] * K3
+    return (k22, k21, k20, k11, k10, k00)
+
+
+def quartic_roots(coeffs):
+    '''Roots of a batch of quartic polynomials, `coeffs` of shape (n, 5) with the
+    highest degree first. The roots of each polynomial are the ones of `np.roots`, in the same
+    order: the eigenvalues of the companion matrices are computed in a single batched call.
+    Missing roots (degenerate polynomials) are filled with complex NaN and polynomials with
+    non-finite coefficients have no roots.'''
+    coeffs = np.asarray(coeffs, dtype=np.float64)
+    roots = np.full((len(coeffs), 4), complex(np.nan, np.nan))
+    finite = np.all(np.isfinite(coeffs), axis=1)
+    regular = finite & (coeffs[:, 0] != 0) & (coeffs[:, 4] != 0)
+    companion = np.zeros((np.count_nonzero(regular), 4, 4))
+    companion[:, [1, 2, 3], [0, 1, 2]] = 1.0
+    companion[:, 0, :] = -coeffs[regular, 1:] / coeffs[regular, :1]
+    roots[regular] = np.linalg.eigvals(companion)
+    # Leading or trailing zero coefficients: rare, delegated to np.roots
+    for i in np.nonzero(finite & ~regular)[0]:
+        r = np.roots(coeffs[i])
+        roots[i, : len(r)] = r
+    return roots
+
+
+def _p4_components(objects, fill=np.nan):
+    return {
+        key: ak.to_numpy(ak.fill_none(getattr(objects, key), fill)).astype(np.float64)
+        for key in ["x", "y", "z", "energy", "mass"]
+    }
+
+
+def _ptetaphim(x, y, z, energy):
+    p4 = vector.array({"px": x, "py": y, "pz": z, "E": energy})
+    return p4.pt, p4.eta, p4.phi, p4.mass
+
+
+def pnuCalculator_vectorized(
+    leptons,
+    leptons_bar,
+    bjets,
+    METs,
+    fatjets,
+    scan=True,
+    params=None,
+    pdf=None,
+    return_ranking=False,
+):
+    '''Array-at-a-time version of `pnuCalculator_v7`, with the same inputs and outputs.
+
+    The analytic system is solved at once for all the events, (b, b_bar) pairings and
+    assignments: the quartic in the neutrino px is solved with a batched companion-matrix
+    eigenvalue computation. Only the loop over the (m_t, m_W) hypotheses is kept in python.
+    The solution with the highest PDF weight is chosen in each event; the ties are resolved
+    as in `pnuCalculator_v7` (first solution in the order m_t, m_W, assignment, pair, root).
+
+    `params` defaults to the `nureco` parameters and `pdf` to `lhapdf.mkPDF(params['PDF'])`:
+    any object with a `xfxQ(pid, x, Q)` method can be used.
+    If `return_ranking` is True the PDF weights of all the real solutions of each event, sorted
+    in decreasing order, are also returned as a jagged array of records with the m_t, m_W hypothesis,
+    the index of the b-jet pair and the assignment (`reverse`) of each solution.
+    '''
+    if params is None:
+        params = nureco
+    if params is None:
+        raise ValueError("The neutrino reconstruction parameters are not available: pass `params`")
+    if pdf is None:
+        if lhapdf is None:
+            raise ImportError("lhapdf is required to compute the PDF weights: install it or pass `pdf`")
+        pdf = lhapdf.mkPDF(params['PDF'])
+
+    if scan == True:
+        M_t_grid = np.linspace(*params['m_t']['scan'])
+        M_W_grid = np.linspace(*params['m_W']['scan'])
+    else:
+        M_t_grid = [params['m_t']['nominal']]
+        M_W_grid = [params['m_W']['nominal']]
+    M_b = params['m_b']['nominal']
+    sentinel = -9999.9
+
+    nEvents = len(bjets)
+    pairs = ak.combinations(bjets, 2)
+    npairs = ak.to_numpy(ak.num(pairs))
+    max_pairs = max(int(npairs.max()) if nEvents else 0, 1)
+    pair_evt = np.repeat(np.arange(nEvents), npairs)
+    pair_idx = np.arange(len(pair_evt)) - np.repeat(np.cumsum(npairs) - npairs, npairs)
+    b0 = _p4_components(ak.flatten(pairs['0']))
+    b1 = _p4_components(ak.flatten(pairs['1']))
+
+    lep = _p4_components(leptons)
+    lep_bar = _p4_components(leptons_bar)
+    met_x = ak.to_numpy(METs.x).astype(np.float64)
+    met_y = ak.to_numpy(METs.y).astype(np.float64)
+    fatjet = _p4_components(fatjets)
+    has_fatjet = ~ak.to_numpy(ak.is_none(fatjets))
+    # Events skipped by the reconstruction (negative lepton pt is used to flag missing leptons)
+    attempted = ~(ak.to_numpy(leptons.pt) < 0) & (npairs > 0)
+
+    # Candidates of a (m_t, m_W) hypothesis: all the pairs, first with the direct
+    # assignment (b, b_bar) = (pair[0], pair[1]) and then with the reversed one.
+    cand_evt = np.tile(pair_evt, 2)
+    cand_pair = np.tile(pair_idx, 2)
+    cand_reverse = np.repeat([0, 1], len(pair_evt))
+    b = {k: np.concatenate([b0[k], b1[k]]) for k in b0}
+    b_bar = {k: np.concatenate([b1[k], b0[k]]) for k in b0}
+    l = {k: v[cand_evt] for k, v in lep.items()}
+    l_bar = {k: v[cand_evt] for k, v in lep_bar.items()}
+    MET_x = met_x[cand_evt]
+    MET_y = met_y[cand_evt]
+    cand_valid = attempted[cand_evt] & has_fatjet[cand_evt]
+
+    solutions = []
+    for iscan, (M_t, M_W) in enumerate((M_t, M_W) for M_t in M_t_grid for M_W in M_W_grid):
+        a1 = (
+            (b["energy"] + l_bar["energy"]) * (M_W**2 - l_bar["mass"] ** 2)
+            - l_bar["energy"] * (M_t**2 - M_b**2 - l_bar["mass"] ** 2)
+            + 2 * b["energy"] * l_bar["energy"] ** 2
+            - 2 * l_bar["energy"] * (b["x"] * l_bar["x"] + b["y"] * l_bar["y"] + b["z"] * l_bar["z"])
+        )
+        a2 = 2 * (b["energy"] * l_bar["x"] - l_bar["energy"] * b["x"])
+        a3 = 2 * (b["energy"] * l_bar["y"] - l_bar["energy"] * b["y"])
+        a4 = 2 * (b["energy"] * l_bar["z"] - l_bar["energy"] * b["z"])
+
+        b1_ = (
+            (b_bar["energy"] + l["energy"]) * (M_W**2 - l["mass"] ** 2)
+            - l["energy"] * (M_t**2 - M_b**2 - l["mass"] ** 2)
+            + 2 * b_bar["energy"] * l["energy"] ** 2
+            - 2 * l["energy"] * (b_bar["x"] * l["x"] + b_bar["y"] * l["y"] + b_bar["z"] * l["z"])
+        )
+        b2_ = 2 * (b_bar["energy"] * l["x"] - l["energy"] * b_bar["x"])
+        b3_ = 2 * (b_bar["energy"] * l["y"] - l["energy"] * b_bar["y"])
+        b4_ = 2 * (b_bar["energy"] * l["z"] - l["energy"] * b_bar["z"])
+
+        c22, c21, c20, c11, c10, c00 = _nureco_coeffs(l_bar, (a1, a2, a3, a4), M_W)
+        d22_, d21_, d20_, d11_, d10_, d00_ = _nureco_coeffs(l, (b1_, b2_, b3_, b4_), M_W)
+
+        d22 = d22_ + (MET_x**2) * d20_ + (MET_y**2) * d00_ + MET_x * MET_y * d10_ + MET_x * d21_ + MET_y * d11_
+        d21 = -d21_ - 2 * MET_x * d20_ - MET_y * d10_
+        d20 = d20_
+        d11 = -d11_ - 2 * MET_y * d00_ - MET_x * d10_
+        d10 = d10_
+        d00 = d00_
+
+        h4 = (
+            (c00**2) * (d22**2)
+            + c11 * d22 * (c11 * d00 - c00 * d11)
+            + c00 * c22 * (d11**2 - 2 * d00 * d22)
+            + c22 * d00 * (c22 * d00 - c11 * d11)
+        )
+        h3 = (
+            c00 * d21 * (2 * c00 * d22 - c11 * d11)
+            + c00 * d11 * (2 * c22 * d10 + c21 * d11)
+            + c22 * d00 * (2 * c21 * d00 - c11 * d10)
+            - c00 * d22 * (c11 * d10 + c10 * d11)
+            - 2 * c00 * d00 * (c22 * d21 + c21 * d22)
+            - d00 * d11 * (c11 * c21 + c10 * c22)
+            + c11 * d00 * (c11 * d21 + 2 * c10 * d22)
+        )
+        h2 = (
+            (c00**2) * (2 * d22 * d20 + d21**2)
+            - c00 * d21 * (c11 * d10 + c10 * d11)
+            + c11 * d20 * (c11 * d00 - c00 * d11)
+            + c00 * d10 * (c22 * d10 - c10 * d22)
+            + c00 * d11 * (2 * c21 * d10 + c20 * d11)
+            + (2 * c22 * c20 + c21**2) * d00**2
+            - 2 * c00 * d00 * (c22 * d20 + c21 * d21 + c20 * d22)
+            + c10 * d00 * (2 * c11 * d21 + c10 * d22)
+            - d00 * d10 * (c11 * c21 + c10 * c22)
+            - d00 * d11 * (c11 * c20 + c10 * c21)
+        )
+        h1 = (
+            c00 * d21 * (2 * c00 * d20 - c10 * d10)
+            - c00 * d20 * (c11 * d10 + c10 * d11)
+            + c00 * d10 * (c21 * d10 + 2 * c20 * d11)
+            - 2 * c00 * d00 * (c21 * d20 + c20 * d21)
+            + c10 * d00 * (2 * c11 * d20 + c10 * d21)
+            - c20 * d00 * (2 * c21 * d00 - c10 * d11)
+            - d00 * d10 * (c11 * c20 + c10 * c21)
+        )
+        h0 = (
+            (c00**2) * (d20**2)
+            + c10 * d20 * (c10 * d00 - c00 * d10)
+            + c20 * d10 * (c00 * d10 - c10 * d00)
+            + c20 * d00 * (c20 * d00 - 2 * c00 * d20)
+        )
+
+        # As in pnuCalculator_v7, h0 is the coefficient of the highest degree
+        roots = quartic_roots(np.stack([h0, h1, h2, h3, h4], axis=1)[cand_valid])
+        icand, iroot = np.nonzero(roots.imag == 0)
+        icand_all = np.nonzero(cand_valid)[0][icand]
+        pnu_x = roots.real[icand, iroot]
+
+        def sel(v):
+            return v[icand_all]
+
+        pnu_y = (sel(c00) * sel(d22) - sel(c22) * sel(d00)) / (sel(c11) * sel(d00) - sel(c00) * sel(d11))
+        pnu_z = -(sel(a1) + sel(a2) * pnu_x + sel(a3) * pnu_y) / sel(a4)
+        pnubar_x = sel(MET_x) - pnu_x
+        pnubar_y = sel(MET_y) - pnu_y
+        pnubar_z = -(sel(b1_) + sel(b2_) * pnubar_x + sel(b3_) * pnubar_y) / sel(b4_)
+
+        # Energy and pz of the ttH system used for the PDF weight. As in pnuCalculator_v7 the
+        # b-jets and the fatjet enter with E = mass and the leptons with their momentum and mass.
+        evt = sel(cand_evt)
+        ttH_energy = (
+            np.sqrt(pnu_x**2 + pnu_y**2 + pnu_z**2)
+            + np.sqrt(sel(l_bar["x"]) ** 2 + sel(l_bar["y"]) ** 2 + sel(l_bar["z"]) ** 2 + sel(l_bar["mass"]) ** 2)
+            + sel(b["mass"])
+            + np.sqrt(pnubar_x**2 + pnubar_y**2 + pnubar_z**2)
+            + np.sqrt(sel(l["x"]) ** 2 + sel(l["y"]) ** 2 + sel(l["z"]) ** 2 + sel(l["mass"]) ** 2)
+            + sel(b_bar["mass"])
+            + fatjet["mass"][evt]
+        )
+        ttH_z = pnu_z + sel(l_bar["z"]) + sel(b["z"]) + pnubar_z + sel(l["z"]) + sel(b_bar["z"]) + fatjet["z"][evt]
+        x1 = (ttH_energy - ttH_z) / params['Ecm']
+        x2 = (ttH_energy + ttH_z) / params['Ecm']
+        in_range = (x1 >= 0) & (x1 <= 1) & (x2 >= 0) & (x2 <= 1)
+        weight = np.full(len(x1), sentinel)
+        weight[in_range] = PDFweight_array(x1[in_range], x2[in_range], params['Q'], pdf)
+
+        solutions.append(
+            {
+                "evt": evt,
+                "order": ((iscan * 2 + sel(cand_reverse)) * max_pairs + sel(cand_pair)) * 4 + iroot,
+                "PDFweight": weight,
+                "m_t": np.full(len(evt), M_t, dtype=np.float64),
+                "m_W": np.full(len(evt), M_W, dtype=np.float64),
+                "pair": sel(cand_pair),
+                "reverse": sel(cand_reverse).astype(bool),
+                "pnu": (pnu_x, pnu_y, pnu_z),
+                "pnubar": (pnubar_x, pnubar_y, pnubar_z),
+                "b": (sel(b["x"]), sel(b["y"]), sel(b["z"]), sel(b["mass"])),
+                "b_bar": (sel(b_bar["x"]), sel(b_bar["y"]), sel(b_bar["z"]), sel(b_bar["mass"])),
+            }
+        )
+
+    def concat(key, n=None):
+        if n is None:
+            return np.concatenate([s[key] for s in solutions])
+        return [np.concatenate([s[key][i] for s in solutions]) for i in range(n)]
+
+    evt = concat("evt")
+    order = concat("order")
+    weight = concat("PDFweight")
+    pnu_xyz = concat("pnu", 3)
+    pnubar_xyz = concat("pnubar", 3)
+    b_xyzm = concat("b", 4)
+    bbar_xyzm = concat("b_bar", 4)
+    mask_events_withsol = np.zeros(nEvents, dtype=bool)
+    mask_events_withsol[evt] = True
+
+    # pnuCalculator_v7 stores a placeholder candidate (all components and weight -9999.9)
+    # for the events without solutions for the first (m_t, m_W) hypothesis
+    with_placeholder = attempted.copy()
+    with_placeholder[solutions[0]["evt"]] = False
+    placeholder_evt = np.nonzero(with_placeholder)[0]
+    n_ph = len(placeholder_evt)
+    sel_evt = np.concatenate([evt, placeholder_evt])
+    sel_order = np.concatenate([order, np.full(n_ph, -1)])
+    sel_weight = np.concatenate([weight, np.full(n_ph, sentinel)])
+
+    def with_ph(components):
+        return [np.concatenate([c, np.full(n_ph, sentinel)]) for c in components]
+
+    # Best candidate: highest weight, then first in the order of pnuCalculator_v7
+    ranked = np.lexsort((sel_order, -sel_weight, sel_evt))
+    evt_ranked = sel_evt[ranked]
+    first = np.ones(len(ranked), dtype=bool)
+    first[1:] = evt_ranked[1:] != evt_ranked[:-1]
+    best = ranked[first]
+    best_evt = evt_ranked[first]
+
+    def fill(values):
+        out = np.full(nEvents, sentinel)
+        out[best_evt] = values[best]
+        return out
+
+    outputs = []
+    for components, charge, is_neutrino in [
+        (with_ph(pnu_xyz), 0.0, True),
+        (with_ph(pnubar_xyz), 0.0, True),
+        (with_ph(b_xyzm), -1.0 / 3.0, False),
+        (with_ph(bbar_xyzm), +1.0 / 3.0, False),
+    ]:
+        x, y, z = (fill(c) for c in components[:3])
+        if is_neutrino:
+            mass = None
+            energy = np.sqrt(x**2 + y**2 + z**2)
+        else:
+            mass = fill(components[3])
+            energy = np.sqrt(mass**2 + x**2 + y**2 + z**2)
+        pt, eta, phi, p4_mass = _ptetaphim(x, y, z, energy)
+        has_best = np.zeros(nEvents, dtype=bool)
+        has_best[best_evt] = True
+        out = {'x': x, 'y': y, 'z': z}
+        for key, values in [('pt', pt), ('eta', eta), ('phi', phi)]:
+            out[key] = np.where(has_best, values, sentinel)
+        out['mass'] = np.where(has_best, p4_mass, sentinel) if is_neutrino else mass
+        out['charge'] = np.where(has_best, charge, sentinel)
+        outputs.append(ak.zip(out, with_name="PtEtaPhiMCandidate"))
+    pnu, pnubar, pbjets, pbbarjets = outputs
+
+    if not return_ranking:
+        return pnu, pnubar, pbjets, pbbarjets, mask_events_withsol
+
+    # Ranking of the real solutions of each event, by decreasing PDF weight
+    ranked = np.lexsort((order, -weight, evt))
+    ranking = ak.unflatten(
+        ak.zip({key: concat(key)[ranked] for key in ["PDFweight", "m_t", "m_W", "pair", "reverse"]}),
+        np.bincount(evt, minlength=nEvents),
+    )
+    return pnu, pnubar, pbjets, pbbarjets, mask_events_withsol, ranking
@@ -469,6 +469,38 @@ def sf_mu_promptmva(params, events, year, key=''):
     return ak.prod(sf, axis=1), ak.prod(sfup, axis=1), ak.prod(sfdown, axis=1)
 
 
+def _btag_jes_variation_name(variation):
+    '''Convert the name of a JES shape variation (e.g. JES_AbsoluteUp_AK4PFchs)
+    to the name of the corresponding btagSF systematic (e.g. up_jesAbsolute).'''
+    if variation.startswith("JES_Total") and variation[-2:] == "Up":
+        return "up_jes"
+    elif variation.startswith("JES_Total") and variation[-4:] == "Down":
+        return "down_jes"
+    # we need to remove the possible jet type
+    variation = variation.replace("_AK4PFchs", "")
+    variation = variation.replace("_AK4PFPuppi", "")
+    if variation[-2:] == "Up":
+        return f"up_jes{variation[4:-2]}"
+    elif variation[-4:] == "Down":
+        return f"down_jes{variation[4:-4]}"
+
+
+def segmented_prod(values, counts):
+    '''
+    Product of the values of each event for all the rows of a (n_rows, n_jets) matrix
+    of per-jet values, with a single segmented reduction over the jet offsets.
+    Returns a (n_rows, n_events) array, with 1 for the events without jets.
+    The products are computed in the jets order, as ak.prod does.
+    '''
+    counts = np.asarray(counts, dtype=np.int64)
+    out = np.ones((values.shape[0], len(counts)), dtype=values.dtype)
+    nonempty = counts > 0
+    if np.any(nonempty):
+        starts = (np.cumsum(counts) - counts)[nonempty]
+        out[:, nonempty] = np.multiply.reduceat(values, starts, axis=1)
+    return out
+
+
 def sf_btag(params, jets, year, njets, variations=["central"]):
     '''
     DeepJet (or other taggers) AK4 btagging SF.
@@ -483,6 +515,10 @@ def sf_btag(params, jets, year, njets, variations=["central"]):
     if variation is not one of the jes ones both the up and down sf is returned.
     If variation is a jet variation the argument must be up_jes* or down_jes* since it is applied on the specified
     Jes variation jets.
+
+    All the requested variations are evaluated in a single (n_variations x n_jets) matrix,
+    starting from the central SF, and the per-event products are computed for all of them
+    with one segmented reduction over the jets offsets (see `segmented_prod`).
     '''
     btagSF = params.jet_scale_factors.btagSF[year]
     btag_discriminator = params.btagging.working_point[year]["btagging_algorithm"]
@@ -493,63 +529,64 @@ def sf_btag(params, jets, year, njets, variations=["central"]):
     abseta = np.abs(ak.to_numpy(ak.flatten(jets.eta)))
     pt = ak.to_numpy(ak.flatten(jets.pt))
     discr = ak.to_numpy(ak.flatten(jets[btag_discriminator]))
+    counts = ak.to_numpy(njets)
+
+    # List of the btagSF systematics to evaluate: (systematic, apply only on c jets)
+    # The row 0 of the SF matrix is the central one.
+    systematics = []
+    for variation in variations:
+        if variation == "central":
+            continue
+        if "cferr" in variation:
+            # Computing the scale factor only on c-flavour jets
+            systematics += [(f"up_{variation}", True), (f"down_{variation}", True)]
+        elif variation.startswith("JES") and "AK4" in variation:
+            # This is a special case where a dedicate btagSF is computed for up and down Jes shape variations.
+            # This is not an up/down variation, but a single modified SF.
+            # N.B: It is a central SF computed on the non c-flavour jets
+            systematics.append((_btag_jes_variation_name(variation), False))
+        else:
+            # Computing the scale factor only NON c-flavour jets
+            systematics += [(f"up_{variation}", False), (f"down_{variation}", False)]
+
+    # The masked inputs are computed once for all the systematics
+    is_c = flavour == 4
+    masked_inputs = {}
+    for c_only in (True, False):
+        index = np.nonzero(is_c if c_only else ~is_c)[0]
+        masked_inputs[c_only] = (index, flavour[index], abseta[index], pt[index], discr[index])
+
+    # The central SF is evaluated only on the jets where it is used: all of them if
+    # the central SF is requested, otherwise the jets not affected by the systematics
+    # (e.g. only the c jets for the JES-varied SF).
+    central_SF_byjet = np.ones(len(flavour))
+    if "central" in variations:
+        central_SF_byjet[:] = corr.evaluate("central", flavour, abseta, pt, discr)
+    else:
+        for c_only in set(not c_only for _, c_only in systematics):
+            index, *inputs = masked_inputs[c_only]
+            central_SF_byjet[index] = corr.evaluate("central", *inputs)
 
-    central_SF_byjet = corr.evaluate("central", flavour, abseta, pt, discr)
+    sf = np.empty((1 + len(systematics), len(flavour)))
+    sf[:] = central_SF_byjet
+    for irow, (systematic, c_only) in enumerate(systematics, start=1):
+        index, *inputs = masked_inputs[c_only]
+        sf[irow, index] = corr.evaluate(systematic, *inputs)
 
-    def _get_sf_variation_with_mask(variation, mask):
-        index = (np.indices(discr.shape)).flatten()[mask]
-        # Copying the central SF
-        sf = np.copy(central_SF_byjet)
-        w = corr.evaluate(variation, flavour[mask], abseta[mask], pt[mask], discr[mask])
-        sf[index] = w
-        sf_out = ak.prod(ak.unflatten(sf, njets), axis=1)
-        return sf_out
+    sf_by_event = segmented_prod(sf, counts)
 
     output = {}
+    irow = 1
     for variation in variations:
         if variation == "central":
-            output[variation] = [ak.prod(ak.unflatten(central_SF_byjet, njets), axis=1)]
+            output[variation] = [sf_by_event[0]]
+        elif variation.startswith("JES") and "AK4" in variation and "cferr" not in variation:
+            output["central"] = [sf_by_event[irow]]
+            irow += 1
         else:
-            # Nominal sf==1
-            nominal = np.ones(ak.num(njets, axis=0))
-            # Systematic variations
-            if "cferr" in variation:
-                # Computing the scale factor only on c-flavour jets
-                c_mask = flavour == 4
-                output[variation] = [
-                    nominal,
-                    _get_sf_variation_with_mask(f"up_{variation}", c_mask),
-                    _get_sf_variation_with_mask(f"down_{variation}", c_mask),
-                ]
-
-            elif variation.startswith("JES") and "AK4" in variation:
-                # We need to convert the name of the variation
-                # from JES_VariationUp to  up_jesVariation
-                if variation.startswith("JES_Total") and variation[-2:] == "Up":
-                    btag_jes_var = "up_jes"
-                elif variation.startswith("JES_Total") and variation[-4:] == "Down":
-                    btag_jes_var = "down_jes"
-                else:
-                    # we need to remove the possible jet type
-                    variation = variation.replace("_AK4PFchs", "")
-                    variation = variation.replace("_AK4PFPuppi", "")
-                    if variation[-2:] == "Up":
-                        btag_jes_var = f"up_jes{variation[4:-2]}"
-                    elif variation[-4:] == "Down":
-                        btag_jes_var = f"down_jes{variation[4:-4]}"
-                # This is a special case where a dedicate btagSF is computed for up and down Jes shape variations.
-                # This is not an up/down variation, but a single modified SF.
-                # N.B: It is a central SF
-                notc_mask = flavour != 4
-                output["central"] = [_get_sf_variation_with_mask(btag_jes_var, notc_mask)]
-            else:
-                # Computing the scale factor only NON c-flavour jets
-                notc_mask = flavour != 4
-                output[variation] = [
-                    nominal,
-                    _get_sf_variation_with_mask(f"up_{variation}", notc_mask),
-                    _get_sf_variation_with_mask(f"down_{variation}", notc_mask),
-                ]
+            # Nominal sf==1 for the systematic variations
+            output[variation] = [np.ones(len(counts)), sf_by_event[irow], sf_by_event[irow + 1]]
+            irow += 2
 
     return output
 
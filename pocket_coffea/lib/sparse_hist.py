@@ -0,0 +1,231 @@
+"""Sparse storage of the histograms over the category and variation axes.
+
+The histograms built by the `HistManager` are dense over the `cat` x `variation` x observable
+axes. In configurations where most of the (category, variation) cells are never filled
+(variations restricted with `only_variations`, subsample-specific shape variations) most of
+the memory, of the size of the .coffea output and of the time spent in `accumulate` goes to
+empty bins.
+
+A `SparseHist` stores only the non-empty (category, variation) blocks of a histogram: each block
+is the numpy array of the observable axes bins (flow bins included). Two `SparseHist` with the
+same axes are merged by adding the blocks they have in common and taking the other ones. The
+dense `hist.Hist` is rebuilt only when needed with `to_hist()`: the plotting, the Datacard and
+`split-output` convert the histograms with `to_hist()` / `densify()`.
+
+The conversion in the processor is enabled by the `sparse_histograms` workflow option
+(see the documentation).
+"""
+from copy import deepcopy
+
+import numpy as np
+import hist
+
+SPARSE_AXES = ("cat", "variation")
+
+# Storages whose bins are merged by a sum of the bin contents
+_ADDITIVE_STORAGES = (
+    hist.storage.Double,
+    hist.storage.Int64,
+    hist.storage.AtomicInt64,
+    hist.storage.Weight,
+)
+
+
+def is_sparsifiable(h, sparse_axes=SPARSE_AXES):
+    '''True if `h` is a hist.Hist with an additive storage whose first axis is one of the `sparse_axes`.'''
+    return (
+        isinstance(h, hist.Hist)
+        and issubclass(h.storage_type, _ADDITIVE_STORAGES)
+        and len(h.axes) > 0
+        and h.axes[0].name in sparse_axes
+    )
+
+
+class SparseHist:
+    '''Histogram storing only the non-empty blocks of its leading category axes.
+
+    The leading axes of the histogram with name in `sparse_axes` (by default the `cat` and
+    `variation` axes of the HistManager histograms) are the sparse axes; the other axes are
+    stored densely in the blocks. The blocks are indexed by the tuple of the bin indices (flow
+    bins included) of the sparse axes. For the `Weight` storage the last dimension of the blocks
+    has size 2 and holds the sum of weights and the variance.
+
+    Build it with `SparseHist.from_hist(h)` and convert it back with `to_hist()`.
+    '''
+
+    def __init__(self, axes, storage_type, nsparse, blocks=None, name=None, label=None):
+        self._axes = tuple(axes)
+        self.storage_type = storage_type
+        self.nsparse = nsparse
+        self.blocks = blocks if blocks is not None else {}
+        self.name = name
+        self.label = label
+
+    @classmethod
+    def from_hist(cls, h, sparse_axes=SPARSE_AXES):
+        '''Build the sparse histogram from the dense hist.Hist `h`.'''
+        if not is_sparsifiable(h, sparse_axes):
+            raise ValueError(
+                f"Cannot build a SparseHist from {type(h)}: an additive storage and a leading "
+                f"axis in {sparse_axes} are needed"
+            )
+        nsparse = 0
+        for ax in h.axes:
+            if ax.name not in sparse_axes:
+                break
+            nsparse += 1
+        view = np.asarray(h.view(flow=True))
+        weighted = issubclass(h.storage_type, hist.storage.Weight)
+        if weighted:
+            nonzero = (view["value"] != 0) | (view["variance"] != 0)
+        else:
+            nonzero = view != 0
+        sparse_shape = view.shape[:nsparse]
+        filled = nonzero.reshape(sparse_shape + (-1,)).any(axis=-1)
+        blocks = {}
+        for key in map(tuple, np.argwhere(filled).tolist()):
+            if weighted:
+                blocks[key] = np.stack([view["value"][key], view["variance"][key]], axis=-1)
+            else:
+                blocks[key] = view[key].copy()
+        # The axes are copied so that the dense histogram is not kept alive
+        return cls(deepcopy(tuple(h.axes)), h.storage_type, nsparse, blocks, name=h.name, label=h.label)
+
+    @property
+    def axes(self):
+        return self._axes
+
+    @property
+    def weighted(self):
+        return issubclass(self.storage_type, hist.storage.Weight)
+
+    @property
+    def nblocks(self):
+        return len(self.blocks)
+
+    def __repr__(self):
+        axes = ", ".join(f"{ax.name}[{ax.size}]" for ax in self._axes)
+        return f"SparseHist({axes}, storage={self.storage_type.__name__}, nblocks={self.nblocks})"
+
+    def to_hist(self):
+        '''Rebuild the dense hist.Hist.'''
+        h = hist.Hist(*self._axes, storage=self.storage_type(), name=self.name, label=self.label)
+        view = np.asarray(h.view(flow=True))
+        for key, block in self.blocks.items():
+            if self.weighted:
+                view["value"][key] = block[..., 0]
+                view["variance"][key] = block[..., 1]
+            else:
+                view[key] = block
+        return h
+
+    def copy(self):
+        return SparseHist(
+            self._axes,
+            self.storage_type,
+            self.nsparse,
+            {key: block.copy() for key, block in self.blocks.items()},
+            name=self.name,
+            label=self.label,
+        )
+
+    def _check_compatible(self, other):
+        if other._axes is self._axes:
+            return
+        if (
+            other.storage_type is not self.storage_type
+            or other.nsparse != self.nsparse
+            or other._axes != self._axes
+        ):
+            raise ValueError(f"Cannot add two SparseHist with different axes or storage: {self} and {other}")
+
+    def __iadd__(self, other):
+        if isinstance(other, hist.Hist):
+            other = SparseHist.from_hist(other, [ax.name for ax in self._axes[: self.nsparse]])
+        if not isinstance(other, SparseHist):
+            return NotImplemented
+        self._check_compatible(other)
+        for key, block in other.blocks.items():
+            if key in self.blocks:
+                self.blocks[key] += block
+            else:
+                self.blocks[key] = block.copy()
+        return self
+
+    def __add__(self, other):
+        if not isinstance(other, (SparseHist, hist.Hist)):
+            return NotImplemented
+        out = self.copy()
+        out += other
+        return out
+
+    def __radd__(self, other):
+        return self.__add__(other)
+
+    def __imul__(self, factor):
+        '''Scale the histogram by a number: the variance is scaled by its square.'''
+        if not np.isscalar(factor):
+            return NotImplemented
+        for block in self.blocks.values():
+            if self.weighted:
+                block[..., 0] *= factor
+                block[..., 1] *= factor * factor
+            else:
+                block *= factor
+        return self
+
+    def __mul__(self, factor):
+        if not np.isscalar(factor):
+            return NotImplemented
+        out = self.copy()
+        out *= factor
+        return out
+
+    def __rmul__(self, factor):
+        return self.__mul__(factor)
+
+    def values_are_finite(self):
+        '''True if all the bin contents, flow bins excluded, are finite: as
+        `np.all(np.isfinite(h.values()))` on the dense histogram.'''
+        sparse_sizes = [ax.size for ax in self._axes[: self.nsparse]]
+        inner = tuple(
+            slice(int(ax.traits.underflow), int(ax.traits.underflow) + ax.size)
+            for ax in self._axes[self.nsparse :]
+        )
+        for key, block in self.blocks.items():
+            if any(i >= size for i, size in zip(key, sparse_sizes)):
+                # overflow bin of a category axis
+                continue
+            values = block[..., 0] if self.weighted else block
+            if not np.all(np.isfinite(values[inner])):
+                return False
+        return True
+
+
+def to_hist(h):
+    '''Return the dense hist.Hist of `h` if it is a SparseHist, `h` otherwise.'''
+    if isinstance(h, SparseHist):
+        return h.to_hist()
+    return h
+
+
+def densify(obj):
+    '''Convert in place all the SparseHist in the (nested) dictionary `obj` to hist.Hist.
+    A SparseHist is converted and returned directly.'''
+    if isinstance(obj, SparseHist):
+        return obj.to_hist()
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            obj[key] = densify(value)
+    return obj
+
+
+def sparsify(obj, sparse_axes=SPARSE_AXES):
+    '''Convert in place the histograms in the (nested) dictionary `obj` to SparseHist.
+    The histograms which cannot be stored as SparseHist are left untouched.'''
+    if is_sparsifiable(obj, sparse_axes):
+        return SparseHist.from_hist(obj, sparse_axes)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            obj[key] = sparsify(value, sparse_axes)
+    return obj
@@ -28,21 +28,24 @@ genWeight = WeightLambda.wrap_func(
     name="genWeight",
     function=lambda params, metadata, events, size, shape_variations:
             events.genWeight,
-    has_variations=False
+    has_variations=False,
+    depends_on_collections=[],
     )
 
 signOfGenWeight = WeightLambda.wrap_func(
     name="signOf_genWeight",
     function=lambda params, metadata, events, size, shape_variations:
        np.sign(events.genWeight),
-    has_variations=False
+    has_variations=False,
+    depends_on_collections=[],
     )
 
 lumi = WeightLambda.wrap_func(
     name="lumi",
     function=lambda params, metadata, events, size, shape_variations:
         np.ones(len(events)) * params.lumi.picobarns[metadata["year"]]["tot"],
-    has_variations=False
+    has_variations=False,
+    depends_on_collections=[],
     )
 
 
@@ -50,7 +53,8 @@ XS = WeightLambda.wrap_func(
     name = "XS",
     function = lambda params, metadata, events, size, shape_variations:
         np.ones(len(events)) * float(metadata["xsec"]),
-    has_variations=False
+    has_variations=False,
+    depends_on_collections=[],
 )
 
 
@@ -58,7 +62,8 @@ pileup = WeightLambda.wrap_func(
     name="pileup",
     function=lambda params, metadata, events, size, shape_variations:
         sf_pileup_reweight(params, events, metadata["year"]),
-    has_variations=True  # no list of variations it means only up and down
+    has_variations=True,  # no list of variations it means only up and down
+    depends_on_collections=[],
     )
 
 
@@ -66,21 +71,24 @@ SF_ele_reco = WeightLambda.wrap_func(
     name="sf_ele_reco",
     function=lambda params, metadata, events, size, shape_variations:
         sf_ele_reco(params, events, metadata["year"]),
-    has_variations=True
+    has_variations=True,
+    depends_on_collections=["Electron"],
     )
 
 SF_ele_id = WeightLambda.wrap_func(
     name="sf_ele_id",
     function=lambda params, metadata, events, size, shape_variations:
         sf_ele_id(params, events, metadata["year"]),
-    has_variations=True
+    has_variations=True,
+    depends_on_collections=["Electron"],
     )
 
 SF_ele_promptMVA = WeightLambda.wrap_func(
     name="sf_ele_promptMVA",
     function=lambda params, metadata, events, size, shape_variations:
         sf_ele_promptmva(params, events, metadata["year"]),
-    has_variations=True
+    has_variations=True,
+    depends_on_collections=["Electron"],
     )
 
 SF_ele_trigger = WeightLambda.wrap_func(
@@ -89,34 +97,39 @@ SF_ele_trigger = WeightLambda.wrap_func(
         params, events, metadata["year"]
     ),
     has_variations=True,
+    depends_on_collections=["Electron"],
 )
 
 SF_mu_id = WeightLambda.wrap_func(
     name="sf_mu_id",
     function=lambda params, metadata, events, size, shape_variations:
         sf_mu(params, events, metadata["year"], 'id'),
-    has_variations=True
+    has_variations=True,
+    depends_on_collections=["Muon"],
     )
 
 SF_mu_iso = WeightLambda.wrap_func(
     name="sf_mu_iso",
     function=lambda params, metadata, events, size, shape_variations:
         sf_mu(params, events, metadata["year"], 'iso'),
-    has_variations=True
+    has_variations=True,
+    depends_on_collections=["Muon"],
     )
 
 SF_mu_trigger = WeightLambda.wrap_func(
     name="sf_mu_trigger",
     function=lambda params, metadata, events, size, shape_variations:
         sf_mu(params, events, metadata["year"], 'trigger'),
-    has_variations=True
+    has_variations=True,
+    depends_on_collections=["Muon"],
     )
 
 SF_mu_promptMVA = WeightLambda.wrap_func(
     name="sf_mu_promptMVA",
     function=lambda params, metadata, events, size, shape_variations:
         sf_mu_promptmva(params, events, metadata["year"], 'promptMVA'),
-    has_variations=True
+    has_variations=True,
+    depends_on_collections=["Muon"],
     )
 
 
@@ -124,7 +137,8 @@ SF_L1prefiring = WeightLambda.wrap_func(
     name="sf_L1prefiring",
     function=lambda params, metadata, events, size, shape_variations:
         sf_L1prefiring(events),
-    has_variations=True
+    has_variations=True,
+    depends_on_collections=[],
     )
 
 
@@ -132,14 +146,16 @@ SF_PSWeight_isr = WeightLambda.wrap_func(
     name="sf_partonshower_isr",
     function=lambda params, metadata, events, size, shape_variations:
         sf_partonshower_isr(events),
-    has_variations=True
+    has_variations=True,
+    depends_on_collections=[],
     )
 
 SF_PSWeight_fsr = WeightLambda.wrap_func(
     name="sf_partonshower_fsr",
     function=lambda params, metadata, events, size, shape_variations:
         sf_partonshower_fsr(events),
-    has_variations=True
+    has_variations=True,
+    depends_on_collections=[],
     )
 
 
@@ -147,14 +163,16 @@ SF_pho_pxseed = WeightLambda.wrap_func(
     name="sf_pho_pxseed",
     function=lambda params, metadata, events, size, shape_variations:
         sf_photon(params, events, metadata["year"], 'pxseed'),
-    has_variations=True
+    has_variations=True,
+    depends_on_collections=["Photon"],
     )
 
 SF_pho_id = WeightLambda.wrap_func(
     name="sf_pho_id",
     function=lambda params, metadata, events, size, shape_variations:
         sf_photon(params, events, metadata["year"], 'id'),
-    has_variations=True
+    has_variations=True,
+    depends_on_collections=["Photon"],
     )
 
 ########################################
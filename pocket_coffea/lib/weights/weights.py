@@ -54,7 +54,7 @@ class WeightWrapperMeta(ABCMeta):
     def wrap_func(cls, name:str,
                   function: Callable[[Any, int, str], Any],
                   has_variations=False, variations=None,
-                  isMC_only=True):
+                  isMC_only=True, depends_on_collections=None):
         '''
         Method to create a new WeightLambda class with the given function.
         The lambda function takes as input the parameters, metadata, events, size and shape_variations.
@@ -62,13 +62,16 @@ class WeightWrapperMeta(ABCMeta):
         - WeightData or WeightDataMultiVariation object: in that case the name is overwritten by the framework
         - 3 arrays (nominal, up, down) -> WeightData is created
         - 1 array (nominal), list of variations [str] , 2 lists of arrays (up, down) -> WeightDataMultiVariation is created
-        
+
+        The `depends_on_collections` argument sets the attribute of the same name
+        of the WeightWrapper class (see the WeightWrapper documentation).
         '''
         # Create a new class with the compute method
         attrs = {'_function': function,
                  'name': name,
                  'has_variations': has_variations,
                  'isMC_only': isMC_only,
+                 'depends_on_collections': depends_on_collections,
                  '__module__': cls.__module__
                  }
         
@@ -118,10 +121,22 @@ class WeightWrapper(ABC, metaclass=WeightWrapperMeta):
 
     If the Weight has a single variation:  has_variations = True, _variations is empty.
 
+    The `depends_on_collections` attribute lists the calibrated collections
+    (format "collection" or "collection.field", as the `calibrated_collections` of the calibrators)
+    from which the inputs of the weight are derived: e.g. ["Muon"] for a SF computed on
+    the MuonGood collection built from the calibrated Muon one. An empty list means that the
+    weight does not depend on any calibration (genWeight, pileup...).
+    With the `reuse_invariant_weights` workflow option, the weights not depending on the
+    collections modified by a shape variation are computed once per chunk on the events
+    before the preselection (with shape_variation="nominal") and reused for all the shape variations.
+    In that case the weight must be computable on the events before the preselection.
+    None (default) means unknown dependencies: the weight is computed for each shape variation.
+
     '''
     name: ClassVar[str] = "base_weight"
     has_variations: ClassVar[bool] = False
     isMC_only: ClassVar[bool] = True
+    depends_on_collections: ClassVar[List[str]] = None
     _variations: List[str] = [] # default empty variation == "Up"/Down  
     
     def __init__(self, params=None, metadata=None):
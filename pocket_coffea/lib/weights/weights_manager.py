@@ -2,12 +2,40 @@ from dataclasses import dataclass
 import inspect
 import awkward as ak
 import numpy as np
-import copy
 from collections.abc import Callable
 from collections import defaultdict
 
 from coffea.analysis_tools import Weights
 from .weights import WeightData, WeightDataMultiVariation
+from ..calibrators.calibrators_manager import _collections_overlap
+from ...utils.profiling import profile_stage
+
+
+def _map_weight_data(out, func, nominal=True):
+    '''Return a new WeightData/WeightDataMultiVariation object with `func` applied to the
+    weight arrays (to the nominal one only if `nominal` is True).
+    Other objects are returned unchanged.'''
+    def _apply(array):
+        return func(array) if array is not None else None
+
+    if isinstance(out, WeightData):
+        return WeightData(out.name,
+                          _apply(out.nominal) if nominal else out.nominal,
+                          _apply(out.up), _apply(out.down))
+    elif isinstance(out, WeightDataMultiVariation):
+        return WeightDataMultiVariation(
+            out.name,
+            _apply(out.nominal) if nominal else out.nominal,
+            out.variations,
+            [_apply(a) for a in out.up] if out.up is not None else None,
+            [_apply(a) for a in out.down] if out.down is not None else None)
+    return out
+
+
+def _copy_array(array):
+    if isinstance(array, ak.Array):
+        return ak.copy(array)
+    return np.array(array, copy=True)
 
 
 class WeightsManager:
@@ -26,6 +54,11 @@ class WeightsManager:
     The configuration of samples/categories is handled by the configuration, but the availability of the
     weight is defined in the WeightWrapper class.
 
+    If the events before the preselection and the preselection mask are passed to the `compute` method,
+    the weights not depending on the collections modified by the current shape variation
+    (see `WeightWrapper.depends_on_collections`) are computed only once per chunk on the events before
+    the preselection and sliced with the preselection mask of each shape variation.
+
     '''
 
     def __init__(
@@ -35,6 +68,7 @@ class WeightsManager:
         weightsWrappers,
         metadata,
         storeIndividual=False,
+        profiler=None,
     ):
         self.params = params
         self._sample = metadata["sample"]
@@ -68,6 +102,11 @@ class WeightsManager:
                 self._available_modifiers_byweight[w] = []
             
         self.storeIndividual = storeIndividual
+        # Optional ProcessingProfiler recording the time spent by each weight ("weights/<name>")
+        self.profiler = profiler
+        # Weights computed on the events before preselection, reused for all the shape variations.
+        # The WeightsManager is created for each chunk.
+        self._invariant_weights = {}
         # Dictionary keeping track of which modifier can be applied to which region
         self._available_modifiers_inclusive = []
         self._available_modifiers_bycat = defaultdict(list)
@@ -123,11 +162,29 @@ class WeightsManager:
                 for k, v in self._available_modifiers_bycat_subsamples.items()
             }
         
-    def compute(self, events, size, shape_variation="nominal"):
+    def is_invariant(self, weight, modified_collections):
+        '''Check if the weight does not depend on the modified calibrated collections.
+        Weights not declaring their dependencies are never invariant.'''
+        deps = self._weightsObj[weight].depends_on_collections
+        if deps is None:
+            return False
+        return not any(_collections_overlap(dep, coll)
+                       for dep in deps for coll in modified_collections)
+
+    def compute(self, events, size, shape_variation="nominal",
+                events_before_presel=None, presel_mask=None, modified_collections=None):
         '''
         Load the weights for the current chunk following the user configuration.
         This created different Weights objects for the inclusive and bycategory weights.
+
+        If `events_before_presel` and `presel_mask` (such that events==events_before_presel[presel_mask])
+        are given, the weights invariant for the shape variation, i.e. not depending on any of the
+        `modified_collections` by the variation calibration, are computed once per chunk
+        on `events_before_presel` and sliced with `presel_mask`.
         '''
+        reuse_invariant = events_before_presel is not None and presel_mask is not None
+        if modified_collections is None:
+            modified_collections = []
         _weightsCache = {}
          # looping on the weights configuration to create the
 
@@ -150,19 +207,26 @@ class WeightsManager:
                 # The configurator has already checked that it is defined somewhere.
                 # DO nothing
                 return
-            if w not in _weightsCache:
-                out = self._weightsObj[w].compute(
-                    events, size, shape_variation
-                )
-                # the output is a WeightData or WeightDataMultiVariation object
-                _weightsCache[w] = out
+            if reuse_invariant and self.is_invariant(w, modified_collections):
+                if w not in self._invariant_weights:
+                    with profile_stage(self.profiler, f"weights/{w}"):
+                        self._invariant_weights[w] = self._weightsObj[w].compute(
+                            events_before_presel, len(events_before_presel), "nominal"
+                        )
+                # Slicing creates new arrays: the cached ones are not modified by coffea
+                out = _map_weight_data(self._invariant_weights[w], lambda a: a[presel_mask])
             else:
-                out = _weightsCache[w]
+                if w not in _weightsCache:
+                    # the output is a WeightData or WeightDataMultiVariation object
+                    with profile_stage(self.profiler, f"weights/{w}"):
+                        _weightsCache[w] = self._weightsObj[w].compute(
+                            events, size, shape_variation
+                        )
+                # coffea Weights modifies in place the variation arrays:
+                # copy them as the same output can be added to more Weights objects
+                out = _map_weight_data(_weightsCache[w], _copy_array, nominal=False)
+
 
-            # Copy the WeightData object to avoid modifying the original
-            # FIXME: there is a coffea bug which modifies in place the weight variation array
-            out = copy.deepcopy(out)
-                
             if isinstance(out, WeightData):
                 weight_obj.add(out.name, out.nominal, out.up, out.down)
                 if self._weightsObj[w].has_variations:
@@ -3,6 +3,8 @@ import click
 from rich import print
 
 from pocket_coffea.utils import dataset
+from pocket_coffea.utils.file_metadata_cache import FILE_METADATA_CACHE_FILENAME
+from pocket_coffea.utils.dataset_discovery import DISCOVERY_CACHE_FILENAME
 
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
@@ -84,6 +86,42 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
     help="Use the redirector path if no site is available after the specified whitelist, blacklist and regexes are applied for sites."
 )
 @click.option("-p", "--parallelize", type=int, default=4)
+@click.option(
+    "--metadata-cache",
+    type=str,
+    default=None,
+    help=f"SQLite file caching the number of entries of the files read with uproot. Default: {FILE_METADATA_CACHE_FILENAME} next to the --cfg file"
+)
+@click.option(
+    "--no-metadata-cache",
+    is_flag=True,
+    default=False,
+    help="Do not read nor write the file metadata cache"
+)
+@click.option(
+    "--max-concurrency",
+    type=int,
+    default=16,
+    help="Maximum number of DAS names queried at the same time on DBS and Rucio"
+)
+@click.option(
+    "--discovery-cache",
+    type=str,
+    default=None,
+    help=f"SQLite file caching the DBS file lists and Rucio replicas. Default: {DISCOVERY_CACHE_FILENAME} next to the --cfg file"
+)
+@click.option(
+    "--discovery-cache-ttl",
+    type=float,
+    default=24,
+    help="Hours after which the cached DBS and Rucio responses are queried again"
+)
+@click.option(
+    "--no-discovery-cache",
+    is_flag=True,
+    default=False,
+    help="Do not read nor write the DBS/Rucio responses cache"
+)
 def build_datasets(
     cfg,
     keys,
@@ -99,6 +137,12 @@ def build_datasets(
     regex_sites,
     sort_replicas,
     parallelize,
+    metadata_cache,
+    no_metadata_cache,
+    max_concurrency,
+    discovery_cache,
+    discovery_cache_ttl,
+    no_discovery_cache,
 ):
     '''Build dataset fileset in json format'''
     # Check for comma separated values
@@ -116,7 +160,16 @@ def build_datasets(
     print(blocklist_sites)
     print("[blue]Priority sites:[/]")
     print(prioritylist_sites)
-        
+
+    if no_metadata_cache:
+        metadata_cache = None
+    elif metadata_cache is None:
+        metadata_cache = os.path.join(os.path.dirname(os.path.abspath(cfg)), FILE_METADATA_CACHE_FILENAME)
+    if no_discovery_cache:
+        discovery_cache = None
+    elif discovery_cache is None:
+        discovery_cache = os.path.join(os.path.dirname(os.path.abspath(cfg)), DISCOVERY_CACHE_FILENAME)
+
     dataset.build_datasets(
         cfg=cfg,
         keys=keys,
@@ -132,6 +185,10 @@ def build_datasets(
         regex_sites=regex_sites,
         sort_replicas=sort_replicas,
         parallelize=parallelize,
+        metadata_cache=metadata_cache,
+        max_concurrency=max_concurrency,
+        discovery_cache=discovery_cache,
+        discovery_cache_ttl=discovery_cache_ttl * 3600,
     )
 
 
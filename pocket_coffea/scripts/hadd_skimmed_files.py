@@ -9,6 +9,8 @@ import subprocess
 import json
 import click
 
+from pocket_coffea.utils.skim import group_skimmed_files, merge_root_files_uproot, copy_file
+
 
 
 def _strip_xrootd_prefix(path):
@@ -66,6 +68,30 @@ def _check_output_file(item):
         return outfile, "unreadable", f"exception: {e}", None
 
 
+def _check_output_file_uproot(item):
+    """Same as `_check_output_file`, reading the number of entries with uproot."""
+    outfile, expected, _ = item
+    local_path = _strip_xrootd_prefix(outfile)
+    if not os.path.exists(local_path):
+        return outfile, "missing", f"file does not exist ({local_path})", None
+    try:
+        import uproot
+        with uproot.open(outfile) as f:
+            if "Events" not in f:
+                return outfile, "unreadable", "no Events tree", None
+            nentries = int(f["Events"].num_entries)
+        if expected is not None and nentries != expected:
+            return (
+                outfile,
+                "wrong_nevents",
+                f"expected {expected} entries, got {nentries}",
+                nentries,
+            )
+        return outfile, "ok", f"{nentries} entries", nentries
+    except Exception as e:
+        return outfile, "unreadable", f"exception: {e}", None
+
+
 _DO_HADD_JOB_SPLITBYFILE_TEMPLATE = """#!/bin/python3
 import os
 import sys
@@ -148,6 +174,30 @@ def do_hadd(group, overwrite=False):
         print(e)
         return group[0], 1
 
+def do_merge_uproot(group, overwrite=False):
+    """Merge a group of files with uproot, without ROOT: same interface as `do_hadd`."""
+    outputfile, inputfiles = group
+    try:
+        if os.path.exists(_strip_xrootd_prefix(outputfile)):
+            if overwrite:
+                print(f"Output file {outputfile} already exists, but overwrite is enabled. It will be overwritten.")
+            else:
+                print(f"Output file {outputfile} already exists. Skipping merging for this group.")
+                return outputfile, 0
+        if outputfile.startswith("root://"):
+            # Written locally and then copied to the xrootd destination
+            fname = os.path.basename(outputfile)
+            merge_root_files_uproot(inputfiles, fname)
+            copy_file(fname, "./", os.path.dirname(outputfile))
+        else:
+            os.makedirs(os.path.dirname(outputfile), exist_ok=True)
+            merge_root_files_uproot(inputfiles, outputfile)
+        return outputfile, 0
+    except Exception as e:
+        print("Error producing group: ", outputfile)
+        print(e)
+        return outputfile, 1
+
 @click.command()
 @click.option(
     '-fl',
@@ -174,6 +224,15 @@ def do_hadd(group, overwrite=False):
 )
 @click.option("--overwrite", is_flag=True, help="Overwrite files")
 @click.option("--dry", is_flag=True, help="Do not execute hadd, save metadata")
+@click.option(
+    "--uproot",
+    "use_uproot",
+    is_flag=True,
+    help=(
+        "Merge the files with uproot in --scaleout local processes instead of ROOT "
+        "(no ROOT installation needed). Also used by --check to read the number of entries."
+    ),
+)
 @click.option(
     "--check",
     is_flag=True,
@@ -186,7 +245,7 @@ def do_hadd(group, overwrite=False):
     ),
 )
 def hadd_skimmed_files(files_list,  outputdir, filter_samples,
-                       filter_datasets, files, events, scaleout, overwrite, dry, check):
+                       filter_datasets, files, events, scaleout, overwrite, dry, use_uproot, check):
     '''
     Regroup skimmed datasets by joining different files (like hadd for ROOT files) 
     '''
@@ -194,7 +253,8 @@ def hadd_skimmed_files(files_list,  outputdir, filter_samples,
         import ROOT as R
         root_available = True
     except ImportError:
-        print("ROOT is not available. Please make sure to have ROOT installed and configured properly to run this script.")
+        if not use_uproot:
+            print("ROOT is not available. Please make sure to have ROOT installed and configured properly to run this script, or use the --uproot option.")
         root_available = False
 
     df = load(files_list)
@@ -230,7 +290,8 @@ def hadd_skimmed_files(files_list,  outputdir, filter_samples,
         nfiles = 0
         group = []
         ngroup = 1
-        for file, nevents in zip(
+        # The chunks appended to the same file by the coalescing skim writer are grouped
+        for file, nevents in group_skimmed_files(
             df["skimmed_files"][dataset], df["nskimmed_events"][dataset]
         ):
             if (files and (nfiles + 1) > files) or (
@@ -261,7 +322,7 @@ def hadd_skimmed_files(files_list,  outputdir, filter_samples,
     json.dump(groups_metadata, open("hadd.json", "w"), indent=2)
 
     if check:
-        existence_only = not root_available
+        existence_only = not root_available and not use_uproot
         if existence_only:
             print(
                 "ROOT is not available — falling back to existence-only check "
@@ -274,13 +335,17 @@ def hadd_skimmed_files(files_list,  outputdir, filter_samples,
                 expected = conf["nevents_per_outfile"].get(outfile)
                 check_items.append((outfile, expected, existence_only))
 
-        mode = "existence" if existence_only else "existence + ROOT + entries"
+        checker = _check_output_file_uproot if use_uproot else _check_output_file
+        if existence_only:
+            mode = "existence"
+        else:
+            mode = "existence + uproot + entries" if use_uproot else "existence + ROOT + entries"
         print(f"\nValidating {len(check_items)} hadded output files ({mode}) ...")
         if scaleout and scaleout > 1:
             with Pool(scaleout) as p:
-                results = p.map(_check_output_file, check_items)
+                results = p.map(checker, check_items)
         else:
-            results = [_check_output_file(it) for it in check_items]
+            results = [checker(it) for it in check_items]
 
         # Group results by status
         by_status = defaultdict(list)
@@ -379,10 +444,10 @@ def hadd_skimmed_files(files_list,  outputdir, filter_samples,
         )
         return
 
-    if not dry and root_available:
+    if not dry and (use_uproot or root_available):
         p = Pool(scaleout)
-        
-        results = p.map(partial(do_hadd, overwrite=overwrite), workload)
+        merge = do_merge_uproot if use_uproot else do_hadd
+        results = p.map(partial(merge, overwrite=overwrite), workload)
 
         print("\n\n\n")
         for group, r in results:
@@ -7,6 +7,8 @@ import pyarrow.parquet as pq
 from rich import print
 from rich.progress import track
 
+from pocket_coffea.utils.parquet_writer import is_coalesced_part
+
 
 def merge_leaf_dir(input_dir, output_file, force):
     # Skip if output exists and not forcing
@@ -33,12 +35,16 @@ def merge_leaf_dir(input_dir, output_file, force):
     # print(f"[green][Merged] {input_dir} -> {output_file}[/]")
 
 
-def find_leaf_dirs(root_input, root_output):
-    """Return list of (leaf_dir, output_file) pairs."""
+def find_leaf_dirs(root_input, root_output, include_coalesced=False):
+    """Return list of (leaf_dir, output_file) pairs.
+    The leaf dirs containing only the large files of the buffered writer
+    (`dump_columns_buffer_size_mb` option) are skipped unless `include_coalesced` is True."""
     tasks = []
     for current_dir, dirs, files in os.walk(root_input):
         if not dirs:  # leaf dir
             parquet_files = [f for f in files if f.endswith(".parquet")]
+            if not include_coalesced and parquet_files and all(map(is_coalesced_part, parquet_files)):
+                continue
             if parquet_files:
                 rel_path = os.path.relpath(current_dir, start=root_input)
                 output_file = os.path.join(root_output, f"{rel_path}.parquet")
@@ -69,14 +75,19 @@ def worker(task):
     help="Overwrite existing output files",
     is_flag=True,
 )
-def main(output_dir: str, jobs: int, force: bool):
+@click.option(
+    "--include-coalesced",
+    help="Merge also the folders already written in large files by the buffered writer",
+    is_flag=True,
+)
+def main(output_dir: str, jobs: int, force: bool, include_coalesced: bool):
     """Merge chunks of exported columns."""
     root_input = os.path.abspath(output_dir)
     root_output = root_input.rstrip(os.sep) + "_merged"
     os.makedirs(root_output, exist_ok=True)
 
     # Collect all leaf directories
-    tasks = [(inp, out, force) for inp, out in find_leaf_dirs(root_input, root_output)]
+    tasks = [(inp, out, force) for inp, out in find_leaf_dirs(root_input, root_output, include_coalesced)]
 
     # Merge with progress bar
     with multiprocessing.Pool(processes=jobs) as pool:
@@ -9,14 +9,25 @@ import cloudpickle
 import yaml
 from pocket_coffea.utils.filter_output import compare_dict_types, get_datasets_in_output, remove_datasets_from_output
 from pocket_coffea.utils.skim import save_skimed_dataset_definition
+from pocket_coffea.utils.load_output import load_output
+from pocket_coffea.utils.indexed_output import IndexedOutput, compact_indexed_output, is_indexed_output, save_indexed_output
 from itertools import islice
 from functools import reduce
 import pickle
 from glob import glob
 import psutil, gc
+import hashlib
+import shutil
+import lz4.frame
+from concurrent.futures import ProcessPoolExecutor, as_completed
 mem_threshold = 0.5 # ~50% + memory needed to dump files, is the empirical threshold on lxplus
 
 
+def load_input(filename):
+    '''Load an input file, either a .coffea or an indexed output file.'''
+    return load_output(filename) if is_indexed_output(filename) else load(filename)
+
+
 def merge_group_reduction(output_files, N_reduction=5, cachedir="merge_cache", max_mem_gb=8, verbose=False):
     with Progress() as progress:
         task1 = progress.add_task("[cyan]Merging...", total=len(output_files))
@@ -29,7 +40,7 @@ def merge_group_reduction(output_files, N_reduction=5, cachedir="merge_cache", m
                 if verbose:
                     filesize = sum([os.path.getsize(f) for f in batch])/1024**3
                     print(f"File size (on disk) to load: {filesize:.3f} GB")
-                loaded_batch = [load(f) for f in batch]
+                loaded_batch = [load_input(f) for f in batch]
                 batch_acc = accumulate(loaded_batch)
                 del loaded_batch, batch
                 if result is None:
@@ -71,8 +82,167 @@ def merge_group_reduction(output_files, N_reduction=5, cachedir="merge_cache", m
 
     new_output_files = glob(f"{cachedir}/*.coffea")
     print(f"[green][b]Since outputs were too large to fit in memory, I created {len(new_output_files)} fragmented output files.[/] These may be moved to and merged on a high-memory machine.[/]")
+    print("[b]Use the -w/--workers option to merge with a bounded-memory tree reduction producing a single output file.[/]")
     exit()
 
+###########################################################
+# Parallel tree reduction, streaming the output key by key
+
+def _shard_keys(output):
+    '''Split an output in shards: one for each histogram variable and one for
+    each other top-level key of the output.'''
+    for key, value in output.items():
+        if key == "variables" and isinstance(value, dict) and len(value) > 0:
+            for var, hists in value.items():
+                yield ("variables", var), hists
+        else:
+            yield (key,), value
+
+
+def _shard_path(outdir, shard_key, index):
+    shard_hash = hashlib.sha1(repr(shard_key).encode()).hexdigest()[:16]
+    return os.path.join(outdir, f"{shard_hash}_{index}.coffea")
+
+
+def _tree_merge_split_task(files, outdir, index):
+    '''First level of the tree reduction: merge a group of output files, loaded one at a time,
+    and save the result in one file per shard (variable or top-level key).
+    Returns the list of (shard key, file) in order of appearance.'''
+    merged = {}
+    for f in files:
+        for shard_key, value in _shard_keys(load_input(f)):
+            if shard_key in merged:
+                merged[shard_key] = accumulate([merged[shard_key], value])
+            else:
+                merged[shard_key] = value
+    out = []
+    for shard_key, value in merged.items():
+        path = _shard_path(outdir, shard_key, index)
+        save((shard_key, value), path)
+        out.append((shard_key, path))
+    return out
+
+
+def _tree_merge_shard_task(files, outdir, index):
+    '''Following levels of the tree reduction: merge some files of the same shard.
+    Only the histograms of a single variable are in memory.'''
+    shard_key, result = load(files[0])
+    for f in files[1:]:
+        _, value = load(f)
+        result = accumulate([result, value])
+        del value
+    path = _shard_path(outdir, shard_key, index)
+    save((shard_key, result), path)
+    return shard_key, path
+
+
+def _save_streaming(output, filename):
+    '''Same format of coffea.util.save, but pickling directly to the compressed file
+    without keeping a copy of the serialized output in memory.'''
+    with lz4.frame.open(filename, "wb") as fout:
+        cloudpickle.dump(output, fout)
+
+
+def _shard_output(shard_key, value):
+    '''Part of the output stored in a shard.'''
+    if shard_key[0] == "variables" and len(shard_key) == 2:
+        return {"variables": {shard_key[1]: value}}
+    return {shard_key[0]: value}
+
+
+def merge_tree_reduction(output_files, N_reduction=5, cachedir="merge_cache", workers=4, verbose=False, output_file=None):
+    '''
+    Merge the output files with a tree reduction in a pool of processes.
+
+    The first level splits the input files in groups of N_reduction files, each merged by a worker,
+    and saves the result of each group as one file per histogram variable (and per other top-level key).
+    Then the files of each variable are merged N_reduction at a time, in parallel, until a single
+    file per variable is left: the memory used by each worker is bounded by N_reduction times
+    the histograms of one variable.
+
+    If `output_file` is set, the merged variables are appended one at a time to it as an indexed
+    output file (see `utils.indexed_output`) and None is returned: only the histograms of one
+    variable are in memory in the main process. Otherwise the variables are loaded one at a time to
+    build the merged output, which is returned (only the final output is fully in memory).
+    '''
+    output_files = list(output_files)
+    N_reduction = max(N_reduction, 2)
+    treedir = os.path.join(cachedir, "tree_merge")
+    os.makedirs(treedir, exist_ok=True)
+    shard_order = []
+    shards = {}
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool, Progress() as progress:
+            groups = [output_files[i:i + N_reduction] for i in range(0, len(output_files), N_reduction)]
+            leveldir = os.path.join(treedir, "level_0")
+            os.makedirs(leveldir, exist_ok=True)
+            task = progress.add_task("[cyan]Merging (level 0)...", total=len(output_files))
+            futures = [pool.submit(_tree_merge_split_task, group, leveldir, i)
+                       for i, group in enumerate(groups)]
+            nfiles = {future: len(group) for future, group in zip(futures, groups)}
+            for future in as_completed(futures):
+                progress.update(task, advance=nfiles[future])
+            # The results are collected in submission order, so that the merging order
+            # (and the floating point sums) does not depend on the scheduling
+            for future in futures:
+                group_result = future.result()
+                for shard_key, path in group_result:
+                    if shard_key not in shards:
+                        shard_order.append(shard_key)
+                        shards[shard_key] = []
+                    shards[shard_key].append(path)
+
+            level = 0
+            while any(len(paths) > 1 for paths in shards.values()):
+                level += 1
+                leveldir = os.path.join(treedir, f"level_{level}")
+                os.makedirs(leveldir, exist_ok=True)
+                to_merge = {k: paths for k, paths in shards.items() if len(paths) > 1}
+                ntasks = sum((len(paths) + N_reduction - 1) // N_reduction for paths in to_merge.values())
+                task = progress.add_task(f"[cyan]Merging (level {level})...", total=ntasks)
+                futures = []
+                for shard_key, paths in to_merge.items():
+                    for i in range(0, len(paths), N_reduction):
+                        futures.append(pool.submit(_tree_merge_shard_task, paths[i:i + N_reduction],
+                                                   leveldir, i // N_reduction))
+                for future in as_completed(futures):
+                    progress.update(task, advance=1)
+                for shard_key in to_merge:
+                    shards[shard_key] = []
+                for future in futures:
+                    shard_key, path = future.result()
+                    shards[shard_key].append(path)
+                if verbose:
+                    mem_usage = psutil.Process(os.getpid()).memory_info().rss / 1024**3
+                    print(f"Level {level} done. Current memory usage: {mem_usage:.3f} GB")
+
+        if output_file is not None:
+            # Stream the merged shards to the output file, one at a time
+            if os.path.exists(output_file):
+                os.remove(output_file)
+            with IndexedOutput(output_file, "a") as store:
+                for shard_key in shard_order:
+                    _, value = load(shards[shard_key][0])
+                    store.append(_shard_output(shard_key, value))
+                    store.clear_cache()
+                    del value
+            compact_indexed_output(output_file)
+            return None
+
+        # Build the final output loading one shard at a time
+        result = {}
+        for shard_key in shard_order:
+            _, value = load(shards[shard_key][0])
+            for key, val in _shard_output(shard_key, value).items():
+                if key == "variables":
+                    result.setdefault("variables", {}).update(val)
+                else:
+                    result[key] = val
+        return result
+    finally:
+        shutil.rmtree(treedir, ignore_errors=True)
+
+
 def process_failed(mark_failed, statusfile, job_dir, job_name, message="missing"):
     if mark_failed and statusfile:
         statusfilesuff = statusfile.split('/')[-1]
@@ -104,8 +274,25 @@ def append_configs(c1, c2):
             
     return c1
 
-def merge_outputs(inputfiles, outputfile, jobs_config=None, force=False, replace=False, N_reduction=5, max_mem_gb=None, cache_dir=None, verbose=False, skip_check=False, mark_failed=False, configurator=None, skip_initial_events_check_datasets=None):
-    '''Merge coffea output files'''
+def merge_outputs(inputfiles, outputfile, jobs_config=None, force=False, replace=False, N_reduction=5, max_mem_gb=None, cache_dir=None, verbose=False, skip_check=False, mark_failed=False, configurator=None, skip_initial_events_check_datasets=None, workers=None, indexed=False):
+    '''Merge coffea output files.
+    If `workers` is set, the files are merged with a parallel tree reduction
+    (see `merge_tree_reduction`) instead of the serial one bounded by `max_mem_gb`.
+    If `indexed` is set, the output is saved as an indexed output file (see `utils.indexed_output`):
+    explicit input files without postprocessing are merged in place in the output, one at a time,
+    or with `workers` streamed to it variable by variable by the tree reduction. The outputs to be
+    postprocessed (-cfg, jobs outputs) are fully built in memory before the postprocessing.'''
+    def merge_files(files, cachedir):
+        if workers:
+            return merge_tree_reduction(files, N_reduction=N_reduction, cachedir=cachedir,
+                                        workers=workers, verbose=verbose)
+        return merge_group_reduction(files, N_reduction=N_reduction, cachedir=cachedir,
+                                     max_mem_gb=max_mem_gb, verbose=verbose)
+
+    if indexed:
+        save_output = save_indexed_output
+    else:
+        save_output = _save_streaming if workers else save
     # Initialised so the "no inputs and no -jc" branch below can test it without
     # NameError (it is only assigned when a jobs_config is provided).
     job_config = None
@@ -144,7 +331,7 @@ def merge_outputs(inputfiles, outputfile, jobs_config=None, force=False, replace
         print(f"[red]Output file {outputfile} already exists. Use -f to overwrite it.")
         exit(1)
     
-    if max_mem_gb is None:
+    if max_mem_gb is None and not workers:
         max_mem_gb = psutil.virtual_memory().available / 1024 ** 3
         print(f"Setting max memory usage to {max_mem_gb:.1f} GB. Output will be split into smaller chunks if memory usage exceeds {mem_threshold*100:.0f}%.")
         print("[b]If you still see OOM kills, set a lower max memory with -m.[/]")
@@ -161,9 +348,9 @@ def merge_outputs(inputfiles, outputfile, jobs_config=None, force=False, replace
         type_mismatches = []
         # Load the reference file once instead of re-deserializing it for every
         # comparison (it was reloaded N-1 times, doubling I/O on large campaigns).
-        d0 = load(inputfiles[0])
+        d0 = load_input(inputfiles[0])
         for f in inputfiles[1:]:
-            type_mismatch_found = compare_dict_types(d0, load(f))
+            type_mismatch_found = compare_dict_types(d0, load_input(f))
             type_mismatches.append(type_mismatch_found)
         if any(type_mismatches):
             print("[red]Type mismatch found between the values of the input dictionaries for the following files:")
@@ -178,6 +365,27 @@ def merge_outputs(inputfiles, outputfile, jobs_config=None, force=False, replace
         if cache_dir is None:
             cache_dir = os.path.join(os.path.dirname(os.path.abspath(outputfile)), "merge_cache")
 
+        if indexed and configurator is None and not replace and workers:
+            # The merged variables are streamed to the output file by the tree reduction
+            merge_tree_reduction(inputfiles, N_reduction=N_reduction, cachedir=cache_dir,
+                                 workers=workers, verbose=verbose, output_file=outputfile)
+            print(f"[green]Output saved to {outputfile}")
+            return
+
+        if indexed and configurator is None and not replace:
+            # Only one input file and the merged records it touches are in memory at a time
+            if os.path.exists(outputfile):
+                os.remove(outputfile)
+            with IndexedOutput(outputfile, "a") as store, Progress() as progress:
+                task = progress.add_task("[cyan]Merging...", total=ninput)
+                for f in inputfiles:
+                    store.append(load_input(f))
+                    store.clear_cache()
+                    progress.update(task, advance=1)
+            compact_indexed_output(outputfile)
+            print(f"[green]Output saved to {outputfile}")
+            return
+
         if replace:
             if ninput < 2:
                 print("[red]--replace needs a base file plus at least one incoming file.[/]")
@@ -185,10 +393,9 @@ def merge_outputs(inputfiles, outputfile, jobs_config=None, force=False, replace
             base_file, incoming_files = inputfiles[0], list(inputfiles[1:])
             print(f"[blue]--replace: '{base_file}' is the base; {len(incoming_files)} "
                   f"incoming file(s) will replace overlapping datasets.[/]")
-            incoming_out = merge_group_reduction(incoming_files, N_reduction=N_reduction, cachedir=cache_dir,
-                                                 max_mem_gb=max_mem_gb, verbose=verbose)
+            incoming_out = merge_files(incoming_files, cache_dir)
             datasets_to_replace = get_datasets_in_output(incoming_out)
-            base_out = load(base_file)
+            base_out = load_input(base_file)
             base_datasets = get_datasets_in_output(base_out)
             replaced = sorted(datasets_to_replace & base_datasets)
             added    = sorted(datasets_to_replace - base_datasets)
@@ -199,8 +406,7 @@ def merge_outputs(inputfiles, outputfile, jobs_config=None, force=False, replace
             total_out = accumulate([base_out, incoming_out])
             del base_out, incoming_out
         else:
-            total_out =  merge_group_reduction(inputfiles, N_reduction=N_reduction, cachedir=cache_dir,
-                                               max_mem_gb=max_mem_gb, verbose=verbose)
+            total_out = merge_files(inputfiles, cache_dir)
 
         # Explicit-file merges are NOT postprocessed by default: their inputs are
         # assumed to be already-postprocessed outputs (e.g. per-dataset merged
@@ -223,7 +429,7 @@ def merge_outputs(inputfiles, outputfile, jobs_config=None, force=False, replace
         else:
             print("No configurator specified (-cfg); merging without postprocessing.")
 
-        save(total_out, outputfile)
+        save_output(total_out, outputfile)
         print(f"[green]Output saved to {outputfile}")
 
     else:
@@ -324,7 +530,7 @@ def merge_outputs(inputfiles, outputfile, jobs_config=None, force=False, replace
                 cache_dir = os.path.join(os.path.abspath(job_config['output_dir']), "merge_cache")
             if suff:
                 cache_dir += f"_{suff}"
-            total_output = merge_group_reduction(this_output_files, N_reduction=N_reduction, cachedir=cache_dir, max_mem_gb=max_mem_gb, verbose=verbose)
+            total_output = merge_files(this_output_files, cache_dir)
             
             # Since it was jobs, there was no postprocessing
             # we do it now after merging all the output
@@ -340,7 +546,7 @@ def merge_outputs(inputfiles, outputfile, jobs_config=None, force=False, replace
 
             # Save the output            
             print(f"[green]Saving output to {thisoutputfile}...[/]")
-            save(total_output, thisoutputfile)
+            save_output(total_output, thisoutputfile)
 
             del total_output
 
@@ -444,9 +650,27 @@ def merge_outputs(inputfiles, outputfile, jobs_config=None, force=False, replace
          "when a corrupted input file had to be skipped. Repeatable.",
 )
 
-def main(inputfiles, outputfile, jobs_config, force, replace, reduction, max_mem_gb, cache_dir, verbose, skip_check, mark_failed, configurator, skip_initial_events_check_datasets):
+@click.option(
+    "-w",
+    "--workers",
+    required=False,
+    type=int,
+    default=None,
+    help="Merge with a parallel tree reduction in a pool of WORKERS processes, merging -n files at a time "
+         "and each histogram variable separately: the memory is bounded by the histograms of one variable "
+         "per worker and a single output file is always produced. -m is ignored in this mode.",
+)
+
+@click.option(
+    "--indexed",
+    is_flag=True,
+    help="Save the output as an indexed output file, whose histograms can be read separately "
+         "(see the documentation). Input files merged without -cfg are appended in place to the output, one at a time.",
+)
+
+def main(inputfiles, outputfile, jobs_config, force, replace, reduction, max_mem_gb, cache_dir, verbose, skip_check, mark_failed, configurator, skip_initial_events_check_datasets, workers, indexed):
     '''Merge coffea output files'''
-    merge_outputs(inputfiles, outputfile, jobs_config, force, replace, reduction, max_mem_gb, cache_dir, verbose, skip_check, mark_failed, configurator, list(skip_initial_events_check_datasets))
+    merge_outputs(inputfiles, outputfile, jobs_config, force, replace, reduction, max_mem_gb, cache_dir, verbose, skip_check, mark_failed, configurator, list(skip_initial_events_check_datasets), workers=workers, indexed=indexed)
 
 if __name__ == "__main__":
     main()
@@ -4,9 +4,9 @@ import re
 import glob
 
 from omegaconf import OmegaConf
-from coffea.util import load
 
 from pocket_coffea.utils.plot_utils import PlotManager
+from pocket_coffea.utils.load_output import load_output
 from pocket_coffea.parameters import defaults
 from coffea.processor import accumulate 
 import click
@@ -44,13 +44,14 @@ import concurrent.futures
 @click.option('--index-file', type=str, help='Path of the index file to be copied recursively in the plots directory and its subdirectories', required=False, default=None)
 @click.option('--no-cache', is_flag=True, help='Do not cache the histograms for faster plotting', required=False, default=False)
 @click.option('--split-by-category', is_flag=True, help='If split-by-category was used during running and merging', required=False, default=False)
+@click.option('--plot-cache', is_flag=True, help='Redraw only the plots whose histograms or options changed since the previous run in the output folder', required=False, default=False)
 
 def make_plots(*args, **kwargs):
     return make_plots_core(*args, **kwargs)
 
 def make_plots_core(input_dir, cfg, overwrite_parameters, outputdir, inputfiles,
                workers, only_cat, only_year, only_syst, exclude_hist, only_hist, split_systematics, partial_unc_band, no_syst,
-               overwrite, log_x, log_y, density, verbose, format, systematics_shifts, no_ratio, no_systematics_ratio, compare, index_file, no_cache, split_by_category):
+               overwrite, log_x, log_y, density, verbose, format, systematics_shifts, no_ratio, no_systematics_ratio, compare, index_file, no_cache, split_by_category, plot_cache):
     '''Plot histograms produced by PocketCoffea processors'''
 
     if split_by_category: 
@@ -67,7 +68,7 @@ def make_plots_core(input_dir, cfg, overwrite_parameters, outputdir, inputfiles,
         for ifl, file in enumerate(all_files):
             make_plots_core(input_dir, cfg, overwrite_parameters, outputdir, [file],
                workers, only_cat, only_year, only_syst, exclude_hist, only_hist, split_systematics, partial_unc_band, no_syst,
-               overwrite or ifl > 0, log_x, log_y, density, verbose, format, systematics_shifts, no_ratio, no_systematics_ratio, compare, index_file, no_cache, False)
+               overwrite or ifl > 0, log_x, log_y, density, verbose, format, systematics_shifts, no_ratio, no_systematics_ratio, compare, index_file, no_cache, False, plot_cache)
             gc.collect()
 
         print("[green]Done making plots for all category-split files![/]")
@@ -112,30 +113,31 @@ def make_plots_core(input_dir, cfg, overwrite_parameters, outputdir, inputfiles,
         all_files.extend(valid_files)
     if not all_files: sys.exit("No valid input files found.")
 
+    def select_variable(variable):
+        if exclude_hist and any(re.search(p, variable) for p in exclude_hist):
+            return False
+        return not only_hist or any(re.search(p, variable) for p in only_hist)
+
     def load_single_file(file):
-        """Helper function to load a single file."""
+        """Helper function to load a single file.
+        Only the selected histograms are read from indexed output files."""
         print(f"[pink]Loading: {file}[/]")
-        return load(file)
+        return load_output(file, variables=select_variable, categories=only_cat or None, years=only_year or None)
     # Use ThreadPoolExecutor to load files concurrently
     with concurrent.futures.ThreadPoolExecutor() as executor:
         files = list(executor.map(load_single_file, all_files))
 
     if files: accumulator = accumulate(files)
 
-    if not overwrite:
+    if not overwrite and not plot_cache:
         if os.path.exists(outputdir):
             raise Exception(f"The output folder '{outputdir}' already exists. Please choose another output folder or run with the option `--overwrite`.")
 
     if not os.path.exists(outputdir):
         os.makedirs(outputdir)
 
-    variables = accumulator['variables'].keys()
-
-    if exclude_hist:
-        variables_to_exclude = [s for s in variables if any([re.search(p, s) for p in exclude_hist])]
-        variables = [s for s in variables if s not in variables_to_exclude]
-    if only_hist:
-        variables = [s for s in variables if any([re.search(p, s) for p in only_hist])]
+    # The histograms are already filtered with --only-hist and --exclude-hist by load_output
+    variables = list(accumulator['variables'].keys())
     hist_objs = { v : accumulator['variables'][v] for v in variables }
 
     plotter = PlotManager(
@@ -153,7 +155,8 @@ def make_plots_core(input_dir, cfg, overwrite_parameters, outputdir, inputfiles,
         verbose=verbose,
         save=True,
         index_file=index_file,
-        cache=not no_cache
+        cache=not no_cache,
+        plot_cache=plot_cache
     )
 
     print("Started plotting.  Please wait...")
@@ -0,0 +1,79 @@
+"""Print the hotspot report of the per-stage processing profile stored in a .coffea output.
+
+The profile is recorded by running with the `profile_processing` workflow option
+(see `pocket_coffea.utils.profiling`).
+
+Typical use:
+    pocket-coffea profile-report output_all.coffea
+    pocket-coffea profile-report output_all.coffea -s TTToSemiLeptonic --top 15
+    pocket-coffea profile-report output_all.coffea --merge-samples
+"""
+import click
+from coffea.util import load
+from rich import print as rprint
+from rich.table import Table
+from rich.console import Console
+
+from pocket_coffea.utils.profiling import PROFILE_OUTPUT_KEY, hotspot_table, merge_profiles
+
+
+def print_hotspot_table(console, title, profile, top=None):
+    table = Table(title=title)
+    table.add_column("Stage", style="cyan", no_wrap=True)
+    table.add_column("Calls", justify="right")
+    table.add_column("Wall [s]", justify="right", style="green")
+    table.add_column("% wall", justify="right", style="bold green")
+    table.add_column("CPU [s]", justify="right")
+    table.add_column("CPU/wall", justify="right")
+    table.add_column("RSS delta [MB]", justify="right", style="magenta")
+    table.add_column("Wall/event [us]", justify="right")
+    for row in hotspot_table(profile, top=top):
+        table.add_row(
+            row["stage"],
+            str(row["calls"]),
+            f"{row['walltime']:.2f}",
+            f"{100 * row['fraction']:.1f}",
+            f"{row['cputime']:.2f}",
+            f"{row['cputime'] / row['walltime']:.2f}" if row["walltime"] > 0 else "-",
+            f"{row['rss_delta']:+.1f}",
+            f"{row['us_per_event']:.1f}",
+        )
+    console.print(table)
+
+
+@click.command(name="profile-report")
+@click.argument("inputfile", type=click.Path(exists=True, dir_okay=False))
+@click.option("-s", "--sample", "samples", multiple=True,
+              help="Print only the requested samples (default: all)")
+@click.option("-n", "--top", type=int, default=None, help="Print only the N slowest stages")
+@click.option("--merge-samples", is_flag=True, help="Print a single report summing all the samples")
+def profile_report(inputfile, samples, top, merge_samples):
+    """Print the per-stage hotspot report of a .coffea output produced with
+    the `profile_processing` workflow option."""
+    console = Console()
+    output = load(inputfile)
+    profiles = output.get(PROFILE_OUTPUT_KEY, {})
+    if not profiles:
+        rprint(f"[red]No processing profile in {inputfile}: "
+               "run with the workflow option `profile_processing: True`[/]")
+        return
+    if samples:
+        missing = [s for s in samples if s not in profiles]
+        if missing:
+            rprint(f"[yellow]Samples not found in the profile: {missing}[/]")
+        profiles = {s: p for s, p in profiles.items() if s in samples}
+
+    if merge_samples:
+        profiles = {"all samples": merge_profiles(profiles.values())}
+
+    for sample, profile in sorted(profiles.items()):
+        print_hotspot_table(
+            console,
+            f"{sample}: {profile['chunks']} chunks, {profile['nevents']:_} events",
+            profile,
+            top=top,
+        )
+
+
+if __name__ == "__main__":
+    profile_report()
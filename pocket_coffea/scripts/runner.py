@@ -18,11 +18,19 @@ from coffea import processor
 from pocket_coffea.utils.configurator import Configurator
 from pocket_coffea.utils.utils import load_config, path_import, adapt_chunksize, save_failed_jobs, load_failed_jobs, FAILED_JOBS_FILENAME
 from pocket_coffea.utils.logging import setup_logging, try_and_log_error
-from pocket_coffea.utils.run import get_runner
+from pocket_coffea.utils.run import get_runner, clear_checkpoint
+from pocket_coffea.utils.worker_writers import flush_executor_writers
+from pocket_coffea.utils.file_metadata_cache import get_file_metadata_cache, default_file_metadata_cache_path
+from pocket_coffea.utils.adaptive_chunksize import (
+    ChunksizeProfile, CHUNKSIZE_PROFILE_FILENAME, get_chunksizes_from_run_options
+)
 from pocket_coffea.utils.time import wait_until
 from pocket_coffea.parameters import defaults as parameters_utils
 from pocket_coffea.executors import executors_base, executors_manual_jobs
 from pocket_coffea.utils.benchmarking import print_processing_stats
+from pocket_coffea.lib.lumi_mask_cache import update_golden_json_skiplist, remove_files_outside_golden_json
+
+GOLDEN_JSON_SKIPLIST_FILENAME = "files_outside_golden_json.json"
 
 @click.command(context_settings=dict(ignore_unknown_options=True, allow_extra_args=True))
 @click.option('--cfg', required=True, type=str,
@@ -65,11 +73,37 @@ from pocket_coffea.utils.benchmarking import print_processing_stats
                    "--recreate-jobs, also idempotently patches an existing jobs_dir so the "
                    "flag is honoured by the inner pocket-coffea call.")
 
+@click.option("--skip-files-outside-golden-json", is_flag=True, default=False,
+              help="Drop from the data filesets the files whose run range is entirely outside the "
+                   "golden JSON of their year, without processing them. The run range of each file "
+                   "is read from its small Runs tree once, and the resulting list is stored in the "
+                   "output folder (files_outside_golden_json.json) and reused by later runs.")
+@click.option("--checkpoint", is_flag=True, default=False,
+              help="Periodically save the partial output and the list of processed chunks in "
+                   "<outputdir>/checkpoints. If the run is interrupted, running again the same command "
+                   "processes only the missing chunks. The checkpoint is removed once the output is saved.")
+@click.option("--checkpoint-every", type=int, default=None,
+              help="Number of chunks processed between two checkpoints (used with --checkpoint), "
+                   "rounded up to a multiple of the executor workers. Default: 10 chunks per worker")
+@click.option("--metadata-cache", type=str, default=None,
+              help="SQLite file caching the number of entries and uuid of the input files, so that "
+                   "repeated runs do not open again all the files before processing. "
+                   "Default: file_metadata_cache.sqlite next to the first dataset json of the configuration.")
+@click.option("--no-metadata-cache", is_flag=True, default=False,
+              help="Do not use the persistent file metadata cache")
+@click.option("--adaptive-chunksize", is_flag=True, default=False,
+              help="Record the time and memory of each chunk in a per-sample profile persistent across runs "
+                   "(chunksize_profile.json next to the config file), and use it to derive the chunksize "
+                   "of each sample reaching the target time and memory per chunk "
+                   "(adaptive-chunksize-* run options). Also used by the manual-jobs executors splitting.")
+
 def run(cfg,  custom_run_options, outputdir, test, limit_files,
            limit_chunks, executor, scaleout, chunksize,
            queue, loglevel, process_separately, executor_custom_setup,
            filter_years, filter_samples, filter_datasets, resubmit_failed,
-           blocklist_sites, recreate_queue, use_redirector, skip_bad_files):
+           blocklist_sites, recreate_queue, use_redirector, skip_bad_files,
+           skip_files_outside_golden_json, checkpoint, checkpoint_every,
+           metadata_cache, no_metadata_cache, adaptive_chunksize):
     '''Run an analysis on NanoAOD files using PocketCoffea processors'''
     # Setting up the output dir
     os.makedirs(outputdir, exist_ok=True)
@@ -154,6 +188,9 @@ def run(cfg,  custom_run_options, outputdir, test, limit_files,
     if skip_bad_files:
         run_options["skip-bad-files"] = True
 
+    if adaptive_chunksize:
+        run_options["adaptive-chunksize"] = True
+
     #Parsing additional runoptions from command line in the format --option=value, or --option. 
     ctx = click.get_current_context()
     for arg in ctx.args:
@@ -231,6 +268,23 @@ def run(cfg,  custom_run_options, outputdir, test, limit_files,
         logging.info(f"Waiting until {run_options['starting-time']} to start processing")
         wait_until(run_options["starting-time"])
 
+    # Adaptive chunksize: per-sample chunksize from the measurements of the previous runs
+    chunksize_profile = None
+    chunksize_by_sample = {}
+    if run_options.get("adaptive-chunksize", False):
+        profile_path = run_options.get("adaptive-chunksize-profile", None)
+        if profile_path is None:
+            profile_path = os.path.join(os.path.dirname(os.path.abspath(cfg)), CHUNKSIZE_PROFILE_FILENAME)
+        chunksize_profile = ChunksizeProfile(profile_path)
+        chunksize_by_sample = get_chunksizes_from_run_options(chunksize_profile, run_options)
+        logging.info(f"Adaptive chunksize profile: {profile_path}")
+        for sample, sample_chunksize in chunksize_by_sample.items():
+            logging.info(f"Adaptive chunksize for sample {sample}: {sample_chunksize}")
+        # Used by the manual-jobs executors to resolve the chunksize of each job
+        run_options["adaptive-chunksize-by-sample"] = chunksize_by_sample
+        # Record the time and memory of each chunk in the output to update the profile
+        config.workflow_options["record_chunk_performance"] = True
+
     # Load the executor class from the lib and instantiate it
     executor_factory = executors_lib.get_executor_factory(executor_name, run_options=run_options, outputdir=outputdir)
     # Check the type of the executor_factory
@@ -271,6 +325,14 @@ def run(cfg,  custom_run_options, outputdir, test, limit_files,
         # Note: we will filter filesets_groups later after groups are constructed
         # since failed jobs refer to group names, not individual dataset names
 
+    if skip_files_outside_golden_json:
+        skiplist_file = os.path.join(outputdir, GOLDEN_JSON_SKIPLIST_FILENAME)
+        # Reused only for the datasets checked against the same golden JSON, updated for the others
+        files_to_skip = update_golden_json_skiplist(skiplist_file, filesets_to_run, config.parameters.lumi.goldenJSON)
+        n_skipped = sum(len(files) for files in files_to_skip.values())
+        logging.info(f"Skipping {n_skipped} data files outside the golden JSON (list in {skiplist_file})")
+        filesets_to_run = remove_files_outside_golden_json(filesets_to_run, files_to_skip)
+
     if len(filesets_to_run) == 0:
         print("No datasets to process, closing")
         exit(1)
@@ -286,6 +348,25 @@ def run(cfg,  custom_run_options, outputdir, test, limit_files,
     else:
         executor = executor_factory.get()
 
+    # Persistent cache of the files metadata (number of entries, uuid) used for the chunking
+    file_metadata_cache = None
+    if not no_metadata_cache:
+        if metadata_cache is None:
+            metadata_cache = default_file_metadata_cache_path(config.datasets_cfg.get("jsons", []))
+        if metadata_cache is not None:
+            logging.info(f"Using the file metadata cache {metadata_cache}")
+            file_metadata_cache = get_file_metadata_cache(metadata_cache)
+
+    chunksize_by_dataset = {
+        dataset: chunksize_by_sample[files["metadata"]["sample"]]
+        for dataset, files in filesets_to_run.items()
+        if files["metadata"]["sample"] in chunksize_by_sample
+    }
+
+    def update_chunksize_profile(output):
+        if chunksize_profile is not None and "chunk_performance" in output:
+            chunksize_profile.update(output["chunk_performance"])
+            chunksize_profile.save()
 
     start_time = time.time()
         
@@ -300,6 +381,7 @@ def run(cfg,  custom_run_options, outputdir, test, limit_files,
         if adapted_chunksize != run_options["chunksize"]:
             logging.info(f"Reducing chunksize from {run_options['chunksize']} to {adapted_chunksize} for datasets")
 
+        checkpoint_dir = os.path.join(outputdir, "checkpoints", "all") if checkpoint else None
         # Get the coffea Runner wrapped with error logging
         run = get_runner(
             executor=executor,
@@ -309,14 +391,23 @@ def run(cfg,  custom_run_options, outputdir, test, limit_files,
             schema=processor.NanoAODSchema,
             format="root",
             error_log_file=f"{outputdir}/error/run_all.err",
-            exit_on_error=True
+            exit_on_error=True,
+            checkpoint_dir=checkpoint_dir,
+            checkpoint_every=checkpoint_every,
+            metadata_cache=file_metadata_cache,
+            chunksize_by_dataset=chunksize_by_dataset,
         )
 
         output = run(filesets_to_run, treename="Events",
                      processor_instance=config.processor_instance)
+        # Write the outputs buffered in the workers (see utils.worker_writers)
+        flush_executor_writers(executor)
         
         print(f"Saving output to {outfile.format('all')}")
         save(output, outfile.format("all") )
+        if checkpoint_dir is not None:
+            clear_checkpoint(checkpoint_dir)
+        update_chunksize_profile(output)
         print_processing_stats(output, start_time, run_options["scaleout"])
 
     else:
@@ -372,6 +463,7 @@ def run(cfg,  custom_run_options, outputdir, test, limit_files,
             if adapted_chunksize != run_options["chunksize"]:
                 logging.info(f"Reducing chunksize from {run_options['chunksize']} to {adapted_chunksize} for dataset(s) {group_name}")
 
+            checkpoint_dir = os.path.join(outputdir, "checkpoints", group_name) if checkpoint else None
             # Get the coffea Runner wrapped with error logging
             run = get_runner(
                 executor=executor,
@@ -381,11 +473,16 @@ def run(cfg,  custom_run_options, outputdir, test, limit_files,
                 schema=processor.NanoAODSchema,
                 format="root",
                 error_log_file=f"{outputdir}/error/run_{group_name}.err",
-                exit_on_error=False # Continue to next dataset on error
+                exit_on_error=False, # Continue to next dataset on error
+                checkpoint_dir=checkpoint_dir,
+                checkpoint_every=checkpoint_every,
+                metadata_cache=file_metadata_cache,
+                chunksize_by_dataset=chunksize_by_dataset,
             )
 
             output = run(fileset_, treename="Events",
                          processor_instance=config.processor_instance)
+            flush_executor_writers(executor)
             if output is None:
                 logging.error(f"Processing of dataset {group_name} failed, moving to the next one")
                 failed_jobs_list.append(group_name)
@@ -393,6 +490,9 @@ def run(cfg,  custom_run_options, outputdir, test, limit_files,
             else:
                 print(f"Saving output to {outfile.format(group_name)}")
                 save(output, outfile.format(group_name))
+                if checkpoint_dir is not None:
+                    clear_checkpoint(checkpoint_dir)
+                update_chunksize_profile(output)
                 print_processing_stats(output, dataset_start_time, run_options["scaleout"])
 
         # Save the list of failed jobs
@@ -3,6 +3,28 @@ from coffea.util import load, save
 import click
 from rich import print
 from pocket_coffea.utils.filter_output import filter_output_by_year, filter_output_by_category
+from pocket_coffea.lib.sparse_hist import densify
+from pocket_coffea.utils.indexed_output import IndexedOutput, is_indexed_output, save_indexed_output
+
+
+def split_indexed_output(inputfile, outputfile, by, ncategory_per_file, overwrite):
+    '''Split an indexed output file: only the records of each part are read to write it.'''
+    with IndexedOutput(inputfile) as store:
+        if by == "year":
+            years = list(store.resolve(store.index["datasets_metadata"])["by_datataking_period"].keys())
+            parts = {outputfile.format(year): dict(years=[year]) for year in years}
+        elif by == "category" or by == "categories":
+            allcategories = sorted(list(store.index["sumw"].keys()))
+            categoryblocks = [allcategories[i:i+ncategory_per_file] for i in range(0, len(allcategories), ncategory_per_file)]
+            parts = {outputfile.format(f"category{ib}"): dict(categories=block) for ib, block in enumerate(categoryblocks)}
+        print(f"[blue]Splitting output by {by}. {len(parts)} output files will be saved:[/]")
+        print(sorted(parts.keys()))
+        for thisoutput, selection in parts.items():
+            if os.path.exists(thisoutput) and not overwrite:
+                raise FileExistsError(f"Output file {thisoutput} already exists. Use --overwrite to overwrite the output files.")
+            save_indexed_output(store.read(**selection), thisoutput)
+            store.clear_cache()
+            print(f"[green]Output saved to {thisoutput}")
 
 def split_output(inputfile, outputfile, by, ncategory_per_file, overwrite):
     '''Split coffea output files'''
@@ -10,8 +32,12 @@ def split_output(inputfile, outputfile, by, ncategory_per_file, overwrite):
         outputfile = inputfile.replace(".coffea", "_{}.coffea")
     else:
         outputfile = outputfile.replace(".coffea", "_{}.coffea")
+    if is_indexed_output(inputfile):
+        split_indexed_output(inputfile, outputfile, by, ncategory_per_file, overwrite)
+        return
     print(f"[blue]Reading input file: {inputfile}")
-    out_all = load(inputfile)
+    # Sparse histograms are converted to hist.Hist to be sliced by category
+    out_all = densify(load(inputfile))
 
     if by == "year":
         years = list(out_all["datasets_metadata"]["by_datataking_period"].keys())
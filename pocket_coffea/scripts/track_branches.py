@@ -0,0 +1,48 @@
+"""Record the NanoAOD branches read by the workflow of a configuration.
+
+The processor of the configuration is run on a few chunks of each dataset and the branches it
+reads are saved in a JSON file, to be passed to the skimming run with the
+``skim_branches_usage`` workflow option (see `pocket_coffea.utils.column_usage`).
+
+Typical use (with the configuration of the analysis running on the skimmed files):
+    pocket-coffea track-branches --cfg config.py -o branches_usage.json -lf 1 -lc 2 -c 2000
+"""
+import click
+from rich import print
+
+from pocket_coffea.utils.utils import load_config
+from pocket_coffea.utils.column_usage import record_branches_usage, save_branches_usage
+
+
+@click.command(name="track-branches")
+@click.option("--cfg", required=True, type=str, help="Config file of the analysis reading the skimmed files")
+@click.option("-o", "--output", type=str, default="branches_usage.json", help="Output JSON file")
+@click.option("-lf", "--limit-files", type=int, default=1, help="Number of files per dataset to process")
+@click.option("-lc", "--limit-chunks", type=int, default=2, help="Number of chunks per file to process")
+@click.option("-c", "--chunksize", type=int, default=1000, help="Number of events per chunk")
+@click.option("--filter-datasets", type=str, help="Track only these datasets (comma separated list)")
+def track_branches(cfg, output, limit_files, limit_chunks, chunksize, filter_datasets):
+    """Record the NanoAOD branches read by the workflow of a configuration."""
+    config = load_config(cfg, save_config=False)
+    if config.save_skimmed_files:
+        # The full analysis must run to record the branches it reads
+        print("[yellow]save_skimmed_files is disabled to track the full processing[/]")
+        config.save_skimmed_files = False
+    filesets = config.filesets
+    if filter_datasets:
+        filesets = {d: f for d, f in filesets.items() if d in filter_datasets.split(",")}
+    usage = record_branches_usage(
+        config.processor_instance,
+        filesets,
+        chunksize=chunksize,
+        limit_files=limit_files,
+        limit_chunks=limit_chunks,
+    )
+    branches = save_branches_usage(usage, output)
+    for dataset, dataset_branches in usage.items():
+        print(f"{dataset}: {len(dataset_branches)} branches")
+    print(f"[green]{len(branches)} branches saved to {output}[/]")
+
+
+if __name__ == "__main__":
+    track_branches()
@@ -0,0 +1,160 @@
+"""Adaptive per-sample chunk sizing from the measured processing throughput.
+
+With the ``record_chunk_performance`` workflow option the processor stores in the output,
+for each processed chunk, the number of events, the wall time measured by the same
+start/stop times used by ``save_processing_metadata``, the resident memory at the start
+of the chunk and the peak resident memory reached while processing it:
+
+    output["chunk_performance"][sample] = [[nevents, walltime, rss_start, rss_peak], ...]
+
+(memory in MB, ``rss_peak`` is None if the process peak memory was reached in an earlier chunk
+and the peak of this chunk is therefore unknown).
+
+The ``ChunksizeProfile`` stores these measurements in a JSON file, persistent across runs,
+and derives for each sample the chunksize hitting a target wall time and memory per chunk.
+The runner uses it with the ``--adaptive-chunksize`` option, both for the executors running
+the chunks directly and for the splitting of the manual-jobs executors.
+"""
+import os
+import sys
+import json
+import time
+import resource
+
+import numpy as np
+
+CHUNKSIZE_PROFILE_FILENAME = "chunksize_profile.json"
+# Number of measurements kept per sample in the profile (the most recent ones)
+MAX_MEASUREMENTS_PER_SAMPLE = 500
+
+
+def get_peak_rss_mb():
+    '''Peak resident memory of the current process in MB.'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def get_rss_mb():
+    '''Current resident memory of the current process in MB.'''
+    import psutil
+    return psutil.Process(os.getpid()).memory_info().rss / 1024**2
+
+
+class ChunkPerformanceRecorder:
+    '''Measure the wall time and the memory usage of the processing of a chunk.
+
+    The recorder is started at the beginning of the chunk processing and ``measurement``
+    returns the record to be saved in the output once the processing is done.'''
+
+    def __init__(self, start_time=None):
+        self.start_time = start_time if start_time is not None else time.time()
+        self.rss_start = get_rss_mb()
+        self.peak_start = get_peak_rss_mb()
+
+    def measurement(self, nevents, stop_time=None):
+        stop_time = stop_time if stop_time is not None else time.time()
+        peak = get_peak_rss_mb()
+        # If the process peak did not grow, the peak of this chunk is not known
+        rss_peak = peak if peak > self.peak_start else None
+        return [int(nevents), stop_time - self.start_time, self.rss_start, rss_peak]
+
+
+def parse_memory_mb(value):
+    '''Convert a memory specification ("2GB", "1500MB", 2000) to MB.'''
+    if isinstance(value, (int, float)):
+        return float(value)
+    value = str(value).strip().upper()
+    for unit, factor in (("GB", 1024.), ("MB", 1.), ("KB", 1 / 1024.), ("G", 1024.), ("M", 1.)):
+        if value.endswith(unit):
+            return float(value[: -len(unit)]) * factor
+    return float(value)
+
+
+def derive_chunksize(measurements, target_time, target_memory=None,
+                     min_chunksize=1000, max_chunksize=1_000_000):
+    '''
+    Derive the chunksize reaching the target wall time (seconds) and memory (MB) per chunk.
+
+    The time per event is the median over the measured chunks, while the memory per event
+    is the largest measured one (chunks with known peak memory), on top of the median
+    memory used by the worker before starting the chunk: the result is the smallest of
+    the two chunksizes, rounded to 1000 events and clipped to [min_chunksize, max_chunksize].
+    Returns None if there are no usable measurements.
+    '''
+    m = [x for x in measurements if x[0] > 0]
+    if not m:
+        return None
+    nevents = np.array([x[0] for x in m], dtype=np.float64)
+    walltime = np.array([x[1] for x in m], dtype=np.float64)
+    candidates = []
+    time_per_event = np.median(walltime / nevents)
+    if time_per_event > 0:
+        candidates.append(target_time / time_per_event)
+    if target_memory is not None:
+        with_peak = [x for x in m if x[3] is not None]
+        if with_peak:
+            base = np.median([x[2] for x in m])
+            mem_per_event = max((x[3] - x[2]) / x[0] for x in with_peak)
+            if mem_per_event > 0:
+                candidates.append(max(target_memory - base, 0.) / mem_per_event)
+    if not candidates:
+        return None
+    chunksize = int(round(min(candidates), -3))
+    return int(np.clip(chunksize, min_chunksize, max_chunksize))
+
+
+class ChunksizeProfile:
+    '''
+    Per-sample chunk performance measurements, persisted in a JSON file.
+
+    The file contains for each sample the list of measurements (see the module documentation)
+    and the chunksize derived at the last update, for reference.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.samples = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.samples = json.load(f)
+
+    def update(self, chunk_performance):
+        '''Add the measurements of an output `chunk_performance` dictionary (sample -> list).'''
+        for sample, measurements in chunk_performance.items():
+            entry = self.samples.setdefault(sample, {"measurements": []})
+            entry["measurements"] = (entry["measurements"] + [list(x) for x in measurements])[
+                -MAX_MEASUREMENTS_PER_SAMPLE:
+            ]
+
+    def get_chunksizes(self, target_time, target_memory=None, min_chunksize=1000, max_chunksize=1_000_000):
+        '''Return the dictionary sample -> derived chunksize for the samples with measurements.'''
+        out = {}
+        for sample, entry in self.samples.items():
+            chunksize = derive_chunksize(entry["measurements"], target_time, target_memory,
+                                         min_chunksize, max_chunksize)
+            if chunksize is not None:
+                entry["chunksize"] = chunksize
+                out[sample] = chunksize
+        return out
+
+    def save(self):
+        folder = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(folder, exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.samples, f, indent=1)
+        os.replace(tmp, self.path)
+
+
+def get_chunksizes_from_run_options(profile, run_options):
+    '''Derive the per-sample chunksizes with the adaptive-chunksize-* run options.'''
+    target_memory = run_options.get("adaptive-chunksize-target-memory", None)
+    if target_memory is None:
+        target_memory = run_options.get("mem-per-worker", None)
+    return profile.get_chunksizes(
+        target_time=float(run_options["adaptive-chunksize-target-time"]),
+        target_memory=parse_memory_mb(target_memory) if target_memory is not None else None,
+        min_chunksize=int(run_options["adaptive-chunksize-min"]),
+        max_chunksize=int(run_options["adaptive-chunksize-max"]),
+    )
@@ -0,0 +1,79 @@
+"""Tracking of the NanoAOD branches read by a workflow, to prune the skimmed files.
+
+`record_branches_usage` runs the processor of a configuration on a few chunks of each dataset,
+with NanoEvents recording every branch that is materialized (the `access_log` of the
+NanoEventsFactory). The list of branches is saved in a JSON file with
+`save_branches_usage` (or with ``pocket-coffea track-branches``) and passed to the skimming
+run with the ``skim_branches_usage`` workflow option: only those branches, and the ones in the
+``skim_keep_branches`` option, are written in the skimmed files (see `utils.skim.uproot_writeable`).
+
+N.B.: only the branches read on the tracked chunks are recorded. Branches read only for some
+datasets, data-taking periods or rare events must be tracked on those datasets or added to
+``skim_keep_branches``.
+"""
+import json
+import uuid
+import logging
+from functools import lru_cache
+
+import uproot
+from coffea.nanoevents import NanoEventsFactory, NanoAODSchema
+
+
+def record_branches_usage(processor_instance, filesets, chunksize=1000, limit_files=1, limit_chunks=2,
+                          treename="Events", schemaclass=NanoAODSchema):
+    '''Run `processor_instance.process` on the first `limit_chunks` chunks of `chunksize` events
+    of the first `limit_files` files of each dataset of `filesets` ({dataset: {"files": [...],
+    "metadata": {...}}}) and return the sorted list of branches read for each dataset.'''
+    usage = {}
+    for dataset, fileset in filesets.items():
+        accessed = set()
+        for filename in fileset["files"][:limit_files]:
+            with uproot.open(filename) as f:
+                nentries = f[treename].num_entries
+                fileuuid = str(uuid.UUID(bytes=f.file.fUUID))
+            for ichunk in range(limit_chunks):
+                start = ichunk * chunksize
+                if start >= nentries:
+                    break
+                stop = min(start + chunksize, nentries)
+                metadata = {
+                    "dataset": dataset,
+                    "filename": filename,
+                    "treename": treename,
+                    "entrystart": start,
+                    "entrystop": stop,
+                    "fileuuid": fileuuid,
+                }
+                metadata.update(fileset.get("metadata", {}))
+                access_log = []
+                events = NanoEventsFactory.from_root(
+                    filename,
+                    treepath=treename,
+                    entry_start=start,
+                    entry_stop=stop,
+                    schemaclass=schemaclass,
+                    metadata=metadata,
+                    access_log=access_log,
+                ).events()
+                processor_instance.process(events)
+                accessed.update(access_log)
+        logging.info(f"Dataset {dataset}: {len(accessed)} branches read")
+        usage[dataset] = sorted(accessed)
+    return usage
+
+
+def save_branches_usage(usage, fileout):
+    '''Save the branches read by the workflow: the union over the datasets is stored in the
+    `branches` key, the lists of each dataset in `by_dataset`.'''
+    branches = sorted(set().union(*usage.values()))
+    with open(fileout, "w") as f:
+        json.dump({"branches": branches, "by_dataset": usage}, f, indent=2)
+    return branches
+
+
+@lru_cache(maxsize=8)
+def load_branches_usage(path):
+    '''Load the list of branches saved by `save_branches_usage` (cached in each process).'''
+    with open(path) as f:
+        return tuple(json.load(f)["branches"])
@@ -6,7 +6,6 @@ from collections import defaultdict
 from multiprocessing import Pool
 from functools import partial
 import subprocess
-import requests
 import parsl
 import uproot
 from parsl import python_app
@@ -17,8 +16,8 @@ from concurrent.futures import ThreadPoolExecutor as TPE
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-from .network import get_proxy_path
-from . import rucio
+from .file_metadata_cache import get_file_metadata_cache
+from .dataset_discovery import DatasetDiscovery, DEFAULT_DISCOVERY_CACHE_TTL
 
 def do_dataset(
     key,
@@ -30,6 +29,8 @@ def do_dataset(
     prioritylist_sites,
     regex_sites,
     sort_replicas: str = "geoip",
+    metadata_cache=None,
+    discovery=None,
     **kwargs,
 ):
     print("*" * 40)
@@ -53,6 +54,8 @@ def do_dataset(
                 "regex_sites": regex_sites,
             },
             sort_replicas=sort_replicas,
+            metadata_cache=metadata_cache,
+            discovery=discovery,
         )
     except:
         raise Exception(f"Error getting info about dataset: {key}")
@@ -75,12 +78,40 @@ def build_datasets(
     regex_sites=None,
     sort_replicas="geoip",
     parallelize=4,
+    metadata_cache=None,
+    max_concurrency=16,
+    discovery_cache=None,
+    discovery_cache_ttl=DEFAULT_DISCOVERY_CACHE_TTL,
 ):
     config = json.load(open(cfg))
 
     if not keys:
         keys = config.keys()
 
+    # Query DBS and Rucio for all the DAS names at once, before building the datasets
+    discovery = DatasetDiscovery(
+        max_workers=max_concurrency,
+        cache=discovery_cache,
+        ttl=discovery_cache_ttl,
+        sites_cfg={
+            "allowlist_sites": allowlist_sites,
+            "include_redirector": include_redirector,
+            "blocklist_sites": blocklist_sites,
+            "prioritylist_sites": prioritylist_sites,
+            "regex_sites": regex_sites,
+        },
+        sort_replicas=sort_replicas,
+    )
+    discovery.prefetch(
+        [
+            (das_name, scfg.get("dbs_instance", "prod/global"))
+            for key in keys if key in config
+            for scfg in config[key]["files"]
+            for das_name in scfg["das_names"]
+            if not das_name.startswith("root://")
+        ]
+    )
+
     args = {
         "config": config,
         "overwrite": overwrite,
@@ -95,6 +126,8 @@ def build_datasets(
         "regex_sites": regex_sites,
         "parallelize": parallelize,
         "sort_replicas": sort_replicas,
+        "metadata_cache": metadata_cache,
+        "discovery": discovery,
     }
     
     if parallelize == 1:
@@ -121,6 +154,8 @@ class Sample:
         metadata,
         sites_cfg,
         sort_replicas: str = "geoip",
+        metadata_cache=None,
+        discovery=None,
         **kwargs,
     ):
         """Represent a single analysis sample.
@@ -133,6 +168,10 @@ class Sample:
          -- isMC: true/false
          -- era: A/B/C/D (only for data)
         - sites_cfg is a dictionary contaning allowlist, blocklist, prioritylist and regex to filter the SITES
+        - metadata_cache is the path of the FileMetadataCache storing the number of entries of the files
+          read with uproot (privately produced samples), None to disable it.
+        - discovery is the DatasetDiscovery engine used for the DBS and Rucio queries (possibly
+          already run on the DAS names of the sample); by default a new one without cache.
         """
         self.name = name
         self.das_names = das_names
@@ -149,18 +188,22 @@ class Sample:
         self.parentslist = []
         self.sites_cfg = sites_cfg
         self.sort_replicas: str = sort_replicas
+        self.metadata_cache = metadata_cache
 
         print(
             f">> Query for sample: {self.metadata['sample']},  das_name: {self.metadata['das_names']}"
         )
-        self.get_filelist()
+        self.get_filelist(discovery)
 
-    def get_filelist(self):
+    def get_filelist(self, discovery=None):
         '''Function to get the dataset filelist from DAS and from Rucio.
         From DAS we get the general info about the dataset (event count, file size),
         whereas from rucio we get the specific path at the sites without the redirector
         (it helps with xrootd access in coffea).
+        The queries are done by the `discovery` engine (see `utils.dataset_discovery`).
         '''
+        if discovery is None:
+            discovery = DatasetDiscovery(max_workers=1, sites_cfg=self.sites_cfg, sort_replicas=self.sort_replicas)
         for das_name in self.das_names:
             if das_name.startswith("root://"):
                 # If it's a privately produced sample stored somewhere over xrootd
@@ -188,47 +231,18 @@ class Sample:
                 self.metadata["nevents"] += total_events 
                 continue
 
-            proxy = get_proxy_path()
-            if "dbs_instance" in self.metadata.keys():
-                link = f"https://cmsweb.cern.ch:8443/dbs/{self.metadata['dbs_instance']}/DBSReader/files?dataset={das_name}&detail=True"
-            else:
-                link = f"https://cmsweb.cern.ch:8443/dbs/prod/global/DBSReader/files?dataset={das_name}&detail=True"
-
-            # print('\t Getting files for dataset: ', das_name)
-            r = requests.get(
-                link,
-                cert=proxy,
-                verify=False,
-            )
-            filesjson = r.json()
-            invalid_list = []
-            for fj in filesjson:
-                if 'is_file_valid' not in fj.keys():
-                    # print("fj=", fj)
-                    raise Exception(f"(probably) an Invalid dataset name provided for entry: {self}!")
-                else:
-                    if fj["is_file_valid"] == 0:
-                        #print(fj)
-                        print(f"\t WARNING: This file is Not Valid on DAS: {fj['logical_file_name']}")
-                        print("\t We are skipping it")
-                        invalid_list.append(fj['logical_file_name'])                        
-                        continue
-                        
-                    self.fileslist_redirector.append(fj['logical_file_name'])
-                    self.metadata["nevents"] += fj['event_count']
-                    self.metadata["size"] += fj['file_size']
+            result = discovery.discover(das_name, self.metadata.get("dbs_instance", "prod/global"))
+            for lfn in result["invalid"]:
+                print(f"\t WARNING: This file is Not Valid on DAS: {lfn}")
+                print("\t We are skipping it")
+            for fj in result["files"]:
+                self.fileslist_redirector.append(fj['logical_file_name'])
+                self.metadata["nevents"] += fj['event_count']
+                self.metadata["size"] += fj['file_size']
             if len(self.fileslist_redirector) == 0:
                 raise Exception(f"Found 0 files for sample {self}!")
 
-            if self.metadata.get("dbs_instance", "prod/global") == "prod/global":
-                # Now query rucio to get the concrete dataset passing the sites filtering options
-                files_replicas, sites, sites_counts = rucio.get_dataset_files_replicas(
-                    das_name, **self.sites_cfg, mode="first", sort=self.sort_replicas, invalid_list=invalid_list
-                )
-            else:
-                # Use DBS to get the site
-                files_replicas, sites = rucio.get_dataset_files_from_dbs(das_name, self.metadata["dbs_instance"])
-                
+            files_replicas = result["replicas"]
             self.fileslist_concrete += files_replicas
 
     # Function to build the sample dictionary
@@ -278,9 +292,21 @@ class Sample:
                 print(f"Missing file: {ff}")
 
     def get_entries_uproot(self,file_path):
-        """Queries a single file for the number of events."""
+        """Queries a single file for the number of events.
+        The result is read from (and stored in) the file metadata cache, if configured."""
+        cache = get_file_metadata_cache(self.metadata_cache) if self.metadata_cache else None
+        if cache is not None:
+            entry = cache.get_entry(file_path, "Events")
+            if entry is not None:
+                return entry["numentries"]
         try:
-            return next(uproot.num_entries(f"{file_path}:Events"))[-1]
+            with uproot.open(file_path) as file:
+                tree = file["Events"]
+                nentries = tree.num_entries
+                if cache is not None:
+                    cache.put_entry(file_path, "Events", numentries=nentries,
+                                    uuid=file.file.fUUID, branches=tree.keys(recursive=False))
+                return nentries
         except Exception as e:
             print(f"Error reading {file_path}: {e}")
             return 0
@@ -297,6 +323,8 @@ class Dataset:
         sites_cfg=None,
         sort_replicas: str = "geoip",
         append_parents=False,
+        metadata_cache=None,
+        discovery=None,
     ):
         self.cfg = cfg
         self.prefix = cfg.get("storage_prefix", None)
@@ -319,10 +347,11 @@ class Dataset:
         )
         self.sort_replicas = sort_replicas
         self.append_parents = append_parents
-        self.get_samples(self.cfg["files"])
+        self.metadata_cache = metadata_cache
+        self.get_samples(self.cfg["files"], discovery)
 
     # Function to build the dataset dictionary
-    def get_samples(self, files):
+    def get_samples(self, files, discovery=None):
         for scfg in files:
             if 'part' in scfg['metadata']:
                 sname = f"{self.name}_{scfg['metadata']['part']}_{scfg['metadata']['year']}"
@@ -341,6 +370,8 @@ class Dataset:
                 metadata=scfg["metadata"],
                 sites_cfg=self.sites_cfg,
                 sort_replicas=self.sort_replicas,
+                metadata_cache=self.metadata_cache,
+                discovery=discovery,
                 **kwargs,
             )
             self.samples_obj.append(sample)
@@ -0,0 +1,295 @@
+"""Concurrent discovery of the files of the CMS datasets from DBS and Rucio.
+
+For every DAS name ``build-datasets`` queries DBS for the list of files (with their number of
+events and size) and then Rucio for the replicas of the files at the sites. Done one DAS name
+after the other, rebuilding a large set of dataset definitions is dominated by the latency of
+these queries.
+
+The ``DatasetDiscovery`` engine runs the queries of all the DAS names of the requested datasets
+concurrently in a pool of threads (``max_workers`` at a time), sharing one HTTP session, whose
+connections to the DBS server are kept alive and reused by all the queries, and one Rucio
+client per thread. The responses are stored in an on-disk ``DiscoveryCache`` (SQLite, by default
+``dataset_discovery_cache.sqlite`` next to the dataset definition file) and reused by the
+following runs until they are older than the time-to-live of the cache.
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .network import get_proxy_path
+from . import rucio
+
+DBS_URL = "https://cmsweb.cern.ch:8443/dbs"
+DISCOVERY_CACHE_FILENAME = "dataset_discovery_cache.sqlite"
+# Details of the DBS files used (and cached)
+DBS_FILE_KEYS = ("logical_file_name", "is_file_valid", "event_count", "file_size")
+# Time-to-live of the cached responses, in seconds
+DEFAULT_DISCOVERY_CACHE_TTL = 24 * 3600
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT NOT NULL PRIMARY KEY,
+    created REAL NOT NULL,
+    value TEXT NOT NULL
+)
+"""
+
+
+class DiscoveryCache:
+    '''
+    SQLite-backed cache of the DBS and Rucio responses, as JSON values.
+    The entries older than ``ttl`` seconds are ignored (and replaced when queried again).
+
+    The connection is opened lazily and is not pickled, so that the cache can be shipped
+    to other processes.
+    '''
+
+    def __init__(self, path, ttl=DEFAULT_DISCOVERY_CACHE_TTL):
+        self.path = os.path.abspath(path)
+        self.ttl = ttl
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {"path": self.path, "ttl": self.ttl}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["ttl"])
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(_SCHEMA)
+            self._conn.commit()
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def get(self, key):
+        '''Return the cached value of `key`, None if missing or expired.'''
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT created, value FROM responses WHERE key=?", (key,)
+            ).fetchone()
+        if row is None or time.time() - row[0] > self.ttl:
+            return None
+        return json.loads(row[1])
+
+    def put(self, key, value):
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                (key, time.time(), json.dumps(value)),
+            )
+            self.conn.commit()
+
+
+def _hash_key(*parts):
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=list).encode()).hexdigest()
+
+
+class DatasetDiscovery:
+    '''
+    Engine querying DBS and Rucio for the files of CMS datasets.
+
+    - max_workers: maximum number of DAS names queried at the same time (and size of the
+      pool of HTTP connections to DBS)
+    - cache: DiscoveryCache or path of the cache file, None to disable the on-disk cache
+    - ttl: time-to-live in seconds of the cached responses, if `cache` is a path
+    - sites_cfg: allowlist/blocklist/prioritylist/regex of the sites for the Rucio replicas,
+      as for `rucio.get_dataset_files_replicas`
+    - sort_replicas: sorting of the Rucio replicas
+    - dbs_url: base url of the DBS servers
+    - proxy: path of the x509 proxy used for the DBS queries; by default the active one
+      (`network.get_proxy_path`). False to not send any client certificate.
+    - rucio_client_factory: function returning a new Rucio client, called once per thread
+    - sites_xrootd_prefix: xrootd prefix rules of the sites; by default read once with
+      `rucio.get_xrootd_sites_map`
+
+    The results of `discover` are kept in memory: `prefetch` runs the queries of many DAS names
+    concurrently, so that the following `discover` calls return immediately.
+    '''
+
+    def __init__(
+        self,
+        max_workers=16,
+        cache=None,
+        ttl=DEFAULT_DISCOVERY_CACHE_TTL,
+        sites_cfg=None,
+        sort_replicas="geoip",
+        dbs_url=DBS_URL,
+        proxy=None,
+        rucio_client_factory=None,
+        sites_xrootd_prefix=None,
+    ):
+        self.max_workers = max_workers
+        self.cache = DiscoveryCache(cache, ttl) if isinstance(cache, (str, os.PathLike)) else cache
+        self.sites_cfg = sites_cfg if sites_cfg else {}
+        self.sort_replicas = sort_replicas
+        self.dbs_url = dbs_url.rstrip("/")
+        self.proxy = proxy
+        self.rucio_client_factory = rucio_client_factory if rucio_client_factory else rucio.get_rucio_client
+        self.sites_xrootd_prefix = sites_xrootd_prefix
+        self.results = {}
+        self._session = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ("_session", "_local", "_lock"):
+            state.pop(key)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._session = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        '''HTTP session shared by the threads, keeping alive up to `max_workers` connections per host.'''
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=self.max_workers,
+                    pool_maxsize=self.max_workers,
+                    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504]),
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                proxy = get_proxy_path() if self.proxy is None else self.proxy
+                if proxy:
+                    session.cert = proxy
+                session.verify = False
+                self._session = session
+            return self._session
+
+    @property
+    def rucio_client(self):
+        '''Rucio client of the current thread.'''
+        if getattr(self._local, "rucio_client", None) is None:
+            self._local.rucio_client = self.rucio_client_factory()
+        return self._local.rucio_client
+
+    def get_sites_xrootd_prefix(self):
+        with self._lock:
+            if self.sites_xrootd_prefix is None:
+                self.sites_xrootd_prefix = rucio.get_xrootd_sites_map()
+            return self.sites_xrootd_prefix
+
+    def _cached(self, key, query):
+        if self.cache is not None:
+            value = self.cache.get(key)
+            if value is not None:
+                return value
+        value = query()
+        if self.cache is not None:
+            self.cache.put(key, value)
+        return value
+
+    def get_dbs_files(self, das_name, dbs_instance="prod/global"):
+        '''List of the files of a dataset in DBS, with their details (validity, event count, size).
+        Responses without the file details (e.g. a wrong dataset name) raise an exception and are not cached.'''
+        def query():
+            r = self.session.get(
+                f"{self.dbs_url}/{dbs_instance}/DBSReader/files",
+                params={"dataset": das_name, "detail": "True"},
+            )
+            r.raise_for_status()
+            files = []
+            for fj in r.json():
+                if "is_file_valid" not in fj:
+                    raise Exception(f"(probably) an Invalid dataset name provided: {das_name}!")
+                files.append({k: fj[k] for k in DBS_FILE_KEYS})
+            return files
+
+        return self._cached(f"dbs_files:{dbs_instance}:{das_name}", query)
+
+    def get_replicas(self, das_name, dbs_instance="prod/global", invalid_list=()):
+        '''List of the paths of the files of the dataset at the sites passing the sites filtering
+        options, from Rucio (first replica of each file), or from the DBS blocks for the datasets
+        not in the global DBS instance.'''
+        invalid_list = sorted(invalid_list)
+
+        def query():
+            if dbs_instance == "prod/global":
+                files, _, _ = rucio.get_dataset_files_replicas(
+                    das_name,
+                    **self.sites_cfg,
+                    mode="first",
+                    sort=self.sort_replicas,
+                    invalid_list=invalid_list,
+                    client=self.rucio_client,
+                    sites_xrootd_prefix=self.get_sites_xrootd_prefix(),
+                )
+            else:
+                files, _ = rucio.get_dataset_files_from_dbs(
+                    das_name,
+                    dbs_instance,
+                    session=self.session,
+                    dbs_url=self.dbs_url,
+                    sites_xrootd_prefix=self.get_sites_xrootd_prefix(),
+                )
+            return files
+
+        key = _hash_key("replicas", das_name, dbs_instance, self.sites_cfg, self.sort_replicas, invalid_list)
+        return self._cached(f"replicas:{key}", query)
+
+    def _discover(self, das_name, dbs_instance):
+        files, invalid = [], []
+        for fj in self.get_dbs_files(das_name, dbs_instance):
+            if fj["is_file_valid"] == 0:
+                invalid.append(fj["logical_file_name"])
+            else:
+                files.append({k: fj[k] for k in ("logical_file_name", "event_count", "file_size")})
+        replicas = self.get_replicas(das_name, dbs_instance, invalid) if files else []
+        return {"files": files, "invalid": invalid, "replicas": replicas}
+
+    def discover(self, das_name, dbs_instance="prod/global"):
+        '''Files of a dataset: returns a dictionary with the valid DBS files ("files", with
+        logical_file_name, event_count and file_size), the logical names of the invalid
+        ones ("invalid") and the paths of the replicas of the valid files ("replicas").
+        The exception raised by a query of `prefetch` is raised here.'''
+        key = (das_name, dbs_instance)
+        if key not in self.results:
+            try:
+                self.results[key] = self._discover(das_name, dbs_instance)
+            except Exception as e:
+                self.results[key] = e
+        result = self.results[key]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def prefetch(self, queries):
+        '''Run concurrently `discover` on a list of (das_name, dbs_instance).
+        The failures are reported and raised again by the `discover` call of the same DAS name.'''
+        queries = [q for q in dict.fromkeys(queries) if q not in self.results]
+        if not queries:
+            return
+        print(f"Querying DBS/Rucio for {len(queries)} DAS names ({self.max_workers} concurrent queries)")
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {q: executor.submit(self._discover, *q) for q in queries}
+            for q, future in futures.items():
+                try:
+                    self.results[q] = future.result()
+                except Exception as e:
+                    print(f"\t WARNING: query failed for {q[0]}: {e}")
+                    self.results[q] = e
@@ -9,6 +9,8 @@ import hist
 import uproot
 from coffea.util import load
 
+from pocket_coffea.lib.sparse_hist import densify
+
 
 def save_histogram_to_root(
     hist_dict: dict[str, dict[str, hist.Hist]],
@@ -75,7 +77,7 @@ def export_coffea_output_to_root(
     """
 
     # load coffea output, get variables histograms
-    histograms = load(coffea_output)["variables"]
+    histograms = densify(load(coffea_output)["variables"])
 
     # make sure all variables are present in the coffea output
     # remove variables that are not present in the coffea output
@@ -0,0 +1,224 @@
+"""Persistent on-disk cache of the per-file metadata of the filesets.
+
+Before processing any chunk, the coffea Runner opens every ROOT file of the fileset to read
+its number of entries and its uuid, and ``build-datasets`` reads the number of events of the
+privately produced samples file by file. For large filesets this means thousands of xrootd
+opens at every invocation.
+
+The ``FileMetadataCache`` stores in a SQLite file (by default ``file_metadata_cache.sqlite``
+next to the dataset definition) the number of entries, the uuid and, when available, the
+list of branches of each (file, tree). It is a mapping with the interface of the coffea
+``Runner.metadata_cache``, so that the Runner fills it during its preprocessing and reuses it
+in the following runs without opening the files again.
+
+The entries of local files are invalidated when the modification time or the size of the
+file change. Remote files (``root://``, ``davs://``...) are not stat-ed: they are assumed to be
+immutable, as the CMS logical file names are.
+"""
+import os
+import json
+import sqlite3
+import logging
+import threading
+import functools
+from collections.abc import MutableMapping
+
+FILE_METADATA_CACHE_FILENAME = "file_metadata_cache.sqlite"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    filename TEXT NOT NULL,
+    treename TEXT NOT NULL,
+    mtime REAL,
+    size INTEGER,
+    numentries INTEGER NOT NULL,
+    uuid TEXT,
+    branches TEXT,
+    clusters TEXT,
+    PRIMARY KEY (filename, treename)
+)
+"""
+
+
+def _file_signature(filename):
+    '''(mtime, size) of a local file, (None, None) for remote or missing files.'''
+    if "://" in filename and not filename.startswith("file://"):
+        return None, None
+    path = filename[len("file://"):] if filename.startswith("file://") else filename
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None, None
+    return stat.st_mtime, stat.st_size
+
+
+def _split_key(key):
+    '''Accept both a coffea FileMeta and a (filename, treename) tuple as key.'''
+    if isinstance(key, tuple):
+        return key
+    return key.filename, key.treename
+
+
+class FileMetadataCache(MutableMapping):
+    '''
+    SQLite-backed cache of the metadata of the (file, tree) of a fileset.
+
+    The mapping interface, keyed by coffea ``FileMeta`` objects (or (filename, treename)
+    tuples), returns the metadata dictionary used by the coffea Runner for the chunking:
+    ``{"numentries": ..., "uuid": ...}`` (plus ``"clusters"`` if stored), merged into the
+    metadata of the fileset carried by the ``FileMeta`` key, which the Runner replaces with
+    the returned dictionary. Only the per-file keys are stored in the cache.
+    The methods ``get_entry`` and ``put_entry`` give access to the full entry, including
+    the list of branches.
+
+    The connection is opened lazily and is not pickled, so that the object can be shipped
+    to other processes together with the Runner.
+    '''
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            # WAL allows concurrent readers while a process is writing
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(_SCHEMA)
+            self._conn.commit()
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def get_entry(self, filename, treename="Events"):
+        '''Return the cached entry of a (file, tree) as a dictionary with keys
+        numentries, uuid (bytes or None), branches (list or None), clusters (list or None).
+        None if the file is not in the cache or the local file changed since it was cached.'''
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT mtime, size, numentries, uuid, branches, clusters FROM files "
+                "WHERE filename=? AND treename=?",
+                (filename, treename),
+            ).fetchone()
+        if row is None:
+            return None
+        mtime, size, numentries, uuid, branches, clusters = row
+        if (mtime, size) != _file_signature(filename):
+            return None
+        return {
+            "numentries": numentries,
+            "uuid": bytes.fromhex(uuid) if uuid is not None else None,
+            "branches": json.loads(branches) if branches is not None else None,
+            "clusters": json.loads(clusters) if clusters is not None else None,
+        }
+
+    def put_entry(self, filename, treename="Events", numentries=None, uuid=None, branches=None, clusters=None):
+        '''Store the metadata of a (file, tree). Fields passed as None do not overwrite the
+        ones already cached for the same version of the file.'''
+        mtime, size = _file_signature(filename)
+        previous = self.get_entry(filename, treename)
+        if previous is not None:
+            uuid = uuid if uuid is not None else previous["uuid"]
+            branches = branches if branches is not None else previous["branches"]
+            clusters = clusters if clusters is not None else previous["clusters"]
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    filename,
+                    treename,
+                    mtime,
+                    size,
+                    int(numentries),
+                    bytes(uuid).hex() if uuid is not None else None,
+                    json.dumps(list(branches)) if branches is not None else None,
+                    json.dumps([int(c) for c in clusters]) if clusters is not None else None,
+                ),
+            )
+            self.conn.commit()
+
+    # Mapping interface used by the coffea Runner
+    def __getitem__(self, key):
+        filename, treename = _split_key(key)
+        entry = self.get_entry(filename, treename)
+        if entry is None or entry["uuid"] is None:
+            raise KeyError(key)
+        # coffea replaces the metadata of the FileMeta with the cached one: keep the
+        # metadata of the fileset (sample, year, isMC...) carried by the FileMeta key
+        metadata = dict(getattr(key, "metadata", None) or {})
+        metadata.update({"numentries": entry["numentries"], "uuid": entry["uuid"]})
+        if entry["clusters"] is not None:
+            metadata["clusters"] = entry["clusters"]
+        return metadata
+
+    def __setitem__(self, key, metadata):
+        filename, treename = _split_key(key)
+        self.put_entry(
+            filename,
+            treename,
+            numentries=metadata["numentries"],
+            uuid=metadata.get("uuid"),
+            clusters=metadata.get("clusters"),
+        )
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __delitem__(self, key):
+        filename, treename = _split_key(key)
+        with self._lock:
+            cursor = self.conn.execute(
+                "DELETE FROM files WHERE filename=? AND treename=?", (filename, treename)
+            )
+            self.conn.commit()
+        if cursor.rowcount == 0:
+            raise KeyError(key)
+
+    def __iter__(self):
+        with self._lock:
+            rows = self.conn.execute("SELECT filename, treename FROM files").fetchall()
+        return iter(rows)
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def __bool__(self):
+        # coffea skips the lookup of empty caches (`if cache and item in cache`):
+        # avoid counting all the rows for that
+        return True
+
+
+@functools.lru_cache(maxsize=None)
+def get_file_metadata_cache(path):
+    '''Return the FileMetadataCache at `path`, opened once per process.'''
+    return FileMetadataCache(path)
+
+
+def default_file_metadata_cache_path(dataset_files):
+    '''Default location of the cache: next to the first dataset definition/json file.
+    Returns None if the folder is not writable.'''
+    if not dataset_files:
+        return None
+    folder = os.path.dirname(os.path.abspath(dataset_files[0]))
+    if not os.access(folder, os.W_OK):
+        logging.warning(f"Folder {folder} not writable: the file metadata cache is disabled")
+        return None
+    return os.path.join(folder, FILE_METADATA_CACHE_FILENAME)
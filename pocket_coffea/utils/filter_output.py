@@ -1,6 +1,12 @@
 # Functions to filter the output dictionary by year
 
+import copy
 from collections import defaultdict
+from collections.abc import Mapping
+
+import hist
+
+from pocket_coffea.lib.sparse_hist import to_hist
 
 def filter_dictionary(d, string):
     d_filtered = {k : val for k,val in d.items() if string in k}
@@ -61,6 +67,120 @@ def filter_output_by_category(o, categories):
         o_filtered[key] = o[key]
     return o_filtered
 
+# Cutflow entries filled before the categorization, kept by any category selection
+CATEGORY_INDEPENDENT_CUTFLOW = ["initial", "skim", "presel"]
+
+def _as_predicate(selection):
+    if selection is None or callable(selection):
+        return selection
+    if isinstance(selection, str):
+        selection = [selection]
+    return set(selection).__contains__
+
+def _empty_like(d):
+    # Same container type (dict or defaultdict with its default factory), without items
+    out = copy.copy(d)
+    out.clear()
+    return out
+
+def _select_categories(h, categories):
+    h = to_hist(h)
+    if isinstance(h, hist.Hist) and "cat" in h.axes.name:
+        return h[{"cat": [cat for cat in h.axes["cat"] if categories(cat)]}]
+    return h
+
+def select_output(o, variables=None, categories=None, years=None, samples=None, datasets=None, resolve=None):
+    """Return the part of a coffea output selected by variable, category, data-taking period,
+    sample and dataset.
+
+    Each selection is either None (no selection), a name, a list of names or a predicate
+    on the name. The histograms are sliced on the `cat` axis, the sumw/sumw2/cutflow entries
+    of the other categories are dropped (the ones in CATEGORY_INDEPENDENT_CUTFLOW are kept).
+    The years and datasets selections drop the unselected datasets from the whole output,
+    the samples selection applies to the histograms, to the columns and to the
+    sumw/sumw2/cutflow entries.
+
+    `resolve` is applied to every node before reading it: it is used by the indexed output
+    files (see `utils.indexed_output`) to load only the records of the selected items.
+    The input output is not modified; the selected histograms are not copied.
+    """
+    if resolve is None:
+        resolve = lambda node: node
+    variables, categories, samples = map(_as_predicate, (variables, categories, samples))
+    years, datasets = _as_predicate(years), _as_predicate(datasets)
+
+    unselected = set()
+    if (years is not None or datasets is not None) and "datasets_metadata" in o:
+        for dataset, meta in resolve(o["datasets_metadata"])["by_dataset"].items():
+            if ((years is not None and not years(str(meta["year"])))
+                    or (datasets is not None and not datasets(dataset))):
+                unselected.add(dataset)
+
+    def materialize(node):
+        node = resolve(node)
+        if isinstance(node, Mapping):
+            out = _empty_like(node)
+            for k, val in node.items():
+                if k not in unselected:
+                    out[k] = materialize(val)
+            return out
+        if isinstance(node, (set, frozenset)) and unselected:
+            return node - unselected
+        return node
+
+    def keep(selection, key):
+        return selection is None or selection(key)
+
+    o = resolve(o)
+    o_selected = _empty_like(o)
+    for key, node in o.items():
+        node = resolve(node)
+        if key in ["variables", "processing_metadata"]:
+            o_selected[key] = _empty_like(node)
+            for var, by_sample in node.items():
+                if key == "variables" and not keep(variables, var):
+                    continue
+                by_sample = resolve(by_sample)
+                o_selected[key][var] = _empty_like(by_sample)
+                for sample, by_dataset in by_sample.items():
+                    if not keep(samples, sample):
+                        continue
+                    by_dataset = resolve(by_dataset)
+                    o_selected[key][var][sample] = _empty_like(by_dataset)
+                    for dataset, h in by_dataset.items():
+                        if dataset in unselected:
+                            continue
+                        h = resolve(h)
+                        if key == "variables" and categories is not None:
+                            h = _select_categories(h, categories)
+                        o_selected[key][var][sample][dataset] = h
+        elif key in ["sumw", "sumw2", "cutflow"]:
+            o_selected[key] = _empty_like(node)
+            for cat, by_dataset in node.items():
+                category_independent = cat in CATEGORY_INDEPENDENT_CUTFLOW
+                if not category_independent and not keep(categories, cat):
+                    continue
+                by_dataset = materialize(by_dataset)
+                if samples is not None and not category_independent:
+                    for dataset, by_sample in by_dataset.items():
+                        for sample in [s for s in by_sample if not samples(s)]:
+                            del by_sample[sample]
+                o_selected[key][cat] = by_dataset
+        elif key == "columns":
+            o_selected[key] = _empty_like(node)
+            for sample, by_dataset in node.items():
+                if keep(samples, sample):
+                    o_selected[key][sample] = materialize(by_dataset)
+        elif key == "datasets_metadata":
+            o_selected[key] = materialize(node)
+            if years is not None and "by_datataking_period" in o_selected[key]:
+                by_period = o_selected[key]["by_datataking_period"]
+                for year in [y for y in by_period if not years(str(y))]:
+                    del by_period[year]
+        else:
+            o_selected[key] = materialize(node)
+    return o_selected
+
 def get_datasets_in_output(o):
     """Return the set of dataset names present in a coffea output.
 
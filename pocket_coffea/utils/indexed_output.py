@@ -0,0 +1,255 @@
+"""Indexed output files, readable by parts.
+
+A .coffea file (`coffea.util.save`) is a single compressed pickle of the full output: reading one
+histogram means decompressing and unpickling all of them. An indexed output file is a zip
+archive (without zip compression) where each item of the output is an independently
+lz4-compressed cloudpickle record, as in `coffea.util.save`:
+
+- one record for each histogram of `variables` and `processing_metadata` (variable x sample x dataset);
+- one record for each category of `sumw`, `sumw2` and `cutflow`;
+- one record for each sample x dataset of `columns`;
+- one record for each other top-level key of the output.
+
+The index is the structure of the output (the same dict/defaultdict containers) with the
+records in place of the items, stored in the archive as well. The records of the selected
+items only are read by `IndexedOutput.read` (see `utils.filter_output.select_output` for the
+selections) and by the lazy mapping returned by `IndexedOutput.lazy`.
+
+`IndexedOutput.append` merges an output in the file in place, with `coffea.processor.accumulate`
+semantics: only the records of the items present in both are read, merged and written again
+(as new records at the end of the archive, followed by a new version of the index). The older
+versions of the records are left in the archive until `compact_indexed_output` is called.
+
+The indexed files are read by `utils.load_output.load_output` and written with
+`utils.load_output.save_output(..., indexed=True)` or ``merge-outputs --indexed``.
+"""
+import os
+import copy
+import zipfile
+from collections.abc import Mapping
+
+import lz4.frame
+import cloudpickle
+from coffea.processor.accumulator import add
+
+from pocket_coffea.utils.filter_output import select_output
+
+INDEXED_OUTPUT_VERSION = 1
+
+# Depth of the records in the top-level keys of the output (0: one record for the key)
+RECORDS_DEPTH = {
+    "variables": 3,
+    "processing_metadata": 3,
+    "sumw": 1,
+    "sumw2": 1,
+    "cutflow": 1,
+    "columns": 2,
+}
+
+
+class Record:
+    '''Placeholder of an item of the output stored in the record `name` of the archive.'''
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getstate__(self):
+        return self.name
+
+    def __setstate__(self, state):
+        self.name = state
+
+    def __repr__(self):
+        return f"Record({self.name})"
+
+
+def is_indexed_output(filename):
+    '''True if `filename` is an indexed output file (a .coffea file is a lz4 frame, not a zip archive).'''
+    return zipfile.is_zipfile(filename)
+
+
+def _empty_like(d):
+    out = copy.copy(d)
+    out.clear()
+    return out
+
+
+class IndexedOutput:
+    '''Indexed output file, opened for reading (mode "r"), to append to it (mode "a") or to
+    write a new one (mode "w").
+
+        with IndexedOutput("output_all.coffea") as out:
+            hists = out.read(variables=["jet_pt"], categories=["2jets"], years=["2018"])
+    '''
+
+    def __init__(self, filename, mode="r"):
+        if mode not in ("r", "a", "w"):
+            raise ValueError(f"Invalid mode {mode} for an indexed output file")
+        if mode == "a" and os.path.exists(filename) and not is_indexed_output(filename):
+            raise ValueError(f"{filename} is not an indexed output file: cannot append to it")
+        self.filename = filename
+        self.mode = mode
+        self._zip = zipfile.ZipFile(filename, mode, compression=zipfile.ZIP_STORED, allowZip64=True)
+        self._cache = {}
+        self._nrecords = 0
+        indices = sorted(n for n in self._zip.namelist() if n.startswith("index/"))
+        # Version of the next index (and of the records written with it)
+        self.version = int(indices[-1].split("/")[1]) + 1 if indices else 0
+        if indices:
+            index = self._read_entry(indices[-1])
+            if index["format_version"] > INDEXED_OUTPUT_VERSION:
+                raise ValueError(f"{filename} was written by a newer version of PocketCoffea")
+            self.index = index["output"]
+        else:
+            self.index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._zip.close()
+        self.clear_cache()
+
+    def clear_cache(self):
+        '''Release the records read so far.'''
+        self._cache.clear()
+
+    def _read_entry(self, name):
+        return cloudpickle.loads(lz4.frame.decompress(self._zip.read(name)))
+
+    def _write_entry(self, name, obj):
+        self._zip.writestr(name, lz4.frame.compress(cloudpickle.dumps(obj)))
+
+    def load_record(self, record):
+        '''Return the item stored in a `Record` (cached).'''
+        if record.name not in self._cache:
+            self._cache[record.name] = self._read_entry(record.name)
+        return self._cache[record.name]
+
+    def resolve(self, node):
+        return self.load_record(node) if isinstance(node, Record) else node
+
+    @property
+    def records(self):
+        '''Names of the records of the current version of the index.'''
+        def _walk(node):
+            if isinstance(node, Record):
+                yield node.name
+            elif isinstance(node, Mapping):
+                for value in node.values():
+                    yield from _walk(value)
+        return list(_walk(self.index)) if self.index is not None else []
+
+    def keys(self):
+        return self.index.keys() if self.index is not None else []
+
+    def read(self, variables=None, categories=None, years=None, samples=None, datasets=None):
+        '''Load the output, or only the selected part of it (see `utils.filter_output.select_output`):
+        only the records of the selected items are read.'''
+        if self.index is None:
+            raise ValueError(f"{self.filename} is empty")
+        return select_output(self.index, variables=variables, categories=categories, years=years,
+                             samples=samples, datasets=datasets, resolve=self.resolve)
+
+    def lazy(self):
+        '''Mapping over the output reading each record when accessed.'''
+        if self.index is None:
+            raise ValueError(f"{self.filename} is empty")
+        return LazyOutput(self, self.index)
+
+    def _split(self, value, depth):
+        if depth > 0 and isinstance(value, Mapping):
+            node = _empty_like(value)
+            for key, val in value.items():
+                node[key] = self._split(val, depth - 1)
+            return node
+        record = Record(f"records/{self.version:06d}/{self._nrecords}")
+        self._nrecords += 1
+        self._write_entry(record.name, value)
+        return record
+
+    def _merge(self, node, value, depth):
+        if isinstance(node, Record):
+            merged = add(self.load_record(node), value)
+            self._cache.pop(node.name, None)
+            return self._split(merged, 0)
+        if isinstance(node, Mapping) and isinstance(value, Mapping):
+            for key, val in value.items():
+                if key in node:
+                    node[key] = self._merge(node[key], val, depth - 1)
+                else:
+                    node[key] = self._split(val, depth - 1)
+            return node
+        raise ValueError(f"Cannot append {type(value)} to {type(node)} in {self.filename}")
+
+    def append(self, output):
+        '''Merge `output` into the file (the output is not modified).'''
+        if self.mode == "r":
+            raise ValueError(f"{self.filename} is opened read-only")
+        if self.index is None:
+            self.index = _empty_like(output)
+        for key, value in output.items():
+            depth = RECORDS_DEPTH.get(key, 0)
+            if key in self.index:
+                self.index[key] = self._merge(self.index[key], value, depth)
+            else:
+                self.index[key] = self._split(value, depth)
+        self._write_entry(f"index/{self.version:06d}",
+                          {"format_version": INDEXED_OUTPUT_VERSION, "output": self.index})
+        self.version += 1
+        self._nrecords = 0
+
+
+class LazyOutput(Mapping):
+    '''Read-only mapping over (a part of) an indexed output file: the records are read when accessed.'''
+
+    def __init__(self, store, node):
+        self._store = store
+        self._node = node
+
+    def __getitem__(self, key):
+        value = self._store.resolve(self._node[key])
+        if isinstance(value, Mapping):
+            return LazyOutput(self._store, value)
+        return value
+
+    def __iter__(self):
+        return iter(self._node)
+
+    def __len__(self):
+        return len(self._node)
+
+    def __repr__(self):
+        return f"LazyOutput({self._store.filename}, keys={list(self._node)})"
+
+    def materialize(self):
+        '''Read all the records below this node and return the plain output.'''
+        return select_output(self._node, resolve=self._store.resolve)
+
+
+def save_indexed_output(output, filename):
+    '''Save `output` in a new indexed output file.'''
+    with IndexedOutput(filename, "w") as store:
+        store.append(output)
+
+
+def append_indexed_output(output, filename):
+    '''Merge `output` into the indexed output file `filename` (created if it does not exist).'''
+    with IndexedOutput(filename, "a") as store:
+        store.append(output)
+
+
+def compact_indexed_output(filename):
+    '''Rewrite the file with only the records of the last version of the index.'''
+    tmpfile = f"{filename}.tmp"
+    with IndexedOutput(filename) as store, zipfile.ZipFile(tmpfile, "w", compression=zipfile.ZIP_STORED,
+                                                           allowZip64=True) as fout:
+        for name in store.records:
+            fout.writestr(name, store._zip.read(name))
+        fout.writestr(f"index/{store.version - 1:06d}", lz4.frame.compress(cloudpickle.dumps(
+            {"format_version": INDEXED_OUTPUT_VERSION, "output": store.index})))
+    os.replace(tmpfile, filename)
@@ -1,10 +1,41 @@
 import sys
 from pprint import pprint
-from coffea.util import load
+from coffea.util import load, save
 
+from pocket_coffea.utils.filter_output import select_output
+from pocket_coffea.utils.indexed_output import IndexedOutput, is_indexed_output, save_indexed_output
 
-def load_output(file):
-    return load(file)
+
+def load_output(file, variables=None, categories=None, years=None, samples=None, datasets=None, lazy=False):
+    '''Load a .coffea or an indexed output file (see `utils.indexed_output`).
+
+    The variables, categories, years, samples and datasets selections (see
+    `utils.filter_output.select_output`) read only the selected records of an indexed file;
+    a .coffea file is fully loaded before the selection.
+    With `lazy=True` an indexed file is returned as a mapping reading the records when accessed.
+    '''
+    selection = dict(variables=variables, categories=categories, years=years, samples=samples, datasets=datasets)
+    has_selection = any(s is not None for s in selection.values())
+    if is_indexed_output(file):
+        store = IndexedOutput(file)
+        if lazy:
+            if has_selection:
+                raise ValueError("The lazy loading of an output does not support selections")
+            return store.lazy()
+        with store:
+            return store.read(**selection)
+    out = load(file)
+    if has_selection:
+        out = select_output(out, **selection)
+    return out
+
+
+def save_output(output, file, indexed=False):
+    '''Save the output as a .coffea file or, if `indexed`, as an indexed output file.'''
+    if indexed:
+        save_indexed_output(output, file)
+    else:
+        save(output, file)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,91 @@
+"""Buffered writer of the column arrays exported with `dump_columns_as_arrays_per_chunk`.
+
+By default each chunk writes one parquet file per (subsample, category, variation). With the
+``dump_columns_buffer_size_mb`` workflow option the arrays are instead accumulated in the
+worker process, separately for each (dataset, subsample, category, variation) output folder,
+and written as a single large file when the buffer of the folder exceeds the threshold and
+when the worker process exits.
+
+The arrays of a chunk are staged in a dictionary local to the chunk (`begin_chunk`) while the
+chunk is processed and moved to the buffers only when the processing of the chunk is completed
+(`commit`), so that a failed (and retried) chunk does not leave duplicated rows and the chunks
+processed at the same time by several threads of a worker do not mix their arrays. The files
+are named ``coalesced-part-<worker>-<n>.parquet``: each output folder is a parquet dataset that
+can be read directly (e.g. with ``pyarrow.dataset``) and that ``pocket-coffea merge-columns``
+skips by default.
+
+The buffers are written by the runner at the end of the processing and before each checkpoint
+(see `utils.worker_writers`), and at the exit of the worker process. N.B.: the arrays of a
+worker killed abruptly before that are lost.
+"""
+import os
+import threading
+
+import awkward as ak
+
+from .utils import dump_ak_array
+from .worker_writers import get_worker_writer, new_worker_id
+
+COALESCED_PART_PREFIX = "coalesced-part-"
+
+
+class BufferedParquetWriter:
+    '''Accumulate awkward arrays per output folder and write them as large parquet files.
+
+    The output folders are identified by the list of subdirectories of `location`, as for
+    `dump_ak_array`. The arrays of a chunk are first staged with `stage()` in the dictionary
+    returned by `begin_chunk()`; `commit()` moves them to the buffers and writes the buffers
+    exceeding `buffer_size_mb`. The buffers are shared by the threads of the process.'''
+
+    def __init__(self, location, buffer_size_mb=256):
+        self.location = location
+        self.buffer_size = buffer_size_mb * 1024**2
+        self.worker_id = new_worker_id()
+        self._buffers = {}
+        self._buffer_bytes = {}
+        self._nfiles = 0
+        self._lock = threading.RLock()
+
+    def begin_chunk(self):
+        '''Return the staging dictionary of a new chunk.'''
+        return {}
+
+    @staticmethod
+    def stage(staging, subdirs, akarr):
+        if len(akarr) == 0:
+            return
+        staging.setdefault(tuple(subdirs), []).append(akarr)
+
+    def commit(self, staging):
+        '''Move the arrays staged by a completed chunk to the buffers and write the buffers above the threshold.'''
+        with self._lock:
+            for key, arrays in staging.items():
+                self._buffers.setdefault(key, []).extend(arrays)
+                self._buffer_bytes[key] = self._buffer_bytes.get(key, 0) + sum(a.nbytes for a in arrays)
+            staging.clear()
+            for key in [k for k, size in self._buffer_bytes.items() if size >= self.buffer_size]:
+                self._write(key)
+
+    def flush(self):
+        '''Write all the buffers.'''
+        with self._lock:
+            for key in list(self._buffers):
+                self._write(key)
+
+    def _write(self, key):
+        with self._lock:
+            arrays = self._buffers.pop(key)
+            self._buffer_bytes.pop(key)
+            akarr = arrays[0] if len(arrays) == 1 else ak.concatenate(arrays)
+            fname = f"{COALESCED_PART_PREFIX}{self.worker_id}-{self._nfiles:05d}.parquet"
+            self._nfiles += 1
+            dump_ak_array(akarr, fname, self.location, list(key))
+
+
+def get_buffered_writer(location, buffer_size_mb):
+    '''Return the writer of the current process for the location, creating it if needed.'''
+    return get_worker_writer(BufferedParquetWriter, location, buffer_size_mb)
+
+
+def is_coalesced_part(fname):
+    return os.path.basename(fname).startswith(COALESCED_PART_PREFIX)
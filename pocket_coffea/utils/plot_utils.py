@@ -1,4 +1,8 @@
 import os
+import copy
+import json
+import hashlib
+import multiprocessing
 from copy import deepcopy
 from multiprocessing import Pool
 from collections import defaultdict
@@ -22,6 +26,8 @@ from cycler import cycler
 
 from omegaconf import OmegaConf
 from pocket_coffea.parameters.defaults import merge_parameters, get_default_parameters
+from pocket_coffea.lib.sparse_hist import to_hist
+from pocket_coffea.__meta__ import __version__
 
 np.seterr(divide="ignore", invalid="ignore", over="ignore")
 
@@ -144,8 +150,36 @@ class Style:
                 "era" : "eras"
             }
 
+# PlotManager shared with the plotting processes forked by PlotManager.map_shapes
+_SHARED_PLOT_MANAGER = None
+
+
+def _run_shared_plot_manager(method, name, **kwargs):
+    return _SHARED_PLOT_MANAGER.run_plot(method, name, **kwargs)
+
+
+def _run_plot_manager(manager, method, name, **kwargs):
+    return manager.run_plot(method, name, **kwargs)
+
+
+def _hash_hist(hasher, h):
+    hasher.update(repr(h.axes).encode())
+    hasher.update(np.ascontiguousarray(h.view(flow=True)).tobytes())
+
+
 class PlotManager:
-    '''This class manages multiple Shape objects and their plotting.'''
+    '''This class manages multiple Shape objects and their plotting.
+
+    With `workers` > 1 the Shape objects are plotted in a pool of processes. Where available,
+    the processes are forked after the PlotManager is built and inherit it: each task only
+    carries the name of its Shape. Otherwise each task carries a copy of the PlotManager
+    restricted to its Shape.
+
+    With `plot_cache` the digest of the histograms and of the plotting options of each Shape is
+    stored, together with the list of its plots, in the `.plot_cache.json` file of `plot_dir`:
+    the plots of the Shape objects whose digest did not change are not redrawn.
+    '''
+    PLOT_CACHE_FILE = ".plot_cache.json"
 
     def __init__(
         self,
@@ -165,7 +199,8 @@ class PlotManager:
         verbose=1,
         save=True,
         index_file=None,
-        cache=True
+        cache=True,
+        plot_cache=False
     ) -> None:
 
         self.shape_objects = {}
@@ -182,6 +217,14 @@ class PlotManager:
         self.toplabel = toplabel
         self.verbose=verbose
         self.cache = cache
+        self.plot_cache = plot_cache and save
+        if self.plot_cache:
+            if OmegaConf.is_config(style_cfg):
+                style_repr = OmegaConf.to_yaml(style_cfg, resolve=True)
+            else:
+                style_repr = repr(style_cfg)
+            self._style_digest = hashlib.sha256(style_repr.encode()).hexdigest()
+            self._plot_cache_entries = self.load_plot_cache()
 
         # Reading the datasets_metadata to
         # build the correct shapes for each datataking year
@@ -197,7 +240,7 @@ class PlotManager:
                     hs[sample] = {}
                     for dataset in datasets:
                         try:
-                            hs[sample][dataset] = hist_objs[variable][sample][dataset]
+                            hs[sample][dataset] = to_hist(hist_objs[variable][sample][dataset])
                         except:
                             print(f"Warning: missing dataset {dataset} for variable {variable}, year {year}")
                     if len(hs[sample].keys()) == 0:
@@ -282,15 +325,7 @@ class PlotManager:
 
     def plot_datamc_all(self, ratio=True, syst=True,  spliteras=False, format="png"):
         '''Plots all the histograms contained in the dictionary, for all years and categories.'''
-        shape_names = list(self.shape_objects.keys())
-        if self.workers > 1:
-            with Pool(processes=self.workers) as pool:
-                # Parallel calls of plot_datamc() on different shape objects
-                pool.map(partial(self.plot_datamc, ratio=ratio, syst=syst, spliteras=spliteras, format=format), shape_names)
-                pool.close()
-        else:
-            for shape in shape_names:
-                self.plot_datamc(shape, ratio=ratio, syst=syst, spliteras=spliteras, format=format)
+        self.map_shapes("plot_datamc", ratio=ratio, syst=syst, spliteras=spliteras, format=format)
 
     def plot_comparison(self, name, ratio=True, format="png"):
         '''Plots one histogram, for all years and categories.'''
@@ -306,18 +341,13 @@ class PlotManager:
 
     def plot_comparison_all(self, ratio=True, format=format):
         '''Plots all the histograms contained in the dictionary, for all years and categories.'''
-        shape_names = list(self.shape_objects.keys())
-        if self.workers > 1:
-            with Pool(processes=self.workers) as pool:
-                pool.map(partial(self.plot_comparison, ratio=ratio, format=format), shape_names)
-                pool.close()
-        else:
-            for shape in shape_names:
-                self.plot_comparison(shape, ratio=ratio, format=format)
+        self.map_shapes("plot_comparison", ratio=ratio, format=format)
 
 
     def plot_systematic_shifts(self, shape, format="png", ratio=True):
         """Plots the systematic shifts for all the variations."""
+        if isinstance(shape, str):
+            shape = self.shape_objects[shape]
         if self.verbose > 0:
             print("Plotting systematic shifts for:", shape.name)
         if shape.dense_dim > 1:
@@ -335,17 +365,106 @@ class PlotManager:
 
     def plot_systematic_shifts_all(self, format="png", ratio=True):
         """Plots the systematic shifts for all the shape objects."""
-        if self.workers > 1:
+        self.map_shapes("plot_systematic_shifts", format=format, ratio=ratio)
+
+    def map_shapes(self, method, **kwargs):
+        '''Call the plotting `method` of the PlotManager on all the Shape objects,
+        in a pool of `workers` processes.'''
+        global _SHARED_PLOT_MANAGER
+        shape_names = list(self.shape_objects.keys())
+        if self.workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+            # The forked processes inherit the PlotManager: only the names are sent to them
+            _SHARED_PLOT_MANAGER = self
+            try:
+                with multiprocessing.get_context("fork").Pool(processes=self.workers) as pool:
+                    results = pool.map(partial(_run_shared_plot_manager, method, **kwargs), shape_names, chunksize=1)
+            finally:
+                _SHARED_PLOT_MANAGER = None
+        elif self.workers > 1:
             with Pool(processes=self.workers) as pool:
-                # Parallel calls of plot_systematic_shifts() on different shape objects
-                pool.map(
-                    partial(self.plot_systematic_shifts, format=format, ratio=ratio),
-                    self.shape_objects.values(),
+                # Each task carries only its own Shape object
+                results = pool.starmap(
+                    partial(_run_plot_manager, **kwargs),
+                    [(self.restricted_to(name), method, name) for name in shape_names],
+                    chunksize=1,
                 )
-                pool.close()
         else:
-            for shape in self.shape_objects.values():
-                self.plot_systematic_shifts(shape, format=format, ratio=ratio)
+            results = [self.run_plot(method, name, **kwargs) for name in shape_names]
+        if self.plot_cache:
+            self.update_plot_cache(results)
+
+    def restricted_to(self, name):
+        '''Shallow copy of the PlotManager with only the Shape object `name`.'''
+        manager = copy.copy(self)
+        manager.shape_objects = {name: self.shape_objects[name]}
+        if self.plot_cache:
+            manager._plot_cache_entries = {
+                k: v for k, v in self._plot_cache_entries.items() if k.split(":", 1)[1] == name
+            }
+        return manager
+
+    def run_plot(self, method, name, **kwargs):
+        '''Call the plotting `method` on the Shape object `name`, unless the plot cache is enabled
+        and its plots are up to date. Returns the key and the entry of the plot cache.'''
+        if not self.plot_cache:
+            getattr(self, method)(name, **kwargs)
+            return None
+        shape = self.shape_objects[name]
+        key = self.plot_cache_key(shape, method)
+        digest = self.shape_digest(shape, method, kwargs)
+        entry = self._plot_cache_entries.get(key)
+        if entry is not None and entry["digest"] == digest and all(os.path.exists(f) for f in entry["files"]):
+            if self.verbose > 0:
+                print("Up to date: ", name)
+            return key, entry
+        shape.saved_files = []
+        getattr(self, method)(name, **kwargs)
+        return key, {"digest": digest, "files": shape.saved_files}
+
+    @staticmethod
+    def plot_cache_key(shape, method):
+        return f"{method}:{shape.name}"
+
+    def shape_digest(self, shape, method, kwargs):
+        '''Digest of the histograms, of the style and of the plotting options of a Shape object.'''
+        hasher = hashlib.sha256()
+        options = dict(
+            version=__version__,
+            method=method,
+            kwargs=sorted(kwargs.items()),
+            toplabel=shape.toplabel,
+            log_x=shape.log_x,
+            log_y=shape.log_y,
+            density=shape.density,
+            has_mcstat=shape.has_mcstat,
+            only_cat=sorted(shape.only_cat),
+            style=self._style_digest,
+        )
+        hasher.update(repr(options).encode())
+        for sample in sorted(shape.h_dict.keys()):
+            hasher.update(sample.encode())
+            _hash_hist(hasher, shape.h_dict[sample])
+        return hasher.hexdigest()
+
+    def load_plot_cache(self):
+        path = os.path.join(self.plot_dir, self.PLOT_CACHE_FILE)
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            print(f"WARNING: the plot cache {path} cannot be read and will be rebuilt.")
+            return {}
+
+    def update_plot_cache(self, results):
+        for key, entry in filter(None, results):
+            self._plot_cache_entries[key] = entry
+        path = os.path.join(self.plot_dir, self.PLOT_CACHE_FILE)
+        os.makedirs(self.plot_dir, exist_ok=True)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(self._plot_cache_entries, f, indent=1)
+        os.replace(f"{path}.tmp", path)
 
 class Shape:
     '''This class handles the plotting of 1D data/MC histograms.
@@ -386,6 +505,8 @@ class Shape:
         self.year=year
         self.verbose = verbose
         self.cache = cache
+        # Files of the plots saved by the Shape (used by the plot cache of the PlotManager)
+        self.saved_files = []
         self._stacksCache = defaultdict(dict)
         assert (
             type(h_dict) in [dict, defaultdict]
@@ -1422,6 +1543,7 @@ class Shape:
                 if self.verbose>0:
                     print("Saving", filepath)
                 plt.savefig(filepath, dpi=150, format=format, bbox_inches="tight")
+                self.saved_files.append(filepath)
             else:
                 plt.show(self.fig)
             plt.close(self.fig)
@@ -1486,6 +1608,7 @@ class Shape:
                 if self.verbose>0:
                     print("Saving", filepath)
                 plt.savefig(filepath, dpi=150, format=format, bbox_inches="tight")
+                self.saved_files.append(filepath)
             else:
                 plt.show(self.fig)
                 plt.close(self.fig)
@@ -1527,6 +1650,7 @@ class Shape:
             if self.verbose > 0:
                 print("Saving", filepath)
             plt.savefig(filepath, dpi=150, format=format, bbox_inches="tight")
+            self.saved_files.append(filepath)
         else:
             plt.show(systematic.fig)
         plt.close(systematic.fig)
@@ -1573,9 +1697,86 @@ class SystManager:
         self.syst_dict = defaultdict(dict)
 
     def update(self, cat, stacks):
-        '''Updates the dictionary of systematic uncertainties with the new cached stacks.'''
+        '''Updates the dictionary of systematic uncertainties with the new cached stacks.
+        The squared errors of all the systematic uncertainties are computed at once by `get_err2`.'''
+        self.check_empty_variations(stacks)
+        err2 = self.get_err2(stacks)
         for syst_name in self.systematics:
-            self.syst_dict[cat][syst_name] = SystUnc(self.shape, stacks, syst_name, verbose=self.verbose)
+            self.syst_dict[cat][syst_name] = SystUnc(
+                self.shape, stacks, syst_name, err2=err2[syst_name], verbose=self.verbose
+            )
+
+    def _merge_flow_bins(self, values):
+        '''Same as `Shape._merge_flow_bins` along the last axis of an array.'''
+        if not self.style.flow:
+            return values
+        merged = values[..., 1:-1].copy()
+        merged[..., 0] += values[..., 0]
+        merged[..., -1] += values[..., -1]
+        return merged
+
+    def _values_cube(self, stacks, variations, flow):
+        '''Array of the values of the MC stack with shape (sample, variation, bin).'''
+        return np.stack([
+            h.values(flow=flow)[np.asarray(h.axes["variation"].index(variations))]
+            for h in stacks["mc"]
+        ])
+
+    def check_empty_variations(self, stacks):
+        '''Warns about the variations different from the nominal with no entries, in any of the MC samples.'''
+        if not self.verbose >= 1 or len(stacks["mc"]) == 0:
+            return
+        variations = list(self.shape.variations)
+        values = self._values_cube(stacks, variations, flow=False)
+        nominal = values[:, variations.index("nominal")][:, None]
+        is_empty = (values == 0).all(axis=-1) & (values != nominal).any(axis=-1)
+        for variation in np.asarray(variations)[is_empty.any(axis=0)]:
+            print(
+                f"WARNING: Empty variation {variation} found in histogram {self.shape.name}. "+
+                "Please check if the input histograms are filled properly."
+            )
+
+    def get_err2(self, stacks):
+        '''Returns the squared up/down errors of all the systematic uncertainties, as a dictionary
+        {syst_name: (err2_up, err2_down)}, with the same definitions of `SystUnc._get_err2`.
+
+        The (sample, variation, bin) cube of the MC values is read once from the stack, and the
+        up/down and one-sided envelopes of all the systematic uncertainties are computed at once.'''
+        syst_names = [s for s in self.systematics if s != "mcstat"]
+        if len(stacks["mc"]) == 0:
+            return {name: (0.0, 0.0) for name in self.systematics}
+        flow = self.style.flow
+        variations = ["nominal"] + [f"{s}Up" for s in syst_names] + [f"{s}Down" for s in syst_names]
+        values = self._merge_flow_bins(self._values_cube(stacks, variations, flow))
+        nsyst = len(syst_names)
+        nom = values[:, :1]
+        err_up = values[:, 1:nsyst + 1] - nom
+        err_down = values[:, nsyst + 1:] - nom
+        up_is_up = err_up > 0
+        down_is_down = err_down < 0
+        is_onesided = up_is_up ^ down_is_down
+        err2_up_twosided = np.where(up_is_up, err_up**2, err_down**2)
+        err2_down_twosided = np.where(up_is_up, err_down**2, err_up**2)
+        err2_max = np.maximum(err2_up_twosided, err2_down_twosided)
+        err2_up_combined = np.where(
+            is_onesided, np.where(up_is_up, err2_max, 0), err2_up_twosided
+        )
+        err2_down_combined = np.where(
+            is_onesided, np.where(down_is_down, err2_max, 0), err2_down_twosided
+        )
+        # The samples are summed one after the other, in the order of the stack, as in SystUnc
+        err2_up, err2_down = 0.0, 0.0
+        for isample in range(values.shape[0]):
+            err2_up = err2_up + err2_up_combined[isample]
+            err2_down = err2_down + err2_down_combined[isample]
+        err2 = {name: (err2_up[i], err2_down[i]) for i, name in enumerate(syst_names)}
+        if "mcstat" in self.systematics:
+            mcstat_err2 = 0.0
+            for h in stacks["mc"]:
+                variances = h.variances(flow=flow)[h.axes["variation"].index("nominal")]
+                mcstat_err2 = mcstat_err2 + self._merge_flow_bins(variances)
+            err2["mcstat"] = (mcstat_err2, mcstat_err2)
+        return err2
 
     def total(self, cat):
         return SystUnc(self.shape, name="total", syst_list=list(self.syst_dict[cat].values()), verbose=self.verbose)
@@ -1595,7 +1796,8 @@ class SystUnc:
     returning a `SystUnc` instance corresponding to their sum in quadrature.'''
 
     def __init__(
-            self, shape: Shape, stacks: dict = None, name: str = None, syst_list: list = None, verbose: int = 1
+            self, shape: Shape, stacks: dict = None, name: str = None, syst_list: list = None, err2: tuple = None,
+            verbose: int = 1
     ) -> None:
         self.shape = shape
         self.style = shape.style
@@ -1617,8 +1819,12 @@ class SystUnc:
             self.bins = stacks["mc_nominal_sum"].axes[0].edges
             self.h_mc_nominal = stacks["mc_nominal_sum"]
             self.nominal = self.shape._merge_flow_bins(self.h_mc_nominal.values(flow=self.style.flow))
-            self.check_empty_variations(stacks)
-            self._get_err2(stacks)
+            if err2 is not None:
+                # Squared errors computed by SystManager.get_err2
+                self.err2_up, self.err2_down = err2
+            else:
+                self.check_empty_variations(stacks)
+                self._get_err2(stacks)
             # Full nominal MC including all MC samples
         elif syst_list:
             self.syst_list = syst_list
@@ -0,0 +1,105 @@
+"""Per-stage profiling of the processing of the chunks.
+
+With the ``profile_processing`` workflow option the processor measures, for each stage of
+``process()`` (skim, calibrators, object preselection, preselection, categories, weights,
+histograms, columns...), the wall time, the CPU time and the change of the resident memory
+of the worker. Calibrators and weights are also broken down by name
+("calibrators/jet_calibration", "weights/pileup"...). Nested stages are included in the time of
+their parent stage.
+
+The measurements are summed over the chunks and stored in the output as plain counters,
+which are merged by the coffea accumulation and by ``merge-outputs``:
+
+    output["processing_profile"][sample] = {
+        "chunks": n, "nevents": n,
+        "stages": {stage: {"calls": n, "walltime": s, "cputime": s, "rss_delta": MB}},
+    }
+
+The ``pocket-coffea profile-report`` command prints the hotspot report from a .coffea file.
+"""
+import time
+import contextlib
+
+from .adaptive_chunksize import get_rss_mb
+
+PROFILE_OUTPUT_KEY = "processing_profile"
+TOTAL_STAGE = "total"
+
+
+class ProcessingProfiler:
+    '''Accumulate wall time, CPU time and RSS delta of named stages.
+    The profiler is created at the beginning of the chunk: the "total" stage
+    is measured from its creation to the call of `to_output`.'''
+
+    def __init__(self):
+        self.stages = {}
+        self._start = (time.perf_counter(), time.process_time(), get_rss_mb())
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        rss_start = get_rss_mb()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            record = self.stages.setdefault(name, {"calls": 0, "walltime": 0., "cputime": 0., "rss_delta": 0.})
+            record["calls"] += 1
+            record["walltime"] += time.perf_counter() - wall_start
+            record["cputime"] += time.process_time() - cpu_start
+            record["rss_delta"] += get_rss_mb() - rss_start
+
+    def to_output(self, nevents):
+        '''Return the profile of a chunk in the format of the output (see the module documentation).'''
+        wall_start, cpu_start, rss_start = self._start
+        stages = {name: dict(record) for name, record in self.stages.items()}
+        stages[TOTAL_STAGE] = {"calls": 1,
+                               "walltime": time.perf_counter() - wall_start,
+                               "cputime": time.process_time() - cpu_start,
+                               "rss_delta": get_rss_mb() - rss_start}
+        return {"chunks": 1, "nevents": int(nevents), "stages": stages}
+
+
+def profile_stage(profiler, name):
+    '''Context manager measuring the stage `name` if the profiler is not None, otherwise a no-op.'''
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.stage(name)
+
+
+def hotspot_table(profile, top=None):
+    '''Return the rows of the hotspot report for the profile of a sample, sorted by wall time.
+    Each row is a dictionary with the stage name, the accumulated counters, the fraction
+    of the total wall time and the wall time per event (in microseconds).'''
+    stages = profile["stages"]
+    if TOTAL_STAGE in stages:
+        total_walltime = stages[TOTAL_STAGE]["walltime"]
+    else:
+        # Only the top-level stages, as the nested ones are included in their parent
+        total_walltime = sum(r["walltime"] for name, r in stages.items() if "/" not in name)
+    nevents = profile.get("nevents", 0)
+    rows = []
+    for name, record in stages.items():
+        rows.append({
+            "stage": name,
+            **record,
+            "fraction": record["walltime"] / total_walltime if total_walltime > 0 else 0.,
+            "us_per_event": 1e6 * record["walltime"] / nevents if nevents > 0 else 0.,
+        })
+    rows.sort(key=lambda r: r["walltime"], reverse=True)
+    if top is not None:
+        rows = rows[:top]
+    return rows
+
+
+def merge_profiles(profiles):
+    '''Sum the profiles of several samples.'''
+    out = {"chunks": 0, "nevents": 0, "stages": {}}
+    for profile in profiles:
+        out["chunks"] += profile.get("chunks", 0)
+        out["nevents"] += profile.get("nevents", 0)
+        for name, record in profile["stages"].items():
+            target = out["stages"].setdefault(name, {k: 0 for k in record})
+            for k, v in record.items():
+                target[k] = target.get(k, 0) + v
+    return out
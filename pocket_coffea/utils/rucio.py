@@ -132,6 +132,7 @@ def get_dataset_files_replicas(
         scope="cms",
         sort: str = "geoip",
         invalid_list=[],
+        sites_xrootd_prefix=None,
 ):
     """Query the Rucio server to get information about the location of all the replicas of the files in a CMS dataset.
 
@@ -163,6 +164,8 @@ def get_dataset_files_replicas(
         invalid_list: list
             A list of invalid files for this dataset (to be exluded in the output).
             Rucio does not know of invalid files, so these need to be obtained beforehand from DAS.
+        sites_xrootd_prefix: dict, optional
+            xrootd prefix rules of the sites, as returned by `get_xrootd_sites_map` (read if not given).
 
     Returns
     -------
@@ -180,7 +183,7 @@ def get_dataset_files_replicas(
            Metadata counting the coverage of the dataset by site
 
     """
-    sites_xrootd_prefix = get_xrootd_sites_map()
+    sites_xrootd_prefix = sites_xrootd_prefix if sites_xrootd_prefix is not None else get_xrootd_sites_map()
     client = client if client else get_rucio_client()
     outsites = []
     outfiles = []
@@ -317,18 +320,28 @@ def get_dataset_files_replicas(
 
 def get_dataset_files_from_dbs(
         dataset_name: str,
-        dbs_instance: str = "prod/global"):
+        dbs_instance: str = "prod/global",
+        session=None,
+        dbs_url: str = "https://cmsweb.cern.ch:8443/dbs",
+        sites_xrootd_prefix=None):
     '''
     This function queries the DBS server to get information about the location
     of each block in a CMS dataset.
     It is used instead of the rucio replica query when the dataset is not available in rucio.
+
+    A `requests.Session` (with the client certificate set) can be passed to reuse its connections,
+    and the xrootd prefix rules of the sites (`get_xrootd_sites_map`) to avoid reading them again.
     '''
 
     # Get the site of the blocks
-    proxy = get_proxy_path()
-    sites_xrootd_prefix = get_xrootd_sites_map()
-    link = f"https://cmsweb.cern.ch:8443/dbs/{dbs_instance}/DBSReader/blocks?dataset={dataset_name}&detail=True"
-    r = requests.get(link, cert=proxy, verify=False)
+    if session is None:
+        session = requests.Session()
+        session.cert = get_proxy_path()
+        session.verify = False
+    if sites_xrootd_prefix is None:
+        sites_xrootd_prefix = get_xrootd_sites_map()
+    link = f"{dbs_url}/{dbs_instance}/DBSReader/blocks?dataset={dataset_name}&detail=True"
+    r = session.get(link)
     outputfiles, outputsites = [], []
 
     if r.status_code == 200:
@@ -336,8 +349,8 @@ def get_dataset_files_from_dbs(
     
         for block in data:
             #now query for files
-            link = f"https://cmsweb.cern.ch:8443/dbs/{dbs_instance}/DBSReader/files?block_name={block['block_name'].replace('#', '%23')}"
-            rfiles = requests.get( link,  cert=proxy, verify=False)
+            link = f"{dbs_url}/{dbs_instance}/DBSReader/files?block_name={block['block_name'].replace('#', '%23')}"
+            rfiles = session.get(link)
             site = block["origin_site_name"]
 
             for f in rfiles.json():
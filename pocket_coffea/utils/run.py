@@ -1,10 +1,222 @@
 import os
 import logging
-from coffea.processor import Runner
+from collections.abc import MutableMapping
+from coffea.processor import Runner, ProcessorABC, accumulate
+from coffea.util import load, save
 
 from pocket_coffea.utils.logging import try_and_log_error
+from pocket_coffea.utils.worker_writers import flush_executor_writers
 
-def get_runner(executor, chunksize, maxchunks, skipbadfiles, schema, format, error_log_file, exit_on_error=True):
+CHECKPOINT_PREFIX = "checkpoint"
+# Default number of chunks per worker of the executor in a checkpointed batch
+CHECKPOINT_CHUNKS_PER_WORKER = 10
+# Output key collecting the chunks processed successfully, removed by the CheckpointedRunner
+COMPLETED_CHUNKS_KEY = "__checkpoint_completed_chunks__"
+
+
+def _checkpoint_files(checkpoint_dir):
+    if not os.path.isdir(checkpoint_dir):
+        return []
+    return sorted(
+        os.path.join(checkpoint_dir, f) for f in os.listdir(checkpoint_dir)
+        if f.startswith(CHECKPOINT_PREFIX + "-") and f.endswith(".coffea")
+    )
+
+
+def clear_checkpoint(checkpoint_dir):
+    '''Remove the checkpoint written by a CheckpointedRunner in `checkpoint_dir`, if any.'''
+    for checkpoint_file in _checkpoint_files(checkpoint_dir):
+        os.remove(checkpoint_file)
+
+
+def _executor_workers(executor):
+    '''Number of chunks processed at the same time by a coffea executor (1 if unknown).'''
+    from coffea.processor import DaskExecutor
+
+    if isinstance(executor, DaskExecutor) and executor.client is not None:
+        return max(len(executor.client.scheduler_info().get("workers", {})), 1)
+    return max(int(getattr(executor, "workers", 1) or 1), 1)
+
+
+class _DeferredPostprocessProcessor(ProcessorABC):
+    '''Wrap a processor so that the coffea Runner does not call its postprocess
+    on the partial outputs: it is called once on the full output by the CheckpointedRunner.
+    The output of each chunk records the chunk key under `COMPLETED_CHUNKS_KEY`, so that the chunks
+    skipped by the Runner (e.g. unreadable files with `skipbadfiles`) are not marked as completed.'''
+
+    def __init__(self, processor_instance):
+        self.processor_instance = processor_instance
+
+    def process(self, events):
+        output = self.processor_instance.process(events)
+        if isinstance(output, MutableMapping):
+            output[COMPLETED_CHUNKS_KEY] = {_metadata_chunk_key(events.metadata)}
+        return output
+
+    def postprocess(self, accumulator):
+        return accumulator
+
+
+def _chunk_key(item):
+    return (item.dataset, item.filename, item.treename, item.entrystart, item.entrystop)
+
+
+def _metadata_chunk_key(metadata):
+    return tuple(metadata[k] for k in ("dataset", "filename", "treename", "entrystart", "entrystop"))
+
+
+class CheckpointedRunner:
+    '''
+    Wrapper of a coffea Runner persisting periodically the partial output and the list of the
+    completed chunks, (dataset, file, treename, entrystart, entrystop), in checkpoint files.
+
+    The chunks are processed in batches with the wrapped Runner. The coffea executors merge the
+    outputs of the chunks on the workers, so the output is available only at the end of each batch:
+    every batch waits for its slowest chunk before the next one is submitted. The batch size is
+    therefore a multiple of the number of workers of the executor, by default
+    `CHECKPOINT_CHUNKS_PER_WORKER` chunks per worker, or `checkpoint_every` rounded up.
+
+    After each batch the output of the batch and its completed chunks are saved atomically in a new
+    file `checkpoint_dir/checkpoint-<n>.coffea`: the previous output is not written again.
+    The chunks skipped by the Runner (`skipbadfiles`) are not recorded as completed and are processed
+    again by the next run. If checkpoint files already exist when the runner is called, the partial
+    outputs are loaded and only the missing chunks are processed.
+    The processor postprocess is called once on the full output, as done by the coffea Runner.
+
+    The checkpoint is valid only for the same chunksize: a checkpoint written with a
+    different chunksize raises an error instead of double counting events.
+    The checkpoint files are kept after the end of the processing: they are removed by the
+    caller once the final output has been saved (see `clear_checkpoint`).
+    '''
+
+    def __init__(self, runner, checkpoint_dir, checkpoint_every=None):
+        self.runner = runner
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_every = checkpoint_every
+
+    @property
+    def batch_size(self):
+        '''Number of chunks processed between two checkpoints, a multiple of the executor workers.'''
+        workers = _executor_workers(getattr(self.runner, "executor", None))
+        if self.checkpoint_every is None:
+            return workers * CHECKPOINT_CHUNKS_PER_WORKER
+        return -(-max(int(self.checkpoint_every), 1) // workers) * workers
+
+    def load_checkpoint(self):
+        '''Return the (output, set of completed chunks) stored in the checkpoint, if any.'''
+        outputs, completed = [], set()
+        for checkpoint_file in _checkpoint_files(self.checkpoint_dir):
+            checkpoint = load(checkpoint_file)
+            if checkpoint["chunksize"] != self.runner.chunksize:
+                raise ValueError(
+                    f"The checkpoint {checkpoint_file} was written with chunksize {checkpoint['chunksize']}, "
+                    f"different from the current one ({self.runner.chunksize}): "
+                    "run with the same chunksize or remove the checkpoint.")
+            if checkpoint["output"] is not None:
+                outputs.append(checkpoint["output"])
+            completed.update(map(tuple, checkpoint["completed"]))
+        return (accumulate(outputs) if outputs else None), completed
+
+    def save_checkpoint(self, output, completed):
+        '''Save the output of a batch and its completed chunks in a new checkpoint file.'''
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        existing = _checkpoint_files(self.checkpoint_dir)
+        index = int(existing[-1][:-len(".coffea")].rsplit("-", 1)[1]) + 1 if existing else 0
+        checkpoint_file = os.path.join(self.checkpoint_dir, f"{CHECKPOINT_PREFIX}-{index:05d}.coffea")
+        tmp_file = checkpoint_file + ".tmp"
+        save({"chunksize": self.runner.chunksize,
+              "completed": sorted(completed),
+              "output": output}, tmp_file)
+        # Atomic creation: a crash while writing does not leave a partial checkpoint
+        os.replace(tmp_file, checkpoint_file)
+
+    def _run_batch(self, batch, processor_instance):
+        try:
+            output = self.runner.run(batch, processor_instance)["out"]
+        except ValueError as e:
+            # Raised by the coffea Runner when all the chunks have been skipped
+            if "No chunks returned results" not in str(e):
+                raise
+            return None, set()
+        if isinstance(output, MutableMapping):
+            return output, output.pop(COMPLETED_CHUNKS_KEY, set())
+        return output, {_chunk_key(c) for c in batch}
+
+    def __call__(self, fileset, treename, processor_instance):
+        output, completed = self.load_checkpoint()
+        chunks = list(self.runner.preprocess(fileset, treename))
+        todo = [c for c in chunks if _chunk_key(c) not in completed]
+        if completed:
+            logging.info(f"Resuming from checkpoint {self.checkpoint_dir}: "
+                         f"{len(chunks) - len(todo)}/{len(chunks)} chunks already processed")
+        wrapped_processor = _DeferredPostprocessProcessor(processor_instance)
+        batch_size = self.batch_size
+        for start in range(0, len(todo), batch_size):
+            batch = todo[start:start + batch_size]
+            batch_output, batch_completed = self._run_batch(batch, wrapped_processor)
+            if len(batch_completed) < len(batch):
+                logging.warning(f"{len(batch) - len(batch_completed)} chunks skipped: "
+                                "they are not recorded in the checkpoint")
+            if batch_output is not None:
+                output = batch_output if output is None else accumulate([output, batch_output])
+            if not batch_completed:
+                continue
+            completed.update(batch_completed)
+            # The buffered outputs of the completed chunks must be on disk before the checkpoint
+            flush_executor_writers(getattr(self.runner, "executor", None))
+            self.save_checkpoint(batch_output, batch_completed)
+            logging.info(f"Checkpoint saved: {len(completed)}/{len(chunks)} chunks processed")
+        if output is None:
+            raise ValueError("No chunks returned results, verify the fileset.")
+        processor_instance.postprocess(output)
+        return output
+
+
+class PerDatasetChunksizeRunner:
+    '''
+    Wrapper of a coffea Runner splitting each dataset with its own chunksize
+    (e.g. derived by the adaptive chunksize from the measured throughput).
+
+    `chunksizes` is a dictionary dataset -> chunksize: the datasets not included use the
+    chunksize of the wrapped Runner. The chunks of all the datasets are then processed
+    together by a single `Runner.run` call.
+    '''
+
+    def __init__(self, runner, chunksizes):
+        self.runner = runner
+        self.chunksizes = dict(chunksizes)
+
+    @property
+    def executor(self):
+        return self.runner.executor
+
+    @property
+    def chunksize(self):
+        return {"default": self.runner.chunksize, **self.chunksizes}
+
+    def preprocess(self, fileset, treename):
+        by_chunksize = {}
+        for dataset, files in fileset.items():
+            chunksize = self.chunksizes.get(dataset, self.runner.chunksize)
+            by_chunksize.setdefault(chunksize, {})[dataset] = files
+        default_chunksize = self.runner.chunksize
+        try:
+            for chunksize, fileset_ in by_chunksize.items():
+                self.runner.chunksize = chunksize
+                yield from list(self.runner.preprocess(fileset_, treename))
+        finally:
+            self.runner.chunksize = default_chunksize
+
+    def run(self, chunks, processor_instance):
+        return self.runner.run(chunks, processor_instance)
+
+    def __call__(self, fileset, treename, processor_instance):
+        chunks = list(self.preprocess(fileset, treename))
+        return self.run(chunks, processor_instance)["out"]
+
+
+def get_runner(executor, chunksize, maxchunks, skipbadfiles, schema, format, error_log_file, exit_on_error=True,
+               checkpoint_dir=None, checkpoint_every=None, metadata_cache=None, chunksize_by_dataset=None):
     """
     Create and return a Coffea Runner wrapped with error logging,
     given the specified configuration parameters.
@@ -26,22 +238,37 @@ def get_runner(executor, chunksize, maxchunks, skipbadfiles, schema, format, err
         Path to the error log file for logging exceptions.
     exit_on_error : bool, optional
         If True, exits the program on error after logging. Default is False.
+    checkpoint_dir : str, optional
+        If set, the Runner is wrapped in a CheckpointedRunner saving the partial output
+        and the completed chunks in this folder, and resuming from them.
+    checkpoint_every : int, optional
+        Number of chunks processed between two checkpoints, rounded up to a multiple of the
+        executor workers. Default is 10 chunks per worker.
+    metadata_cache : MutableMapping, optional
+        Cache of the (file, tree) metadata used by the Runner for the chunking,
+        e.g. a persistent FileMetadataCache. Default is the coffea in-memory cache.
+    chunksize_by_dataset : dict, optional
+        Chunksize to be used for each dataset, overriding `chunksize` (see PerDatasetChunksizeRunner).
     Returns
     -------
     Runner
         A Coffea Runner instance configured with the specified parameters.
     """
+    runner = Runner(
+        executor=executor,
+        chunksize=chunksize,
+        maxchunks=maxchunks,
+        skipbadfiles=skipbadfiles,
+        schema=schema,
+        format=format,
+        metadata_cache=metadata_cache,
+    )
+    if chunksize_by_dataset:
+        runner = PerDatasetChunksizeRunner(runner, chunksize_by_dataset)
+    if checkpoint_dir is not None:
+        runner = CheckpointedRunner(runner, checkpoint_dir, checkpoint_every)
 
     # Create and return the Runner wrapped with error logging
     return try_and_log_error(
         error_log_file, exit_on_error=exit_on_error
-    )(
-        Runner(
-            executor=executor,
-            chunksize=chunksize,
-            maxchunks=maxchunks,
-            skipbadfiles=skipbadfiles,
-            schema=schema,
-            format=format,
-        )
-    )
+    )(runner)
@@ -2,6 +2,7 @@ import os
 import pathlib
 import shutil
 import json
+import fnmatch
 import awkward as ak
 from typing import Any, Dict, List, Optional
 
@@ -19,19 +20,50 @@ def is_rootcompat(a):
     return False
 
 
-def uproot_writeable(events):
-    """Restrict to columns that uproot can write compactly"""
+# Branches always written in the pruned skimmed files
+DEFAULT_KEEP_BRANCHES = ("run", "luminosityBlock", "event", "skimRescaleGenWeight")
+
+
+class BranchesSelector:
+    """Select the branches by exact name or by shell-style pattern (e.g. `HLT_*`)."""
+
+    def __init__(self, branches):
+        self.names = set()
+        self.patterns = []
+        for b in branches:
+            if any(c in b for c in "*?["):
+                self.patterns.append(b)
+            else:
+                self.names.add(b)
+
+    def __call__(self, name):
+        return name in self.names or any(fnmatch.fnmatchcase(name, p) for p in self.patterns)
+
+
+def uproot_writeable(events, keep_branches=None):
+    """Restrict to columns that uproot can write compactly.
+
+    If `keep_branches` (a callable, e.g. a `BranchesSelector`) is given, only the branches
+    for which it returns True are written. The counter `nX` of a collection is kept by
+    writing one of its branches."""
     out = {}
     for bname in events.fields:
         if events[bname].fields:
+            fields = [n for n in events[bname].fields if is_rootcompat(events[bname][n])]
+            if keep_branches is not None:
+                kept = [n for n in fields if keep_branches(f"{bname}_{n}")]
+                if not kept and fields and keep_branches(f"n{bname}"):
+                    kept = fields[:1]
+                if not kept:
+                    continue
+                fields = kept
             out[bname] = ak.zip(
                 {
                     n: ak.packed(ak.without_parameters(events[bname][n]))
-                    for n in events[bname].fields
-                    if is_rootcompat(events[bname][n])
+                    for n in fields
                 }
             )
-        else:
+        elif keep_branches is None or keep_branches(bname):
             out[bname] = ak.packed(ak.without_parameters(events[bname]))
     return out
 
@@ -85,6 +117,71 @@ def copy_file(
     pathlib.Path(local_file).unlink()
 
 
+def group_skimmed_files(files, nevents):
+    """Return the list of the distinct skimmed files with their number of events.
+
+    The chunks appended to the same file by the coalescing skim writer (see
+    `utils.skim_writer`) are listed once per chunk in the `skimmed_files` output:
+    their events are summed. The order of the files is preserved."""
+    grouped = {}
+    for file, n in zip(files, nevents):
+        grouped[file] = grouped.get(file, 0) + n
+    return list(grouped.items())
+
+
+def _rebuild_collections(arrays, collections):
+    """Zip the jagged branches read from a tree in the collections sharing the same
+    counter, so that uproot writes them back with the original names (`Jet_pt`, `nJet`)."""
+    out = {}
+    zipped = set()
+    for coll, branches in collections.items():
+        out[coll] = ak.zip({b[len(coll) + 1:]: arrays[b] for b in branches})
+        zipped.update(branches)
+        zipped.add(f"n{coll}")
+    for name in arrays.fields:
+        if name not in zipped:
+            out[name] = arrays[name]
+    return out
+
+
+def merge_root_files_uproot(inputfiles, outputfile, treename="Events", step_size="200 MB", compression=None):
+    """Merge the `treename` trees of the ROOT files in a single file using only uproot
+    (an alternative to `hadd` not needing a ROOT installation).
+
+    The input files are read in batches of `step_size` and appended to the output tree.
+    The jagged branches sharing a counter `nX` and named `X_*` are merged as the collection
+    `X`, preserving the NanoAOD branch names. By default the output file has the compression
+    of the first input file. Returns the number of merged entries."""
+    import uproot
+
+    with uproot.open(inputfiles[0]) as first:
+        if compression is None:
+            compression = first.file.compression
+        tree = first[treename]
+        by_counter = {}
+        for branch in tree.branches:
+            if branch.count_branch is not None:
+                by_counter.setdefault(branch.count_branch.name, []).append(branch.name)
+        collections = {
+            counter[1:]: branches
+            for counter, branches in by_counter.items()
+            if counter.startswith("n") and all(b.startswith(counter[1:] + "_") for b in branches)
+        }
+        empty = tree.arrays(entry_stop=0)
+
+    nentries = 0
+    with uproot.recreate(outputfile, compression=compression) as fout:
+        for arrays in uproot.iterate([f"{f}:{treename}" for f in inputfiles], step_size=step_size):
+            data = _rebuild_collections(arrays, collections)
+            if treename in fout:
+                fout[treename].extend(data)
+            else:
+                fout[treename] = data
+            nentries += len(arrays)
+        if treename not in fout:
+            fout[treename] = _rebuild_collections(empty, collections)
+    return nentries
+
 
 def apply_skim_sumgenweights_override(accumulator, filesets):
     '''Override `accumulator['sum_genweights']` and
@@ -167,7 +264,11 @@ def save_skimed_dataset_definition(processing_out, fileout, check_initial_events
         # Count the remaining events
         datasets_info[key] =  {
             "metadata": datasets_metadata[key],
-            "files": processing_out["skimmed_files"][key]
+            "files": [
+                file for file, _ in group_skimmed_files(
+                    processing_out["skimmed_files"][key], processing_out["nskimmed_events"][key]
+                )
+            ]
         }
         datasets_info[key]["metadata"]["isSkim"] = "True"
         datasets_info[key]["metadata"]["nevents"] = str(sum(processing_out["nskimmed_events"][key]))
@@ -0,0 +1,98 @@
+"""Coalescing writer of the skimmed NanoAOD chunks.
+
+By default `export_skimmed_chunk` writes one ROOT file per chunk and copies it to the
+`save_skimmed_files` folder. With the ``skim_target_file_size_mb`` workflow option each worker
+process instead appends the skimmed chunks of a dataset to a local ROOT file, which is copied
+to the output folder when it exceeds the target size and when the worker process exits.
+
+The skimmed files are named ``<dataset>__coalesced-skim-<worker>-<n>.root``. Each thread of the
+worker appends to its own file, the writes being serialized by a lock of the writer. Each chunk
+records in the output the final location of the file it is appended to, so that the skimmed
+dataset definition lists every file once (see `utils.skim.group_skimmed_files`).
+
+The open files are completed and copied by the runner at the end of the processing and before
+each checkpoint (see `utils.worker_writers`), and at the exit of the worker process. N.B.: the
+events of a worker killed abruptly before that are lost and its files are missing from the
+output folder (use ``pocket-coffea hadd-skimmed-files --check`` to find them).
+"""
+import os
+import threading
+
+import awkward as ak
+import uproot
+
+from .skim import copy_file
+from .worker_writers import get_worker_writer, new_worker_id
+
+COALESCED_SKIM_PREFIX = "coalesced-skim-"
+
+
+def tree_schema(tree):
+    '''Names and types of the branches of a tree (a dict of arrays, see `uproot_writeable`).'''
+    return tuple(sorted((name, str(ak.type(array).type)) for name, array in tree.items()))
+
+
+class CoalescingSkimWriter:
+    '''Append the skimmed chunks of each dataset to a local ROOT file and copy it to
+    `location`/<dataset> when its size exceeds `target_size_mb`.
+
+    Each thread has its own open file per dataset. A chunk with a different set of branches
+    (or of branch types) than the open file, e.g. a different list of HLT paths, starts a new file.'''
+
+    def __init__(self, location, target_size_mb=2048, compression=None, localdir="./"):
+        self.location = location
+        self.target_size = target_size_mb * 1024**2
+        self.compression = compression if compression is not None else uproot.ZSTD(5)
+        self.localdir = localdir
+        self.worker_id = new_worker_id()
+        # Open files by (thread, dataset)
+        self._open = {}
+        self._nfiles = 0
+        self._lock = threading.RLock()
+
+    def write(self, dataset, tree):
+        '''Append the tree (dict of arrays) of a chunk to the file of the dataset of the current thread.
+        Returns the final location of the file.'''
+        schema = tree_schema(tree)
+        key = (threading.get_ident(), dataset)
+        with self._lock:
+            current = self._open.get(key)
+            if current is not None and current["schema"] != schema:
+                self._close(key)
+                current = None
+            if current is None:
+                fname = f"{dataset}__{COALESCED_SKIM_PREFIX}{self.worker_id}-{self._nfiles:05d}.root"
+                self._nfiles += 1
+                fout = uproot.recreate(os.path.join(self.localdir, fname), compression=self.compression)
+                fout["Events"] = tree
+                current = self._open[key] = {"file": fout, "fname": fname, "schema": schema, "dataset": dataset}
+            else:
+                current["file"]["Events"].extend(tree)
+            destination = os.path.join(self.location, dataset, current["fname"])
+            if os.path.getsize(os.path.join(self.localdir, current["fname"])) >= self.target_size:
+                self._close(key)
+        return destination
+
+    def _close(self, key):
+        '''Complete an open file and copy it to the output folder.'''
+        with self._lock:
+            current = self._open.pop(key)
+            current["file"].close()
+            copy_file(current["fname"], self.localdir, self.location, subdirs=[current["dataset"]])
+
+    def close(self, dataset):
+        '''Complete and copy the open files of the dataset (of all the threads).'''
+        with self._lock:
+            for key in [k for k in self._open if k[1] == dataset]:
+                self._close(key)
+
+    def flush(self):
+        '''Complete and copy all the open files.'''
+        with self._lock:
+            for key in list(self._open):
+                self._close(key)
+
+
+def get_coalescing_skim_writer(location, target_size_mb):
+    '''Return the writer of the current process for the location, creating it if needed.'''
+    return get_worker_writer(CoalescingSkimWriter, location, target_size_mb)
@@ -8,6 +8,7 @@ import hist
 import numpy as np
 import uproot
 
+from pocket_coffea.lib.sparse_hist import densify
 from pocket_coffea.utils.histogram import rebin_hist
 from pocket_coffea.utils.stat.processes import DataProcesses, MCProcesses
 from pocket_coffea.utils.stat.systematics import Systematics
@@ -95,7 +96,8 @@ class Datacard:
         :type rateparam_norm_categories: list[str], optional
         """
 
-        self.histograms = histograms
+        # SparseHist inputs are converted (in place) to hist.Hist
+        self.histograms = densify(histograms)
         self.datasets_metadata = datasets_metadata
         self.cutflow = cutflow
         self.mc_processes = mc_processes
@@ -410,6 +412,79 @@ class Datacard:
         :rtype: hist.Hist
         """
         cat = category if category is not None else self.category
+        return self.rearrange_histograms_by_category(is_data=is_data, categories=[cat])[cat]
+
+    def _rearrangement_plan(self, is_data: bool, processes_names: list[str], variations: list[str]) -> list:
+        """Index maps from the input histograms to the rearranged histogram.
+
+        For each non-empty input histogram (in the order of the processes, samples, years and
+        datasets) returns the histogram, the index of its process on the ``process`` axis and,
+        for MC, the indices on the ``variation`` axis of the target variations and of the source
+        variations filling them. Shape variations missing in a sample are filled with its
+        nominal variation.
+        """
+        processes = self.data_processes if is_data else self.mc_processes
+        shape_systematics = self.systematics.get_systematics_by_type("shape").values()
+        plan = []
+        missing_variations = {}
+        for process in processes.values():
+            for sample in process.samples:
+                for year in process.years:
+                    assert year is not None, "Processes should have a year"
+                    for dataset in self.get_datasets_by_sample(sample, year):
+                        if self.is_empty_dataset(dataset):
+                            continue
+                        histogram = self.histograms[sample][dataset]
+                        if is_data:
+                            plan.append((histogram, processes_names.index("data_obs"), None, None))
+                            continue
+                        source_axis = histogram.axes["variation"]
+                        source_nominal = source_axis.index("nominal")
+                        target = [variations.index("nominal")]
+                        source = [source_nominal]
+                        for systematic in shape_systematics:
+                            for shift in ("Up", "Down"):
+                                source_variation = f"{systematic.get_coffea_name(process.name)}{shift}"
+                                target.append(variations.index(f"{systematic.datacard_name}{shift}"))
+                                if source_variation in source_axis:
+                                    source.append(source_axis.index(source_variation))
+                                else:
+                                    missing_variations.setdefault(sample, set()).add(source_variation)
+                                    source.append(source_nominal)
+                        plan.append((
+                            histogram,
+                            processes_names.index(f"{process.name}_{year}"),
+                            np.asarray(target),
+                            np.asarray(source),
+                        ))
+        if self.verbose:
+            for sample, missing in missing_variations.items():
+                print(
+                    f"Setting {len(missing)} missing variation(s) to nominal variation for sample {sample}: "
+                    f"{', '.join(sorted(missing))}"
+                )
+        return plan
+
+    def rearrange_histograms_by_category(
+        self,
+        is_data: bool = False,
+        categories: list[str] = None,
+    ) -> dict[str, hist.Hist]:
+        """Rearrange histograms from pocket_coffea output format to match processes
+        and systematics, for several categories in one pass over the input histograms.
+
+        The input bins of all the categories and source variations of each input histogram
+        are gathered at once from its ``view()`` and accumulated in the (category, process,
+        variation, bin) arrays of the output with NumPy fancy indexing.
+
+        :param is_data: Flag to indicate if the datacard is for data, defaults to False
+        :type is_data: bool, optional
+        :param categories: Categories to select; defaults to ``[self.category]``.
+        :type categories: list[str], optional
+        :return: Rearranged histogram of each category
+        :rtype: dict[str, hist.Hist]
+        """
+        categories = list(categories) if categories is not None else [self.category]
         if is_data:
             processes = self.data_processes
         else:
@@ -434,75 +509,48 @@ class Datacard:
             processes_names = [
                 "data_obs"
             ]  # For data, we use a single process name without year
-            new_histogram = hist.Hist(
-                hist.axis.StrCategory(processes_names, name="process"),
-                variable_axis,
-                storage=hist.storage.Weight(),
-            )
+            axes = [hist.axis.StrCategory(processes_names, name="process")]
+            variations = []
         else:
             processes_names = [
                 f"{process_name}_{year}"
                 for process_name, process in processes.items()
                 for year in process.years
             ]
-            new_histogram = hist.Hist(
+            variations = list(self.shape_variations)
+            axes = [
                 hist.axis.StrCategory(processes_names, name="process"),
-                hist.axis.StrCategory(self.shape_variations, name="variation"),
-                variable_axis,
-                storage=hist.storage.Weight(),
-            )
-        new_histogram_view = new_histogram.view()
-
-        for process in processes.values():
-            for sample in process.samples:
-                years = process.years
-                for year in years:
-                    assert year is not None, "Processes should have a year"
-                    for dataset in self.get_datasets_by_sample(sample, year):
-                        if self.is_empty_dataset(dataset):
-                            continue
-                        histogram = self.histograms[sample][dataset]
-                        if is_data:
-                            process_index = new_histogram.axes["process"].index(
-                                "data_obs"
-                            )
-                            new_histogram_view[process_index, :] += histogram[
-                                cat, :
-                            ].view()
-                        else:
-                            process_index = new_histogram.axes["process"].index(
-                                f"{process.name}_{year}"
-                            )
-                            # Save nominal variation
-                            variation_index_nominal = new_histogram.axes[
-                                "variation"
-                            ].index("nominal")
-                            new_histogram_view[
-                                process_index, variation_index_nominal, :
-                            ] += histogram[cat, "nominal", :].view()
-                            for (
-                                syst_name,
-                                systematic,
-                            ) in self.systematics.get_systematics_by_type(
-                                "shape"
-                            ).items():
-                                for shift in ("Up", "Down"):
-                                    source_variation = f"{systematic.get_coffea_name(process.name)}{shift}"
-                                    variation_index = new_histogram.axes[
-                                        "variation"
-                                    ].index(f"{systematic.datacard_name}{shift}")
-                                    if source_variation in histogram.axes["variation"]:
-                                        new_histogram_view[
-                                            process_index, variation_index, :
-                                        ] += histogram[cat, source_variation, :].view()
-                                    else:
-                                        print(
-                                            f"Setting `{source_variation}` variation to nominal variation for sample {sample}."
-                                        )
-                                        new_histogram_view[
-                                            process_index, variation_index, :
-                                        ] += histogram[cat, "nominal", :].view()
-        return new_histogram
+                hist.axis.StrCategory(variations, name="variation"),
+            ]
+        shape = (len(categories), len(processes_names)) + ((len(variations),) if not is_data else ()) + (len(variable_axis),)
+        values = np.zeros(shape)
+        variances = np.zeros(shape)
+
+        for histogram, process_index, target, source in self._rearrangement_plan(is_data, processes_names, variations):
+            category_axis = histogram.axes[0]
+            category_index = np.asarray(category_axis.index(categories))
+            if np.any(category_index >= len(category_axis)):
+                missing = [c for c in categories if c not in category_axis]
+                raise KeyError(f"Categories {missing} not found in the input histograms")
+            view = histogram.view()
+            if is_data:
+                selected = view[category_index]
+                values[:, process_index] += selected["value"]
+                variances[:, process_index] += selected["variance"]
+            else:
+                selected = view[category_index[:, None], source[None, :]]
+                # np.add.at accumulates several systematics with the same target variation
+                np.add.at(values[:, process_index], (slice(None), target), selected["value"])
+                np.add.at(variances[:, process_index], (slice(None), target), selected["variance"])
+
+        new_histograms = {}
+        for icat, cat in enumerate(categories):
+            new_histogram = hist.Hist(*axes, variable_axis, storage=hist.storage.Weight())
+            new_histogram_view = new_histogram.view()
+            new_histogram_view["value"] = values[icat]
+            new_histogram_view["variance"] = variances[icat]
+            new_histograms[cat] = new_histogram
+        return new_histograms
 
     def _all_input_categories(self) -> list[str]:
         """List the category labels available on the input histograms' category axis."""
@@ -532,9 +580,7 @@ class Datacard:
             return {}
 
         cats = self.rateparam_norm_categories or self._all_input_categories()
-        hists_by_cat = {
-            cat: self.rearrange_histograms(is_data=False, category=cat) for cat in cats
-        }
+        hists_by_cat = self.rearrange_histograms_by_category(is_data=False, categories=cats)
 
         shape_systs = self.systematics.get_systematics_by_type("shape")
         scales = {}
@@ -0,0 +1,61 @@
+"""Registry of the writers accumulating the outputs of many chunks in a worker process.
+
+The buffered column writer (`utils.parquet_writer`) and the coalescing skim writer
+(`utils.skim_writer`) keep one writer per output location in each worker process, shared by
+the chunks processed by the process (also from several threads, e.g. dask workers with more
+than one thread). The writers implement a thread-safe ``flush()`` writing all their buffers.
+
+The buffers are written:
+
+- explicitly by the runner with `flush_executor_writers`, at the end of the processing and
+  before each checkpoint, on all the dask workers or in the main process (iterative executor);
+- at the normal exit of the process, for the other workers (futures executor pool, parsl).
+"""
+import os
+import uuid
+import socket
+import threading
+import multiprocessing.util
+
+# Writers of the current process, by (pid, writer class, arguments)
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def new_worker_id():
+    '''Unique identifier of a writer, used in the name of its output files.'''
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+def get_worker_writer(writer_class, *args):
+    '''Return the writer of the current process built with `writer_class(*args)`, creating it if needed.'''
+    # The pid avoids reusing the writer of the parent in a forked process
+    key = (os.getpid(), writer_class, args)
+    with _writers_lock:
+        if key not in _writers:
+            writer = writer_class(*args)
+            # Run at the exit of the main process and of the multiprocessing workers
+            multiprocessing.util.Finalize(writer, writer.flush, exitpriority=10)
+            _writers[key] = writer
+        return _writers[key]
+
+
+def flush_worker_writers():
+    '''Write the buffers of all the writers of the current process.'''
+    with _writers_lock:
+        writers = [w for (pid, _, _), w in _writers.items() if pid == os.getpid()]
+    for writer in writers:
+        writer.flush()
+
+
+def flush_executor_writers(executor):
+    '''Write the buffers of the writers of the processes running the chunks of a coffea executor:
+    all the workers of a dask executor, the current process otherwise. The workers of the
+    futures executor are flushed when their pool is shut down at the end of each run; the
+    parsl workers only at their exit.'''
+    from coffea.processor import DaskExecutor
+
+    if isinstance(executor, DaskExecutor) and executor.client is not None:
+        executor.client.run(flush_worker_writers)
+    else:
+        flush_worker_writers()
@@ -17,11 +17,17 @@ from coffea.analysis_tools import PackedSelection
 from ..lib.weights.weights_manager import WeightsManager
 from ..lib.columns_manager import ColumnsManager
 from ..lib.hist_manager import HistManager
+from ..lib.sparse_hist import SparseHist, sparsify
 from ..lib.jets import load_jet_factory
 from ..lib.calibrators.calibrators_manager import CalibratorsManager
-from ..utils.skim import uproot_writeable, copy_file, apply_skim_sumgenweights_override
+from ..utils.skim import uproot_writeable, copy_file, apply_skim_sumgenweights_override, BranchesSelector, DEFAULT_KEEP_BRANCHES
+from ..utils.column_usage import load_branches_usage
 from ..utils.utils import dump_ak_array
+from ..utils.parquet_writer import get_buffered_writer
+from ..utils.skim_writer import get_coalescing_skim_writer
 from ..utils.metadata import to_bool
+from ..utils.adaptive_chunksize import ChunkPerformanceRecorder
+from ..utils.profiling import ProcessingProfiler, profile_stage, PROFILE_OUTPUT_KEY
 from ..lib.delayed_eval import DelayedEvalBranchManager
 
 from ..utils.configurator import Configurator
@@ -208,6 +214,20 @@ class BaseProcessorABC(processor.ProcessorABC, ABC):
         self.output['cutflow']['skim'][self._dataset] = self.nEvents_after_skim
         self.has_events = self.nEvents_after_skim > 0
 
+    def get_skim_branches_selector(self):
+        '''Selector of the branches written in the skimmed files: the branches read by the analysis
+        (JSON file of the `skim_branches_usage` workflow option, see utils.column_usage) and
+        the ones in the `skim_keep_branches` option. None (all the branches) if both are unset.'''
+        options = self.workflow_options or {}
+        usage_file = options.get("skim_branches_usage", None)
+        keep = options.get("skim_keep_branches", None)
+        if usage_file is None and keep is None:
+            return None
+        branches = list(DEFAULT_KEEP_BRANCHES) + list(keep or [])
+        if usage_file is not None:
+            branches += load_branches_usage(usage_file)
+        return BranchesSelector(branches)
+
     def export_skimmed_chunk(self):
         ''' Function that export the skimmed chunk to a new ROOT file.
         It rescales the genweight so that the processing on the skimmed file respects
@@ -223,29 +243,34 @@ class BaseProcessorABC(processor.ProcessorABC, ABC):
                 self.events["skimRescaleGenWeight"] =  np.ones(self.nEvents_after_skim) * self.output['sum_genweights'][self._dataset] / skimmed_sumw
             self.output['sum_genweights_skimmed'] = { self._dataset : skimmed_sumw }
 
-        filename = (
-            "__".join(
-                [
-                    self._dataset,
-                    self.events.metadata['fileuuid'],
-                    str(self.events.metadata['entrystart']),
-                    str(self.events.metadata['entrystop']),
-                ]
+        # Opt-in: write only the branches used by the analysis
+        keep_branches = self.get_skim_branches_selector()
+        target_size = self.workflow_options.get("skim_target_file_size_mb", None) if self.workflow_options else None
+        if target_size is not None:
+            # Opt-in: append the chunk to a larger file of the worker (see utils.skim_writer)
+            writer = get_coalescing_skim_writer(self.cfg.save_skimmed_files_folder, target_size)
+            skimmed_file = writer.write(self._dataset, uproot_writeable(self.events, keep_branches))
+        else:
+            filename = (
+                "__".join(
+                    [
+                        self._dataset,
+                        self.events.metadata['fileuuid'],
+                        str(self.events.metadata['entrystart']),
+                        str(self.events.metadata['entrystop']),
+                    ]
+                )
+                + ".root"
             )
-            + ".root"
-        )
-        with uproot.recreate(f"{filename}", compression=uproot.ZSTD(5)) as fout:
-            fout["Events"] = uproot_writeable(self.events)
-        # copy the file
-        copy_file(
-            filename, "./", self.cfg.save_skimmed_files_folder, subdirs=[self._dataset]
-        )
+            with uproot.recreate(f"{filename}", compression=uproot.ZSTD(5)) as fout:
+                fout["Events"] = uproot_writeable(self.events, keep_branches)
+            # copy the file
+            copy_file(
+                filename, "./", self.cfg.save_skimmed_files_folder, subdirs=[self._dataset]
+            )
+            skimmed_file = os.path.join(self.cfg.save_skimmed_files_folder, self._dataset, filename)
         # save the new file location for the new dataset definition
-        self.output["skimmed_files"] = {
-            self._dataset: [
-                os.path.join(self.cfg.save_skimmed_files_folder, self._dataset, filename)
-            ]
-        }
+        self.output["skimmed_files"] = {self._dataset: [skimmed_file]}
         self.output["nskimmed_events"] = {self._dataset: [self.nEvents_after_skim]}
 
     @abstractmethod
@@ -291,7 +316,13 @@ class BaseProcessorABC(processor.ProcessorABC, ABC):
         N.B.: Preselection happens after the objects correction and cleaning.'''
 
         # Now that the preselection mask is complete we can apply it to events
-        self.events = self.events[self.get_preselection_mask(variation)]
+        presel_mask = self.get_preselection_mask(variation)
+        if self.workflow_options.get("reuse_invariant_weights", False):
+            # Keep the events before the preselection to compute
+            # the weights invariant for the shape variations only once per chunk
+            self._events_before_presel = self.events
+            self._presel_mask = presel_mask
+        self.events = self.events[presel_mask]
         self.nEvents_after_presel = self.nevents
         self.output['cutflow']['presel'].setdefault(self._dataset, {})[variation] = self.nEvents_after_presel
         self.has_events = self.nEvents_after_presel > 0
@@ -357,6 +388,7 @@ class BaseProcessorABC(processor.ProcessorABC, ABC):
             self.weights_config_allsamples[self._sample],
             self.weights_classes,
             storeIndividual=False,
+            profiler=getattr(self, "_profiler", None),
             metadata={
                 "year": self._year,
                 "sample": self._sample,
@@ -374,9 +406,19 @@ class BaseProcessorABC(processor.ProcessorABC, ABC):
         calculation.
         '''
         # Compute the weights
-        self.weights_manager.compute(self.events,
-                                     size=self.nEvents_after_presel,
-                                     shape_variation=variation)
+        if self.workflow_options.get("reuse_invariant_weights", False):
+            self.weights_manager.compute(
+                self.events,
+                size=self.nEvents_after_presel,
+                shape_variation=variation,
+                events_before_presel=self._events_before_presel,
+                presel_mask=self._presel_mask,
+                modified_collections=self.calibrators_manager.get_modified_collections(variation),
+            )
+        else:
+            self.weights_manager.compute(self.events,
+                                         size=self.nEvents_after_presel,
+                                         shape_variation=variation)
 
     def compute_weights_extra(self, variation):
         '''Function that can be defined by user processors
@@ -457,6 +499,8 @@ class BaseProcessorABC(processor.ProcessorABC, ABC):
             calibrators_manager=self.calibrators_manager,
             custom_axes=self.custom_axes,
             isMC=self._isMC,
+            fill_engine=self.workflow_options.get("hist_fill_engine", "legacy") if self.workflow_options else "legacy",
+            cache_templates=self.workflow_options.get("hist_templates_cache", True) if self.workflow_options else True,
         )
 
     def define_histograms_extra(self):
@@ -520,6 +564,9 @@ class BaseProcessorABC(processor.ProcessorABC, ABC):
                     self._columns[name],
                     self._categories,
                     variations_config=self.cfg.variations_config[self._sample] if self._isMC else None,
+                    # Opt-in: chunked accumulators, concatenated only when accessed or saved
+                    accumulator=self.workflow_options.get("columns_accumulator", "column"),
+                    spill_threshold_mb=self.workflow_options.get("columns_spill_threshold_mb", None),
                 )
 
     def define_column_accumulators_extra(self):
@@ -557,7 +604,7 @@ class BaseProcessorABC(processor.ProcessorABC, ABC):
                     for category, akarr in out_arrays.items():
                         # building the file name
                         subdirs = [self._dataset, subs, category, variation]
-                        dump_ak_array(akarr, fname, self.workflow_options["dump_columns_as_arrays_per_chunk"] + "/", subdirs)
+                        self.dump_column_arrays(akarr, fname, subdirs)
 
                 else:
                     # Filling columns to be accumulated for all the chunks
@@ -594,7 +641,7 @@ class BaseProcessorABC(processor.ProcessorABC, ABC):
                          + ".parquet")
                 for category, akarr in out_arrays.items():
                     subdirs = [self._dataset, category, variation]
-                    dump_ak_array(akarr, fname, self.workflow_options["dump_columns_as_arrays_per_chunk"] + "/", subdirs)
+                    self.dump_column_arrays(akarr, fname, subdirs)
             else:
                 outcols[self._sample] = {self._dataset: self.column_managers[
                     self._sample
@@ -606,6 +653,15 @@ class BaseProcessorABC(processor.ProcessorABC, ABC):
                     weights_manager=self.weights_manager
                 )}
 
+    def dump_column_arrays(self, akarr, fname, subdirs):
+        '''Export the columns of the chunk for a category and variation in the
+        `dump_columns_as_arrays_per_chunk` location: directly as a parquet file of the chunk or,
+        with the `dump_columns_buffer_size_mb` option, through the buffered writer of the worker.'''
+        if self._columns_writer is not None:
+            self._columns_writer.stage(self._columns_staging, subdirs, akarr)
+        else:
+            dump_ak_array(akarr, fname, self.workflow_options["dump_columns_as_arrays_per_chunk"] + "/", subdirs)
+
     def fill_column_accumulators_extra(self, variation):
         pass
 
@@ -673,11 +729,30 @@ class BaseProcessorABC(processor.ProcessorABC, ABC):
                     self.output["processing_metadata"][f"throughput_per_chunk_{k}"][
                         self._sample][self._dataset] = hepc.hist_obj
 
+        if self._chunk_recorder is not None:
+            self.output["chunk_performance"] = {
+                self._sample: [self._chunk_recorder.measurement(self.nEvents_initial, self.stop_time)]
+            }
+        self.save_processing_profile()
+
+    def profile_stage(self, name):
+        '''Context manager measuring a stage of the processing if the
+        `profile_processing` workflow option is active, otherwise a no-op.'''
+        return profile_stage(getattr(self, "_profiler", None), name)
+
+    def save_processing_profile(self):
+        '''Store the per-stage profile of the chunk in the output, if the profiling is active.'''
+        if getattr(self, "_profiler", None) is not None:
+            self.output[PROFILE_OUTPUT_KEY] = {
+                self._sample: self._profiler.to_output(self.nEvents_initial)
+            }
 
     def initialize_calibrators(self):
         '''Creates the calibator manager and initialize all the calibrators.
         This prepares also the list of avaialable shape variations for this chunk.
         That will be utilized by the HistManager to create the histograms variations axes.'''
+        # Opt-in: re-run for each shape variation only the calibrators affected by it
+        skip_unaffected = self.workflow_options.get("skip_unaffected_calibrators", False)
 
         if self.params.jets_calibration.get("legacy_txt_calibration", False):
             self.calibrators_manager = CalibratorsManager(
@@ -686,6 +761,8 @@ class BaseProcessorABC(processor.ProcessorABC, ABC):
                 self.params,
                 self._metadata,
                 requested_calibrator_variations=self.cfg.available_shape_variations[self._sample],
+                skip_unaffected_calibrators=skip_unaffected,
+                profiler=getattr(self, "_profiler", None),
                 # Additional arg to pass the jmefactory to the jet calibrator --> hack until we remove it
                 jme_factory=self.jmefactory,
             )
@@ -696,6 +773,8 @@ class BaseProcessorABC(processor.ProcessorABC, ABC):
                 self.params,
                 self._metadata,
                 requested_calibrator_variations=self.cfg.available_shape_variations[self._sample],
+                skip_unaffected_calibrators=skip_unaffected,
+                profiler=getattr(self, "_profiler", None),
             )
 
     def _announce_skim_mode(self, skim_mode):
@@ -783,6 +862,28 @@ class BaseProcessorABC(processor.ProcessorABC, ABC):
           - count events in each category
         '''
         self.start_time = time.time()
+        # Opt-in: measure time and memory of the chunk for the adaptive chunksize (see utils.adaptive_chunksize)
+        if self.workflow_options.get("record_chunk_performance", False):
+            self._chunk_recorder = ChunkPerformanceRecorder(self.start_time)
+        else:
+            self._chunk_recorder = None
+        # Opt-in: per-stage wall time, CPU time and memory profiling (see utils.profiling)
+        if self.workflow_options.get("profile_processing", False):
+            self._profiler = ProcessingProfiler()
+        else:
+            self._profiler = None
+        # Opt-in: buffer the exported column arrays in the worker and write them in large files
+        # (see utils.parquet_writer)
+        if (self.workflow_options.get("dump_columns_as_arrays_per_chunk", None) is not None
+            and self.workflow_options.get("dump_columns_buffer_size_mb", None) is not None):
+            self._columns_writer = get_buffered_writer(
+                self.workflow_options["dump_columns_as_arrays_per_chunk"] + "/",
+                self.workflow_options["dump_columns_buffer_size_mb"],
+            )
+            self._columns_staging = self._columns_writer.begin_chunk()
+        else:
+            self._columns_writer = None
+            self._columns_staging = None
         self.events = events
         # Define the accumulator instance for this chunk
         self.output = copy.deepcopy(self.output_format)
@@ -813,11 +914,13 @@ class BaseProcessorABC(processor.ProcessorABC, ABC):
         # BE CAREFUL: objects are not corrected and cleaned at this stage, the skimming
         # selections MUST be loose and inclusive w.r.t the final selections.
         #########################
-        # Customization point for derived workflows before skimming
-        self.process_extra_before_skim()
-        # MET filter, lumimask, + custom skimming function
-        self.skim_events()
+        with self.profile_stage("skim"):
+            # Customization point for derived workflows before skimming
+            self.process_extra_before_skim()
+            # MET filter, lumimask, + custom skimming function
+            self.skim_events()
         if not self.has_events:
+            self.save_processing_profile()
             return self.output
 
         skim_mode = self.workflow_options.get("skim_mode", "skim") if self.workflow_options else "skim"
@@ -828,7 +931,9 @@ class BaseProcessorABC(processor.ProcessorABC, ABC):
                 f"[skim] {self._dataset}: mode='skim' — exporting {self.nEvents_after_skim} events "
                 f"(skim cuts on raw NanoAOD, no calibration / no preselection)."
             )
-            self.export_skimmed_chunk()
+            with self.profile_stage("skim_export"):
+                self.export_skimmed_chunk()
+            self.save_processing_profile()
             return self.output
 
         # --- Systematic-aware skimming logic
@@ -867,9 +972,12 @@ class BaseProcessorABC(processor.ProcessorABC, ABC):
             )
 
             if not self.has_events:
+                self.save_processing_profile()
                 return self.output
 
-            self.export_skimmed_chunk()
+            with self.profile_stage("skim_export"):
+                self.export_skimmed_chunk()
+            self.save_processing_profile()
             return self.output
         # --------------------------
 
@@ -880,34 +988,38 @@ class BaseProcessorABC(processor.ProcessorABC, ABC):
 
         self.process_extra_after_skim()
         # Define and load the calibators
-        self.initialize_calibrators()
-        # Define and load the weights manager
-        self.define_weights()
-        # Create the HistManager and ColumnManager before systematic variations
-        self.define_custom_axes_extra()
-        self.define_histograms()
-        self.define_histograms_extra()
-        self.define_column_accumulators()
-        self.define_column_accumulators_extra()
+        with self.profile_stage("calibrators"):
+            self.initialize_calibrators()
+        with self.profile_stage("setup"):
+            # Define and load the weights manager
+            self.define_weights()
+            # Create the HistManager and ColumnManager before systematic variations
+            self.define_custom_axes_extra()
+            self.define_histograms()
+            self.define_histograms_extra()
+            self.define_column_accumulators()
+            self.define_column_accumulators_extra()
 
         for variation in self.loop_over_variations():
-            # Custom code just after calibrations
-            self.process_extra_after_calibrators(variation)
-            # Apply preselections
-            self.apply_object_preselection(variation)
-            self.count_objects(variation)
-            # Compute variables after object preselection
-            self.define_common_variables_before_presel(variation)
-            # Customization point for derived workflows after preselection cuts
-            self.process_extra_before_presel(variation)
-
-            # Prepare delayed branches snapshot on nominal before preselections filter out events
-            if variation == "nominal":
-                self.delayed_branches.prepare_nominal_snapshot(self.events)
+            with self.profile_stage("object_preselection"):
+                # Custom code just after calibrations
+                self.process_extra_after_calibrators(variation)
+                # Apply preselections
+                self.apply_object_preselection(variation)
+                self.count_objects(variation)
+                # Compute variables after object preselection
+                self.define_common_variables_before_presel(variation)
+                # Customization point for derived workflows after preselection cuts
+                self.process_extra_before_presel(variation)
+
+            with self.profile_stage("preselection"):
+                # Prepare delayed branches snapshot on nominal before preselections filter out events
+                if variation == "nominal":
+                    self.delayed_branches.prepare_nominal_snapshot(self.events)
 
-            # This will remove all the events not passing preselection
-            # from further processing
-            self.apply_preselections(variation)
+                # This will remove all the events not passing preselection
+                # from further processing
+                self.apply_preselections(variation)
 
             # nEvents_after_presel is overwritten by every variation; remember the
             # nominal one so save_processing_metadata (run once after this loop)
@@ -923,30 +1035,47 @@ class BaseProcessorABC(processor.ProcessorABC, ABC):
             ##########################
             # After the preselection cuts has been applied more processing is performend
             ##########################
-            # Customization point for derived workflows after preselection cuts
-            self.define_common_variables_after_presel(variation)
-            self.process_extra_after_presel(variation)
+            with self.profile_stage("preselection"):
+                # Customization point for derived workflows after preselection cuts
+                self.define_common_variables_after_presel(variation)
+                self.process_extra_after_presel(variation)
 
-            # This function applies all the cut functions in the cfg file
-            # Each category is an AND of some cuts.
-            self.define_categories(variation)
+            with self.profile_stage("categories"):
+                # This function applies all the cut functions in the cfg file
+                # Each category is an AND of some cuts.
+                self.define_categories(variation)
 
-            # Update delayed branches for this variation after final categories are defined
-            # so they see the final selection masks
-            self.delayed_branches.update_for_current_variation(self.events, self._categories)
+                # Update delayed branches for this variation after final categories are defined
+                # so they see the final selection masks
+                self.delayed_branches.update_for_current_variation(self.events, self._categories)
 
             # Weights
-            self.compute_weights(variation)
-            self.compute_weights_extra(variation)
+            with self.profile_stage("weights"):
+                self.compute_weights(variation)
+                self.compute_weights_extra(variation)
 
             # Fill histograms
-            self.fill_histograms(variation)
-            self.fill_histograms_extra(variation)
-            self.fill_column_accumulators(variation)
-            self.fill_column_accumulators_extra(variation)
+            with self.profile_stage("histograms"):
+                self.fill_histograms(variation)
+                self.fill_histograms_extra(variation)
+            with self.profile_stage("columns"):
+                self.fill_column_accumulators(variation)
+                self.fill_column_accumulators_extra(variation)
 
             # Count events
-            self.count_events(variation)
+            with self.profile_stage("count_events"):
+                self.count_events(variation)
+
+        if self._columns_writer is not None:
+            # The chunk is completed: its columns can be written
+            with self.profile_stage("columns"):
+                self._columns_writer.commit(self._columns_staging)
+
+        # Opt-in: store only the filled (category, variation) blocks of the histograms
+        # (see lib.sparse_hist)
+        if self.workflow_options.get("sparse_histograms", False):
+            with self.profile_stage("histograms"):
+                sparsify(self.output["variables"])
 
         self.stop_time = time.time()
         self.save_processing_metadata()
@@ -1095,7 +1224,11 @@ class BaseProcessorABC(processor.ProcessorABC, ABC):
         for var, vardata in accumulator["variables"].items():
             for samplename, dataset_in_sample in vardata.items():
                 for dataset, histo in dataset_in_sample.items():
-                    if not np.all(np.isfinite(histo.values().flatten())):
+                    if isinstance(histo, SparseHist):
+                        finite = histo.values_are_finite()
+                    else:
+                        finite = np.all(np.isfinite(histo.values().flatten()))
+                    if not finite:
                         raise Exception(
                             f"NaN or Inf values in the histogram {var} for dataset {dataset} after rescaling"
                         )
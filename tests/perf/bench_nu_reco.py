@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""Benchmark of the dileptonic neutrino reconstruction: the array-at-a-time
+`reconstruction.pnuCalculator_vectorized` against the per-event loop of `pnuCalculator_v7`.
+
+The events are synthetic (one lepton and one anti-lepton, 0-4 b-jets, one fatjet and a random
+MET per event) and a toy PDF replaces lhapdf, so no input file nor lhapdf installation is
+needed. The outputs are checked to be equal (up to floating point rounding) and the time of
+both implementations is printed, without and with the (m_t, m_W) scan.
+
+    python tests/perf/bench_nu_reco.py --nevents 100 500 --scan-points 3
+"""
+import argparse
+import contextlib
+import io
+import time
+import types
+
+import numpy as np
+import awkward as ak
+from coffea.nanoevents.methods import candidate
+
+from pocket_coffea.lib import reconstruction
+from pocket_coffea.lib.reconstruction import pnuCalculator_v7, pnuCalculator_vectorized
+
+
+class ToyPDF:
+    def xfxQ(self, pid, x, Q):
+        return x**0.3 * (1 - x) ** (3 + abs(pid) % 7) * (1 + 0.1 * pid)
+
+
+def make_candidates(rng, counts, mass):
+    n = int(np.sum(counts))
+    flat = ak.zip(
+        {
+            "pt": rng.exponential(60.0, n) + 20.0,
+            "eta": rng.uniform(-2.4, 2.4, n),
+            "phi": rng.uniform(-np.pi, np.pi, n),
+            "mass": mass(n),
+            "charge": np.zeros(n),
+        },
+        with_name="PtEtaPhiMCandidate",
+        behavior=candidate.behavior,
+    )
+    return ak.unflatten(flat, counts)
+
+
+def make_events(nevents, seed=7):
+    rng = np.random.default_rng(seed)
+    ones = np.ones(nevents, dtype=int)
+    leptons = ak.flatten(make_candidates(rng, ones, lambda n: np.full(n, 0.105)))
+    leptons_bar = ak.flatten(make_candidates(rng, ones, lambda n: np.full(n, 0.000511)))
+    bjets = make_candidates(rng, rng.integers(0, 5, nevents), lambda n: rng.uniform(5, 20, n))
+    fatjets = ak.flatten(make_candidates(rng, ones, lambda n: rng.uniform(50, 200, n)))
+    METs = ak.zip(
+        {"r": rng.exponential(80.0, nevents), "phi": rng.uniform(-np.pi, np.pi, nevents)},
+        with_name="PolarTwoVector",
+        behavior=candidate.behavior,
+    )
+    return leptons, leptons_bar, bjets, METs, fatjets
+
+
+def check_equal(reference, vectorized):
+    assert np.array_equal(reference[4], vectorized[4])
+    for ref, vec in zip(reference[:4], vectorized[:4]):
+        for field in ak.fields(ref):
+            # The neutrino mass is the cancellation sqrt(E^2 - p^2) of a massless vector
+            atol = 1e-3 if field == "mass" else 1e-6
+            np.testing.assert_allclose(ak.to_numpy(vec[field]), ak.to_numpy(ref[field]),
+                                       rtol=1e-6, atol=atol, equal_nan=True, err_msg=field)
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    # pnuCalculator_v7 prints the mass hypothesis for each event
+    with contextlib.redirect_stdout(io.StringIO()):
+        out = func(*args, **kwargs)
+    return time.perf_counter() - start, out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nevents", type=int, nargs="+", default=[100, 500])
+    parser.add_argument("--scan-points", type=int, default=3, help="Number of m_t and m_W points of the scan")
+    args = parser.parse_args()
+
+    reconstruction.nureco = {
+        "PDF": "toy",
+        "Ecm": 13000.0,
+        "Q": 173.0,
+        "m_t": {"nominal": 172.5, "scan": [170.0, 175.0, args.scan_points]},
+        "m_W": {"nominal": 80.4, "scan": [79.9, 80.9, args.scan_points]},
+        "m_b": {"nominal": 4.8},
+    }
+    reconstruction.lhapdf = types.SimpleNamespace(UP=2, AUP=-2, DOWN=1, ADOWN=-1, GLUON=21,
+                                                  mkPDF=lambda name: ToyPDF())
+
+    for nevents in args.nevents:
+        inputs = make_events(nevents)
+        for scan in [False, True]:
+            t_ref, out_ref = timed(pnuCalculator_v7, *inputs, scan=scan)
+            t_new, out_new = timed(pnuCalculator_vectorized, *inputs, scan=scan)
+            check_equal(out_ref, out_new)
+            label = f"scan {args.scan_points}x{args.scan_points}" if scan else "nominal"
+            print(f"nevents={nevents:>7} {label:>9}: per-event {t_ref * 1e3:9.1f} ms, "
+                  f"vectorized {t_new * 1e3:7.1f} ms, speedup x{t_ref / t_new:.0f} "
+                  f"({out_new[4].sum()} events with solutions, outputs equal)")
+
+
+if __name__ == "__main__":
+    main()
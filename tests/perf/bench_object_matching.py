@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""Benchmark of the greedy deltaR matching of `deltaR_matching`: the ak.ArrayBuilder based
+`object_matching` against the array-native `object_matching_flat`.
+
+Synthetic partons and jets are generated with multiplicities typical of semileptonic ttH(bb)
+events (6-8 partons, 4-12 jets), with jets close in (eta, phi) to a subset of the partons
+so that the matching is not trivial. The outputs of the two implementations are checked to
+be identical and the best time of a few repetitions (after the numba compilation) is printed.
+
+    python tests/perf/bench_object_matching.py --nevents 10000 100000 --dpt-max 30
+"""
+import argparse
+import time
+
+import numpy as np
+import awkward as ak
+from coffea.nanoevents.methods import vector
+
+from pocket_coffea.lib.deltaR_matching import object_matching, object_matching_flat
+
+ak.behavior.update(vector.behavior)
+
+
+def make_objects(pt, eta, phi, counts):
+    return ak.zip(
+        {
+            "pt": ak.unflatten(pt, counts),
+            "eta": ak.unflatten(eta, counts),
+            "phi": ak.unflatten(phi, counts),
+            "mass": ak.unflatten(np.zeros(len(pt), dtype=pt.dtype), counts),
+        },
+        with_name="PtEtaPhiMLorentzVector",
+    )
+
+
+def make_ttH_like(nevents, seed=42):
+    rng = np.random.default_rng(seed)
+    n_partons = rng.integers(6, 9, nevents)
+    n_jets = rng.integers(4, 13, nevents)
+    npart, njet = n_partons.sum(), n_jets.sum()
+    p_pt = rng.exponential(60.0, npart).astype(np.float32) + 20
+    p_eta = rng.uniform(-2.5, 2.5, npart).astype(np.float32)
+    p_phi = rng.uniform(-np.pi, np.pi, npart).astype(np.float32)
+    # Each jet is a smeared copy of a random parton of the same event (or a random jet)
+    parton_start = np.cumsum(n_partons) - n_partons
+    jet_event = np.repeat(np.arange(nevents), n_jets)
+    src = parton_start[jet_event] + (rng.random(njet) * n_partons[jet_event]).astype(np.int64)
+    fake = rng.random(njet) < 0.3
+    j_pt = np.where(fake, rng.exponential(40.0, njet) + 20, p_pt[src] * rng.normal(1, 0.15, njet)).astype(np.float32)
+    j_eta = np.where(fake, rng.uniform(-2.5, 2.5, njet), p_eta[src] + rng.normal(0, 0.1, njet)).astype(np.float32)
+    j_phi = np.where(fake, rng.uniform(-np.pi, np.pi, njet), p_phi[src] + rng.normal(0, 0.1, njet)).astype(np.float32)
+    return make_objects(p_pt, p_eta, p_phi, n_partons), make_objects(j_pt, j_eta, j_phi, n_jets)
+
+
+def best_time(func, args, kwargs, repeat):
+    best, out = np.inf, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return out, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--nevents", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--dr-min", type=float, default=0.4)
+    parser.add_argument("--dpt-max", type=float, default=None)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    kwargs = dict(dr_min=args.dr_min, dpt_max=args.dpt_max, return_indices=True)
+    # numba compilation of both implementations
+    partons, jets = make_ttH_like(100)
+    object_matching(partons, jets, **kwargs)
+    object_matching_flat(partons, jets, **kwargs)
+
+    print(f"{'nevents':>10} {'ArrayBuilder [s]':>18} {'flat [s]':>10} {'speedup':>8}")
+    for nevents in args.nevents:
+        partons, jets = make_ttH_like(nevents)
+        out_ref, t_ref = best_time(object_matching, (partons, jets), kwargs, args.repeat)
+        out_new, t_new = best_time(object_matching_flat, (partons, jets), kwargs, args.repeat)
+        for a, b in zip(out_ref, out_new):
+            assert ak.to_list(a) == ak.to_list(b), "outputs differ"
+        print(f"{nevents:>10} {t_ref:>18.3f} {t_new:>10.3f} {t_ref / t_new:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""Microbenchmark of `parton_provenance.reverse_index_array` (binary search) against the
+reference linear-scan implementation `reverse_index_array_linear`.
+
+Synthetic GenPart trees are generated for each requested number of events: a chunk of
+2 x N events with a random number of genparts per event, of which a random half is kept
+(as after a preselection mask), so that the global indices of the kept events have gaps.
+Random global indices of genparts of the kept events are converted to flat indices with
+both implementations; the outputs are checked to be identical and the timings printed.
+
+    python tests/perf/bench_reverse_index.py --nevents 100000 1000000 --nidx 2000
+
+The linear scan is O(N_idx x N_events), so --nidx-linear limits the number of indices
+converted with it (the timing is extrapolated to --nidx).
+"""
+import argparse
+import time
+
+import numpy as np
+
+from pocket_coffea.lib.parton_provenance import reverse_index_array, reverse_index_array_linear
+
+
+def make_genparts_tree(nevents, seed=42, min_parts=20, max_parts=80):
+    '''Return (firstgenpart_idxG_numpy, genparts_offsets, counts) for a synthetic
+    masked chunk of `nevents` events.'''
+    rng = np.random.default_rng(seed)
+    counts_all = rng.integers(min_parts, max_parts, 2 * nevents)
+    first_all = np.zeros(len(counts_all), dtype=np.int64)
+    np.cumsum(counts_all[:-1], out=first_all[1:])
+    kept = np.sort(rng.choice(len(counts_all), nevents, replace=False))
+    counts = counts_all[kept]
+    offsets = np.zeros(nevents, dtype=np.int64)
+    np.cumsum(counts[:-1], out=offsets[1:])
+    return first_all[kept], offsets, counts
+
+
+def make_indices(first, offsets, counts, nidx, seed=7):
+    '''Random global indices of genparts of the kept events and the expected flat indices.'''
+    rng = np.random.default_rng(seed)
+    events = rng.integers(0, len(counts), nidx)
+    local = (rng.random(nidx) * counts[events]).astype(np.int64)
+    return first[events] + local, offsets[events] + local
+
+
+def timeit(func, *args, repeat=3):
+    func(*args)  # jit compilation
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return out, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--nevents", type=int, nargs="+", default=[100_000, 1_000_000])
+    parser.add_argument("--nidx", type=int, default=2000, help="Number of indices to convert")
+    parser.add_argument("--nidx-linear", type=int, default=200,
+                        help="Number of indices converted with the linear scan")
+    args = parser.parse_args()
+
+    print(f"{'nevents':>10} {'binary [s]':>12} {'linear [s]':>12} {'speedup':>10}")
+    for nevents in args.nevents:
+        first, offsets, counts = make_genparts_tree(nevents)
+        idxGs, expected = make_indices(first, offsets, counts, args.nidx)
+        out, t_bin = timeit(reverse_index_array, idxGs, first, offsets, nevents)
+        assert np.array_equal(out, expected)
+        nlin = min(args.nidx_linear, args.nidx)
+        out_lin, t_lin = timeit(reverse_index_array_linear, idxGs[:nlin], first, offsets, nevents, repeat=1)
+        assert np.array_equal(out_lin, out[:nlin])
+        t_lin *= args.nidx / nlin
+        print(f"{nevents:>10} {t_bin:>12.2e} {t_lin:>12.2e} {t_lin / t_bin:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
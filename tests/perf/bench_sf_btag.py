@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""Benchmark of the btag shape SF evaluation of `scale_factors.sf_btag`: the batched
+evaluation of all the variations in one (n_variations x n_jets) matrix reduced with a single
+`np.multiply.reduceat`, against the reference per-variation copy + `ak.unflatten` + `ak.prod`.
+
+A synthetic correctionlib file with the inputs of the BTV shape corrections is written in a
+temporary folder; jets have ttH-like multiplicities. The outputs are checked to be identical
+and the best time of a few repetitions is printed for the nominal call (central + 9 regular
+up/down variations) and for a set of JES-correlated calls (one per JES variation).
+
+    python tests/perf/bench_sf_btag.py --nevents 10000 100000 --njes 30
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import awkward as ak
+import correctionlib.schemav2 as cs
+from omegaconf import OmegaConf
+
+from pocket_coffea.lib.scale_factors import sf_btag, _btag_jes_variation_name, load_correction_set
+
+SYSTEMATICS = ["hf", "lf", "hfstats1", "hfstats2", "lfstats1", "lfstats2", "cferr1", "cferr2", "jes"]
+
+
+def write_correction(path, jes_sources):
+    keys = ["central"] + [f"{d}_{s}" for s in SYSTEMATICS + [f"jes{j}" for j in jes_sources]
+                          for d in ["up", "down"]]
+    # Binned in (abseta, pt, discriminant) as the BTV shape corrections
+    edges = [[0, 0.8, 1.6, 2.5], [20, 30, 50, 70, 100, 140, 200, 300, 600, 1000, 14000],
+             list(np.linspace(0, 1, 21))]
+    nbins = 3 * 10 * 20
+    rng = np.random.default_rng(1)
+    content = [
+        cs.CategoryItem(key=k, value=cs.MultiBinning(
+            nodetype="multibinning", inputs=["abseta", "pt", "discriminant"], edges=edges,
+            content=list(rng.normal(1.0, 0.05, nbins)), flow="clamp"))
+        for k in keys
+    ]
+    corr = cs.Correction(
+        name="deepJet_shape", version=1,
+        inputs=[cs.Variable(name="systematic", type="string"), cs.Variable(name="flavor", type="int"),
+                cs.Variable(name="abseta", type="real"), cs.Variable(name="pt", type="real"),
+                cs.Variable(name="discriminant", type="real")],
+        output=cs.Variable(name="weight", type="real"),
+        data=cs.Category(nodetype="category", input="systematic", content=content),
+    )
+    with open(path, "w") as f:
+        f.write(cs.CorrectionSet(schema_version=2, corrections=[corr]).model_dump_json(exclude_unset=True))
+
+
+def make_jets(nevents, seed=42):
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(4, 13, nevents)
+    n = counts.sum()
+    flat = ak.zip({
+        "pt": rng.exponential(60.0, n) + 20,
+        "eta": rng.uniform(-2.5, 2.5, n),
+        "hadronFlavour": rng.choice([0, 4, 5], n, p=[0.6, 0.1, 0.3]),
+        "btagDeepFlavB": rng.uniform(0, 1, n),
+    })
+    return ak.unflatten(flat, counts), counts
+
+
+def sf_btag_per_variation(params, jets, year, njets, variations):
+    '''Per-variation evaluation, as done before the batched evaluator.'''
+    btagSF = params.jet_scale_factors.btagSF[year]
+    corr = load_correction_set(btagSF.file)[btagSF.name]
+    flavour = ak.to_numpy(ak.flatten(jets.hadronFlavour))
+    abseta = np.abs(ak.to_numpy(ak.flatten(jets.eta)))
+    pt = ak.to_numpy(ak.flatten(jets.pt))
+    discr = ak.to_numpy(ak.flatten(jets.btagDeepFlavB))
+    central = corr.evaluate("central", flavour, abseta, pt, discr)
+
+    def with_mask(variation, mask):
+        index = (np.indices(discr.shape)).flatten()[mask]
+        sf = np.copy(central)
+        sf[index] = corr.evaluate(variation, flavour[mask], abseta[mask], pt[mask], discr[mask])
+        return ak.prod(ak.unflatten(sf, njets), axis=1)
+
+    out = {}
+    for var in variations:
+        if var == "central":
+            out[var] = [ak.prod(ak.unflatten(central, njets), axis=1)]
+        elif "cferr" in var:
+            out[var] = [np.ones(len(njets)), with_mask(f"up_{var}", flavour == 4),
+                        with_mask(f"down_{var}", flavour == 4)]
+        elif var.startswith("JES"):
+            out["central"] = [with_mask(_btag_jes_variation_name(var), flavour != 4)]
+        else:
+            out[var] = [np.ones(len(njets)), with_mask(f"up_{var}", flavour != 4),
+                        with_mask(f"down_{var}", flavour != 4)]
+    return out
+
+
+def run_calls(func, params, jets, counts, calls):
+    return [func(params, jets, "2018", counts, variations) for variations in calls]
+
+
+def best_time(func, args, repeat):
+    best, out = np.inf, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nevents", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--njes", type=int, default=30, help="Number of JES sources (x2 up/down calls)")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    jes_sources = [f"Source{i}" for i in range(args.njes // 2)]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "btagging.json")
+        write_correction(path, jes_sources)
+        params = OmegaConf.create({
+            "jet_scale_factors": {"btagSF": {"2018": {"file": path, "name": "deepJet_shape"}}},
+            "btagging": {"working_point": {"2018": {"btagging_algorithm": "btagDeepFlavB"}}},
+        })
+        nominal_calls = [["central"] + SYSTEMATICS[:-1]]
+        jes_calls = [[f"JES_{s}_AK4PFchs{d}"] for s in jes_sources for d in ["Up", "Down"]]
+
+        for nevents in args.nevents:
+            jets, counts = make_jets(nevents)
+            for label, calls in [("nominal", nominal_calls), (f"{len(jes_calls)} JES", jes_calls)]:
+                t_ref, out_ref = best_time(run_calls, (sf_btag_per_variation, params, jets, counts, calls), args.repeat)
+                t_new, out_new = best_time(run_calls, (sf_btag, params, jets, counts, calls), args.repeat)
+                for o_ref, o_new in zip(out_ref, out_new):
+                    assert o_ref.keys() == o_new.keys()
+                    for key in o_ref:
+                        for a, b in zip(o_ref[key], o_new[key]):
+                            assert np.array_equal(ak.to_numpy(a), np.asarray(b)), key
+                print(f"nevents={nevents:>8} {label:>8}: per-variation {t_ref * 1e3:8.1f} ms, "
+                      f"batched {t_new * 1e3:8.1f} ms, speedup x{t_ref / t_new:.1f} (outputs identical)")
+
+
+if __name__ == "__main__":
+    main()
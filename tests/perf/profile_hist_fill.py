@@ -22,6 +22,14 @@ caching/reordering change):
     git stash pop
     python tests/profiling/profile_hist_fill.py --compare /tmp/prof/output_before.coffea /tmp/prof/output_after.coffea
 
+The columnar fill engine (`workflow_options["hist_fill_engine"] = "columnar"`) can be A/B-ed
+against the default one without touching the code, with the --fill-engine option:
+
+    python tests/profiling/profile_hist_fill.py --cfg <cfg> --outdir /tmp/prof --label legacy   --save-output
+    python tests/profiling/profile_hist_fill.py --cfg <cfg> --outdir /tmp/prof --label columnar --save-output \
+        --fill-engine columnar
+    python tests/profiling/profile_hist_fill.py --compare /tmp/prof/output_legacy.coffea /tmp/prof/output_columnar.coffea
+
 The comparison is exact (numpy.array_equal) over every histogram (values and variances,
 flow included) plus sumw / sumw2 / cutflow.
 
@@ -39,10 +47,12 @@ import numpy as np
 # (called for every broadcast request); `mask_and_broadcast_weight` is the wrapped body,
 # so its call count is the number of actual broadcasts (i.e. cache misses).
 _WATCH = ("fill_histograms", "inner", "mask_and_broadcast_weight",
-          "get_masks", "ones_like", "flatten", "broadcast_arrays")
+          "get_masks", "ones_like", "flatten", "broadcast_arrays",
+          "_fill_histogram_columnar", "prepare_entries", "add")
 
 
-def run_and_profile(cfg_path, outdir, label, chunksize, limit_files, limit_chunks, save_output):
+def run_and_profile(cfg_path, outdir, label, chunksize, limit_files, limit_chunks, save_output,
+                    fill_engine=None):
     from coffea.processor import Runner
     from coffea.nanoevents import NanoAODSchema
     from coffea.util import save
@@ -55,6 +65,8 @@ def run_and_profile(cfg_path, outdir, label, chunksize, limit_files, limit_chunk
     # load_config resolves relative paths (datasets/params) from the config's own directory
     os.chdir(os.path.dirname(cfg_path))
     config = load_config(os.path.basename(cfg_path), save_config=True, outputdir=outdir)
+    if fill_engine is not None:
+        config.workflow_options["hist_fill_engine"] = fill_engine
 
     run_options = defaults.get_default_run_options()["general"]
     run_options["limit-files"] = limit_files
@@ -158,6 +170,8 @@ def main():
     parser.add_argument("--limit-chunks", type=int, default=1)
     parser.add_argument("--save-output", action="store_true",
                         help="save the accumulated output as output_<label>.coffea for --compare")
+    parser.add_argument("--fill-engine", choices=["legacy", "columnar"], default=None,
+                        help="HistManager fill engine (default: the one of the config workflow_options)")
     parser.add_argument("--compare", nargs=2, metavar=("BEFORE.coffea", "AFTER.coffea"),
                         help="compare two saved outputs bit-for-bit and exit")
     args = parser.parse_args()
@@ -167,7 +181,7 @@ def main():
     if not args.cfg:
         parser.error("either --cfg or --compare is required")
     run_and_profile(args.cfg, args.outdir, args.label, args.chunksize,
-                    args.limit_files, args.limit_chunks, args.save_output)
+                    args.limit_files, args.limit_chunks, args.save_output, args.fill_engine)
 
 
 if __name__ == "__main__":
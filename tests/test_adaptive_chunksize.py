@@ -0,0 +1,86 @@
+"""Offline tests of the adaptive per-sample chunksize derived from the measured chunks."""
+import numpy as np
+import uproot
+from coffea import processor
+
+from pocket_coffea.utils.adaptive_chunksize import (
+    ChunkPerformanceRecorder,
+    ChunksizeProfile,
+    derive_chunksize,
+    get_chunksizes_from_run_options,
+    parse_memory_mb,
+)
+from pocket_coffea.utils.run import PerDatasetChunksizeRunner
+
+
+def test_derive_chunksize_time_limited():
+    # 1 ms per event, no memory growth
+    measurements = [[10_000, 10.0, 500., None], [20_000, 20.0, 500., None], [5_000, 5.5, 500., None]]
+    assert derive_chunksize(measurements, target_time=60) == 60_000
+    assert derive_chunksize(measurements, target_time=60, target_memory=2000) == 60_000
+    assert derive_chunksize(measurements, target_time=60, max_chunksize=50_000) == 50_000
+    assert derive_chunksize(measurements, target_time=0.1, min_chunksize=5_000) == 5_000
+
+
+def test_derive_chunksize_memory_limited():
+    # 10 kB per event on top of 500 MB at the start of the chunk: 1500 MB for 150k events
+    measurements = [[10_000, 1.0, 500., 500. + 10_000 * 0.01], [20_000, 2.0, 500., 500. + 20_000 * 0.008]]
+    assert derive_chunksize(measurements, target_time=600, target_memory=2000) == 150_000
+    # Without memory target only the time limits the chunksize (clipped to the maximum)
+    assert derive_chunksize(measurements, target_time=600) == 1_000_000
+
+
+def test_derive_chunksize_no_measurements():
+    assert derive_chunksize([], target_time=60) is None
+    assert derive_chunksize([[0, 1.0, 100., None]], target_time=60) is None
+
+
+def test_parse_memory():
+    assert parse_memory_mb("2GB") == 2048
+    assert parse_memory_mb("1500MB") == 1500
+    assert parse_memory_mb(1000) == 1000
+
+
+def test_recorder():
+    recorder = ChunkPerformanceRecorder()
+    big = np.ones(20_000_000)
+    nevents, walltime, rss_start, rss_peak = recorder.measurement(1000)
+    del big
+    assert nevents == 1000 and walltime >= 0 and rss_start > 0
+    assert rss_peak is None or rss_peak > rss_start
+
+
+def test_profile_persistence(tmp_path):
+    path = str(tmp_path / "profile" / "chunksize_profile.json")
+    profile = ChunksizeProfile(path)
+    profile.update({"TTbar": [[10_000, 100.0, 500., None]], "DATA": [[10_000, 1.0, 500., None]]})
+    profile.save()
+
+    profile = ChunksizeProfile(path)
+    profile.update({"TTbar": [[10_000, 100.0, 500., None]]})
+    assert len(profile.samples["TTbar"]["measurements"]) == 2
+    run_options = {
+        "adaptive-chunksize-target-time": 120,
+        "adaptive-chunksize-target-memory": None,
+        "mem-per-worker": "2GB",
+        "adaptive-chunksize-min": 5000,
+        "adaptive-chunksize-max": 1_000_000,
+    }
+    assert get_chunksizes_from_run_options(profile, run_options) == {"TTbar": 12_000, "DATA": 1_000_000}
+
+
+def test_per_dataset_chunksize_runner(tmp_path):
+    files = {}
+    for name, n in [("a", 100), ("b", 100)]:
+        path = str(tmp_path / f"{name}.root")
+        with uproot.recreate(path) as f:
+            f["Events"] = {"x": np.arange(n, dtype=np.float64)}
+        files[name] = [path]
+    runner = processor.Runner(executor=processor.IterativeExecutor(), chunksize=50)
+    wrapped = PerDatasetChunksizeRunner(runner, {"a": 10})
+    chunks = list(wrapped.preprocess(files, "Events"))
+    assert sorted(c.entrystop - c.entrystart for c in chunks if c.dataset == "a") == [10] * 10
+    assert sorted(c.entrystop - c.entrystart for c in chunks if c.dataset == "b") == [50, 50]
+    # The chunksize of the wrapped runner is restored
+    assert runner.chunksize == 50
+    assert wrapped.chunksize == {"default": 50, "a": 10}
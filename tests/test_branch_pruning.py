@@ -0,0 +1,85 @@
+"""Offline tests of the tracking of the branches read by a processor and of the pruning of
+the skimmed files, on a small synthetic NanoAOD file."""
+import numpy as np
+import awkward as ak
+import uproot
+from coffea import processor
+from coffea.nanoevents import NanoEventsFactory, NanoAODSchema
+
+from pocket_coffea.utils.column_usage import record_branches_usage, save_branches_usage, load_branches_usage
+from pocket_coffea.utils.skim import uproot_writeable, BranchesSelector, DEFAULT_KEEP_BRANCHES
+
+
+def write_nanoaod(path, n=100, seed=1):
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(0, 4, n)
+    ncounts = counts.sum()
+
+    def jagged(values):
+        return ak.unflatten(values.astype(np.float32), counts)
+
+    tree = {
+        "run": np.ones(n, dtype=np.uint32),
+        "luminosityBlock": np.ones(n, dtype=np.uint32),
+        "event": np.arange(n, dtype=np.uint64),
+        "genWeight": rng.normal(1, 0.1, n).astype(np.float32),
+        "Jet": ak.zip({
+            "pt": jagged(rng.exponential(50, ncounts)),
+            "eta": jagged(rng.normal(size=ncounts)),
+            "phi": jagged(rng.uniform(-3, 3, ncounts)),
+            "mass": jagged(rng.exponential(10, ncounts)),
+        }),
+        "Electron": ak.zip({"pt": jagged(rng.exponential(30, ncounts))}),
+        "MET": ak.zip({"pt": rng.exponential(40, n).astype(np.float32), "phi": rng.uniform(-3, 3, n).astype(np.float32)}),
+        "HLT_IsoMu24": rng.random(n) > 0.5,
+        "HLT_Ele32": rng.random(n) > 0.5,
+    }
+    with uproot.recreate(path) as f:
+        f["Events"] = tree
+
+
+class JetMETProcessor(processor.ProcessorABC):
+    def process(self, events):
+        jets = events.Jet[events.Jet.pt > 30]
+        return {events.metadata["dataset"]: ak.sum(jets.pt) + ak.sum(events.MET.pt) + ak.sum(ak.num(events.Electron))}
+
+    def postprocess(self, accumulator):
+        return accumulator
+
+
+def test_record_branches_usage(tmp_path):
+    fname = str(tmp_path / "nano.root")
+    write_nanoaod(fname)
+    filesets = {"TTbar_2018": {"files": [fname], "metadata": {"year": "2018"}}}
+    usage = record_branches_usage(JetMETProcessor(), filesets, chunksize=30, limit_chunks=2)
+    assert usage == {"TTbar_2018": ["Jet_pt", "MET_pt", "nElectron", "nJet"]}
+    branches = save_branches_usage(usage, str(tmp_path / "usage.json"))
+    assert list(load_branches_usage(str(tmp_path / "usage.json"))) == branches
+
+
+def test_pruned_skim(tmp_path):
+    fname = str(tmp_path / "nano.root")
+    write_nanoaod(fname)
+    events = NanoEventsFactory.from_root(fname, schemaclass=NanoAODSchema).events()
+    events["skimRescaleGenWeight"] = np.ones(len(events))
+    full = uproot_writeable(events)
+    assert "Electron" in full and "HLT" in full
+    selector = BranchesSelector(list(DEFAULT_KEEP_BRANCHES) + ["Jet_pt", "MET_pt", "nElectron", "HLT_Iso*"])
+    out = str(tmp_path / "skim.root")
+    with uproot.recreate(out) as f:
+        f["Events"] = uproot_writeable(events, selector)
+    tree = uproot.open(out)["Events"]
+    # The counter of a collection read only through its size is kept
+    assert set(tree.keys()) == {
+        "run", "luminosityBlock", "event", "skimRescaleGenWeight",
+        "nJet", "Jet_pt", "MET_pt", "nElectron", "Electron_pt", "HLT_IsoMu24",
+    }
+    skimmed = NanoEventsFactory.from_root(out, schemaclass=NanoAODSchema).events()
+    assert ak.to_list(skimmed.Jet.pt) == ak.to_list(events.Jet.pt)
+    assert ak.to_list(ak.num(skimmed.Electron)) == ak.to_list(ak.num(events.Electron))
+
+
+def test_branches_selector():
+    selector = BranchesSelector(["Jet_pt", "HLT_*", "Flag_?oodVertices"])
+    assert selector("Jet_pt") and selector("HLT_IsoMu24") and selector("Flag_goodVertices")
+    assert not selector("Jet_eta") and not selector("nJet")
@@ -0,0 +1,135 @@
+"""Offline tests of the buffered writer of the exported column arrays and of the
+merge-columns handling of its files."""
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import awkward as ak
+import pyarrow.dataset as ds
+
+from pocket_coffea.utils.parquet_writer import BufferedParquetWriter, get_buffered_writer, is_coalesced_part
+from pocket_coffea.utils.worker_writers import flush_executor_writers
+from pocket_coffea.scripts.merge_columns import find_leaf_dirs
+
+
+def chunk_array(start, n):
+    return ak.zip({"JetGood_pt": ak.unflatten(np.arange(start, start + 2 * n, dtype=np.float64), 2),
+                   "weight": np.ones(n)}, depth_limit=1)
+
+
+def parquet_files(folder):
+    return sorted(f for f in os.listdir(folder) if f.endswith(".parquet"))
+
+
+def test_buffer_threshold_and_flush(tmp_path):
+    location = str(tmp_path) + "/"
+    # ~2 chunks of 100 rows fit in the threshold
+    writer = BufferedParquetWriter(location, buffer_size_mb=4e-3)
+    for ichunk in range(5):
+        staging = writer.begin_chunk()
+        for category in ["2btag", "4jets"]:
+            writer.stage(staging, ["TTbar_2018", category, "nominal"], chunk_array(1000 * ichunk, 100))
+        writer.stage(staging, ["TTbar_2018", "empty", "nominal"], chunk_array(0, 10)[:0])
+        writer.commit(staging)
+
+    folder = tmp_path / "TTbar_2018" / "2btag" / "nominal"
+    written = parquet_files(folder)
+    assert 1 <= len(written) < 5
+    assert all(is_coalesced_part(f) for f in written)
+    writer.flush()
+    written = parquet_files(folder)
+    table = ds.dataset(str(folder), format="parquet").to_table()
+    assert table.num_rows == 500
+    pts = np.sort(ak.to_numpy(ak.flatten(ak.from_arrow(table)["JetGood_pt"])))
+    assert np.array_equal(pts, np.sort(np.concatenate([np.arange(1000 * i, 1000 * i + 200) for i in range(5)])))
+    assert not (tmp_path / "TTbar_2018" / "empty").exists()
+    # No local temporary file left behind
+    assert not any(is_coalesced_part(f) for f in os.listdir("."))
+
+
+def test_uncommitted_chunk_is_discarded(tmp_path):
+    writer = BufferedParquetWriter(str(tmp_path) + "/", buffer_size_mb=100)
+    staging = writer.begin_chunk()
+    writer.stage(staging, ["DATA", "cat", "nominal"], chunk_array(0, 10))
+    writer.commit(staging)
+    # A chunk failing after staging its columns: retried from scratch
+    failed = writer.begin_chunk()
+    writer.stage(failed, ["DATA", "cat", "nominal"], chunk_array(0, 10))
+    staging = writer.begin_chunk()
+    writer.stage(staging, ["DATA", "cat", "nominal"], chunk_array(100, 10))
+    writer.commit(staging)
+    writer.flush()
+    table = ds.dataset(str(tmp_path / "DATA" / "cat" / "nominal"), format="parquet").to_table()
+    assert table.num_rows == 20
+
+
+def test_concurrent_chunks(tmp_path):
+    # Chunks processed by several threads of a worker, with interleaved stage/commit
+    writer = BufferedParquetWriter(str(tmp_path) + "/", buffer_size_mb=2e-3)
+    interleaved = [writer.begin_chunk() for _ in range(2)]
+    writer.stage(interleaved[0], ["DATA", "cat", "nominal"], chunk_array(0, 10))
+    writer.stage(interleaved[1], ["DATA", "cat", "nominal"], chunk_array(100, 10))
+    writer.commit(interleaved[1])
+    # The uncompleted chunk 0 is not written with chunk 1
+    writer.flush()
+    table = ds.dataset(str(tmp_path / "DATA" / "cat" / "nominal"), format="parquet").to_table()
+    assert table.num_rows == 10
+
+    def process_chunk(ichunk):
+        staging = writer.begin_chunk()
+        for i in range(5):
+            writer.stage(staging, ["TTbar", "cat", "nominal"], chunk_array(1000 * ichunk + 10 * i, 5))
+        writer.commit(staging)
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(process_chunk, range(40)))
+    writer.flush()
+    pts = ak.from_arrow(ds.dataset(str(tmp_path / "TTbar" / "cat" / "nominal"), format="parquet").to_table())["JetGood_pt"]
+    expected = [np.arange(1000 * c + 10 * i, 1000 * c + 10 * i + 10) for c in range(40) for i in range(5)]
+    assert np.array_equal(np.sort(ak.to_numpy(ak.flatten(pts))), np.sort(np.concatenate(expected)))
+
+
+def test_flush_executor_writers(tmp_path):
+    from coffea.processor import IterativeExecutor
+    writer = get_buffered_writer(str(tmp_path) + "/", 100)
+    staging = writer.begin_chunk()
+    writer.stage(staging, ["DATA", "cat", "nominal"], chunk_array(0, 10))
+    writer.commit(staging)
+    assert not (tmp_path / "DATA").exists()
+    # Written explicitly by the runner, before the process exits
+    flush_executor_writers(IterativeExecutor())
+    table = ds.dataset(str(tmp_path / "DATA" / "cat" / "nominal"), format="parquet").to_table()
+    assert table.num_rows == 10
+
+
+def test_flush_at_process_exit(tmp_path):
+    code = (
+        "import numpy as np, awkward as ak\n"
+        "from pocket_coffea.utils.parquet_writer import get_buffered_writer\n"
+        f"w = get_buffered_writer({str(tmp_path) + '/'!r}, 100)\n"
+        "s = w.begin_chunk()\n"
+        "w.stage(s, ['DATA', 'cat', 'nominal'], ak.zip({'x': np.arange(7.)}))\n"
+        "w.commit(s)\n"
+    )
+    subprocess.run([sys.executable, "-c", code], check=True, cwd=tmp_path)
+    table = ds.dataset(str(tmp_path / "DATA" / "cat" / "nominal"), format="parquet").to_table()
+    assert table.num_rows == 7
+
+
+def test_merge_columns_skips_coalesced(tmp_path):
+    root_in, root_out = tmp_path / "columns", tmp_path / "columns_merged"
+    writer = BufferedParquetWriter(str(root_in) + "/", buffer_size_mb=100)
+    staging = writer.begin_chunk()
+    writer.stage(staging, ["TTbar", "coalesced", "nominal"], chunk_array(0, 10))
+    writer.commit(staging)
+    writer.flush()
+    chunk_dir = root_in / "TTbar" / "per_chunk" / "nominal"
+    chunk_dir.mkdir(parents=True)
+    ak.to_parquet(chunk_array(0, 10), str(chunk_dir / "uuid_Events_0-10.parquet"))
+
+    leaves = [os.path.relpath(d, root_in) for d, _ in find_leaf_dirs(str(root_in), str(root_out))]
+    assert leaves == [os.path.join("TTbar", "per_chunk", "nominal")]
+    leaves = find_leaf_dirs(str(root_in), str(root_out), include_coalesced=True)
+    assert len(leaves) == 2
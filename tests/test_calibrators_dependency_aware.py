@@ -0,0 +1,150 @@
+"""Offline tests of the dependency-aware mode of the CalibratorsManager: the calibrators
+not affected by a variation must be skipped, giving the same events as the full sequence."""
+import numpy as np
+import awkward as ak
+import pytest
+
+from pocket_coffea.lib.calibrators.calibrator import Calibrator
+from pocket_coffea.lib.calibrators.calibrators_manager import CalibratorsManager
+
+
+CALLS = []
+
+
+class DepJetsCalibrator(Calibrator):
+    name = "test_dep_jets"
+    has_variations = True
+    isMC_only = False
+    depends_on_collections = []
+    calibrated_collections = ["Jet.pt"]
+
+    def initialize(self, events):
+        self._variations = ["JES_Up", "JES_Down"]
+        self.scale = {"nominal": 1.1, "JES_Up": 1.2, "JES_Down": 1.0}
+
+    def calibrate(self, events, orig_colls, variation, already_applied_calibrators=None):
+        CALLS.append((self.name, variation))
+        return {"Jet.pt": events.Jet.pt * self.scale.get(variation, self.scale["nominal"])}
+
+
+class DepMuonsCalibrator(Calibrator):
+    name = "test_dep_muons"
+    has_variations = True
+    isMC_only = False
+    depends_on_collections = []
+    calibrated_collections = ["Muon.pt"]
+
+    def initialize(self, events):
+        self._variations = ["muon_scaleUp", "muon_scaleDown"]
+        self.scale = {"nominal": 0.9, "muon_scaleUp": 0.95, "muon_scaleDown": 0.85}
+
+    def calibrate(self, events, orig_colls, variation, already_applied_calibrators=None):
+        CALLS.append((self.name, variation))
+        return {"Muon.pt": events.Muon.pt * self.scale.get(variation, self.scale["nominal"])}
+
+
+class DepMETCalibrator(Calibrator):
+    name = "test_dep_met"
+    has_variations = True
+    isMC_only = False
+    depends_on_collections = ["Jet", "MET"]
+    calibrated_collections = ["MET.pt"]
+
+    def initialize(self, events):
+        self._variations = ["unclustUp", "unclustDown"]
+
+    def calibrate(self, events, orig_colls, variation, already_applied_calibrators=None):
+        CALLS.append((self.name, variation))
+        shift = {"unclustUp": 1.0, "unclustDown": -1.0}.get(variation, 0.0)
+        return {"MET.pt": events.MET.pt + ak.sum(events.Jet.pt - orig_colls["Jet.pt"], axis=1) + shift}
+
+
+class UndeclaredCalibrator(Calibrator):
+    name = "test_dep_undeclared"
+    has_variations = False
+    isMC_only = False
+    calibrated_collections = ["Electron.pt"]
+
+    def initialize(self, events):
+        pass
+
+    def calibrate(self, events, orig_colls, variation, already_applied_calibrators=None):
+        CALLS.append((self.name, variation))
+        return {"Electron.pt": events.Electron.pt * 1.05}
+
+
+SEQUENCE = [DepJetsCalibrator, DepMuonsCalibrator, DepMETCalibrator, UndeclaredCalibrator]
+
+
+def make_events(nevents=200, seed=3):
+    rng = np.random.default_rng(seed)
+
+    def coll(mean):
+        counts = rng.integers(0, 4, nevents)
+        return ak.zip({"pt": ak.unflatten(rng.exponential(mean, counts.sum()), counts)})
+
+    return ak.Array({
+        "Jet": coll(50.0),
+        "Muon": coll(20.0),
+        "Electron": coll(20.0),
+        "MET": ak.zip({"pt": rng.exponential(40.0, nevents)}),
+    })
+
+
+def run_loop(skip_unaffected):
+    CALLS.clear()
+    events = make_events()
+    manager = CalibratorsManager(
+        SEQUENCE, events, params=None, metadata={"isMC": True, "year": "2018"},
+        skip_unaffected_calibrators=skip_unaffected,
+    )
+    out = {}
+    for variation, events_calib in manager.calibration_loop(
+            events, variations=["JES_Up", "muon_scaleDown", "unclustUp"]):
+        out[variation] = {coll: ak.to_list(events_calib[coll].pt)
+                          for coll in ["Jet", "Muon", "Electron", "MET"]}
+    # The events are reset to the original at the end of the loop
+    assert ak.to_list(events.Jet.pt) == ak.to_list(make_events().Jet.pt)
+    return out, list(CALLS)
+
+
+def test_dependency_aware_same_output():
+    full, calls_full = run_loop(False)
+    skipped, calls_skipped = run_loop(True)
+    assert full == skipped
+    assert len(calls_full) == 16
+    assert len(calls_skipped) < len(calls_full)
+
+
+@pytest.mark.parametrize("variation, expected", [
+    ("JES_Up", ["test_dep_jets", "test_dep_met", "test_dep_undeclared"]),
+    ("muon_scaleDown", ["test_dep_muons", "test_dep_undeclared"]),
+    ("unclustUp", ["test_dep_met", "test_dep_undeclared"]),
+    ("nominal", ["test_dep_jets", "test_dep_muons", "test_dep_met", "test_dep_undeclared"]),
+])
+def test_calibrators_to_run(variation, expected):
+    manager = CalibratorsManager(
+        SEQUENCE, make_events(), params=None, metadata={"isMC": True, "year": "2018"},
+        skip_unaffected_calibrators=True,
+    )
+    assert manager.get_calibrators_to_run(variation) == expected
+
+
+def test_dependency_aware_calls():
+    _, calls = run_loop(True)
+    assert [c for c in calls if c[1] == "JES_Up"] == [
+        ("test_dep_jets", "JES_Up"), ("test_dep_met", "JES_Up"), ("test_dep_undeclared", "JES_Up")]
+    assert [c for c in calls if c[1] == "muon_scaleDown"] == [
+        ("test_dep_muons", "muon_scaleDown"), ("test_dep_undeclared", "muon_scaleDown")]
+
+
+@pytest.mark.parametrize("variation, expected", [
+    ("JES_Up", ["Jet.pt", "MET.pt", "Electron.pt"]),
+    ("muon_scaleDown", ["Muon.pt", "Electron.pt"]),
+    ("nominal", []),
+])
+def test_modified_collections(variation, expected):
+    manager = CalibratorsManager(
+        SEQUENCE, make_events(), params=None, metadata={"isMC": True, "year": "2018"},
+    )
+    assert manager.get_modified_collections(variation) == expected
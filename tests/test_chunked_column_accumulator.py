@@ -0,0 +1,116 @@
+"""Offline tests of the chunked column accumulator and of its choice in ColOut/ColumnsManager."""
+import numpy as np
+import awkward as ak
+import pytest
+from coffea.processor import accumulate
+from coffea.processor.accumulator import column_accumulator
+from coffea.util import save, load
+
+from pocket_coffea.lib.column_accumulators import chunked_column_accumulator, make_column_accumulator
+from pocket_coffea.lib.columns_manager import ColumnsManager, ColOut
+
+
+def chunks(n=20, size=100, seed=2):
+    rng = np.random.default_rng(seed)
+    return [rng.normal(size=size) for _ in range(n)]
+
+
+def chunk_output(acc_type, value, **kwargs):
+    return {"columns": {"TTbar": {"TTbar_2018": {"cat": {"nominal": {
+        "JetGood_pt": make_column_accumulator(value, acc_type, **kwargs)}}}}}}
+
+
+def test_same_value_as_column_accumulator():
+    arrays = chunks()
+    ref = accumulate([chunk_output("column", a) for a in arrays])
+    out = accumulate([chunk_output("chunked", a) for a in arrays])
+    acc = out["columns"]["TTbar"]["TTbar_2018"]["cat"]["nominal"]["JetGood_pt"]
+    assert isinstance(acc, chunked_column_accumulator)
+    assert acc.nblocks == len(arrays)
+    assert len(acc) == 2000
+    assert np.array_equal(acc.value, ref["columns"]["TTbar"]["TTbar_2018"]["cat"]["nominal"]["JetGood_pt"].value)
+    # Concatenated once on access
+    assert acc.nblocks == 1
+
+
+def test_mixed_with_column_accumulator():
+    a, b, c = chunks(3)
+    acc = chunked_column_accumulator(a)
+    acc.add(column_accumulator(b))
+    plain = column_accumulator(c)
+    plain.add(acc)
+    assert np.array_equal(plain.value, np.concatenate([c, a, b]))
+    assert np.array_equal((acc + column_accumulator(c)).value, np.concatenate([a, b, c]))
+    with pytest.raises(ValueError):
+        acc.add(chunked_column_accumulator(np.zeros((2, 3))))
+
+
+def test_spill_keeps_order(tmp_path):
+    arrays = chunks(10, size=20_000)
+    acc = chunked_column_accumulator(arrays[0], spill_threshold_mb=0.3, spill_dir=str(tmp_path))
+    other = chunked_column_accumulator(arrays[1], spill_threshold_mb=0.3, spill_dir=str(tmp_path))
+    for a in arrays[2:5]:
+        other.add(chunked_column_accumulator(a))
+    for a in arrays[5:]:
+        acc.add(chunked_column_accumulator(a))
+    assert any(isinstance(b, np.memmap) for b in acc._blocks)
+    acc.add(other)
+    # The spill files are unlinked right away
+    assert list(tmp_path.iterdir()) == []
+    expected = np.concatenate([arrays[0]] + arrays[5:] + arrays[1:5])
+    assert np.array_equal(acc.value, expected)
+
+
+def test_save_and_load(tmp_path):
+    arrays = chunks(5)
+    acc = accumulate([chunked_column_accumulator(a, spill_threshold_mb=1e-3, spill_dir=str(tmp_path))
+                      for a in arrays])
+    path = str(tmp_path / "output.coffea")
+    save({"columns": acc}, path)
+    loaded = load(path)["columns"]
+    assert type(loaded.value) is np.ndarray
+    assert np.array_equal(loaded.value, np.concatenate(arrays))
+    empty = load_roundtrip(chunked_column_accumulator(np.zeros(0)), tmp_path)
+    assert len(empty.value) == 0
+
+
+def load_roundtrip(acc, tmp_path):
+    path = str(tmp_path / "roundtrip.coffea")
+    save(acc, path)
+    return load(path)
+
+
+def test_unknown_accumulator():
+    with pytest.raises(ValueError):
+        make_column_accumulator(np.zeros(3), "sparse")
+
+
+class _FakeCats:
+    multidim_collection = None
+
+    def get_mask(self, category):
+        return np.array([True, False, True])
+
+
+class _FakeWM:
+    _isMC = False
+
+    def get_weight(self, category, subsample=None, modifier=None):
+        return np.array([1.0, 2.0, 3.0])
+
+
+@pytest.mark.parametrize("default", ["column", "chunked"])
+def test_columns_manager_choice(default):
+    events = ak.Array({"JetGood": ak.zip({"pt": ak.Array([[10.0, 20.0], [], [5.0]])}),
+                       "MET": ak.zip({"pt": ak.Array([1.0, 2.0, 3.0])})})
+    cfg = {"baseline": [ColOut("JetGood", ["pt"]), ColOut("MET", ["pt"], accumulator="chunked")]}
+    cm = ColumnsManager(cfg, categories_config=_FakeCats(), variations_config=None, accumulator=default)
+    out = cm.fill_columns_accumulators(events, _FakeCats(), "nominal", weights_manager=_FakeWM())["baseline"]["nominal"]
+    expected_type = chunked_column_accumulator if default == "chunked" else column_accumulator
+    assert type(out["weight"]) is expected_type
+    assert type(out["JetGood_pt"]) is expected_type
+    assert type(out["JetGood_N"]) is expected_type
+    assert type(out["MET_pt"]) is chunked_column_accumulator
+    assert list(out["JetGood_pt"].value) == [10.0, 20.0, 5.0]
+    assert list(out["JetGood_N"].value) == [2, 1]
+    assert list(out["MET_pt"].value) == [1.0, 3.0]
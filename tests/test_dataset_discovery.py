@@ -0,0 +1,160 @@
+"""Offline tests of the concurrent DBS/Rucio dataset discovery against a local mock DBS server."""
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+from pocket_coffea.utils.dataset import Sample
+from pocket_coffea.utils.dataset_discovery import DatasetDiscovery, DiscoveryCache
+
+DAS_NAMES = [f"/Sample{i}/Run3Summer22NanoAODv12-v2/NANOAODSIM" for i in range(12)]
+SITES_MAP = {"T2_CH_CSCS": "root://storage01.lcg.cscs.ch:1096//pnfs/lcg.cscs.ch/cms/trivcat"}
+
+
+def dbs_files(das_name):
+    files = [
+        {"logical_file_name": f"/store/mc{das_name}/file{i}.root", "is_file_valid": 1,
+         "event_count": 100 + i, "file_size": 1000, "dataset": das_name}
+        for i in range(3)
+    ]
+    files[1]["is_file_valid"] = 0
+    return files
+
+
+class MockDBS(BaseHTTPRequestHandler):
+    # Keep-alive connections, to check that they are reused
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.inflight += 1
+            server.max_inflight = max(server.max_inflight, server.inflight)
+            server.connections.add(self.client_address)
+        time.sleep(0.05)
+        url = urlparse(self.path)
+        das_name = parse_qs(url.query).get("dataset", [""])[0]
+        if url.path == "/dbs/prod/global/DBSReader/files" and das_name in DAS_NAMES:
+            body = json.dumps(dbs_files(das_name)).encode()
+        else:
+            body = json.dumps([{"error": "invalid dataset"}]).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with server.lock:
+            server.inflight -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def dbs_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockDBS)
+    server.lock = threading.Lock()
+    server.requests, server.inflight, server.max_inflight = 0, 0, 0
+    server.connections = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class MockRucioClient:
+    calls = []
+
+    def list_replicas(self, dids, **kwargs):
+        dataset = dids[0]["name"]
+        MockRucioClient.calls.append(dataset)
+        for f in dbs_files(dataset):
+            yield {
+                "name": f["logical_file_name"],
+                "rses": {"T2_CH_CSCS": ["pfn"]},
+                "pfns": {"pfn": {"rse": "T2_CH_CSCS", "type": "DISK", "volatile": False}},
+                "states": {"T2_CH_CSCS": "AVAILABLE"},
+            }
+
+
+def make_discovery(server, **kwargs):
+    return DatasetDiscovery(
+        dbs_url=f"http://127.0.0.1:{server.server_address[1]}/dbs",
+        proxy=False,
+        rucio_client_factory=MockRucioClient,
+        sites_xrootd_prefix=SITES_MAP,
+        **kwargs,
+    )
+
+
+def test_discover(dbs_server):
+    discovery = make_discovery(dbs_server, max_workers=1)
+    result = discovery.discover(DAS_NAMES[0])
+    assert [f["logical_file_name"] for f in result["files"]] == [f"/store/mc{DAS_NAMES[0]}/file{i}.root" for i in (0, 2)]
+    assert result["invalid"] == [f"/store/mc{DAS_NAMES[0]}/file1.root"]
+    # The invalid file is skipped in the replicas
+    assert result["replicas"] == [f"{SITES_MAP['T2_CH_CSCS']}/store/mc{DAS_NAMES[0]}/file{i}.root" for i in (0, 2)]
+    # A wrong dataset name raises, also when queried again
+    with pytest.raises(Exception, match="Invalid dataset name"):
+        discovery.discover("/Wrong/Dataset/NANOAODSIM")
+    with pytest.raises(Exception, match="Invalid dataset name"):
+        discovery.discover("/Wrong/Dataset/NANOAODSIM")
+
+
+def test_prefetch_bounded_concurrency(dbs_server):
+    discovery = make_discovery(dbs_server, max_workers=4)
+    discovery.prefetch([(das_name, "prod/global") for das_name in DAS_NAMES] + [("/Wrong/Dataset/NANOAODSIM", "prod/global")])
+    assert dbs_server.requests == len(DAS_NAMES) + 1
+    assert 1 < dbs_server.max_inflight <= 4
+    # The keep-alive connections are reused by the queries
+    assert len(dbs_server.connections) <= 4
+    # The failed query is raised by discover, the others are served from memory
+    with pytest.raises(Exception, match="Invalid dataset name"):
+        discovery.discover("/Wrong/Dataset/NANOAODSIM")
+    assert discovery.discover(DAS_NAMES[3])["files"][0]["event_count"] == 100
+    assert dbs_server.requests == len(DAS_NAMES) + 1
+
+
+def test_cache_ttl(dbs_server, tmp_path):
+    cache_file = str(tmp_path / "discovery_cache.sqlite")
+    make_discovery(dbs_server, max_workers=4, cache=cache_file).prefetch([(d, "prod/global") for d in DAS_NAMES])
+    assert dbs_server.requests == len(DAS_NAMES)
+    MockRucioClient.calls.clear()
+    # A new run reads the responses from the cache
+    discovery = make_discovery(dbs_server, max_workers=4, cache=cache_file)
+    results = [discovery.discover(d) for d in DAS_NAMES]
+    assert dbs_server.requests == len(DAS_NAMES)
+    assert MockRucioClient.calls == []
+    assert results[5] == make_discovery(dbs_server).discover(DAS_NAMES[5])
+    # Expired entries are queried again
+    expired = make_discovery(dbs_server, cache=DiscoveryCache(cache_file, ttl=0))
+    expired.discover(DAS_NAMES[0])
+    assert dbs_server.requests == len(DAS_NAMES) + 2
+    # Wrong dataset names are not cached
+    for _ in range(2):
+        with pytest.raises(Exception):
+            make_discovery(dbs_server, cache=cache_file).discover("/Wrong/Dataset/NANOAODSIM")
+    assert dbs_server.requests == len(DAS_NAMES) + 4
+
+
+def test_sample_with_discovery(dbs_server):
+    discovery = make_discovery(dbs_server, max_workers=4)
+    discovery.prefetch([(d, "prod/global") for d in DAS_NAMES[:2]])
+    sample = Sample(
+        name="Sample_2022",
+        das_names=DAS_NAMES[:2],
+        sample="Sample",
+        metadata={"year": "2022", "isMC": True},
+        sites_cfg={},
+        discovery=discovery,
+    )
+    assert sample.metadata["nevents"] == 2 * (100 + 102)
+    assert sample.metadata["size"] == 4 * 1000
+    assert len(sample.fileslist_redirector) == len(sample.fileslist_concrete) == 4
+    assert sample.fileslist_concrete[0].startswith(SITES_MAP["T2_CH_CSCS"])
+    assert dbs_server.requests == 2
@@ -0,0 +1,126 @@
+"""Offline tests of the persistent file metadata cache used by the runner and build-datasets."""
+import os
+import pickle
+
+import numpy as np
+import pytest
+import uproot
+from coffea import processor
+from coffea.processor import executor as coffea_executor
+
+from pocket_coffea.utils.dataset import Sample
+from pocket_coffea.utils.file_metadata_cache import (
+    FileMetadataCache,
+    default_file_metadata_cache_path,
+)
+
+
+@pytest.fixture
+def root_files(tmp_path):
+    files = []
+    for i, n in enumerate([120, 45]):
+        path = str(tmp_path / f"file_{i}.root")
+        with uproot.recreate(path) as f:
+            f["Events"] = {"x": np.arange(n, dtype=np.float64), "y": np.ones(n, dtype=np.int32)}
+        files.append(path)
+    return files
+
+
+def preprocess(files, cache):
+    runner = processor.Runner(
+        executor=processor.IterativeExecutor(), chunksize=50, metadata_cache=cache
+    )
+    return list(runner.preprocess({"DATA": files}, "Events"))
+
+
+def test_runner_fills_and_reuses_cache(root_files, tmp_path, monkeypatch):
+    cache_path = str(tmp_path / "cache.sqlite")
+    chunks = preprocess(root_files, FileMetadataCache(cache_path))
+    assert sum(c.entrystop - c.entrystart for c in chunks) == 165
+
+    cache = FileMetadataCache(cache_path)
+    assert len(cache) == 2
+    assert cache.get_entry(root_files[0], "Events")["numentries"] == 120
+
+    # A second runner must not open the files anymore
+    def fail(*args, **kwargs):
+        raise AssertionError("the file has been opened")
+    monkeypatch.setattr(coffea_executor.uproot, "open", fail)
+    assert preprocess(root_files, cache) == chunks
+
+
+def test_cache_invalidation_on_change(root_files, tmp_path):
+    cache = FileMetadataCache(str(tmp_path / "cache.sqlite"))
+    cache.put_entry(root_files[1], "Events", numentries=45, uuid=b"\x01" * 16, branches=["x", "y"])
+    entry = cache.get_entry(root_files[1], "Events")
+    assert entry == {"numentries": 45, "uuid": b"\x01" * 16, "branches": ["x", "y"], "clusters": None}
+    assert (root_files[1], "Events") in cache
+
+    # Remote files are not stat-ed
+    cache.put_entry("root://host//store/a.root", "Events", numentries=3, uuid=b"\x02" * 16)
+    assert cache.get_entry("root://host//store/a.root", "Events")["numentries"] == 3
+
+    stat = os.stat(root_files[1])
+    os.utime(root_files[1], (stat.st_atime, stat.st_mtime + 10))
+    assert cache.get_entry(root_files[1], "Events") is None
+    assert (root_files[1], "Events") not in cache
+
+
+def test_cache_partial_update_and_pickle(tmp_path):
+    cache = FileMetadataCache(str(tmp_path / "cache.sqlite"))
+    key = ("root://host//store/b.root", "Events")
+    cache.put_entry(*key, numentries=10, branches=["a"])
+    # Without uuid the entry cannot be used by the coffea Runner
+    assert key not in cache
+    cache[key] = {"numentries": 10, "uuid": b"\x03" * 16}
+    assert cache[key] == {"numentries": 10, "uuid": b"\x03" * 16}
+    assert cache.get_entry(*key)["branches"] == ["a"]
+
+    cache2 = pickle.loads(pickle.dumps(cache))
+    assert cache2[key]["uuid"] == b"\x03" * 16
+    del cache2[key]
+    assert key not in cache
+
+
+def test_sample_get_entries_uproot_cached(root_files, tmp_path, monkeypatch):
+    sample = Sample.__new__(Sample)
+    sample.metadata_cache = str(tmp_path / "cache.sqlite")
+    assert sample.get_entries_uproot(root_files[0]) == 120
+    entry = FileMetadataCache(sample.metadata_cache).get_entry(root_files[0], "Events")
+    assert entry["branches"] == ["x", "y"]
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the file has been opened")
+    monkeypatch.setattr(uproot, "open", fail)
+    assert sample.get_entries_uproot(root_files[0]) == 120
+
+
+def test_default_path(tmp_path):
+    assert default_file_metadata_cache_path([]) is None
+    # Missing (not writable) folder
+    assert default_file_metadata_cache_path([str(tmp_path / "datasets" / "a.json")]) is None
+    os.makedirs(tmp_path / "datasets")
+    assert default_file_metadata_cache_path([str(tmp_path / "datasets" / "a.json")]) == \
+        str(tmp_path / "datasets" / "file_metadata_cache.sqlite")
+
+
+def test_runner_keeps_fileset_metadata(root_files, tmp_path, monkeypatch):
+    cache_path = str(tmp_path / "cache.sqlite")
+    fileset = {"DATA": {"files": root_files, "metadata": {"sample": "DATA", "year": "2018", "isMC": False}}}
+
+    def run_preprocess(cache):
+        runner = processor.Runner(
+            executor=processor.IterativeExecutor(), chunksize=50, metadata_cache=cache
+        )
+        return list(runner.preprocess(fileset, "Events"))
+
+    # First run (metadata fetched from the files) and second run (read from the cache)
+    expected = run_preprocess(None)
+    for _ in range(2):
+        chunks = run_preprocess(FileMetadataCache(cache_path))
+        assert chunks == expected
+        for chunk in chunks:
+            assert chunk.usermeta == {"sample": "DATA", "year": "2018", "isMC": False}
+    # Only the per-file keys are stored
+    cache = FileMetadataCache(cache_path)
+    assert set(cache[(root_files[0], "Events")]) == {"numentries", "uuid"}
@@ -0,0 +1,167 @@
+"""Offline tests of the columnar histogram fill engine: it must give bit-identical
+histograms to the legacy HistManager fill loop."""
+import numpy as np
+import awkward as ak
+import pytest
+
+from pocket_coffea.lib.hist_manager import HistManager, HistConf, Axis
+
+
+class FakeSelection:
+    def __init__(self, masks):
+        self.masks = masks
+
+    def keys(self):
+        return self.masks.keys()
+
+    def get_masks(self):
+        return iter(self.masks.items())
+
+
+class FakeWeightsManager:
+    def __init__(self, nevents, categories, seed=1):
+        rng = np.random.default_rng(seed)
+        self.nominal = rng.normal(1.0, 0.3, nevents)
+        self.modifiers = {
+            f"w{i}{d}": rng.normal(1.0, 0.1, nevents) for i in range(3) for d in ("Up", "Down")
+        }
+        self.by_cat = {cat: rng.normal(1.0, 0.05, nevents) for cat in categories}
+        self.sub = rng.normal(1.0, 0.2, nevents)
+
+    def get_available_modifiers_byweight(self, weight):
+        return [f"{weight}Up", f"{weight}Down"]
+
+    def get_weight(self, category, modifier=None):
+        w = self.nominal * self.by_cat[category]
+        if modifier is not None:
+            w = w * self.modifiers[modifier]
+        return w
+
+    def get_weight_only_subsample(self, subsample, category, modifier=None):
+        w = self.sub * self.by_cat[category]
+        if modifier is not None:
+            w = w * self.modifiers[modifier]
+        return w
+
+
+class FakeCalibratorsManager:
+    def get_available_variations(self, var):
+        if var == "JES":
+            return ["JES_Up", "JES_Down"]
+        return []
+
+
+def make_events(nevents=500, seed=7):
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(0, 6, nevents)
+    njets = counts.sum()
+    jets = ak.zip(
+        {
+            "pt": ak.unflatten(rng.exponential(60.0, njets), counts),
+            "eta": ak.unflatten(rng.uniform(-3, 3, njets).astype(np.float32), counts),
+            "btag": ak.unflatten(rng.integers(0, 4, njets), counts),
+        }
+    )
+    return ak.Array(
+        {
+            "JetGood": jets,
+            "nJetGood": counts,
+            "HT": rng.exponential(300.0, nevents),
+        }
+    )
+
+
+def make_hist_config():
+    return {
+        "nJets": HistConf([Axis(field="nJetGood", label="nJ", bins=5, start=0, stop=5, coll="events")]),
+        "HT": HistConf([Axis(field="HT", label="HT", bins=20, start=0, stop=1000, coll="events",
+                             underflow=False, overflow=False)]),
+        "jet_pt": HistConf([Axis(field="pt", label="pt", bins=[0, 30, 50, 100, 200, 500], coll="JetGood")]),
+        "jet_pt_eta": HistConf([
+            Axis(field="pt", label="pt", bins=10, start=0, stop=300, coll="JetGood"),
+            Axis(field="eta", label="eta", bins=6, start=-2.4, stop=2.4, coll="JetGood"),
+        ]),
+        "jet_btag": HistConf([Axis(field="btag", label="b", type="int", start=0, stop=3, coll="JetGood")]),
+        "jet1_pt": HistConf([Axis(field="pt", label="pt", bins=10, start=0, stop=300, coll="JetGood", pos=1)]),
+        "jet_pt_noweights": HistConf(
+            [Axis(field="pt", label="pt", bins=10, start=0, stop=300, coll="JetGood")], no_weights=True
+        ),
+        "jet_pt_onlyvar": HistConf(
+            [Axis(field="pt", label="pt", bins=10, start=0, stop=300, coll="JetGood")],
+            only_variations=["w0Up", "w0Down"], only_categories=["catA"],
+        ),
+    }
+
+
+def build_and_fill(engine, isMC=True, subsamples=False, shape_variation="nominal", custom_weight=None):
+    events = make_events()
+    n = len(events)
+    categories = FakeSelection({
+        "catA": np.asarray(events.nJetGood >= 2),
+        "catB": np.asarray(events.HT > 200),
+        "catEmpty": np.zeros(n, dtype=bool),
+    })
+    subs_masks = {"sub1": np.asarray(events.nJetGood % 2 == 0), "sub2": np.asarray(events.nJetGood % 2 == 1)} \
+        if subsamples else {"sample": np.ones(n, dtype=bool)}
+    subs = FakeSelection(subs_masks)
+    variations_config = {
+        "weights": {"catA": ["w0", "w1"], "catB": ["w0"], "catEmpty": []},
+        "shape": {"catA": ["JES"], "catB": [], "catEmpty": []},
+        "by_subsample": {
+            "sample__sub1": {"weights": {"catA": ["w2"], "catB": [], "catEmpty": []},
+                             "shape": {"catA": [], "catB": ["JES"], "catEmpty": []}},
+            "sample__sub2": {"weights": {"catA": [], "catB": [], "catEmpty": []},
+                             "shape": {"catA": [], "catB": [], "catEmpty": []}},
+        },
+    }
+    hm = HistManager(
+        make_hist_config(),
+        "2018",
+        "sample",
+        subsamples,
+        list(subs_masks.keys()),
+        categories,
+        variations_config=variations_config if isMC else None,
+        weights_manager=FakeWeightsManager(n, categories.keys()),
+        calibrators_manager=FakeCalibratorsManager(),
+        processor_params=None,
+        custom_axes=[],
+        isMC=isMC,
+        fill_engine=engine,
+    )
+    hm.fill_histograms(events, categories, shape_variation=shape_variation, subsamples=subs,
+                       custom_weight=custom_weight)
+    return hm
+
+
+@pytest.mark.parametrize("isMC", [True, False])
+@pytest.mark.parametrize("subsamples", [False, True])
+@pytest.mark.parametrize("shape_variation", ["nominal", "JES_Up"])
+def test_columnar_fill_bit_identical(isMC, subsamples, shape_variation):
+    if not isMC and shape_variation != "nominal":
+        pytest.skip("no shape variations for data")
+    legacy = build_and_fill("legacy", isMC, subsamples, shape_variation)
+    columnar = build_and_fill("columnar", isMC, subsamples, shape_variation)
+    for subsample in legacy.subsamples:
+        hl, hc = legacy.get_histograms(subsample), columnar.get_histograms(subsample)
+        assert set(hl) == set(hc)
+        for name in hl:
+            assert hl[name].axes == hc[name].axes
+            assert np.array_equal(hl[name].values(flow=True), hc[name].values(flow=True)), name
+            assert np.array_equal(hl[name].variances(flow=True), hc[name].variances(flow=True)), name
+
+
+def test_columnar_fill_custom_weight():
+    events = make_events()
+    custom = {"jet_pt": np.random.default_rng(3).uniform(0.5, 1.5, len(events))}
+    legacy = build_and_fill("legacy", custom_weight=custom)
+    columnar = build_and_fill("columnar", custom_weight=custom)
+    hl = legacy.get_histograms("sample")["jet_pt"]
+    hc = columnar.get_histograms("sample")["jet_pt"]
+    assert np.array_equal(hl.values(flow=True), hc.values(flow=True))
+    assert np.array_equal(hl.variances(flow=True), hc.variances(flow=True))
+
+
+def test_unknown_fill_engine():
+    with pytest.raises(ValueError):
+        build_and_fill("vectorized")
@@ -0,0 +1,109 @@
+"""Offline tests of the per-process cache of the HistManager histogram templates: the histograms
+handed out to each chunk must be identical to the ones built without the cache and independent
+of each other."""
+import numpy as np
+import pytest
+
+from pocket_coffea.lib import hist_manager
+from pocket_coffea.lib.hist_manager import HistManager, HistConf, Axis
+from tests.test_hist_fill_engine import (
+    FakeSelection,
+    FakeWeightsManager,
+    FakeCalibratorsManager,
+    make_events,
+    make_hist_config,
+)
+
+
+class FakeCalibratorsManagerMoreJES(FakeCalibratorsManager):
+    def get_available_variations(self, var):
+        if var == "JES":
+            return ["JES_Up", "JES_Down", "JES2_Up", "JES2_Down"]
+        return []
+
+
+def build(cache_templates, calibrators_manager=None, hist_config=None, fill=True):
+    events = make_events()
+    n = len(events)
+    categories = FakeSelection({"catA": np.asarray(events.nJetGood >= 2), "catB": np.asarray(events.HT > 200)})
+    subs = FakeSelection({"sample": np.ones(n, dtype=bool)})
+    variations_config = {
+        "weights": {"catA": ["w0", "w1"], "catB": ["w0"]},
+        "shape": {"catA": ["JES"], "catB": []},
+    }
+    hm = HistManager(
+        hist_config or make_hist_config(),
+        "2018",
+        "sample",
+        False,
+        ["sample"],
+        categories,
+        variations_config=variations_config,
+        weights_manager=FakeWeightsManager(n, categories.keys()),
+        calibrators_manager=calibrators_manager or FakeCalibratorsManager(),
+        processor_params=None,
+        custom_axes=[],
+        isMC=True,
+        cache_templates=cache_templates,
+    )
+    if fill:
+        hm.fill_histograms(events, categories, shape_variation="nominal", subsamples=subs)
+    return hm
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    hist_manager._hist_templates_cache.clear()
+    yield
+    hist_manager._hist_templates_cache.clear()
+
+
+def test_cached_templates_identical():
+    reference = build(cache_templates=False)
+    assert len(hist_manager._hist_templates_cache) == 0
+    first = build(cache_templates=True)
+    second = build(cache_templates=True)
+    assert len(hist_manager._hist_templates_cache) == 1
+    for hm in [first, second]:
+        hr, hc = reference.get_histograms("sample"), hm.get_histograms("sample")
+        assert set(hr) == set(hc)
+        for name in hr:
+            assert hr[name].axes == hc[name].axes
+            # Each chunk starts from empty histograms
+            assert np.array_equal(hr[name].values(flow=True), hc[name].values(flow=True)), name
+            assert hm.histograms["sample"][name].only_variations == reference.histograms["sample"][name].only_variations
+    # The clones do not share the histograms nor the configuration lists
+    h1, h2 = first.histograms["sample"]["HT"], second.histograms["sample"]["HT"]
+    assert h1.hist_obj is not h2.hist_obj
+    assert h1.only_variations is not h2.only_variations
+    (templates,) = hist_manager._hist_templates_cache.values()
+    for hcfg in templates["sample"].values():
+        assert hcfg.hist_obj.sum(flow=True).value == 0
+
+
+def test_cache_key_depends_on_variations_and_config():
+    build(cache_templates=True, fill=False)
+    more = build(cache_templates=True, calibrators_manager=FakeCalibratorsManagerMoreJES(), fill=False)
+    assert len(hist_manager._hist_templates_cache) == 2
+    assert "JES2_Up" in more.histograms["sample"]["HT"].only_variations
+
+    config = make_hist_config()
+    config["HT"] = HistConf([Axis(field="HT", label="HT", bins=40, start=0, stop=1000, coll="events")])
+    rebinned = build(cache_templates=True, hist_config=config, fill=False)
+    assert len(hist_manager._hist_templates_cache) == 3
+    assert rebinned.get_histograms("sample")["HT"].axes[-1].size == 40
+
+
+@pytest.mark.parametrize("cache_templates", [False, True])
+def test_only_and_exclude_samples(cache_templates):
+    config = make_hist_config()
+    pt_axis = [Axis(field="pt", label="pt", bins=10, start=0, stop=300, coll="JetGood")]
+    config["only_this_sample"] = HistConf(pt_axis, only_samples=["sample"])
+    config["only_other_sample"] = HistConf(pt_axis, only_samples=["other"])
+    config["exclude_this_sample"] = HistConf(pt_axis, exclude_samples=["sample"])
+    config["exclude_other_sample"] = HistConf(pt_axis, exclude_samples=["other"])
+    hm = build(cache_templates=cache_templates, hist_config=config)
+    hists = hm.get_histograms("sample")
+    assert "only_this_sample" in hists and "exclude_other_sample" in hists
+    assert "only_other_sample" not in hists and "exclude_this_sample" not in hists
+    assert hists["only_this_sample"].sum(flow=True).value > 0
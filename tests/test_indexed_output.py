@@ -0,0 +1,186 @@
+"""Offline tests of the indexed output files: partial and lazy reads, in-place append and compaction."""
+import os
+import zipfile
+from collections import defaultdict
+
+import numpy as np
+import hist
+import pytest
+from coffea.util import save
+from coffea.processor import accumulate
+
+from pocket_coffea.utils.indexed_output import (
+    IndexedOutput, LazyOutput, append_indexed_output, compact_indexed_output, is_indexed_output,
+)
+from pocket_coffea.utils.load_output import load_output, save_output
+from pocket_coffea.utils.filter_output import filter_output_by_category, filter_output_by_year
+from pocket_coffea.lib.sparse_hist import SparseHist
+from pocket_coffea.scripts.merge_outputs import merge_outputs
+from pocket_coffea.scripts.split_output import split_output
+
+CATEGORIES = ["baseline", "2jets", "3jets"]
+DATASETS = {"TTbar_2017": ("TTbar", "2017"), "TTbar_2018": ("TTbar", "2018"), "DATA_2018": ("DATA", "2018")}
+
+
+def make_hist(seed):
+    h = hist.Hist(
+        hist.axis.StrCategory(CATEGORIES, name="cat"),
+        hist.axis.StrCategory(["nominal", "JES_up"], name="variation"),
+        hist.axis.Regular(10, 0, 100, name="pt"),
+        storage=hist.storage.Weight(),
+    )
+    rng = np.random.default_rng(seed)
+    h.fill(cat="baseline", variation="nominal", pt=rng.uniform(0, 100, 50), weight=rng.normal(1, 0.1, 50))
+    h.fill(cat="2jets", variation="JES_up", pt=rng.uniform(0, 100, 20))
+    return h
+
+
+def make_output(seed=0):
+    out = {
+        "variables": defaultdict(dict),
+        "cutflow": {"initial": {}, "skim": {}},
+        "sumw": defaultdict(dict),
+        "sumw2": defaultdict(dict),
+        "sum_genweights": {},
+        "sum_signOf_genweights": {},
+        "datasets_metadata": {"by_datataking_period": {}, "by_dataset": defaultdict(dict)},
+    }
+    for ivar, var in enumerate(["jet_pt", "lep_pt"]):
+        out["variables"][var] = {}
+        for dataset, (sample, year) in DATASETS.items():
+            out["variables"][var].setdefault(sample, {})[dataset] = make_hist(seed * 100 + ivar * 10 + len(dataset))
+    for dataset, (sample, year) in DATASETS.items():
+        out["cutflow"]["initial"][dataset] = 1000 + seed
+        out["cutflow"]["skim"][dataset] = 500 + seed
+        out["sum_genweights"][dataset] = 1000.0 + seed
+        out["sum_signOf_genweights"][dataset] = 900.0 + seed
+        out["datasets_metadata"]["by_dataset"][dataset] = {"sample": sample, "year": year}
+        out["datasets_metadata"]["by_datataking_period"].setdefault(year, defaultdict(set))[sample].add(dataset)
+        for cat in CATEGORIES:
+            out["cutflow"].setdefault(cat, {})[dataset] = {sample: {"nominal": 10 + seed}}
+            out["sumw"][cat][dataset] = {sample: {"nominal": 5.0 + seed}}
+            out["sumw2"][cat][dataset] = {sample: {"nominal": 2.0 + seed}}
+    return out
+
+
+def assert_output_equal(a, b):
+    assert type(a) == type(b)
+    if isinstance(a, dict):
+        assert list(a.keys()) == list(b.keys())
+        for k in a:
+            assert_output_equal(a[k], b[k])
+    elif isinstance(a, hist.Hist):
+        assert a.axes == b.axes
+        assert np.allclose(a.view(flow=True).value, b.view(flow=True).value)
+        assert np.allclose(a.view(flow=True).variance, b.view(flow=True).variance)
+    else:
+        assert a == b
+
+
+def test_roundtrip(tmp_path):
+    out = make_output()
+    fname = str(tmp_path / "output_all.coffea")
+    save_output(out, fname, indexed=True)
+    assert is_indexed_output(fname)
+    assert_output_equal(load_output(fname), out)
+    with IndexedOutput(fname) as store:
+        # One record per histogram, per category of the cutflow/sumw and per other key
+        assert len(store.records) == 6 + 5 + 3 + 3 + 3
+
+
+def test_partial_read(tmp_path):
+    out = make_output()
+    fname = str(tmp_path / "output_all.coffea")
+    save_output(out, fname, indexed=True)
+    with IndexedOutput(fname) as store:
+        selected = store.read(variables=["jet_pt"], categories=["2jets"], years="2018")
+        # Only the histograms of the selected variable and datasets are read
+        assert set(store._cache) == {r.name for r in [store.index["variables"]["jet_pt"]["TTbar"]["TTbar_2018"],
+                                                      store.index["variables"]["jet_pt"]["DATA"]["DATA_2018"]]
+                                     } | {store.index[k].name for k in ["datasets_metadata", "sum_genweights", "sum_signOf_genweights"]} \
+            | {store.index["cutflow"][c].name for c in ["initial", "skim", "2jets"]} | {store.index[k]["2jets"].name for k in ["sumw", "sumw2"]}
+    assert list(selected["variables"]) == ["jet_pt"]
+    assert list(selected["variables"]["jet_pt"]["TTbar"]) == ["TTbar_2018"]
+    assert list(selected["cutflow"]) == ["initial", "skim", "2jets"]
+    assert list(selected["sum_genweights"]) == ["TTbar_2018", "DATA_2018"]
+    assert list(selected["datasets_metadata"]["by_datataking_period"]) == ["2018"]
+    # Same result as the filtering of the full output
+    by_year = filter_output_by_category(filter_output_by_year(out, "2018"), ["2jets"])
+    assert_output_equal(selected["variables"]["jet_pt"], dict(by_year["variables"]["jet_pt"]))
+    assert selected["sumw"]["2jets"] == by_year["sumw"]["2jets"]
+    # The selections are also applied to the .coffea files
+    save(out, str(tmp_path / "output.coffea"))
+    assert_output_equal(load_output(str(tmp_path / "output.coffea"), variables=["jet_pt"], categories=["2jets"],
+                                    years="2018"), selected)
+
+
+def test_sparse_histograms_selection(tmp_path):
+    out = make_output()
+    out["variables"]["jet_pt"]["TTbar"]["TTbar_2018"] = SparseHist.from_hist(out["variables"]["jet_pt"]["TTbar"]["TTbar_2018"])
+    fname = str(tmp_path / "output_all.coffea")
+    save_output(out, fname, indexed=True)
+    h = load_output(fname, categories=lambda cat: cat.endswith("jets"))["variables"]["jet_pt"]["TTbar"]["TTbar_2018"]
+    assert list(h.axes["cat"]) == ["2jets", "3jets"]
+    assert h[{"cat": "2jets", "variation": "JES_up"}].sum().value == 20
+
+
+def test_lazy(tmp_path):
+    out = make_output()
+    fname = str(tmp_path / "output_all.coffea")
+    save_output(out, fname, indexed=True)
+    lazy = load_output(fname, lazy=True)
+    assert isinstance(lazy, LazyOutput)
+    assert list(lazy["variables"]) == ["jet_pt", "lep_pt"]
+    assert lazy._store._cache == {}
+    h = lazy["variables"]["lep_pt"]["DATA"]["DATA_2018"]
+    assert_output_equal(h, out["variables"]["lep_pt"]["DATA"]["DATA_2018"])
+    assert len(lazy._store._cache) == 1
+    assert_output_equal(lazy.materialize(), out)
+    with pytest.raises(ValueError):
+        load_output(fname, lazy=True, variables=["jet_pt"])
+
+
+def test_append(tmp_path):
+    outputs = [make_output(seed) for seed in range(3)]
+    # The third output brings a new variable and a new dataset
+    outputs[2]["variables"]["met_pt"] = {"TTbar": {"TTbar_2018": make_hist(7)}}
+    outputs[2]["sum_genweights"]["WJets_2018"] = 10.0
+    fname = str(tmp_path / "merged.coffea")
+    for out in outputs:
+        append_indexed_output(out, fname)
+    expected = accumulate([make_output(seed) for seed in range(2)] + [outputs[2]])
+    assert_output_equal(load_output(fname), expected)
+    size = os.path.getsize(fname)
+    compact_indexed_output(fname)
+    assert os.path.getsize(fname) < size
+    assert_output_equal(load_output(fname), expected)
+    # Appending after the compaction does not overwrite the existing records
+    append_indexed_output(make_output(3), fname)
+    assert_output_equal(load_output(fname), accumulate([expected, make_output(3)]))
+    names = zipfile.ZipFile(fname).namelist()
+    assert len(names) == len(set(names))
+
+
+def test_append_to_coffea_file(tmp_path):
+    fname = str(tmp_path / "output.coffea")
+    save(make_output(), fname)
+    with pytest.raises(ValueError):
+        append_indexed_output(make_output(), fname)
+
+
+def test_merge_and_split_indexed(tmp_path):
+    inputs = []
+    for seed in range(3):
+        inputs.append(str(tmp_path / f"output_{seed}.coffea"))
+        save(make_output(seed), inputs[-1])
+    merged = str(tmp_path / "output_merged.coffea")
+    merge_outputs(inputs, merged, indexed=True)
+    assert is_indexed_output(merged)
+    expected = accumulate([make_output(seed) for seed in range(3)])
+    assert_output_equal(load_output(merged), expected)
+
+    split_output(merged, None, "year", 8, False)
+    for year in ["2017", "2018"]:
+        part = str(tmp_path / f"output_merged_{year}.coffea")
+        assert is_indexed_output(part)
+        assert_output_equal(load_output(part), load_output(merged, years=[year]))
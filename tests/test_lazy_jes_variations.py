@@ -0,0 +1,107 @@
+"""Offline test of the lazy JES variations of `jet_correction_corrlib` and of the JetsCalibrator:
+the varied pt and mass built on demand from the stored shifts must be identical to the eager fields."""
+import copy
+
+import numpy as np
+import awkward as ak
+import pytest
+import correctionlib.schemav2 as cs
+from omegaconf import OmegaConf
+
+from pocket_coffea.lib.jets import jet_correction_corrlib, apply_jes_delta
+from pocket_coffea.lib.calibrators.common.common import JetsCalibrator
+
+SOURCES = ["Total", "Absolute", "FlavorQCD"]
+
+
+def _correction(name, inputs, expression, variables):
+    return cs.Correction(
+        name=name,
+        version=1,
+        inputs=[cs.Variable(name=i, type="real") for i in inputs],
+        output=cs.Variable(name="correction", type="real"),
+        data=cs.Formula(nodetype="formula", expression=expression, parser="TFormula", variables=variables),
+    )
+
+
+@pytest.fixture(scope="module")
+def json_path(tmp_path_factory):
+    corrections = [_correction("TEST_L1L2L3Res_AK4PFchs", ["JetPt", "JetEta", "Rho", "JetA"],
+                               "1.05+0.01*y-0.0001*x+0.001*z*t", ["JetPt", "JetEta", "Rho", "JetA"])]
+    for i, source in enumerate(SOURCES):
+        corrections.append(_correction(f"TEST_{source}_AK4PFchs", ["JetEta", "JetPt"],
+                                       f"0.01*{i + 1}+0.002*abs(x)+1/y", ["JetEta", "JetPt"]))
+    path = tmp_path_factory.mktemp("jec") / "jet_jerc.json"
+    path.write_text(cs.CorrectionSet(schema_version=2, corrections=corrections).model_dump_json(exclude_unset=True))
+    return str(path)
+
+
+def make_events(nevents=300, seed=11):
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(0, 7, nevents)
+    n = counts.sum()
+    jets = ak.zip({
+        "pt": rng.exponential(50.0, n) + 15,
+        "mass": rng.exponential(8.0, n) + 1,
+        "rawFactor": rng.uniform(0, 0.2, n),
+        "eta": rng.uniform(-4.7, 4.7, n),
+        "phi": rng.uniform(-np.pi, np.pi, n),
+        "area": rng.uniform(0.4, 0.6, n),
+    })
+    return ak.Array({
+        "Jet": ak.unflatten(jets, counts),
+        "fixedGridRhoFastjetAll": rng.uniform(5, 40, nevents),
+        "event": np.arange(nevents),
+        "run": np.ones(nevents, dtype=np.int64),
+    })
+
+
+def correct(json_path, events, lazy):
+    return jet_correction_corrlib(
+        calib_params={"json_path": json_path, "jec_mc": "TEST", "jer": "TEST_JER", "level": "L1L2L3Res"},
+        variations=[f"JES_{s}" for s in SOURCES],
+        events=events,
+        jet_type="AK4PFchs",
+        jet_coll_name="Jet",
+        chunk_metadata={"isMC": True, "year": "2018", "era": None, "nano_version": 9},
+        nano_version=9,
+        apply_jer=False,
+        lazy_jes_variations=lazy,
+    )
+
+
+def test_lazy_jes_fields_identical(json_path):
+    events = make_events()
+    eager = correct(json_path, events, lazy=False)
+    lazy, deltas = correct(json_path, events, lazy=True)
+    assert sorted(deltas) == sorted(f"JES_{s}" for s in SOURCES)
+    assert not any(f.startswith("pt_JES") for f in lazy.fields)
+    assert ak.to_list(lazy.pt) == ak.to_list(eager.pt)
+    for source in SOURCES:
+        for direction in ["up", "down"]:
+            pt, mass = apply_jes_delta(lazy, deltas[f"JES_{source}"], direction)
+            assert ak.to_list(pt) == ak.to_list(eager[f"pt_JES_{source}_{direction}"])
+            assert ak.to_list(mass) == ak.to_list(eager[f"mass_JES_{source}_{direction}"])
+
+
+def test_jets_calibrator_lazy_variation(json_path):
+    events = make_events()
+    eager = correct(json_path, events, lazy=False)
+    lazy, deltas = correct(json_path, events, lazy=True)
+
+    def make_calibrator(jets, jes_deltas):
+        calibrator = JetsCalibrator.__new__(JetsCalibrator)
+        calibrator.year = "2018"
+        calibrator.jet_calib_param = OmegaConf.create({"collection": {"2018": {"AK4PFchs": "Jet"}}})
+        calibrator.jets_calibrated = {"Jet": jets}
+        calibrator.jes_deltas = jes_deltas
+        return calibrator
+
+    for source in SOURCES:
+        for direction in ["up", "down"]:
+            out_eager = {"Jet": copy.copy(eager)}
+            make_calibrator(eager, {}).apply_variation(out_eager, "AK4PFchs", f"JES_{source}", direction)
+            out_lazy = {"Jet": copy.copy(lazy)}
+            make_calibrator(lazy, {"Jet": deltas}).apply_variation(out_lazy, "AK4PFchs", f"JES_{source}", direction)
+            for field in ["pt", "mass", "rawFactor"]:
+                assert ak.to_list(out_lazy["Jet"][field]) == ak.to_list(out_eager["Jet"][field])
@@ -0,0 +1,138 @@
+"""Offline tests of the cached, pre-indexed golden-JSON lumi mask.
+
+The IndexedLumiMask must give the same result as coffea's LumiMask, be parsed once per
+path, and the fileset helpers must drop only the data files entirely outside the golden JSON.
+"""
+import json
+
+import numpy as np
+import awkward as ak
+import pytest
+from coffea.lumi_tools import LumiMask
+
+from pocket_coffea.lib import lumi_mask_cache
+from pocket_coffea.lib.lumi_mask_cache import (
+    IndexedLumiMask,
+    files_outside_golden_json,
+    remove_files_outside_golden_json,
+    update_golden_json_skiplist,
+)
+from pocket_coffea.parameters.lumi import goldenJSON
+
+
+@pytest.fixture
+def small_golden_json(tmp_path):
+    path = tmp_path / "golden.json"
+    path.write_text(json.dumps({
+        "100": [[1, 10], [20, 20], [30, 45]],
+        "105": [[5, 8]],
+        "110": [[1, 1000]],
+    }))
+    return str(path)
+
+
+def test_indexed_lumi_mask_small(small_golden_json):
+    mask = IndexedLumiMask(small_golden_json)
+    runs = np.array([100, 100, 100, 100, 100, 100, 103, 105, 105, 110, 99, 111], dtype=np.uint32)
+    lumis = np.array([1, 10, 11, 20, 21, 45, 5, 4, 8, 1000, 5, 1], dtype=np.uint32)
+    expected = [True, True, False, True, False, True, False, False, True, True, False, False]
+    assert mask(runs, lumis).tolist() == expected
+    assert mask(ak.Array(runs), ak.Array(lumis)).tolist() == expected
+    assert np.array_equal(mask(runs, lumis), LumiMask(small_golden_json)(runs, lumis))
+
+
+def test_indexed_lumi_mask_same_as_coffea():
+    path = goldenJSON["2018"]
+    rng = np.random.default_rng(42)
+    runs = rng.integers(314000, 326000, 200_000).astype(np.uint32)
+    lumis = rng.integers(0, 2000, 200_000).astype(np.uint32)
+    assert np.array_equal(IndexedLumiMask(path)(runs, lumis), LumiMask(path)(runs, lumis))
+
+
+def test_load_lumi_mask_caches_by_path(small_golden_json, tmp_path):
+    other = tmp_path / "other.json"
+    other.write_text(json.dumps({"1": [[1, 2]]}))
+    lumi_mask_cache.load_lumi_mask.cache_clear()
+    try:
+        a1 = lumi_mask_cache.load_lumi_mask(small_golden_json)
+        a2 = lumi_mask_cache.load_lumi_mask(small_golden_json)
+        b1 = lumi_mask_cache.load_lumi_mask(str(other))
+        assert a1 is a2
+        assert a1 is not b1
+    finally:
+        lumi_mask_cache.load_lumi_mask.cache_clear()
+
+
+def test_overlaps_run_range(small_golden_json):
+    mask = IndexedLumiMask(small_golden_json)
+    assert mask.overlaps_run_range(90, 100)
+    assert mask.overlaps_run_range(101, 105)
+    assert not mask.overlaps_run_range(101, 104)
+    assert not mask.overlaps_run_range(111, 200)
+    assert not mask.overlaps_run_range(1, 99)
+
+
+def test_files_outside_golden_json(small_golden_json):
+    filesets = {
+        "DATA_2018": {"files": ["a.root", "b.root", "c.root", "d.root"],
+                      "metadata": {"isMC": "False", "year": "2018"}},
+        "MC_2018": {"files": ["mc.root"], "metadata": {"isMC": "True", "year": "2018"}},
+        "DATA_2017": {"files": ["e.root"], "metadata": {"isMC": "False", "year": "2017"}},
+    }
+    run_ranges = {"a.root": (100, 100), "b.root": (101, 104), "c.root": None,
+                  "d.root": (111, 120), "mc.root": (1, 1), "e.root": (1, 1)}
+    to_skip = files_outside_golden_json(filesets, {"2018": small_golden_json},
+                                        run_range_getter=run_ranges.get)
+    assert to_skip == {"DATA_2018": ["b.root", "d.root"]}
+
+    filtered = remove_files_outside_golden_json(filesets, to_skip)
+    assert filtered["DATA_2018"]["files"] == ["a.root", "c.root"]
+    assert filtered["DATA_2018"]["metadata"] == filesets["DATA_2018"]["metadata"]
+    assert filtered["MC_2018"] is filesets["MC_2018"]
+    # The input filesets are not modified
+    assert len(filesets["DATA_2018"]["files"]) == 4
+
+    filtered = remove_files_outside_golden_json(filesets, {"DATA_2017": ["e.root"]})
+    assert "DATA_2017" not in filtered
+
+
+def test_update_golden_json_skiplist(small_golden_json, tmp_path):
+    skiplist_file = str(tmp_path / "files_outside_golden_json.json")
+    run_ranges = {"a.root": (100, 100), "b.root": (101, 104), "d.root": (111, 120), "e.root": (111, 111)}
+    read = []
+
+    def run_range_getter(file):
+        read.append(file)
+        return run_ranges[file]
+
+    data = {"files": ["a.root", "b.root"], "metadata": {"isMC": "False", "year": "2018"}}
+    filesets = {"DATA_2018": data, "MC_2018": {"files": ["mc.root"], "metadata": {"isMC": "True", "year": "2018"}}}
+    golden = {"2018": small_golden_json}
+    assert update_golden_json_skiplist(skiplist_file, filesets, golden, run_range_getter) == {"DATA_2018": ["b.root"]}
+    assert read == ["a.root", "b.root"]
+
+    # Reused without reading the files again
+    read.clear()
+    assert update_golden_json_skiplist(skiplist_file, filesets, golden, run_range_getter) == {"DATA_2018": ["b.root"]}
+    assert read == []
+
+    # A dataset added to the run, and a new file of the known dataset: only the new files are read
+    filesets["DATA_2018"] = {**data, "files": ["a.root", "b.root", "d.root"]}
+    filesets["DATA_2018_B"] = {"files": ["e.root"], "metadata": {"isMC": "False", "year": "2018"}}
+    assert update_golden_json_skiplist(skiplist_file, filesets, golden, run_range_getter) == \
+        {"DATA_2018": ["b.root", "d.root"], "DATA_2018_B": ["e.root"]}
+    assert sorted(read) == ["d.root", "e.root"]
+    # Running on a subset keeps the results of the other datasets
+    read.clear()
+    assert update_golden_json_skiplist(skiplist_file, {"DATA_2018": data}, golden, run_range_getter) == \
+        {"DATA_2018": ["b.root"]}
+    assert update_golden_json_skiplist(skiplist_file, filesets, golden, run_range_getter)["DATA_2018_B"] == ["e.root"]
+    assert read == []
+
+    # An updated golden JSON (same path) is checked again
+    with open(small_golden_json, "w") as f:
+        json.dump({"100": [[1, 10]], "102": [[1, 5]], "115": [[1, 5]]}, f)
+    # (a new process: the lumi mask is parsed again)
+    lumi_mask_cache.load_lumi_mask.cache_clear()
+    assert update_golden_json_skiplist(skiplist_file, filesets, golden, run_range_getter) == {"DATA_2018_B": ["e.root"]}
+    assert sorted(read) == ["a.root", "b.root", "d.root", "e.root"]
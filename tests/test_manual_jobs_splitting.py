@@ -183,6 +183,27 @@ def test_chunksize_dict_rejects_mixed_sample_job():
         ExecutorFactoryManualABC._resolve_chunksize_for_job(cfg, mixed_split)
 
 
+def test_chunksize_adaptive_with_scalar():
+    adaptive = {"TT": 40_000, "DATA": 300_000}
+    assert ExecutorFactoryManualABC._resolve_chunksize_for_job(
+        150_000, _make_single_sample_job("TT"), adaptive) == 40_000
+    # Samples without measurements keep the scalar value
+    assert ExecutorFactoryManualABC._resolve_chunksize_for_job(
+        150_000, _make_single_sample_job("ttH"), adaptive) == 150_000
+    # Jobs mixing samples get the smallest chunksize
+    mixed_split = {
+        "TT_2018": {"files": ["t.root"], "metadata": {"sample": "TT", "nevents": "10"}},
+        "DATA_2018": {"files": ["d.root"], "metadata": {"sample": "DATA", "nevents": "10"}},
+    }
+    assert ExecutorFactoryManualABC._resolve_chunksize_for_job(150_000, mixed_split, adaptive) == 40_000
+
+
+def test_chunksize_dict_takes_precedence_over_adaptive():
+    cfg = {"TT": 50_000, "default": 150_000}
+    assert ExecutorFactoryManualABC._resolve_chunksize_for_job(
+        cfg, _make_single_sample_job("TT"), {"TT": 40_000}) == 50_000
+
+
 def test_chunksize_validate_keys_warns_on_unknown(capsys):
     filesets = _make_filesets([("TT_2018", "TT", 10, ["f.root"])])
     cfg = {"TT": 50_000, "Typo": 99_999, "default": 150_000}
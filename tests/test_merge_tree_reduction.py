@@ -0,0 +1,93 @@
+"""Offline tests of the parallel tree-reduction mode of merge-outputs: the result must be
+the same as the serial accumulation of all the outputs, in a single output file."""
+import numpy as np
+import hist
+from coffea.util import load, save
+from coffea.processor import accumulate
+
+import pocket_coffea.scripts.merge_outputs as mo
+
+
+def make_output(i):
+    rng = np.random.default_rng(i)
+    dataset = f"DATA_{i % 3}"
+    out = {
+        "sum_genweights": {dataset: float(i)},
+        "cutflow": {"initial": {dataset: 100 + i}, "skim": {dataset: 50 + i}},
+        "variables": {},
+    }
+    for var in ["jet_pt", "ht", "nJets"]:
+        h = hist.Hist(hist.axis.Regular(10, 0, 100, name=var), storage=hist.storage.Weight())
+        h.fill(rng.uniform(0, 100, 50), weight=rng.uniform(0.5, 1.5, 50))
+        out["variables"][var] = {"sample": {dataset: h}}
+    if i % 2:
+        out["variables"]["only_odd"] = {"sample": {dataset: h.copy()}}
+    return out
+
+
+def write_outputs(tmp_path, n):
+    files = []
+    for i in range(n):
+        f = str(tmp_path / f"output_{i}.coffea")
+        save(make_output(i), f)
+        files.append(f)
+    return files
+
+
+def assert_same_output(a, b):
+    assert list(a) == list(b)
+    assert a["sum_genweights"] == b["sum_genweights"]
+    assert a["cutflow"] == b["cutflow"]
+    assert list(a["variables"]) == list(b["variables"])
+    for var, by_sample in a["variables"].items():
+        for sample, by_dataset in by_sample.items():
+            assert set(by_dataset) == set(b["variables"][var][sample])
+            for dataset, h in by_dataset.items():
+                h2 = b["variables"][var][sample][dataset]
+                assert np.allclose(h.values(flow=True), h2.values(flow=True), rtol=1e-12)
+                assert np.allclose(h.variances(flow=True), h2.variances(flow=True), rtol=1e-12)
+
+
+def test_merge_tree_reduction_same_as_serial(tmp_path):
+    files = write_outputs(tmp_path, 11)
+    expected = accumulate([load(f) for f in files])
+    merged = mo.merge_tree_reduction(files, N_reduction=3, cachedir=str(tmp_path / "cache"), workers=2)
+    assert_same_output(expected, merged)
+    # The intermediate files are removed
+    assert not (tmp_path / "cache" / "tree_merge").exists()
+
+
+def test_merge_outputs_with_workers_single_file(tmp_path):
+    files = write_outputs(tmp_path, 7)
+    outfile = str(tmp_path / "merged.coffea")
+    mo.merge_outputs(files, outfile, force=True, N_reduction=2, workers=2)
+    assert_same_output(accumulate([load(f) for f in files]), load(outfile))
+
+
+def test_merge_tree_reduction_streams_indexed_output(tmp_path, monkeypatch):
+    from pocket_coffea.utils.indexed_output import IndexedOutput
+    from pocket_coffea.utils.load_output import load_output
+
+    files = write_outputs(tmp_path, 9)
+    appended = []
+    append = IndexedOutput.append
+
+    def recording_append(self, output):
+        appended.append(output)
+        return append(self, output)
+
+    monkeypatch.setattr(IndexedOutput, "append", recording_append)
+    outfile = str(tmp_path / "merged.coffea")
+    assert mo.merge_tree_reduction(files, N_reduction=2, cachedir=str(tmp_path / "cache"),
+                                   workers=2, output_file=outfile) is None
+    # Each merged shard is appended on its own: at most one variable at a time
+    assert all(len(out.get("variables", {})) <= 1 and len(out) == 1 for out in appended)
+    assert_same_output(accumulate([load(f) for f in files]), load_output(outfile))
+    assert not (tmp_path / "cache" / "tree_merge").exists()
+
+    # merge-outputs --indexed with workers streams the tree reduction to the output file
+    appended.clear()
+    outfile2 = str(tmp_path / "merged_cli.coffea")
+    mo.merge_outputs(files, outfile2, force=True, N_reduction=2, workers=2, indexed=True)
+    assert len(appended) == len(list(mo._shard_keys(accumulate([load(f) for f in files]))))
+    assert_same_output(load_output(outfile), load_output(outfile2))
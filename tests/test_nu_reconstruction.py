@@ -0,0 +1,114 @@
+"""Offline test of the vectorized dileptonic neutrino reconstruction: the outputs of
+`pnuCalculator_vectorized` must match the per-event `pnuCalculator_v7` on synthetic events,
+with a toy PDF in place of lhapdf."""
+import types
+
+import numpy as np
+import awkward as ak
+import pytest
+from coffea.nanoevents.methods import candidate
+
+from pocket_coffea.lib import reconstruction
+from pocket_coffea.lib.reconstruction import pnuCalculator_v7, pnuCalculator_vectorized, quartic_roots
+
+NURECO = {
+    "PDF": "toy",
+    "Ecm": 13000.0,
+    "Q": 173.0,
+    "m_t": {"nominal": 172.5, "scan": [170.0, 175.0, 2]},
+    "m_W": {"nominal": 80.4, "scan": [79.9, 80.9, 2]},
+    "m_b": {"nominal": 4.8},
+}
+
+
+class ToyPDF:
+    def xfxQ(self, pid, x, Q):
+        return x**0.3 * (1 - x) ** (3 + abs(pid) % 7) * (1 + 0.1 * pid)
+
+
+def toy_lhapdf():
+    return types.SimpleNamespace(UP=2, AUP=-2, DOWN=1, ADOWN=-1, GLUON=21, mkPDF=lambda name: ToyPDF())
+
+
+def make_candidates(rng, counts, mass):
+    n = int(np.sum(counts))
+    flat = ak.zip(
+        {
+            "pt": rng.exponential(60.0, n) + 20.0,
+            "eta": rng.uniform(-2.4, 2.4, n),
+            "phi": rng.uniform(-np.pi, np.pi, n),
+            "mass": np.full(n, mass) if np.isscalar(mass) else mass(n),
+            "charge": np.zeros(n),
+        },
+        with_name="PtEtaPhiMCandidate",
+        behavior=candidate.behavior,
+    )
+    return ak.unflatten(flat, counts)
+
+
+def make_events(nevents, seed=3):
+    rng = np.random.default_rng(seed)
+    ones = np.ones(nevents, dtype=int)
+    leptons = ak.flatten(make_candidates(rng, ones, 0.105))
+    leptons_bar = ak.flatten(make_candidates(rng, ones, 0.000511))
+    # Flag a missing lepton as in the analysis
+    leptons = ak.with_field(leptons, ak.where(np.arange(nevents) % 17 == 5, -1.0, leptons.pt), "pt")
+    bjets = make_candidates(rng, rng.integers(0, 5, nevents), lambda n: rng.uniform(5, 20, n))
+    fatjets = ak.flatten(make_candidates(rng, ones, lambda n: rng.uniform(50, 200, n)))
+    METs = ak.zip(
+        {"r": rng.exponential(80.0, nevents), "phi": rng.uniform(-np.pi, np.pi, nevents)},
+        with_name="PolarTwoVector",
+        behavior=candidate.behavior,
+    )
+    return leptons, leptons_bar, bjets, METs, fatjets
+
+
+@pytest.fixture
+def toy_nureco(monkeypatch):
+    monkeypatch.setattr(reconstruction, "nureco", NURECO)
+    monkeypatch.setattr(reconstruction, "lhapdf", toy_lhapdf())
+
+
+def test_quartic_roots_as_np_roots():
+    rng = np.random.default_rng(1)
+    coeffs = rng.normal(size=(200, 5))
+    coeffs[:5, 0] = 0.0
+    coeffs[5:10, 4] = 0.0
+    coeffs[10, 2] = np.nan
+    roots = quartic_roots(coeffs)
+    for c, r in zip(coeffs, roots):
+        if not np.all(np.isfinite(c)):
+            assert np.all(np.isnan(r))
+            continue
+        expected = np.roots(c)
+        np.testing.assert_allclose(r[: len(expected)], expected, rtol=1e-10, atol=1e-12)
+        assert np.all(np.isnan(r[len(expected):]))
+
+
+@pytest.mark.parametrize("scan", [False, True])
+def test_vectorized_matches_v7(toy_nureco, scan):
+    inputs = make_events(60)
+    reference = pnuCalculator_v7(*inputs, scan=scan)
+    vectorized = pnuCalculator_vectorized(*inputs, scan=scan)
+
+    mask_ref, mask_vec = reference[4], vectorized[4]
+    assert np.array_equal(mask_ref, mask_vec)
+    assert mask_vec.sum() > 10 and (~mask_vec).sum() > 0
+    for ref, vec in zip(reference[:4], vectorized[:4]):
+        assert ak.fields(ref) == ak.fields(vec)
+        for field in ak.fields(ref):
+            # The neutrino mass is the cancellation sqrt(E^2 - p^2) of a massless vector
+            atol = 1e-3 if field == "mass" else 1e-6
+            np.testing.assert_allclose(
+                ak.to_numpy(vec[field]), ak.to_numpy(ref[field]), rtol=1e-6, atol=atol, equal_nan=True, err_msg=field
+            )
+
+
+def test_ranking(toy_nureco):
+    inputs = make_events(40)
+    pnu, pnubar, pbjets, pbbarjets, mask, ranking = pnuCalculator_vectorized(*inputs, scan=True, return_ranking=True)
+    assert len(ranking) == 40
+    assert np.array_equal(ak.num(ranking) > 0, mask)
+    weights = ranking.PDFweight
+    assert ak.all(weights[:, 1:] <= weights[:, :-1])
+    assert set(np.unique(ak.to_numpy(ak.flatten(ranking.m_t)))) <= {170.0, 175.0}
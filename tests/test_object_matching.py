@@ -3,10 +3,11 @@
 Uses coffea's Lorentz-vector behavior so `obj.metric_table` (deltaR) works on
 hand-built objects.
 """
+import numpy as np
 import awkward as ak
 from coffea.nanoevents.methods import vector
 
-from pocket_coffea.lib.deltaR_matching import object_matching
+from pocket_coffea.lib.deltaR_matching import object_matching, object_matching_flat
 
 ak.behavior.update(vector.behavior)
 
@@ -39,3 +40,33 @@ def test_pure_dr_matching_unchanged():
     matched_obj, matched_obj2, dr = object_matching(quarks, jets, dr_min=0.4)
     # Each jet matched to the quark at the same eta.
     assert ak.to_list(matched_obj.eta) == [[0.02, 1.02]]
+
+
+def test_flat_matcher_same_as_object_matching():
+    rng = np.random.default_rng(5)
+    n1 = rng.integers(0, 9, 300)
+    n2 = rng.integers(0, 13, 300)
+    n2[:3] = [0, 70, 0]  # empty events and more than 64 objects (multi-word bitset)
+
+    def random_obj(counts):
+        def field(low, high):
+            return ak.unflatten(rng.uniform(low, high, counts.sum()).astype("float32"), counts)
+        return _obj(pt=field(20, 200), eta=field(-1, 1), phi=field(-1, 1))
+
+    quarks, jets = random_obj(n1), random_obj(n2)
+    for dpt_max in [None, 30.0]:
+        ref = object_matching(quarks, jets, dr_min=0.5, dpt_max=dpt_max, return_indices=True)
+        new = object_matching_flat(quarks, jets, dr_min=0.5, dpt_max=dpt_max, return_indices=True)
+        for a, b in zip(ref, new):
+            assert ak.to_list(a) == ak.to_list(b)
+        # deltaR_padnone and deltaR_masked keep the float32 dtype of the inputs
+        # (the ArrayBuilder of object_matching returns deltaR_padnone as float64)
+        assert str(ak.type(new[2])) == "300 * var * ?float32"
+        assert str(ak.type(new[5])) == str(ak.type(ref[5])) == "300 * var * float32"
+
+
+def test_flat_matcher_dpt_cut_does_not_block_valid_match():
+    jets = _obj(pt=[[52.0]], eta=[[0.0]], phi=[[0.0]])
+    quarks = _obj(pt=[[100.0, 50.0]], eta=[[0.0, 0.0]], phi=[[0.1, 0.2]])
+    matched_obj, matched_obj2, dr = object_matching_flat(quarks, jets, dr_min=0.5, dpt_max=10.0)
+    assert ak.to_list(matched_obj.pt) == [[50.0]]
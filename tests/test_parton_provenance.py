@@ -0,0 +1,61 @@
+"""Offline tests of the GenPart global -> flat index conversion of parton_provenance."""
+import numpy as np
+import awkward as ak
+from numba.typed import List
+
+from pocket_coffea.lib.parton_provenance import (
+    reverse_index_array,
+    reverse_index_array_linear,
+    get_genparts_offsets_index,
+    analyze_W_flat,
+)
+
+
+def make_masked_tree(nevents=500, seed=3):
+    rng = np.random.default_rng(seed)
+    counts_all = rng.integers(1, 30, 2 * nevents)
+    first_all = np.concatenate([[0], np.cumsum(counts_all)[:-1]])
+    kept = np.sort(rng.choice(len(counts_all), nevents, replace=False))
+    counts = counts_all[kept]
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    return first_all[kept], offsets, counts
+
+
+def test_reverse_index_array_same_as_linear():
+    first, offsets, counts = make_masked_tree()
+    nevents = len(counts)
+    rng = np.random.default_rng(1)
+    events = rng.integers(0, nevents, 3000)
+    events[:5] = [0, nevents - 1, nevents - 1, 0, 1]
+    local = (rng.random(len(events)) * counts[events]).astype(np.int64)
+    idxGs = first[events] + local
+    out = reverse_index_array(idxGs, first, offsets, nevents)
+    assert np.array_equal(out, offsets[events] + local)
+    assert np.array_equal(out, reverse_index_array_linear(idxGs, first, offsets, nevents))
+
+
+def test_get_genparts_offsets_index():
+    genparts = ak.Array([[1, 2, 3], [], [4], [5, 6]])
+    first, offsets, nevents = get_genparts_offsets_index(ak.Array([0, 10, 10, 12]), genparts)
+    assert first.dtype == np.int64
+    assert offsets.tolist() == [0, 3, 3, 4]
+    assert nevents == 4
+
+
+def test_analyze_W_flat():
+    # Two events, global offsets 0 and 100 (the events in between are masked).
+    # Event 0: W (0, not last copy) -> W (1, last copy) -> mu (2), nu (3)
+    # Event 1: W (100, last copy) -> q (101), q (102)
+    first = np.array([0, 100], dtype=np.int64)
+    offsets = np.array([0, 4], dtype=np.int64)
+    last_copy = 1 << 13
+    statusFlags = np.array([0, last_copy, 0, 0, last_copy, 0, 0])
+    pdgId = np.array([24, 24, 13, -14, -24, 1, -2])
+    children_idx = [np.array([1]), np.array([2, 3]), np.zeros(0, dtype=np.int64),
+                    np.zeros(0, dtype=np.int64), np.array([101, 102]),
+                    np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)]
+    children = List(children_idx)
+    is_leptonic, idx_children = analyze_W_flat(np.array([0, 4]), children, statusFlags, pdgId,
+                                               first, offsets, 2)
+    assert is_leptonic.tolist() == [True, False]
+    assert idx_children.tolist() == [[2, 3], [5, 6]]
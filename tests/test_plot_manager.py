@@ -0,0 +1,172 @@
+"""Tests of the dispatching of the plots of the PlotManager and of its plot cache.
+
+The drawing of the Shape objects is replaced by a function writing a small text file with the
+content of the histograms, so that the outputs of the serial and of the parallel paths can be
+compared and the redraws counted.
+
+The ``plot_utils`` module is imported by the `tests.utils.plot_utils` fixture, which does not need
+the CAT metadata on cvmfs.
+"""
+import os
+
+import hist
+import numpy as np
+import pytest
+from omegaconf import OmegaConf
+
+import pocket_coffea
+from tests.utils import plot_utils
+
+CATEGORIES = ["baseline", "2jets"]
+VARIABLES = ["jet_pt", "lep_pt"]
+DATASETS_METADATA = {
+    "by_datataking_period": {"2018": {"TTbar": {"TTbar_2018"}, "DATA_SingleMuon": {"DATA_SingleMuon_2018"}}},
+    "by_dataset": {
+        "TTbar_2018": {"sample": "TTbar", "year": "2018", "isMC": "True"},
+        "DATA_SingleMuon_2018": {"sample": "DATA_SingleMuon", "year": "2018", "isMC": "False"},
+    },
+}
+
+
+def make_hist(seed, data=False):
+    axes = [hist.axis.StrCategory(CATEGORIES, name="cat")]
+    if not data:
+        axes.append(hist.axis.StrCategory(["nominal", "JESUp", "JESDown"], name="variation"))
+    h = hist.Hist(*axes, hist.axis.Regular(10, 0, 100, name="pt", label="$p_T$"),
+                  storage=hist.storage.Weight())
+    rng = np.random.default_rng(seed)
+    for cat in CATEGORIES:
+        if data:
+            h.fill(cat=cat, pt=rng.uniform(0, 100, 100))
+        else:
+            for variation in ["nominal", "JESUp", "JESDown"]:
+                h.fill(cat=cat, variation=variation, pt=rng.uniform(0, 100, 100))
+    return h
+
+
+def make_hists():
+    return {
+        variable: {
+            "TTbar": {"TTbar_2018": make_hist(i)},
+            "DATA_SingleMuon": {"DATA_SingleMuon_2018": make_hist(i + 10, data=True)},
+        }
+        for i, variable in enumerate(VARIABLES)
+    }
+
+
+def make_style():
+    style = OmegaConf.load(
+        os.path.join(os.path.dirname(pocket_coffea.__file__), "parameters", "plotting_style.yaml")
+    ).plotting_style
+    style.plot_upper_label.by_year = {"2018": 59.8}
+    return style
+
+
+@pytest.fixture
+def drawn(plot_utils, monkeypatch):
+    '''Replace the drawing of the data/MC plots: returns the list of the Shape objects drawn
+    in the current process.'''
+    drawn = []
+
+    def plot_datamc_all(self, ratio=True, syst=True, spliteras=False, save=True, format="png"):
+        drawn.append(self.name)
+        for cat in self.categories:
+            filepath = os.path.join(self.plot_dir, cat, f"{self.name}_{cat}.{format}")
+            with open(filepath, "w") as f:
+                for sample in sorted(self.h_dict):
+                    f.write(f"{sample} {self.h_dict[sample][{'cat': cat}].sum().value!r}\n")
+            self.saved_files.append(filepath)
+
+    monkeypatch.setattr(plot_utils.Shape, "plot_datamc_all", plot_datamc_all)
+    return drawn
+
+
+def make_manager(plot_utils, plot_dir, hists=None, style=None, **kwargs):
+    return plot_utils.PlotManager(VARIABLES, hists if hists is not None else make_hists(), DATASETS_METADATA,
+                                  str(plot_dir), style if style is not None else make_style(), verbose=0, **kwargs)
+
+
+def read_plots(plot_dir):
+    plots = {}
+    for cat in CATEGORIES:
+        for filename in os.listdir(os.path.join(plot_dir, cat)):
+            with open(os.path.join(plot_dir, cat, filename)) as f:
+                plots[(cat, filename)] = f.read()
+    return plots
+
+
+def test_map_shapes_parallel_paths(plot_utils, tmp_path, drawn, monkeypatch):
+    make_manager(plot_utils, tmp_path / "serial", workers=1, plot_cache=True).plot_datamc_all()
+    make_manager(plot_utils, tmp_path / "fork", workers=2, plot_cache=True).plot_datamc_all()
+    # Without the fork start method each task carries a PlotManager restricted to its Shape
+    monkeypatch.setattr(plot_utils.multiprocessing, "get_all_start_methods", lambda: ["spawn"])
+    make_manager(plot_utils, tmp_path / "restricted", workers=2, plot_cache=True).plot_datamc_all()
+
+    serial = read_plots(tmp_path / "serial")
+    assert len(serial) == len(VARIABLES) * len(CATEGORIES)
+    assert read_plots(tmp_path / "fork") == serial
+    assert read_plots(tmp_path / "restricted") == serial
+
+    # The plot cache lists the same digests and files, relative to each plot dir
+    def cache(path):
+        entries = make_manager(plot_utils, path, workers=1, plot_cache=True)._plot_cache_entries
+        return {k: (v["digest"], sorted(os.path.relpath(f, path) for f in v["files"]))
+                for k, v in entries.items()}
+
+    assert len(cache(tmp_path / "serial")) == len(VARIABLES)
+    assert cache(tmp_path / "fork") == cache(tmp_path / "serial")
+    assert cache(tmp_path / "restricted") == cache(tmp_path / "serial")
+
+
+def test_restricted_to(plot_utils, tmp_path, drawn):
+    manager = make_manager(plot_utils, tmp_path, workers=1, plot_cache=True)
+    manager.plot_datamc_all()
+    restricted = manager.restricted_to("jet_pt_2018")
+    assert list(restricted.shape_objects) == ["jet_pt_2018"]
+    assert list(restricted._plot_cache_entries) == ["plot_datamc:jet_pt_2018"]
+    assert list(manager.shape_objects) == ["jet_pt_2018", "lep_pt_2018"]
+
+
+def test_plot_cache_skips_unchanged_shapes(plot_utils, tmp_path, drawn):
+    make_manager(plot_utils, tmp_path, workers=1, plot_cache=True).plot_datamc_all()
+    assert sorted(drawn) == ["jet_pt_2018", "lep_pt_2018"]
+    assert os.path.exists(tmp_path / plot_utils.PlotManager.PLOT_CACHE_FILE)
+
+    drawn.clear()
+    make_manager(plot_utils, tmp_path, workers=1, plot_cache=True).plot_datamc_all()
+    assert drawn == []
+
+    # Without the plot cache everything is drawn again
+    make_manager(plot_utils, tmp_path, workers=1).plot_datamc_all()
+    assert sorted(drawn) == ["jet_pt_2018", "lep_pt_2018"]
+
+
+def test_plot_cache_redraws_changed_shapes(plot_utils, tmp_path, drawn):
+    make_manager(plot_utils, tmp_path, workers=1, plot_cache=True).plot_datamc_all()
+
+    # A changed histogram redraws only its Shape
+    drawn.clear()
+    hists = make_hists()
+    hists["jet_pt"]["TTbar"]["TTbar_2018"].fill(cat="2jets", variation="nominal", pt=[5.0])
+    make_manager(plot_utils, tmp_path, hists=hists, workers=1, plot_cache=True).plot_datamc_all()
+    assert drawn == ["jet_pt_2018"]
+    assert "TTbar 301.0" in read_plots(tmp_path)[("2jets", "jet_pt_2018_2jets.png")]
+
+    # A changed style option redraws everything
+    drawn.clear()
+    style = make_style()
+    style.opts_figure.datamc.figsize = [10, 10]
+    make_manager(plot_utils, tmp_path, hists=hists, style=style, workers=1, plot_cache=True).plot_datamc_all()
+    assert sorted(drawn) == ["jet_pt_2018", "lep_pt_2018"]
+
+    # A deleted plot file redraws its Shape
+    drawn.clear()
+    os.remove(tmp_path / "baseline" / "lep_pt_2018_baseline.png")
+    make_manager(plot_utils, tmp_path, hists=hists, style=style, workers=1, plot_cache=True).plot_datamc_all()
+    assert drawn == ["lep_pt_2018"]
+    assert os.path.exists(tmp_path / "baseline" / "lep_pt_2018_baseline.png")
+
+    # A different plotting option redraws everything
+    drawn.clear()
+    make_manager(plot_utils, tmp_path, hists=hists, style=style, workers=1, plot_cache=True).plot_datamc_all(ratio=False)
+    assert sorted(drawn) == ["jet_pt_2018", "lep_pt_2018"]
@@ -0,0 +1,110 @@
+"""Tests of the squared errors of the systematic uncertainties of the data/MC plots.
+
+`SystManager.get_err2` computes the up/down squared errors of all the systematic uncertainties
+of a category at once: they must be identical to the ones computed by `SystUnc._get_err2`
+for each systematic uncertainty, including one-sided, empty and missing variations.
+
+The ``plot_utils`` module is imported by the `tests.utils.plot_utils` fixture, which does not need
+the CAT metadata on cvmfs.
+"""
+import os
+
+import hist
+import numpy as np
+import pytest
+from omegaconf import OmegaConf
+
+import pocket_coffea
+from tests.utils import plot_utils
+
+CATEGORIES = ["baseline", "2jets"]
+SAMPLES = ["TTbar", "WJets", "ZJets"]
+# twosided: up and down on opposite sides of the nominal; onesided: both above the nominal;
+# empty: no entries in the down variation; partial: missing in the WJets histogram
+VARIATIONS = ["nominal", "twosidedUp", "twosidedDown", "onesidedUp", "onesidedDown",
+              "emptyUp", "emptyDown", "partialUp", "partialDown"]
+SCALES = {"nominal": 1.0, "twosidedUp": 1.2, "twosidedDown": 0.9, "onesidedUp": 1.1,
+          "onesidedDown": 1.3, "emptyUp": 1.05, "emptyDown": None, "partialUp": 1.15, "partialDown": 0.8}
+
+
+def make_hist(sample, seed):
+    variations = [v for v in VARIATIONS if not (sample == "WJets" and v.startswith("partial"))]
+    h = hist.Hist(
+        # Same axes as the histograms of the HistManager
+        hist.axis.StrCategory(CATEGORIES, name="cat", label="Category"),
+        hist.axis.StrCategory(variations, name="variation", label="Variation"),
+        hist.axis.Regular(12, 0, 100, name="pt", label="$p_T$"),
+        storage=hist.storage.Weight(),
+    )
+    rng = np.random.default_rng(seed)
+    for cat in CATEGORIES:
+        # The same events are used for all the variations, with scaled weights
+        pt = rng.uniform(-10, 110, 200)
+        weight = rng.normal(1, 0.3, 200)
+        for variation in variations:
+            if SCALES[variation] is not None:
+                h.fill(cat=cat, variation=variation, pt=pt, weight=weight * SCALES[variation])
+    return h
+
+
+def make_shape(plot_utils, flow, has_mcstat):
+    style = OmegaConf.load(
+        os.path.join(os.path.dirname(pocket_coffea.__file__), "parameters", "plotting_style.yaml")
+    ).plotting_style
+    style.plot_upper_label.by_year = {"2018": 59.8}
+    style.flow = flow
+    hists = {"pt": {s: {f"{s}_2018": make_hist(s, i)} for i, s in enumerate(SAMPLES)}}
+    datasets_metadata = {
+        "by_datataking_period": {"2018": {s: {f"{s}_2018"} for s in SAMPLES}},
+        "by_dataset": {f"{s}_2018": {"sample": s, "year": "2018", "isMC": "True"} for s in SAMPLES},
+    }
+    manager = plot_utils.PlotManager(["pt"], hists, datasets_metadata, "", style, has_mcstat=has_mcstat,
+                          workers=1, verbose=0, save=False)
+    return manager.shape_objects["pt_2018"]
+
+
+@pytest.mark.parametrize("has_mcstat", [True, False])
+@pytest.mark.parametrize("flow", [True, False])
+def test_get_err2_matches_per_systematic(plot_utils, flow, has_mcstat):
+    shape = make_shape(plot_utils, flow, has_mcstat)
+    syst_manager = shape.syst_manager
+    expected = ["twosided", "onesided", "empty", "partial"] + (["mcstat"] if has_mcstat else [])
+    assert sorted(syst_manager.systematics) == sorted(expected)
+    for cat in CATEGORIES:
+        stacks = shape._get_stacks(cat)
+        assert len(stacks["mc"]) == len(SAMPLES)
+        err2 = syst_manager.get_err2(stacks)
+        assert sorted(err2) == sorted(expected)
+        for name in syst_manager.systematics:
+            legacy = plot_utils.SystUnc(shape, stacks, name, verbose=0)
+            err2_up, err2_down = err2[name]
+            assert np.array_equal(err2_up, legacy.err2_up), (cat, name)
+            assert np.array_equal(err2_down, legacy.err2_down), (cat, name)
+            # The SystUnc objects used for the plots hold the same errors
+            syst = syst_manager.get_syst(name, cat)
+            assert np.array_equal(syst.err2_up, legacy.err2_up)
+            assert np.array_equal(syst.err2_down, legacy.err2_down)
+        # The one-sided uncertainty has no downward error
+        assert np.all(err2["onesided"][1] == 0) and np.any(err2["onesided"][0] > 0)
+        # The missing variation is replaced by the nominal: no error from the WJets sample
+        assert np.any(err2["partial"][0] > 0)
+
+
+def test_check_empty_variations(plot_utils, capsys):
+    shape = make_shape(plot_utils, flow=False, has_mcstat=True)
+    syst_manager = shape.syst_manager
+    syst_manager.verbose = 1
+    stacks = shape._get_stacks("baseline")
+    capsys.readouterr()
+    syst_manager.check_empty_variations(stacks)
+    warnings = [line for line in capsys.readouterr().out.splitlines() if "WARNING" in line]
+    assert len(warnings) == 1
+    assert "Empty variation emptyDown" in warnings[0]
+
+    # The per-systematic check of SystUnc finds the same empty variation
+    plot_utils.SystUnc(shape, stacks, "empty", verbose=1)
+    assert "Empty variation" in capsys.readouterr().out
+
+    # Nothing to report without MC samples
+    syst_manager.check_empty_variations({"mc": []})
+    assert capsys.readouterr().out == ""
@@ -0,0 +1,111 @@
+"""Offline tests of the per-stage processing profile and of the profile-report command."""
+import time
+
+import numpy as np
+import awkward as ak
+from click.testing import CliRunner
+from coffea.processor import accumulate
+from coffea.util import save
+
+from pocket_coffea.lib.calibrators.calibrator import Calibrator
+from pocket_coffea.lib.calibrators.calibrators_manager import CalibratorsManager
+from pocket_coffea.lib.weights import WeightLambda
+from pocket_coffea.lib.weights.weights_manager import WeightsManager
+from pocket_coffea.scripts.profile_report import profile_report
+from pocket_coffea.utils.profiling import (
+    ProcessingProfiler,
+    profile_stage,
+    hotspot_table,
+    merge_profiles,
+)
+
+
+class ProfiledScaleCalibrator(Calibrator):
+    name = "test_profiled_scale"
+    has_variations = True
+    isMC_only = False
+    depends_on_collections = []
+    calibrated_collections = ["Jet.pt"]
+
+    def initialize(self, events):
+        self._variations = ["scaleUp"]
+
+    def calibrate(self, events, orig_colls, variation, already_applied_calibrators=None):
+        return {"Jet.pt": events.Jet.pt * (1.1 if variation == "scaleUp" else 1.0)}
+
+
+profiled_weight = WeightLambda.wrap_func(
+    name="test_profiled_weight",
+    function=lambda params, metadata, events, size, shape_variation: np.ones(size),
+)
+
+
+def chunk_profile(sleep):
+    profiler = ProcessingProfiler()
+    for _ in range(2):
+        with profile_stage(profiler, "weights"):
+            with profile_stage(profiler, "weights/pileup"):
+                time.sleep(sleep)
+    with profile_stage(profiler, "histograms"):
+        time.sleep(2 * sleep)
+    return profiler.to_output(nevents=1000)
+
+
+def test_profiler_stages_and_merge():
+    out = accumulate([{"processing_profile": {"TTbar": chunk_profile(0.01)}},
+                      {"processing_profile": {"TTbar": chunk_profile(0.01)}}])
+    profile = out["processing_profile"]["TTbar"]
+    assert profile["chunks"] == 2
+    assert profile["nevents"] == 2000
+    assert profile["stages"]["weights"]["calls"] == 4
+    assert profile["stages"]["weights/pileup"]["walltime"] >= 0.04
+    assert profile["stages"]["weights"]["walltime"] >= profile["stages"]["weights/pileup"]["walltime"]
+
+    rows = hotspot_table(profile)
+    assert rows[0]["stage"] == "total"
+    assert rows[0]["fraction"] == 1.0
+    assert {r["stage"] for r in rows[1:]} == {"weights", "weights/pileup", "histograms"}
+    assert len(hotspot_table(profile, top=2)) == 2
+
+    merged = merge_profiles([profile, profile])
+    assert merged["nevents"] == 4000
+    assert merged["stages"]["weights"]["calls"] == 8
+
+
+def test_noop_without_profiler():
+    with profile_stage(None, "anything"):
+        pass
+
+
+def test_managers_record_stages_by_name():
+    profiler = ProcessingProfiler()
+    events = ak.Array({"Jet": ak.zip({"pt": ak.Array([[10.0, 20.0], [], [5.0]])})})
+    manager = CalibratorsManager([ProfiledScaleCalibrator], events, params=None,
+                                 metadata={"isMC": True, "year": "2018"}, profiler=profiler)
+    for variation, _ in manager.calibration_loop(events, variations=["scaleUp"]):
+        pass
+    assert profiler.stages["calibrators"]["calls"] == 4
+    # initialize + 2 variations
+    assert profiler.stages["calibrators/test_profiled_scale"]["calls"] == 3
+
+    conf = {"inclusive": ["test_profiled_weight"], "bycategory": {}, "is_split_bycat": False, "by_subsample": {}}
+    wm = WeightsManager(None, conf, [profiled_weight], profiler=profiler,
+                        metadata={"sample": "s", "dataset": "d", "year": "2018", "isMC": True})
+    wm.compute(events, size=3)
+    assert profiler.stages["weights/test_profiled_weight"]["calls"] == 1
+
+
+def test_profile_report_command(tmp_path):
+    path = str(tmp_path / "output.coffea")
+    save({"processing_profile": {"TTbar": chunk_profile(0.001), "DATA": chunk_profile(0.001)}}, path)
+    runner = CliRunner()
+    result = runner.invoke(profile_report, [path, "--top", "3"])
+    assert result.exit_code == 0, result.output
+    assert "TTbar" in result.output and "DATA" in result.output
+    result = runner.invoke(profile_report, [path, "--merge-samples", "-s", "TTbar"])
+    assert result.exit_code == 0, result.output
+    assert "all samples" in result.output and "weights/pileup" in result.output
+
+    save({"variables": {}}, path)
+    result = runner.invoke(profile_report, [path])
+    assert "No processing profile" in result.output
@@ -0,0 +1,154 @@
+"""Offline tests of the chunk-level checkpointing of the runner.
+
+A fake coffea Runner yields the WorkItems of a small fileset: an interrupted run must
+leave a checkpoint from which a restarted run processes only the missing chunks,
+giving the same output as an uninterrupted run.
+"""
+import os
+from types import SimpleNamespace
+
+import pytest
+from coffea.processor import ProcessorABC
+from coffea.processor.executor import WorkItem
+from coffea.processor.accumulator import accumulate
+
+from pocket_coffea.utils.run import (
+    CheckpointedRunner,
+    clear_checkpoint,
+)
+
+
+FILESET = {
+    "DATA": {"files": {"a.root": "Events", "b.root": "Events"}},
+    "MC": {"files": {"c.root": "Events"}},
+}
+NENTRIES = {"a.root": 25, "b.root": 10, "c.root": 31}
+
+
+def checkpoint_files(path):
+    return sorted(f for f in os.listdir(path) if f.startswith("checkpoint-"))
+
+
+class FakeRunner:
+    def __init__(self, chunksize=10, fail_after=None, bad_files=(), workers=None):
+        self.chunksize = chunksize
+        self.maxchunks = None
+        self.fail_after = fail_after
+        self.bad_files = set(bad_files)
+        self.executor = SimpleNamespace(workers=workers)
+        self.processed = []
+        self.batches = []
+
+    def preprocess(self, fileset, treename):
+        for dataset, content in fileset.items():
+            for filename in content["files"]:
+                n = NENTRIES[filename]
+                for start in range(0, n, self.chunksize):
+                    yield WorkItem(dataset, filename, treename, start,
+                                   min(start + self.chunksize, n), "uuid", {})
+
+    def run(self, items, processor_instance):
+        outputs = []
+        self.batches.append(len(items))
+        for item in items:
+            if self.fail_after is not None and len(self.processed) >= self.fail_after:
+                raise RuntimeError("worker lost")
+            self.processed.append(item)
+            # Chunks of unreadable files are skipped, as with skipbadfiles
+            if item.filename in self.bad_files:
+                continue
+            events = SimpleNamespace(metadata={
+                "dataset": item.dataset, "filename": item.filename, "treename": item.treename,
+                "entrystart": item.entrystart, "entrystop": item.entrystop})
+            outputs.append(processor_instance.process(events))
+        if not outputs:
+            raise ValueError("No chunks returned results, verify ``processor`` instance structure.")
+        out = accumulate(outputs)
+        processor_instance.postprocess(out)
+        return {"out": out}
+
+
+class CountingProcessor(ProcessorABC):
+    def __init__(self):
+        self.n_postprocess = 0
+
+    def process(self, events):
+        m = events.metadata
+        return {m["dataset"]: {"nevents": m["entrystop"] - m["entrystart"],
+                               "chunks": [(m["filename"], m["entrystart"])]}}
+
+    def postprocess(self, accumulator):
+        self.n_postprocess += 1
+        accumulator["postprocessed"] = True
+
+
+def expected_output():
+    return {"DATA": {"nevents": 35}, "MC": {"nevents": 31}}
+
+
+def test_checkpointed_runner_full(tmp_path):
+    runner = CheckpointedRunner(FakeRunner(), str(tmp_path), checkpoint_every=2)
+    processor = CountingProcessor()
+    out = runner(FILESET, "Events", processor)
+    assert {d: {"nevents": out[d]["nevents"]} for d in ["DATA", "MC"]} == expected_output()
+    # postprocess is called once on the full output
+    assert processor.n_postprocess == 1
+    assert out["postprocessed"]
+    # One checkpoint file per batch of 2 chunks
+    assert len(checkpoint_files(tmp_path)) == 4
+    clear_checkpoint(str(tmp_path))
+    assert checkpoint_files(tmp_path) == []
+
+
+def test_checkpointed_runner_resume(tmp_path):
+    # The first run crashes after 5 of the 8 chunks: 4 are saved in the checkpoint
+    failing = FakeRunner(fail_after=5)
+    with pytest.raises(RuntimeError):
+        CheckpointedRunner(failing, str(tmp_path), checkpoint_every=2)(
+            FILESET, "Events", CountingProcessor())
+
+    resumed = FakeRunner()
+    processor = CountingProcessor()
+    out = CheckpointedRunner(resumed, str(tmp_path), checkpoint_every=2)(FILESET, "Events", processor)
+    assert len(resumed.processed) == 8 - 4
+    assert {d: {"nevents": out[d]["nevents"]} for d in ["DATA", "MC"]} == expected_output()
+    all_chunks = sorted(out["DATA"]["chunks"] + out["MC"]["chunks"])
+    assert len(all_chunks) == len(set(all_chunks)) == 8
+    assert processor.n_postprocess == 1
+
+    # Nothing left to do: the output is the one stored in the checkpoint
+    rerun = FakeRunner()
+    out2 = CheckpointedRunner(rerun, str(tmp_path))(FILESET, "Events", CountingProcessor())
+    assert rerun.processed == []
+    assert out2["DATA"]["nevents"] == 35
+
+
+def test_checkpointed_runner_chunksize_mismatch(tmp_path):
+    CheckpointedRunner(FakeRunner(chunksize=10), str(tmp_path))(FILESET, "Events", CountingProcessor())
+    with pytest.raises(ValueError, match="chunksize"):
+        CheckpointedRunner(FakeRunner(chunksize=5), str(tmp_path))(FILESET, "Events", CountingProcessor())
+
+
+def test_checkpointed_runner_skipped_chunks(tmp_path):
+    # The chunks of b.root are skipped: they are not recorded as completed
+    bad = FakeRunner(bad_files={"b.root"})
+    out = CheckpointedRunner(bad, str(tmp_path), checkpoint_every=2)(FILESET, "Events", CountingProcessor())
+    assert out["DATA"]["nevents"] == 25
+    assert "__checkpoint_completed_chunks__" not in out
+
+    # The next run processes only the skipped chunks
+    resumed = FakeRunner()
+    out = CheckpointedRunner(resumed, str(tmp_path), checkpoint_every=2)(FILESET, "Events", CountingProcessor())
+    assert [i.filename for i in resumed.processed] == ["b.root"]
+    assert {d: {"nevents": out[d]["nevents"]} for d in ["DATA", "MC"]} == expected_output()
+
+
+def test_checkpointed_runner_batch_size(tmp_path):
+    # The batches are a multiple of the number of workers of the executor
+    assert CheckpointedRunner(FakeRunner(workers=3), str(tmp_path), checkpoint_every=4).batch_size == 6
+    assert CheckpointedRunner(FakeRunner(workers=4), str(tmp_path)).batch_size == 40
+    assert CheckpointedRunner(FakeRunner(), str(tmp_path), checkpoint_every=5).batch_size == 5
+
+    runner = FakeRunner(workers=3)
+    CheckpointedRunner(runner, str(tmp_path), checkpoint_every=4)(FILESET, "Events", CountingProcessor())
+    assert runner.batches == [6, 2]
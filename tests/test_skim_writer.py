@@ -0,0 +1,140 @@
+"""Offline tests of the coalescing skim writer and of the uproot-only merging of the skimmed files."""
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import awkward as ak
+import uproot
+from click.testing import CliRunner
+from coffea.util import save
+
+from pocket_coffea.utils.skim import group_skimmed_files, merge_root_files_uproot
+from pocket_coffea.utils.skim_writer import CoalescingSkimWriter
+from pocket_coffea.scripts.hadd_skimmed_files import hadd_skimmed_files
+
+COMPRESSION = uproot.ZLIB(1)
+
+
+def make_tree(n, seed, hlt=("HLT_IsoMu24",)):
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(0, 4, n)
+    tree = {
+        "Jet": ak.zip({
+            "pt": ak.unflatten(rng.exponential(50, counts.sum()), counts),
+            "eta": ak.unflatten(rng.normal(size=counts.sum()), counts),
+        }),
+        "MET": ak.zip({"pt": rng.exponential(40, n)}),
+        "event": np.arange(seed * 1000, seed * 1000 + n),
+    }
+    for path in hlt:
+        tree[path] = rng.random(n) > 0.5
+    return tree
+
+
+def read(files):
+    return ak.concatenate([uproot.open(f)["Events"].arrays() for f in files])
+
+
+def test_coalescing_writer(tmp_path):
+    outdir, localdir = tmp_path / "skim", tmp_path / "local"
+    localdir.mkdir()
+    writer = CoalescingSkimWriter(str(outdir), target_size_mb=0.06, compression=COMPRESSION, localdir=str(localdir))
+    records = []
+    for seed in range(6):
+        records.append((writer.write("TTbar_2018", make_tree(300, seed)), 300))
+    records.append((writer.write("DATA_2018", make_tree(50, 10)), 50))
+    # A different list of HLT paths starts a new file
+    records.append((writer.write("DATA_2018", make_tree(50, 11, hlt=("HLT_IsoMu27",))), 50))
+    writer.flush()
+    assert os.listdir(localdir) == []
+
+    grouped = group_skimmed_files([f for f, _ in records], [n for _, n in records])
+    ttbar = [f for f, _ in grouped if "TTbar" in f]
+    assert 1 < len(ttbar) < 6
+    assert sum(n for _, n in grouped) == 1900
+    for file, nevents in grouped:
+        assert os.path.exists(file)
+        assert uproot.open(file)["Events"].num_entries == nevents
+    events = read(ttbar)
+    assert np.array_equal(events.event, np.concatenate([np.arange(s * 1000, s * 1000 + 300) for s in range(6)]))
+    # Same branches as the per-chunk files
+    assert set(events.fields) == {"nJet", "Jet_pt", "Jet_eta", "MET_pt", "event", "HLT_IsoMu24"}
+    data = [f for f, _ in grouped if "DATA" in f]
+    assert len(data) == 2
+
+
+def test_coalescing_writer_threads(tmp_path):
+    outdir, localdir = tmp_path / "skim", tmp_path / "local"
+    localdir.mkdir()
+    writer = CoalescingSkimWriter(str(outdir), target_size_mb=0.05, compression=COMPRESSION, localdir=str(localdir))
+
+    def write_chunk(seed):
+        return writer.write("TTbar_2018", make_tree(100, seed)), 100
+
+    # Chunks of the same dataset written at the same time by several threads of a worker
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        records = list(pool.map(write_chunk, range(24)))
+    writer.flush()
+    assert os.listdir(localdir) == []
+    grouped = group_skimmed_files([f for f, _ in records], [n for _, n in records])
+    for file, nevents in grouped:
+        assert uproot.open(file)["Events"].num_entries == nevents
+    events = read([f for f, _ in grouped])
+    assert np.array_equal(np.sort(events.event), np.concatenate([np.arange(s * 1000, s * 1000 + 100) for s in range(24)]))
+
+
+def test_group_skimmed_files():
+    assert group_skimmed_files(["b", "a", "b", "c"], [1, 2, 3, 4]) == [("b", 4), ("a", 2), ("c", 4)]
+
+
+def write_file(path, tree):
+    with uproot.recreate(path, compression=COMPRESSION) as fout:
+        fout["Events"] = tree
+
+
+def test_merge_uproot(tmp_path):
+    inputs = []
+    for seed in range(3):
+        inputs.append(str(tmp_path / f"in{seed}.root"))
+        write_file(inputs[-1], make_tree(200, seed))
+    out = str(tmp_path / "merged.root")
+    assert merge_root_files_uproot(inputs, out, step_size=150) == 600
+    merged = uproot.open(out)["Events"]
+    assert merged.keys() == uproot.open(inputs[0])["Events"].keys()
+    assert merged["Jet_pt"].count_branch.name == "nJet"
+    assert ak.to_list(merged.arrays()) == ak.to_list(read(inputs))
+    assert uproot.open(out).file.compression == COMPRESSION
+
+
+def test_hadd_skimmed_files_uproot(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    files = []
+    for seed in range(5):
+        files.append(str(tmp_path / "skim" / f"chunk{seed}.root"))
+        os.makedirs(os.path.dirname(files[-1]), exist_ok=True)
+        write_file(files[-1], make_tree(100, seed))
+    output = {
+        # The last file is listed for two chunks, as written by the coalescing writer
+        "skimmed_files": {"TTbar_2018": files + [files[-1]]},
+        "nskimmed_events": {"TTbar_2018": [100] * 4 + [60, 40]},
+        "datasets_metadata": {"by_dataset": {"TTbar_2018": {"sample": "TTbar", "size": "1000", "isMC": "True"}}},
+        "cutflow": {"skim": {"TTbar_2018": 500}, "initial": {"TTbar_2018": 1000}},
+        "sum_genweights": {"TTbar_2018": 1000.0},
+        "sum_genweights_skimmed": {"TTbar_2018": 500.0},
+    }
+    save(output, str(tmp_path / "output_all.coffea"))
+    outdir = str(tmp_path / "hadd")
+    args = ["-fl", "output_all.coffea", "-o", outdir, "-f", "2", "-s", "2", "--uproot"]
+    result = CliRunner().invoke(hadd_skimmed_files, args)
+    assert result.exit_code == 0, result.output
+    groups = json.load(open("hadd.json"))["TTbar_2018"]
+    assert sorted(groups["nevents_per_outfile"].values()) == [100, 200, 200]
+    for outfile, nevents in groups["nevents_per_outfile"].items():
+        assert uproot.open(outfile)["Events"].num_entries == nevents
+    definition = json.load(open("skimmed_dataset_definition_hadd.json"))
+    assert definition["TTbar_2018"]["metadata"]["nevents"] == "500"
+
+    result = CliRunner().invoke(hadd_skimmed_files, args + ["--check"])
+    assert result.exit_code == 0, result.output
+    assert "All output files are present" in result.output
@@ -0,0 +1,156 @@
+"""Offline tests of the sparse storage of the histograms over the category and variation axes."""
+import os
+
+import numpy as np
+import hist
+import pytest
+from coffea.processor import accumulate
+from coffea.util import save, load
+
+from pocket_coffea.lib.sparse_hist import SparseHist, densify, sparsify, to_hist
+from pocket_coffea.utils.filter_output import filter_output_by_category
+
+CATEGORIES = [f"cat{i}" for i in range(6)]
+VARIATIONS = ["nominal"] + [f"syst{i}{d}" for i in range(10) for d in ["Up", "Down"]]
+
+
+def make_hist(seed, storage="weight", filled=(("cat0", "nominal"), ("cat2", "syst3Up"), ("cat5", "nominal"))):
+    rng = np.random.default_rng(seed)
+    h = hist.Hist(
+        hist.axis.StrCategory(CATEGORIES, name="cat", label="Category"),
+        hist.axis.StrCategory(VARIATIONS, name="variation", label="Variation"),
+        hist.axis.Regular(20, 0, 200, name="pt"),
+        hist.axis.Variable([0, 1.5, 2.5], name="eta"),
+        storage=storage,
+        name="Counts",
+    )
+    for cat, variation in filled:
+        n = 500
+        kwargs = {"weight": rng.normal(1, 0.2, n)} if storage == "weight" else {}
+        h.fill(cat=cat, variation=variation, pt=rng.exponential(60, n), eta=rng.uniform(-0.5, 3, n), **kwargs)
+    return h
+
+
+def assert_same_hist(h1, h2):
+    assert h1.axes == h2.axes
+    assert h1.storage_type is h2.storage_type
+    assert np.array_equal(h1.values(flow=True), h2.values(flow=True))
+    if h1.variances() is not None:
+        assert np.array_equal(h1.variances(flow=True), h2.variances(flow=True))
+
+
+@pytest.mark.parametrize("storage", ["weight", "double", "int64"])
+def test_roundtrip(storage):
+    h = make_hist(1, storage)
+    sh = SparseHist.from_hist(h)
+    assert sh.nsparse == 2
+    assert sh.nblocks == 3
+    assert_same_hist(sh.to_hist(), h)
+    assert sh.to_hist().name == "Counts"
+    # Empty histogram
+    empty = SparseHist.from_hist(make_hist(1, storage, filled=()))
+    assert empty.nblocks == 0
+    assert_same_hist(empty.to_hist(), make_hist(1, storage, filled=()))
+
+
+def test_data_histogram_without_variation_axis():
+    h = make_hist(1)[{"variation": "nominal"}]
+    sh = SparseHist.from_hist(h)
+    assert sh.nsparse == 1
+    assert sorted(sh.blocks) == [(0,), (5,)]
+    assert_same_hist(sh.to_hist(), h)
+
+
+def test_accumulate_as_dense():
+    filled = [
+        (("cat0", "nominal"), ("cat2", "syst3Up")),
+        (("cat0", "nominal"), ("cat1", "syst0Down")),
+        (("cat5", "syst9Up"),),
+        (),
+    ]
+    dense = [make_hist(i, filled=f) for i, f in enumerate(filled)]
+    outputs = [{"variables": {"pt": {"TTbar": {"TTbar_2018": SparseHist.from_hist(h)}}}} for h in dense]
+    inputs_blocks = [o["variables"]["pt"]["TTbar"]["TTbar_2018"].blocks[(0, 0)].copy() for o in outputs[:2]]
+    out = accumulate(outputs)
+    merged = out["variables"]["pt"]["TTbar"]["TTbar_2018"]
+    assert isinstance(merged, SparseHist)
+    assert merged.nblocks == 4
+    assert_same_hist(merged.to_hist(), accumulate(dense))
+    # The inputs are not modified
+    for o, block in zip(outputs[:2], inputs_blocks):
+        assert np.array_equal(o["variables"]["pt"]["TTbar"]["TTbar_2018"].blocks[(0, 0)], block)
+
+
+def test_mixed_with_dense():
+    h1, h2 = make_hist(1), make_hist(2, filled=(("cat1", "nominal"),))
+    assert_same_hist((SparseHist.from_hist(h1) + h2).to_hist(), h1 + h2)
+    sh = SparseHist.from_hist(h2)
+    sh += h1
+    assert_same_hist(sh.to_hist(), h1 + h2)
+
+
+def test_incompatible_axes():
+    h = make_hist(1)
+    other = hist.Hist(
+        hist.axis.StrCategory(CATEGORIES, name="cat"),
+        hist.axis.StrCategory(VARIATIONS, name="variation"),
+        hist.axis.Regular(10, 0, 200, name="pt"),
+        storage="weight",
+    )
+    with pytest.raises(ValueError):
+        SparseHist.from_hist(h) + SparseHist.from_hist(other)
+    with pytest.raises(ValueError):
+        SparseHist.from_hist(h[{"cat": 0, "variation": 0}])
+    with pytest.raises(ValueError):
+        SparseHist.from_hist(hist.Hist(hist.axis.StrCategory(["a"], name="cat"), storage="mean"))
+
+
+def test_scaling():
+    h = make_hist(3)
+    sh = SparseHist.from_hist(h)
+    scaled = sh * 0.25
+    sh *= 0.25
+    h *= 0.25
+    assert_same_hist(sh.to_hist(), h)
+    assert_same_hist(scaled.to_hist(), h)
+
+
+def test_values_are_finite():
+    h = make_hist(3)
+    assert SparseHist.from_hist(h).values_are_finite()
+    # Infinite values only in the flow bins are not checked, as for the dense histograms
+    h.fill(cat="cat1", variation="nominal", pt=[1000.0], eta=[1.0], weight=[np.inf])
+    assert SparseHist.from_hist(h).values_are_finite()
+    assert np.all(np.isfinite(h.values()))
+    h.fill(cat="cat1", variation="nominal", pt=[10.0], eta=[1.0], weight=[np.nan])
+    assert not SparseHist.from_hist(h).values_are_finite()
+
+
+def test_save_load_and_size(tmp_path):
+    h = make_hist(4)
+    dense_file, sparse_file = str(tmp_path / "dense.coffea"), str(tmp_path / "sparse.coffea")
+    save({"variables": {"pt": {"TTbar": {"TTbar_2018": h}}}}, dense_file)
+    save(sparsify({"variables": {"pt": {"TTbar": {"TTbar_2018": h}}}}), sparse_file)
+    assert os.path.getsize(sparse_file) < os.path.getsize(dense_file)
+    loaded = load(sparse_file)
+    assert isinstance(loaded["variables"]["pt"]["TTbar"]["TTbar_2018"], SparseHist)
+    assert_same_hist(densify(loaded)["variables"]["pt"]["TTbar"]["TTbar_2018"], h)
+
+
+def test_sparsify_densify_and_split_by_category():
+    output = {
+        **{key: {cat: {} for cat in CATEGORIES} for key in ["sumw", "sumw2", "cutflow"]},
+        "variables": {"pt": {"TTbar": {"TTbar_2018": make_hist(5)}}},
+        "processing_metadata": {},
+    }
+    reference = output["variables"]["pt"]["TTbar"]["TTbar_2018"].copy()
+    mean = hist.Hist(hist.axis.StrCategory(["a"], name="cat"), storage="mean")
+    sparsify(output)
+    assert isinstance(output["variables"]["pt"]["TTbar"]["TTbar_2018"], SparseHist)
+    # Storages which cannot be merged by a sum are left dense
+    assert sparsify({"mean": mean})["mean"] is mean
+    assert to_hist(reference) is reference
+    filtered = filter_output_by_category(densify(output), ["cat0", "cat2"])
+    h = filtered["variables"]["pt"]["TTbar"]["TTbar_2018"]
+    assert list(h.axes["cat"]) == ["cat0", "cat2"]
+    assert_same_hist(h, reference[{"cat": ["cat0", "cat2"]}])
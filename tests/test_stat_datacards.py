@@ -106,3 +106,81 @@ def test_rate_matches_clipped_template_integral():
 def test_rate_unchanged_without_negative_bins():
     dc = _single_process_datacard([10.0, 3.0, 5.0, 2.0])
     assert dc.rate("sig_2018") == pytest.approx(20.0)
+
+
+def _multi_process_datacard():
+    """Two processes over two years and two categories, with one shape systematic
+    missing in the `bkg_sample` histograms."""
+    years, categories = ["2017", "2018"], ["cat", "other"]
+    rng = np.random.default_rng(42)
+    histograms, by_period, cutflow = {}, {}, {"presel": {}}
+    variations = {
+        "sig_sample": ["nominal", "JESUp", "JESDown", "PUUp", "PUDown"],
+        "bkg_sample": ["nominal", "PUDown", "PUUp"],
+    }
+    for sample, sample_variations in variations.items():
+        histograms[sample] = {}
+        for year in years:
+            datasets = [f"{sample}_{year}_{i}" for i in range(2)]
+            by_period.setdefault(year, {})[sample] = datasets
+            for dataset in datasets:
+                histogram = hist.Hist(
+                    hist.axis.StrCategory(categories, name="cat"),
+                    hist.axis.StrCategory(sample_variations, name="variation"),
+                    hist.axis.Regular(5, 0, 5, name="x"),
+                    storage=hist.storage.Weight(),
+                )
+                view = histogram.view()
+                view["value"] = rng.uniform(0, 10, view.shape)
+                view["variance"] = rng.uniform(0, 1, view.shape)
+                histograms[sample][dataset] = histogram
+                cutflow["presel"][dataset] = {"nominal": 100}
+    # An empty dataset is skipped
+    cutflow["presel"]["bkg_sample_2018_1"]["nominal"] = 0
+    return Datacard(
+        histograms=histograms,
+        datasets_metadata={"by_datataking_period": by_period},
+        cutflow=cutflow,
+        years=years,
+        mc_processes=MCProcesses(
+            [
+                MCProcess(name="sig", samples=["sig_sample"], is_signal=True, years=years),
+                MCProcess(name="bkg", samples=["bkg_sample"], is_signal=False, years=years),
+            ]
+        ),
+        systematics=Systematics(
+            [
+                SystematicUncertainty(name=name, typ="shape", processes=["sig", "bkg"], years=years, value=1.0)
+                for name in ["JES", "PU"]
+            ]
+        ),
+        category="cat",
+        verbose=False,
+    )
+
+
+def test_rearrange_histograms_matches_per_bin_slicing():
+    dc = _multi_process_datacard()
+    rearranged = dc.rearrange_histograms_by_category(categories=["cat", "other"])
+    assert list(rearranged) == ["cat", "other"]
+    assert rearranged["cat"] == dc.histogram
+    for cat, histogram in rearranged.items():
+        for process, sample in [("sig", "sig_sample"), ("bkg", "bkg_sample")]:
+            for year in ["2017", "2018"]:
+                datasets = [d for d in dc.get_datasets_by_sample(sample, year) if not dc.is_empty_dataset(d)]
+                for variation in histogram.axes["variation"]:
+                    expected = np.zeros((2, 5))
+                    for dataset in datasets:
+                        source = dc.histograms[sample][dataset]
+                        # Missing variations are filled with the nominal variation
+                        if variation not in source.axes["variation"]:
+                            variation_in_source = "nominal"
+                        else:
+                            variation_in_source = variation
+                        view = source[cat, variation_in_source, :].view()
+                        expected += np.stack([view["value"], view["variance"]])
+                    view = histogram[f"{process}_{year}", variation, :].view()
+                    assert np.allclose(view["value"], expected[0])
+                    assert np.allclose(view["variance"], expected[1])
+    with pytest.raises(KeyError):
+        dc.rearrange_histograms_by_category(categories=["missing"])
@@ -0,0 +1,81 @@
+"""Offline tests of the reuse of the calibration-invariant weights across shape variations."""
+import numpy as np
+import awkward as ak
+
+from pocket_coffea.lib.weights import WeightLambda, WeightData
+from pocket_coffea.lib.weights.weights_manager import WeightsManager
+
+CALLS = []
+
+
+def _counting(name, factor):
+    def func(params, metadata, events, size, shape_variation):
+        CALLS.append((name, len(events), shape_variation))
+        return WeightData(name, events.x * factor, events.x * factor * 1.1, events.x * factor * 0.9)
+    return func
+
+
+inv_weight = WeightLambda.wrap_func(name="test_inv_weight", function=_counting("test_inv_weight", 2.0),
+                                    has_variations=True, depends_on_collections=[])
+muon_weight = WeightLambda.wrap_func(name="test_muon_weight", function=_counting("test_muon_weight", 3.0),
+                                     has_variations=True, depends_on_collections=["Muon"])
+jet_weight = WeightLambda.wrap_func(name="test_jet_weight", function=_counting("test_jet_weight", 0.5),
+                                    has_variations=True)
+
+
+def make_manager():
+    conf = {
+        "inclusive": ["test_inv_weight", "test_jet_weight"],
+        "bycategory": {"catA": ["test_muon_weight"], "catB": ["test_muon_weight"]},
+        "is_split_bycat": True,
+        "by_subsample": {},
+    }
+    return WeightsManager(None, conf, [inv_weight, muon_weight, jet_weight],
+                          metadata={"sample": "s", "dataset": "d", "year": "2018", "isMC": True})
+
+
+def test_invariant_weights_computed_once():
+    CALLS.clear()
+    events = ak.zip({"x": np.arange(1.0, 11.0)})
+    wm = make_manager()
+    results = {}
+    for variation, modified, mask in [
+        ("nominal", [], events.x > 3),
+        ("JES_TotalUp", ["Jet.pt", "Jet.mass", "MET.pt"], events.x > 5),
+        ("muon_scaleUp", ["Muon.pt"], events.x > 2),
+    ]:
+        wm.compute(events[mask], size=int(ak.sum(mask)), shape_variation=variation,
+                   events_before_presel=events, presel_mask=ak.to_numpy(mask),
+                   modified_collections=modified)
+        results[variation] = (ak.to_numpy(events.x[mask]),
+                              wm.get_weight("catA"),
+                              wm.get_weight("catA", modifier="test_inv_weightUp"),
+                              [wm.get_weight(cat, modifier="test_muon_weightUp") for cat in ["catA", "catB"]])
+
+    calls = {}
+    for name, nevents, shape_variation in CALLS:
+        calls.setdefault(name, []).append((nevents, shape_variation))
+    # Computed once on the events before preselection
+    assert calls["test_inv_weight"] == [(10, "nominal")]
+    # Recomputed only for the variation modifying the muons
+    assert calls["test_muon_weight"] == [(10, "nominal"), (8, "muon_scaleUp")]
+    # Unknown dependencies: computed for each variation
+    assert calls["test_jet_weight"] == [(7, "nominal"), (5, "JES_TotalUp"), (8, "muon_scaleUp")]
+
+    for variation, (x, nominal, up, up_muon) in results.items():
+        np.testing.assert_allclose(nominal, x * 2.0 * x * 0.5 * x * 3.0)
+        np.testing.assert_allclose(up, nominal * 1.1)
+        # The same weight output is added to two Weights objects
+        for w in up_muon:
+            np.testing.assert_allclose(w, nominal * 1.1)
+
+
+def test_weights_not_modified_in_place_without_reuse():
+    events = ak.zip({"x": np.arange(1.0, 6.0)})
+    wm = make_manager()
+    for _ in range(2):
+        wm.compute(events, size=5, shape_variation="nominal")
+        for cat in ["catA", "catB"]:
+            np.testing.assert_allclose(wm.get_weight(cat, modifier="test_muon_weightDown"),
+                                       wm.get_weight(cat) * 0.9)
+    assert wm._invariant_weights == {}
@@ -40,6 +40,24 @@ def events_run3():
 
     return events_run3
 
+@pytest.fixture(scope="session")
+def plot_utils():
+    '''The plot_utils module, imported also without the CAT metadata on cvmfs: the default parameters
+    loaded at import register a `cvmfs` resolver building the paths without listing the cvmfs folders.'''
+    from omegaconf import OmegaConf
+    from pocket_coffea.parameters import defaults
+
+    def setup_cvmfs_resolver(group_tags=None):
+        def cvmfs_path_resolver(period, group, file, tag=None):
+            return f"/cvmfs/cms-griddata.cern.ch/cat/metadata/{group}/{period}/{tag or 'latest'}/{file}"
+        OmegaConf.register_new_resolver("cvmfs", cvmfs_path_resolver, replace=True)
+
+    # Only the import is patched: the following get_default_parameters calls register the real resolver
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(defaults, "setup_cvmfs_resolver", setup_cvmfs_resolver)
+        from pocket_coffea.utils import plot_utils
+    return plot_utils
+
 def compare_outputs(output, old_output, exclude_variables=None):
     for cat, data in old_output["sumw"].items():
         assert cat in output["sumw"]